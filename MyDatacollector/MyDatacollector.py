@@ -40,6 +40,7 @@ __license__ = 'RPL-1.5'
 
 __HELP__ = """ Download measurements from a server (for now TTN MQTT server):
     Data acquisition input is multithreaded.
+    Output channels publish records via own worker thread(s) (see Conf['fanout']).
     Subscribe to measurements from a Mosquitto Broker server(s) (eg TTN LoRa server)
     and
     Publish measurements as client to Sensors.Community and MySQL database
@@ -100,11 +101,19 @@ __HELP__ = """ Download measurements from a server (for now TTN MQTT server):
 
     database:output=true (default)
     database:debug=false (default)
+    rollup:output=false (default) hourly/daily rollups of measurements (MyROLLUP)
+    rollup:age=300 (default) secs rollup aggregates are kept in memory
+    rollup:window=21600 (default) secs rolled up records are remembered to skip duplicates
+    latest:output=false (default) latest measurement per kit table (MyLATEST)
+    latest:interval=60 (default) min secs between updates of a kit row
 
     notices:output=true (default)
 
     logger:print=true (default) print in colored format.
     file=RestoredDataFile only restore data from this dump file.
+    file=dump1.gz,dump2.gz speed=unlimited replay (gzip) dump files at high speed,
+        speed=realtime or speed=10x (replay 10 times faster as real time).
+    workers=4 supervisor mode: collector sharded over 4 worker processes on device ID.
     debug=true (default false) switch debugging on.
     calibrate=SDS011,BME280 Calibrate values to this sensor type if defined in DB.
     Or database acces credential settings: host=xyz, user=name, password=acacadabra
@@ -115,12 +124,12 @@ __HELP__ = """ Download measurements from a server (for now TTN MQTT server):
 
 __modulename__='$RCSfile: MyDatacollector.py,v $'[10:-4]
 __version__ = "1." + "$Revision: 4.70 $"[11:-2]
-import inspect
+import sys
 def WHERE(fie=False):
     global __modulename__, __version__
     if fie:
       try:
-        return "%s V%s/%s" % (__modulename__ ,__version__,inspect.stack()[1][3])
+        return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
       except: pass
     return "%s V%s" % (__modulename__ ,__version__)
 
@@ -137,14 +146,29 @@ try:
     import json                 # module to deal with json formated structures
     from jsmin import jsmin     # tool to delete comments and compress json
     import socket
+    import tempfile             # default directory of worker spill files
     socket.setdefaulttimeout(120)
     import re                   # handle regular expressions
     import copy                 # copy values iso ref to objects
+    import threading            # output channel workers
+    if sys.version[0] == '2':
+        import Queue
+    else:
+        import queue as Queue
 
     from lib import MyDB                 # measurements kit database module
     from lib import MyLogger             # logging module
     from lib import MyMQTTclient         # module to receive MQTT data records
     from lib import MyGPS                # module to handle GPS ordinates/distances
+    from lib import MyRecord             # read only data record views for output channels
+    from lib import MyNotice             # background dispatcher of email/Slack notices
+    from lib import MyValidate           # compiled validation rules of sensed values
+    from lib import MySpool              # durable spool of records for output channels which are down
+    from lib import MyMetrics            # pipeline stage latency and throughput metrics
+    from lib import MySupervisor         # collector worker processes sharded on device ID
+    from lib import MySensorTypes        # in memory catalog of SensorTypes table
+    try: from lib import MyWebhook       # asyncio HTTP ingest of TTN webhook uplinks
+    except ImportError: MyWebhook = None # Python 2: no asyncio
 except ImportError as e:
     sys.exit("One of the import modules not found: %s\n" % str(e))
 
@@ -161,8 +185,7 @@ PingTimeout = 0          # last time ping request was sent
 Channels = []            # output channels
 DB = MyDB                # shortcut to Output channel database dict
 Resources = None         # link to input resource handler
-SensorsCache = {}        # is a cache (SensorTypes DB table) indexed by sensor product names with list of
-                         # product (upper), producer, category and fields(name,unit,calibration) details
+Supervised = None        # worker nr in supervisor mode
 
 def PrintException():
     lineno = sys.exc_info()[-1].tb_lineno
@@ -196,6 +219,8 @@ MQTTdefaults = {
             'user': 'account_name',
             'password': 'ttn-account.acacadabra',
             # TODO: 'cert' : None,       # X.509 encryption
+            # TTN V3 webhook input iso MQTT subscription, port is the HTTP listen port:
+            # 'webhook': { 'address': '0.0.0.0', 'path': '/ttn/uplink', 'secret': 'acacadabra' },
         }
 
 Conf = {
@@ -210,11 +235,60 @@ Conf = {
                          # *2 is wait time to try to reconnect with MQTT server
     'check': [('luchtdruk',100),('temp',20),('rv',20),('pm10',30),('pm25',30)], # sensor fields for fluctuation faults
                          # if measurement values do not fluctuate send notice sensor is broken
+    # input record queue between MQTT client threads and collector
+    # overflow policy on full queue: drop-newest, drop-oldest or block (max timeout secs, None: forever)
+    'queue': { 'size': 100, 'overflow': 'drop-newest', 'timeout': None },
+    # kit meta info cache: max nr of kits (least recently used is evicted), ttl secs to refresh
+    # from DB, ttl shortened randomly by max jitter fraction, warmup: load active kits on start
+    # size None: sized on warm up to the nr of active kits (min 500), a fixed size should be
+    # at least the nr of active kits: a smaller cache misses on almost every record
+    # not registered devices: max unknown devices rejected for unknown_ttl secs, cleared on
+    # registration tables change (polled every regpoll secs), rejections reported every report secs
+    'cache': { 'size': None, 'ttl': 24*60*60, 'jitter': 0.1, 'warmup': True,
+               'unknown': 1000, 'unknown_ttl': 60*60, 'regpoll': 5*60, 'report': 60*60 },
+    # duplicate uplink suppression (e.g. TTN V2 and V3 brokers, overlapping subscriptions)
+    # before decoding: max size uplinks seen in last window secs, size 0: disabled
+    'dedup': { 'size': 10000, 'window': 120 },
+    # output channel fan out: publish records via worker thread(s) per output channel
+    # workers: nr of threads per channel (0: publish in collector loop),
+    # inbox: max records waiting per worker, wait: max secs to wait on full inbox (no wait if spooled),
+    # ordering: 'kit' records of a kit are published in order, 'none': no ordering,
+    # drain: max secs to finish publishing queued records on exit
+    # per channel the defaults can be overwritten via Channels[indx]['fanout']
+    'fanout': { 'workers': 1, 'inbox': 50, 'wait': 30, 'ordering': 'kit', 'drain': 60 },
+    # startup scan for kits not seen for a while: 'background' (thread), True (wait on scan) or False
+    'deadkits': 'background',
+    # durable spool (SQLite WAL file per channel) of records for an output channel which is down
+    # channels: names of spooled output channels (not Community: it spills POSTs itself),
+    # directory: persistent spool files directory (None: no spooling),
+    # size: max records (oldest dropped), age: max secs, rate: replay records per sec,
+    # retry: secs to wait after a connection failure, attempts: max failed replays of a record.
+    # per channel the defaults can be overwritten via Channels[indx]['spool']
+    'spool': { 'channels': ['archive'], 'directory': None,
+               'size': 100000, 'age': 7*24*60*60, 'rate': 20, 'retry': 60, 'attempts': 5 },
 
     # defines nodes, LoRa, firmware, classes, etc. for Configure info
     # this will read from a dump MQTT file, can be defined from command line file=..
     # 'file': 'Dumped.json', # uncomment this for operation from data from file
     'FILE': None,
+    # replay and backfill mode of input file(s): no poll waits, parallel decoding of files,
+    # records merged on timestamp (records of a kit in order), bulk writes to the archive
+    # speed: None (no replay mode), 0 or 'unlimited', 'realtime', N or 'Nx' times real time,
+    # workers: max decode processes (one per file), chunk: records per decoded batch,
+    # rows: archive rows buffered per measurements table
+    'replay': { 'speed': None, 'workers': 4, 'chunk': 500, 'rows': 500 },
+    # pipeline stage metrics: port: local HTTP endpoint (Prometheus text format) on address,
+    # file: periodic JSON dump every interval secs. None: disabled
+    'metrics': { 'port': None, 'address': '127.0.0.1', 'file': None, 'interval': 60 },
+    # supervisor mode: collector sharded over worker processes (workers > 1), each with
+    # own DB connection, kit cache and output channel workers. mode: 'frontend' records
+    # are routed by a front end process hashed on device ID (records of a kit in order by
+    # one worker), or 'shared': workers use MQTT shared subscriptions ($share/group/topic)
+    # of the broker (no per kit ordering). queue: max records waiting per worker,
+    # wait: max secs to wait on a full worker queue, report: secs between metrics reports,
+    # drain: max secs for a worker to stop gracefully. SIGHUP: rolling restart of workers.
+    'supervisor': { 'workers': 0, 'mode': 'frontend', 'group': 'MySense', 'queue': 1000,
+                    'wait': 5, 'report': 15, 'drain': 90 },
     # 'initfile': 'MyDatacollector.conf.json', # meta identy data for sensor kits
     'initfile': None,
     # 'nodes': {},  # DB of sensorkits info deprecated
@@ -291,6 +365,9 @@ def EXIT(status=0):
     import os
     import signal
     import platform
+    if Supervised != None: # worker process: do not kill the process group
+      MyLogger.stop()      # process exit will flush multiprocessing queues
+      sys.exit(status)
     # get the current PID for safe terminate server if needed:
     PID = os.getpid()
     if platform.system() != 'Windows':
@@ -347,47 +424,22 @@ def translate( sense, ext=False ):
     if not ext: return sense
     return 'field_' + sense
 
-# get Taylor seq for refs
-def getCalibration(serialized, stype, refs=[]):
-    if not serialized or not refs: return None # similar to [0,1] Taylor
-    serialized = serialized.split('|')
-    for ref in refs:
-      ref = re.compile(ref+'/.*',re.I)
-      if ref.match(stype): return None  # do not calibrate against similar sensor type
-      for i in range(len(serialized)):
-        if ref.match(serialized[i]): return [float(a) for a in serialized[i].split('/')[1:]]
-    return None
-
-# product information from DB table SensorTypes DB cache handling
+# product information from DB table SensorTypes catalog (MySensorTypes)
+# returns catalog entry, or product name if not found
 def SensorInfo(product):
-    global SensorsCache, DB, Conf
-    try:
-      one = SensorsCache[product.upper()]
-      if one['ttl'] > int(time()): return one
-    except: pass
+    global DB
+    one = MySensorTypes.Product(product, DB=DB)  # catalog is loaded on first use
+    return one if one else product
 
+# Returns True if sensor types of the kit need to be renewed after a change in
+# DB table SensorTypes: sensor type info and calibration plans of output channels
+def SensorTypesChanged(info):
+    generation = MySensorTypes.Changed()
     try:
-      # time to live cache entry is 12 hours
-      qry = DB.db_query("SELECT UNIX_TIMESTAMP(now())+12*60*60,matching,producer,category,fields FROM SensorTypes WHERE product LIKE '%s' LIMIT 1" % product, True)[0]
-      if len(qry) != 5:
-        MyLogger.log(WHERE(True),'ATTENT','Unable to find sensor type %s in SensorTypes DB table' % product)
-      fields = []
-      if qry[4]:
-        for one in qry[4].split(';'):
-          fields.append(one.split(','))
-          try:
-            if len(fields[-1]) == 3 and Conf['CalRefs']:
-              fields[-1][2] = getCalibration(fields[-1][2],qry[1],Conf['CalRefs'])
-              if not fields[-1][2]: fields[-1].pop(2)
-          except:
-            if len(fields[-1]) == 3: fields[-1].pop(2)
-          fields[-1] = tuple(fields[-1])
-      # match has reg exp for all product names withg same type of measurements
-      SensorsCache[product.upper()] = {'ttl':qry[0],'type':product.upper(),'match':re.compile(qry[1].replace('?','.'),re.I),'producer':qry[2],'category':qry[3].lower(),'fields':tuple(fields)}
-    except: # product does not exists in DB table and cache
-      # SensorsCache[product.upper()] = product
-      return product
-    return SensorsCache[product.upper()]
+      if info['SensorTypes'] == generation: return False
+    except: pass
+    info['SensorTypes'] = generation
+    return True
 
 # import notice addresses if available and changed
 def importNotices():
@@ -436,7 +488,8 @@ def monitorPrt(msg, color=DFLT): # default color is black
     try: sys.stdout(msg+'\n')
     except: pass
 
-def Initialize(DB=DB, debug=debug, verbose=None):
+# resources=False: no input resource handler (supervisor front end)
+def Initialize(DB=DB, debug=debug, verbose=None, resources=True):
     global Conf, notices, MQTTdefaults, Channels, Resources
     if (not 'initfile' in Conf.keys()) or not Conf['initfile']:
         MyLogger.log(WHERE(True),'WARNING',"No initialisation file defined, use internal definitions.")
@@ -456,15 +509,17 @@ def Initialize(DB=DB, debug=debug, verbose=None):
             MyLogger.log(WHERE(),'ATTENT','Missing or errors in LoRa init json file with info for all LaRa nodes. Exiting.')
             return False
         # nodes info are exported to Database tables Sensors and TTNtable
-        for item in ['project','brokers','translate','notice','from','SMTP','MyDB','adminDB',]:
+        for item in ['project','brokers','translate','notice','from','SMTP','MyDB','adminDB','queue','cache','dedup','fanout','deadkits','spool','replay','metrics','supervisor',]:
             if item in new.keys():
                 Conf[item] = new[item]
                 MyLogger.log(WHERE(),'ATTENT','Overwriting dflt definitions for Conf[%s].' % item)
     # collect type of input channels, here file TTN dump or list of TTN MQTT apps
     if 'FILE' in Conf.keys() and Conf['FILE']:
-      MQTTdefaults['resource'] = Conf['FILE']
       del MQTTdefaults['port']
-      Conf['input'] = [MQTTdefaults]
+      Conf['input'] = []
+      for one in str(Conf['FILE']).split(','):  # one or more input files
+        broker = MQTTdefaults.copy(); broker['resource'] = one.strip()
+        Conf['input'].append(broker)
     elif not Conf['input']:
       try: Conf['input'] = Conf['brokers'] # different key in use
       except: pass
@@ -495,8 +550,29 @@ def Initialize(DB=DB, debug=debug, verbose=None):
     if not len(Conf['input']):
       MyLogger.log(WHERE(),'CRITICAL','No input channel defined.')
       EXIT(1)
+    if not resources: return True
+    return InitResources(DB=DB, debug=debug, verbose=verbose)
+
+# input resource handler with kit cache
+def InitResources(DB=DB, debug=debug, verbose=None):
+    global Conf, Channels, Resources
+    replay = None
+    if Conf['FILE'] and Conf['replay']['speed'] != None: # replay mode of input files
+      replay = dict([(a,Conf['replay'][a]) for a in ['speed','workers','chunk'] if a in Conf['replay']])
+      for item in Channels:  # bulk writes to archive
+        if item.get('script') != 'MyARCHIVE': continue
+        item['Conf']['rows'] = max(item['Conf'].get('rows',1),Conf['replay'].get('rows',1))
+        try: item['module'].Conf['rows'] = item['Conf']['rows']
+        except: pass
+    if 'MyDB' in Conf.keys(): # use DB info and credentials from init file, before kit cache warm up
+      for one,value in Conf['MyDB'].items():
+        if one in ['hostname','port','database','user','password','pool',]:
+          DB.Conf[one] = value
     try:
-      Resources = MyMQTTclient.MQTT_data(Conf['input'], DB=DB, verbose=verbose, debug=debug, logger=MyLogger.log)
+      Resources = MyMQTTclient.MQTT_data(Conf['input'], DB=DB, verbose=verbose, debug=debug, logger=MyLogger.log,
+          qsize=Conf['queue'].get('size',100), overflow=Conf['queue'].get('overflow','drop-newest'),
+          qtimeout=Conf['queue'].get('timeout',None), cache=Conf['cache'], replay=replay,
+          dedup=Conf['dedup'])
     except: 
       MyLogger.log(WHERE(),'CRITICAL','Input initialisation for (MQTT) brokers failed')
       EXIT(1)
@@ -505,10 +581,12 @@ def Initialize(DB=DB, debug=debug, verbose=None):
       except: BrkrID = ''
       MyLogger.log(WHERE(),'INFO','Input is read from: %s%s' % (broker['resource'],BrkrID))
     if not Resources: return False
-    if 'MyDB' in Conf.keys(): # use DB info and credentials from init file
-      for one,value in Conf['MyDB'].items():
-        if one in ['hostname','port','database','user','password',]:
-          DB.Conf[one] = value
+    for item in Channels:  # kit cache last seen from in memory latest measurements
+      if item.get('script') == 'MyLATEST' and item.get('module') and item['Conf'].get('output'):
+        Resources.KitInfo.Latest = item['module'].LastSeen
+    CompileRules()  # validation rules of sensed values
+    # catalog of sensor types, shared with output channels
+    MySensorTypes.Load(DB=DB, CalRefs=Conf['CalRefs'], log=MyLogger.log)
 
     return True
 
@@ -551,72 +629,30 @@ def UniqAddress( to ):
             Rslt.append(one.strip()); cleaned.append(addr)
     return Rslt
 
-def email_message(message, you):
+# notices are queued to the MyNotice dispatcher thread (digest per recipient)
+# notices with an urgent level (CRITICAL, ERROR) are not delayed
+def email_message(message, you, level='ATTENT'):
     global Conf, debug
     if not 'from' in Conf.keys(): return True
     if not 'SMTP' in Conf.keys(): return True
-    # Import smtplib for the actual sending function
-    import smtplib
-    # Import the email modules we'll need
-    from email.mime.text import MIMEText
 
-    # the text contains only ASCII characters.
-    msg = MIMEText("Notice from TTN collector\n" + message)
-    
-    # me == the sender's email address
     # you == the recipient's email address
     if not type(you) is list: you = you.split(',')
     you = UniqAddress(you)
-    # msg['Subject'] = 'MySense: TTN data collector service notice'
-    msg['Subject'] = 'MySense: TTN data collector service TEST notice'
-    msg['From'] = Conf['from']
-    msg['To'] = ','.join(you)
     if debug:
-        sys.stderr.write("Email, not sent, via %s: %s\n" % (Conf['SMTP'],str(msg)))
+        sys.stderr.write("Email, not sent, via %s to %s: %s\n" % (Conf['SMTP'],','.join(you),message))
         return True
-    
-    # Send the message via our own SMTP server, but don't include the
-    # envelope header.
-    try:
-        s = smtplib.SMTP(Conf['SMTP'])
-        s.sendmail(Conf['from'], you, msg.as_string())
-        s.quit()
-    except Exception as e:
-        MyLogger.log(WHERE(True),'ERROR',"Email notice failure: %s" % str(e))
-        if debug: sys.stderr.write("Email notice failure with: %s\n" % str(msg)) # comment this out
-        return False
-    return True
+    MyNotice.Conf['from'] = Conf['from']; MyNotice.Conf['SMTP'] = Conf['SMTP']
+    return MyNotice.email(message, you, level)
 
-def slack_message(message, slackURL):
+def slack_message(message, slackURL, level='ATTENT'):
     global debug
-    rts = True
     if not type(slackURL) is list: slackURL = slackURL.split(',')
-    for one in slackURL:
-      one = 'https://' + one.strip()
-      if debug:
-        MyLogger.log(WHERE(True),'DEBUG','Notice via curl/Slack sent to %s (not sent) via curl): %s' % (one, message))
-        continue
-      lines = []
-      curl = [  #'/bin/echo',
-        '/usr/bin/curl',
-        '-X', 'POST',
-        '-H', 'Content-type: application/json',
-        '--data', '{"text": "_MySense_ TTN collector service *notice*!\n%s"}' % message,
-        '--silent', '--show-error',
-        one
-        ]
-      try:
-        import subprocess
-        p = subprocess.Popen(curl, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        for line in p.stdout.readlines(): lines.append(line)
-        if len(lines) and line[0] == 'ok': lines.pop(0)
-      except Exception as e:
-        MyLogger.log(WHERE(True),'ERROR',"Slack notice failure: %s" % str(e))
-        # print("Slack notice failure with: %s" % str(curl)) # comment this out
-        rts = False
-        continue
-      p.wait()
-    return rts
+    if debug:
+      for one in slackURL:
+        MyLogger.log(WHERE(True),'DEBUG','Notice via Slack sent to %s (not sent): %s' % (one.strip(), message))
+      return True
+    return MyNotice.slack(message, [one.strip() for one in slackURL], level)
 
 # obtain notice address for a kit from Sensors DB tbl
 def kitInfo(DBi,project,serial,fields=[]):
@@ -632,7 +668,8 @@ def kitInfo(DBi,project,serial,fields=[]):
 
 # distribute notices for an event
 # info: identication project,serial or None
-def sendNotice(message,info=None,all=False):
+# level: notice level, ERROR and CRITICAL notices are sent without delay
+def sendNotice(message,info=None,all=False,level='ATTENT'):
     global Conf, debug, monitor, notices
     try: # check if sending notices has methods and addresses
         if not len(Conf['notice'][0]): return False
@@ -713,40 +750,54 @@ def sendNotice(message,info=None,all=False):
         monitorPrt("Send %s Notice to: %s\n" % (item,', '.join(value[1])), RED)
         monitorPrt("     Message  : %s\n" % str(message), (GRAY if not notices else BLUE))
         if extra: message += '\nKit ID and location: %s' % extra
-        value[0](message, value[1])
+        value[0](message, value[1], level)
     return True
 
 # only once at startup time: get names operational defined kits silent for long period
-def DeadKits():
+# a few queries: existing tables, last datum of tables in chunks, TTN ids
+# background: scan in a thread, collector does not wait
+def DeadKits(background=False):
     global DB, TelegramCnt
     if not DB: return False
+    if background:
+      scan = threading.Thread(name='DeadKits', target=DeadKits)
+      scan.daemon = True; scan.start()
+      return True
+    start = time()
     # obtain all operational kits
     kitTbls = DB.db_query("SELECT DISTINCT Sensors.project, Sensors.serial FROM Sensors, TTNtable WHERE Sensors.active AND TTNtable.active ORDER BY Sensors.datum DESC", True)
-    if not len(kitTbls): return False
+    if not kitTbls: return False
+    tables = DB.db_tables()   # existing tables
+    if not tables: return False
+    kitTbls = [kit for kit in kitTbls if '%s_%s' % (kit[0],kit[1]) in tables]
+    lastSeen = {}
+    for item in Channels:  # in memory latest measurements, if channel is in use
+      if item.get('script') == 'MyLATEST' and item.get('module') and item['Conf'].get('output'):
+        lastSeen = item['module'].LastSeen()
+    missing = [tbl for tbl in ['%s_%s' % (kit[0],kit[1]) for kit in kitTbls] if not tbl in lastSeen]
+    if missing: lastSeen.update(DB.db_lastseen(missing))
     lastRun = 0 # get last date one was active
     Selection = []
     for kit in kitTbls:
-      datum = 0
-      try:
-        tbl = DB.db_query("SHOW TABLES like '%s_%s'" % (kit[0],kit[1]), True)
-        if not len(tbl) or not len(tbl[0]): continue # table does not exists
-        datum = DB.db_query("SELECT UNIX_TIMESTAMP(datum) FROM %s_%s ORDER BY datum DESC LIMIT 1" % (kit[0],kit[1]), True)
-        if datum[0][0]:
-          datum = int(datum[0][0])
-          Selection.append([datum,kit[0],kit[1]])
-          if lastRun < datum: lastRun = datum
-      except: pass
+      datum = lastSeen.get('%s_%s' % (kit[0],kit[1]),0)
+      if datum:
+        Selection.append([datum,kit[0],kit[1]])
+        if lastRun < datum: lastRun = datum
+    MyLogger.log(WHERE(True),'INFO',"Scanned %d kit tables in %.1f secs" % (len(kitTbls),time()-start))
     if not lastRun: return False
+    TTNids = {}
+    for (project,serial,TTNid) in (DB.db_query("SELECT DISTINCT project, serial, TTN_id FROM TTNtable WHERE active", True) or []):
+      if TTNid and not (project,serial) in TTNids: TTNids[(project,serial)] = TTNid
     # topic id for dead kits
     Fnd = False
     for indx in range(len(Selection)):
       diff = lastRun - Selection[indx][0]
       if diff <= 2*60*60: continue
       try:
-        TTNid = DB.db_query("SELECT DISTINCT TTN_id FROM TTNtable WHERE project = '%s' AND serial = '%s' AND active" % (Selection[indx][1],Selection[indx][2]), True)
-        if not len(TTNid) or not len(TTNid[0]): continue
+        TTNid = TTNids.get((Selection[indx][1],Selection[indx][2]))
+        if not TTNid: continue
         Fnd = True
-        MyLogger.log(WHERE(),'ATTENT',"Kit TTN id %s, project %s, serial %s, not seen for a while. Last seen: %s." % (TTNid[0][0], Selection[indx][1],Selection[indx][2],datetime.datetime.fromtimestamp(Selection[indx][0]).strftime("%Y-%m-%d %H:%M")) )
+        MyLogger.log(WHERE(),'ATTENT',"Kit TTN id %s, project %s, serial %s, not seen for a while. Last seen: %s." % (TTNid, Selection[indx][1],Selection[indx][2],datetime.datetime.fromtimestamp(Selection[indx][0]).strftime("%Y-%m-%d %H:%M")) )
         if not TelegramCnt: continue  # sendNotices only when fully operating
         if diff <= 24*60*60:
           sendNotice("Kit project %s, serial %s:\t last seen %dh:%dm:%ds ago.\nMaybe not connected?\nLast time seen: %s." % (Selection[indx][1],Selection[indx][2],diff/3600,(diff%3600)/60,(diff%(3600*60))%60,datetime.datetime.fromtimestamp(Selection[indx][0]).strftime("%Y-%m-%d %H:%M")), info={'id': {'project': Selection[indx][1],'serial':Selection[indx][2]}},all=True)
@@ -784,62 +835,35 @@ InvalidSensed = {
     'prevrain': [0,50],
     'geohash':  re.compile(r'^u1h[hjknu][a-z0-9]{,10}$',re.I),# reg exp, change this for other regions
 }
+# InvalidSensed and Conf['check'] compiled once into rule objects (MyValidate)
+ValidRules = None   # field: ValueRule
+StaticRules = None  # static value detection slots and triggers per field
+def CompileRules():
+    global Conf, InvalidSensed, ValidRules, StaticRules
+    ValidRules = MyValidate.Compile(InvalidSensed)
+    StaticRules = MyValidate.StaticRules(Conf['check'])
+
 # check for valid value of sensed data
 def ValidValue(info,afield,avalue):
-    global InvalidSensed
-    if avalue == None: return True
-    fld = afield.lower()
-    if fld == 'accu' and avalue > 15: fld = 'level'
-    try:
-      if not type(InvalidSensed[fld]) is list:
-        if type(avalue) in [str,unicode] and InvalidSensed[fld].match(avalue):
-          return True # skip others not in this region
-      elif InvalidSensed[fld][0] <=  avalue < InvalidSensed[fld][1]:
-        # eg temp == 0.0 denotes a sensor failure
-        if avalue != 0.0 or not fld in ['temp']:
-          try: del info['invalids'][fld]
-          except: pass
-          return True
-    except: return True
-    try: info['invalids']
-    except: info['invalids'] = {fld: -1}
-    try: info['invalids'][fld] += 1
-    except: info['invalids'][fld] = 0
-    return False
+    global ValidRules
+    if ValidRules == None: CompileRules()
+    return MyValidate.Valid(ValidRules,info,afield,avalue)
 
 # check for sensor field value fluctuation, no fluctuation give notice
-# if not present initialize cache entry
-# reset after 100?, notice once after 20 times same value. To Do: use interval timings
-toBeChck = None
+# state per kit in info['check']: fixed size list with slot [count, value] per field
+# notice once after trigger times same value, again every 200 times. To Do: use interval timings
 def FluctCheck(info,afield,avalue):
-    global Conf, toBeChck
-    if toBeChck == None: toBeChck = set([ a[0] for a in Conf['check']])
-    if not afield in toBeChck: return None
-    # if value == None: return afield
-    try: chk = info['check']
-    except: chk = info['check'] = {}
-    try: chk[afield]
-    except:
-      chk[afield] = [0,avalue]
-    if (chk[afield][1] == None) or (chk[afield][1] != avalue):
-      # chk[afield][2] == max(chk[afield][0],avalue)
-      # chk[afield][3] == min(chk[afield][0],avalue)
-      chk[afield][1] = avalue
-      chk[afield][0] = 0
+    global StaticRules
+    if StaticRules == None: CompileRules()
+    static = StaticRules.Count(info,afield,avalue)
+    if static == None: return None
+    count, trigger = static
+    if count <= trigger: # await fluctuations for ca 10 hours
       return None
-    # same value: to do: make max value variable per sensor type
-    chk[afield][0] += 1
-
-    for one in toBeChck:  # get amount of static values permitted for afield
-      if Conf['check'][0] == afield:
-        trigger = Conf['check'][1]; break
-    else: trigger = 40
-    if chk[afield][0] <= trigger: # await fluctuations for ca 10 hours
-      return None
-    if chk[afield][0] > trigger+1 and (chk[afield][0] % 200): # have already give notice
+    if count > trigger+1 and (count % 200): # have already give notice
       return afield
-    MyLogger.log(WHERE(True),'ATTENT','kit %s/%s has (malfunctioning) sensor field %s, which gives static value of %.2f #%d.' % (info['id']['project'],info['id']['serial'],afield,avalue,chk[afield][0]))
-    sendNotice('%s: kit project %s, serial %s has (malfunctioning) sensor field %s, which gives static value of %.2f on a row of %d times. Skipped data.' % (datetime.datetime.fromtimestamp(time()).strftime("%Y-%m-%d %H:%M"),info['id']['project'],info['id']['serial'],afield,avalue,chk[afield][0]),info=info,all=False)
+    MyLogger.log(WHERE(True),'ATTENT','kit %s/%s has (malfunctioning) sensor field %s, which gives static value of %.2f #%d.' % (info['id']['project'],info['id']['serial'],afield,avalue,count))
+    sendNotice('%s: kit project %s, serial %s has (malfunctioning) sensor field %s, which gives static value of %.2f on a row of %d times. Skipped data.' % (datetime.datetime.fromtimestamp(time()).strftime("%Y-%m-%d %H:%M"),info['id']['project'],info['id']['serial'],afield,avalue,count),info=info,all=False)
     return afield
 
 # hack to delete PM mass None values when PM count is not zero
@@ -927,11 +951,11 @@ def CheckPMmass( field, value, cnt ):
 #            'gtw': [[],...] LoRa gateway nearby [gwID,rssi,snr,(lat,long,alt)]
 #            'unknown_fields': [] seen but not used fields
 #            'FromFILE':  True if data read is read from file
-#            'check':     dict of current static sensor values
+#            'check':     list of [count, value] static sensor values per checked field
 #        },
 #      }
 # Example:
-# {'count': 0, 'DATAid': u'SAN_b4e62df4b311', 'WEBactive': 1, 'TTNtableID': 1590665967, 'valid': 1, 'timestamp': 1629569059, 'id': {'project': u'SAN', 'serial': u'b4e62df4b311'}, 'interval': 240, 'SensorsID': 1593163787, 'MQTTid': u'201802215971az/bwlvc-b311', 'location': u'u1hjtzwmqd', 'kit_loc': None, 'gtw': [], 'active': 1, 'Luftdaten': u'b4e62df4b311', 'unknown_fields': [], 'sensors': u'PMSX003,BME280,NEO-6', 'last_seen': 1627828712, 'check': {'rv': [5,100.0}}
+# {'count': 0, 'DATAid': u'SAN_b4e62df4b311', 'WEBactive': 1, 'TTNtableID': 1590665967, 'valid': 1, 'timestamp': 1629569059, 'id': {'project': u'SAN', 'serial': u'b4e62df4b311'}, 'interval': 240, 'SensorsID': 1593163787, 'MQTTid': u'201802215971az/bwlvc-b311', 'location': u'u1hjtzwmqd', 'kit_loc': None, 'gtw': [], 'active': 1, 'Luftdaten': u'b4e62df4b311', 'unknown_fields': [], 'sensors': u'PMSX003,BME280,NEO-6', 'last_seen': 1627828712, 'check': [[-1,None],[5,100.0]]}
 
 # check if measurement kit is behaving: activated, needs to be throttled
 def IsBehavingKit(info,now):
@@ -1336,8 +1360,8 @@ def HasMeasurements(info,data,DBchanges):
       return rts
 
     try:
-      if not type(info['sensors']) is list:
-        info['sensors'] = SensorTypes(info['sensors'])
+      if SensorTypesChanged(info) or not type(info['sensors']) is list:
+        info['sensors'] = SensorTypes(','.join(getTypes(info['sensors'],key='type')) if info['sensors'] else None)
     except: pass
     DBsensors = set(getTypes(info['sensors'],key='type'))
 
@@ -1726,7 +1750,10 @@ def GetDataRecord():
       sleep(10)
 
     # convert fields and values to MySense ident/data record
-    return Data2Frwrd(info, data)
+    start = MyMetrics.clock()
+    try: return Data2Frwrd(info, data)
+    finally: TranslateLatency.since(start)
+TranslateLatency = MyMetrics.histogram('translate_seconds','translate and validation of a record')
 
 # MAIN part of MQTT The Things Network Broker #######################
 
@@ -1777,6 +1804,8 @@ def Configure():
             'Conf': {
                 'output': True,
                 'monitor': False,  # monitoring correct publish data
+                'digest': 5*60,    # secs to collect notices per recipient in one digest
+                'urgent': ['FATAL','CRITICAL','ERROR'], # notice levels sent without delay
                 # to do: add notices filtering in sendNotices
             }
         },
@@ -1795,6 +1824,28 @@ def Configure():
                 'file': sys.stdout, 'print': True,
                 'monitor': False,  # monitoring correct publish data
                 'DEBUG': False,    # do not insert data into measurements table
+                'rows': 10,        # max measurements buffered per table (1: no buffering)
+                'age': 60,         # max secs measurements are buffered
+            }
+        },
+        {   'name': 'rollup', 'script': 'MyROLLUP', 'module': None,
+            'timeout': time()-1,
+            'Conf': {
+                'output': False, 'timeout': time()-1,
+                'file': sys.stdout, 'print': True,
+                'monitor': False,  # monitoring correct publish data
+                'age': 5*60,       # max secs aggregates are kept in memory
+                'buckets': 5000,   # max hourly/daily aggregates in memory
+                'window': 6*60*60, # secs rolled up records are remembered to skip duplicates
+            }
+        },
+        {   'name': 'latest', 'script': 'MyLATEST', 'module': None,
+            'timeout': time()-1,
+            'Conf': {
+                'output': False, 'timeout': time()-1,
+                'file': sys.stdout, 'print': True,
+                'monitor': False,  # monitoring correct publish data
+                'interval': 60,    # min secs between updates of a kit in LatestMeasurements
             }
         },
         {   'name': 'Community', 'script': 'MyCOMMUNITY', 'module': None,
@@ -1804,6 +1855,8 @@ def Configure():
                 'id_prefix': "TTN-", # prefix ID prepended to serial number of module
                 'community': 'https://api.luftdaten.info/v1/push-sensor-data/', # api end point
                 'timeout': 3*15,  # wait timeout on http request result
+                'workers': 2,     # POST threads per host
+                'queue': 250,     # POST queue size per host, overflow to spill file
                 # expression to identify serials subjected for data to be forwarded
                 'active': True,    # output to sensors.community is also activated
                 'DEBUG' : False,   # show what is sent and POST status
@@ -1824,7 +1877,7 @@ def ImportArguments():
     for arg in sys.argv[1:]:
         if arg in ['help','-help','-h']:
           print(__HELP__); exit(0)
-        Match =  re.match(r'\s*(?P<channel>community:|console:|archive:|monitor:|notices:|logger:)?(?P<key>[^=]+)=(?P<value>.*)', arg, re.IGNORECASE)
+        Match =  re.match(r'\s*(?P<channel>community:|console:|archive:|rollup:|latest:|monitor:|notices:|logger:)?(?P<key>[^=]+)=(?P<value>.*)', arg, re.IGNORECASE)
         if Match:
             Match = Match.groupdict()
             if Match['value'] == '': Match['value'] = None
@@ -1845,9 +1898,20 @@ def ImportArguments():
                             # sys.stderr.write("Channel %s new value Conf[%s]: %s\n" %(Channels[indx]['name'],key,str(Match['value'])))
                         break
             else:
-                CMatch = re.match(r'(file|initfile|noticefile|smtp|from|debug|calibrate)',Match['key'], re.IGNORECASE)
+                CMatch = re.match(r'-*(file|initfile|noticefile|smtp|from|debug|calibrate|speed|workers)',Match['key'], re.IGNORECASE)
                 if CMatch:
-                    if Match['key'].lower() in ['smtp','debug','file']:
+                    if Match['key'].lstrip('-').lower() == 'speed': # replay mode of input file(s)
+                        # speed=false or speed=none: no replay, speed= or speed=true: unlimited
+                        if Match['value'] is False or arg.split('=',1)[1].strip().lower() == 'none':
+                            Conf['replay']['speed'] = None
+                        elif Match['value'] is None or Match['value'] is True:
+                            Conf['replay']['speed'] = 0
+                        else: Conf['replay']['speed'] = Match['value']
+                        sys.stderr.write("New value Conf[replay][speed]: %s\n" % str(Conf['replay']['speed']))
+                    elif Match['key'].lstrip('-').lower() == 'workers': # supervisor mode
+                        Conf['supervisor']['workers'] = int(Match['value'] or 0)
+                        sys.stderr.write("New value Conf[supervisor][workers]: %s\n" % str(Conf['supervisor']['workers']))
+                    elif Match['key'].lower() in ['smtp','debug','file']:
                         Conf[Match['key'].upper()] = Match['value'].split(',') if type(Conf[Match['key'].upper()]) is list else  Match['value']
                         # MyLogger.log(WHERE(),'INFO',"New value Conf[%s]: %s\n" %(Match['key'].upper(),str(Match['value'])))
                         sys.stderr.write("New value Conf[%s]: %s\n" %(Match['key'].upper(),str(Match['value'])) )
@@ -1895,6 +1959,10 @@ def UpdateChannelsConf():
               except: pass
             if type( Conf['notices'] ) is str:
               Conf['notices'] = re.compile(Conf['notices'])
+            for item in MyNotice.__options__:
+              if item in notices.keys(): MyNotice.Conf[item] = notices[item]
+            MyNotice.Conf['log'] = MyLogger.log
+            if not MyNotice.Conf['STOP'] in __stop__: __stop__.append(MyNotice.Conf['STOP'])
         elif Channels[indx]['name'] == 'logger':
           for item in Channels[indx]['Conf'].keys():
             MyLogger.Conf[item] = Channels[indx]['Conf'][item]
@@ -1947,6 +2015,22 @@ def UpdateChannelsConf():
                  if MyARCHIVE.Conf['STOP']: __stop__.append( MyARCHIVE.Conf['STOP'] )
               except: pass
               MyARCHIVE.__version__ = MyARCHIVE.__version__.replace('0.',' %s-' % __version__)
+            elif Channels[indx]['script'] == 'MyROLLUP':
+              from lib import MyROLLUP
+              Channels[indx]['module'] = MyROLLUP
+              MyROLLUP.Conf['DB'] = DB
+              try:
+                 if MyROLLUP.Conf['STOP']: __stop__.append( MyROLLUP.Conf['STOP'] )
+              except: pass
+              MyROLLUP.__version__ = MyROLLUP.__version__.replace('0.',' %s-' % __version__)
+            elif Channels[indx]['script'] == 'MyLATEST':
+              from lib import MyLATEST
+              Channels[indx]['module'] = MyLATEST
+              MyLATEST.Conf['DB'] = DB
+              try:
+                 if MyLATEST.Conf['STOP']: __stop__.append( MyLATEST.Conf['STOP'] )
+              except: pass
+              MyLATEST.__version__ = MyLATEST.__version__.replace('0.',' %s-' % __version__)
             elif Channels[indx]['script'] == 'MyCOMMUNITY':
               from lib import MyCOMMUNITY
               Channels[indx]['module'] = MyCOMMUNITY
@@ -1977,10 +2061,295 @@ def UpdateChannelsConf():
       return False
     return True
 
+# publish a record to output channel Channels[indx]
+# record is a read only view or a private copy (channel module Conf['mutable'])
+# called from collector loop, channel worker thread or spool replay thread
+# on a connection failure (IOError) the record is spooled if the channel has a spool,
+# and the channel is throttled for the spool retry time
+# returns False on publishing exception, on replay the exception is raised
+# on replay the channel Commit() is used if defined (record is written at once), and
+# True is only returned if the record is published: a spooled record is deleted
+ChannelsLock = threading.RLock()  # guard for channel errors and timeout accounting
+def PublishChannel(indx, info, record, artifacts, replay=False):
+    global Channels, Conf, monitor
+    RsltOK = False
+    try: RsltOK = Channels[indx]['Conf']
+    except: pass
+    Rslt = True; filtered = False; published = True
+    try:
+        # check if output is filtered for this channel
+        if 'filter' in Channels[indx].keys() and Channels[indx]['filter'] and not Channels[indx]['filter'].match(info['id']['project']+'_'+info['id']['serial']):
+          filtered = True # do not publish if defined not to
+        if not filtered:
+          # supply output channel with (a view of) the data record
+          start = MyMetrics.clock()
+          publish = Channels[indx]['module'].publish
+          if replay: publish = getattr(Channels[indx]['module'],'Commit',publish)
+          Rslt = publish(
+                info = info,
+                data = record,
+                artifacts = artifacts,
+                )
+          ChannelMetric(indx,'latency').since(start)
+          published = Rslt is True or (type(Rslt) is list and len(Rslt) > 0 and Rslt != ['Buffered'])
+        # handle normal result of the data forwarding
+        # failures without an exception event will not be queued for a retry
+        if type(Rslt) is bool and not filtered:
+          if Rslt == True:
+            if RsltOK and monitor:
+              try:
+                if Conf['monitor'].match(info['id']['project']+'_'+info['id']['serial']):
+                  monitorPrt("    %s OK" % ('Forwarded record to %s:' % Channels[indx]['name']),LBLUE)
+              except: pass
+          else:
+            MyLogger.log(WHERE(),'ATTENT','Kit %s/%s data no output to %s' % (info['id']['project'],info['id']['serial'],Channels[indx]['name']))
+            monitorPrt("    %s no data output" % ('Forwarding record to %s:' % Channels[indx]['name']),BLUE)
+        elif Rslt:
+          if type(Rslt) is str or type(Rslt) is unicode:
+            MyLogger.log(WHERE(),'INFO','Kit %s/%s data output to %s: %s' % (info['id']['project'],info['id']['serial'],Channels[indx]['name'],str(Rslt)))
+            if Rslt.upper().find('DISABLED') < 0: # output was not disabled for kit
+              # output not OK
+              monitorPrt("    %s %s" % ('Attent forwarding record to %s, result ' % Channels[indx]['name'],str(Rslt)))
+          elif type(Rslt) is list:
+            try: Rslt = ', '.join(Rslt)
+            except: Rslt = str(Rslt)
+            if len(Rslt):
+              if RsltOK and monitor and not filtered:
+                try:
+                  if Conf['monitor'].match(info['id']['project']+'_'+info['id']['serial']):
+                    monitorPrt("    %s OK for %s" % ('Forwarding record to %s:' % Channels[indx]['name'],str(Rslt)),LBLUE)
+                except: pass
+            else:
+              MyLogger.log(WHERE(),'ATTENT','Kit %s/%s data output to %s: %s' % (info['id']['project'],info['id']['serial'],Channels[indx]['name'],str(Rslt)))
+              monitorPrt("    %-50.50s NO output." % (('Kit %s/%s data output to %s:' % (info['id']['project'],info['id']['serial'],Channels[indx]['name'])),str(Rslt)),RED)
+        else:
+          MyLogger.log(WHERE(),'ATTENT','Kit %s/%s data output failure to %s returned: %s' % (info['id']['project'],info['id']['serial'],Channels[indx]['name'],str(Rslt)))
+          monitorPrt("    %-50.50s UNKNOWN FAILURE" % ('Kit %s/%s data NO output to %s:' % (info['id']['project'],info['id']['serial'],Channels[indx]['name'])),RED)
+        if ('message' in Channels[indx]['module'].Conf.keys()) and Channels[indx]['module'].Conf['message']:
+          try:
+            sendNotice(Channels[indx]['module'].Conf['message'],info=info,all=False)
+            Channels[indx]['module'].Conf['message'] = ''
+          except: pass
+        with ChannelsLock:
+          Channels[indx]['errors'] = 0
+          Channels[indx]['timeout'] = time()-1
+        MyLogger.log(WHERE(True),'DEBUG','Sent record to outputchannel %s' % Channels[indx]['name'])
+
+    # handle publishing exceptions for current output channel
+    # try to redo the data forwarding later
+    except Exception as e:
+      ChannelMetric(indx,'failures').inc()
+      if replay: raise         # spool will retry, no error accounting
+      spooler = Channels[indx].get('spooler')
+      if spooler != None and isinstance(e,(IOError,OSError)):  # channel is down
+        if not len(spooler):
+          MyLogger.log(WHERE(True),'ERROR','while sending record to %s: %s' % (Channels[indx]['name'],str(e)))
+        spooler.put(info, record, artifacts)
+        with ChannelsLock:  # spool records till retry time
+          Channels[indx]['timeout'] = max(Channels[indx]['timeout'],time()+spooler.conf['retry'])
+        return False
+      MyLogger.log(WHERE(True),'ERROR','while sending record to %s: %s' % (Channels[indx]['name'],str(e)))
+      with ChannelsLock: Channels[indx]['errors'] += 1
+      ChannelErrors(indx)
+      return False
+    ChannelErrors(indx)
+    return published if replay else True
+
+# output channel metrics: publish latency, failures, inbox and spool depth
+def ChannelMetric(indx, metric):
+    global Channels
+    try: return Channels[indx]['metrics'][metric]
+    except KeyError: pass
+    name = Channels[indx]['name']
+    Channels[indx]['metrics'] = {
+        'latency': MyMetrics.histogram('publish_seconds','output channel publish of a record',channel=name),
+        'failures': MyMetrics.counter('publish_failures_total','output channel publish exceptions',channel=name),
+        }
+    MyMetrics.gauge('channel_inbox_records', (lambda: sum([a.qsize() for a in (Channels[indx].get('inboxes') or [])])), 'records waiting in output channel inbox(es)', channel=name)
+    MyMetrics.gauge('channel_spool_records', (lambda: len(Channels[indx]['spooler'])), 'records in output channel spool', channel=name)
+    return Channels[indx]['metrics'][metric]
+
+# start local metrics endpoint and/or periodic metrics dump
+def StartMetrics():
+    global Conf, __stop__
+    MyMetrics.gauge('records_total', (lambda: TelegramCnt), 'input records received')
+    if not Conf['metrics'].get('port') and not Conf['metrics'].get('file'): return False
+    for item in MyMetrics.__options__:
+      if item in Conf['metrics']: MyMetrics.Conf[item] = Conf['metrics'][item]
+    MyMetrics.Conf['log'] = MyLogger.log
+    for indx in range(len(Channels)):
+      if Channels[indx].get('inboxes') != None: ChannelMetric(indx,'latency')
+    if not MyMetrics.Conf['STOP'] in __stop__: __stop__.append(MyMetrics.Conf['STOP'])
+    return MyMetrics.Start()
+
+# output channel error accounting: on too many errors throttle, and finally disable output
+def ChannelErrors(indx):
+    global Channels
+    with ChannelsLock:
+      if Channels[indx]['errors'] > 20:
+        if time() > Channels[indx]['timeout']: # throttle 5 mins
+          # skip output for 5 minutes
+          Channels[indx]['timeout'] = time()+5*60
+          Channels[indx]['errors'] += 1
+      if Channels[indx]['errors'] <= 40 or not Channels[indx]['Conf']['output']: return
+      Channels[indx]['Conf']['output'] = False
+      try: Channels[indx]['module'].Conf['output'] = False
+      except: pass
+    MyLogger.log(WHERE(True),'ERROR','Too many errors. Loaded output channel %s: DISABLED' % Channels[indx]['name'])
+    sendNotice('TTN MQTT Server %s: too many errors. Output channel %s: output is DISabled' % (socket.getfqdn(),Channels[indx]['name']),info=None,all=False,level='ERROR')
+
+# output channel fan out, per output channel worker thread(s) with bounded inbox
+# ordering 'kit': a kit is bound to one worker with own inbox (records of kit in order)
+# ordering 'none': workers share one inbox
+def ChannelFanout(indx):
+    global Channels, Conf
+    fanout = Conf['fanout'].copy()
+    try: fanout.update(Channels[indx]['fanout'])
+    except: pass
+    return fanout
+
+# spool configuration of output channel, None if channel is not spooled
+# Community is not spooled: POSTs are asynchronous and spilled by the channel
+def ChannelSpool(indx):
+    global Channels, Conf
+    if not Channels[indx]['name'] in Conf['spool']['channels'] and not Channels[indx].get('spool'):
+      return None
+    if Channels[indx].get('script') == 'MyCOMMUNITY':
+      MyLogger.log(WHERE(True),'ATTENT','Output channel %s is not spooled: it spills POSTs itself' % Channels[indx]['name'])
+      return None
+    spool = Conf['spool'].copy(); del spool['channels']
+    try: spool.update(Channels[indx]['spool'])
+    except: pass
+    if not spool.get('directory'):
+      MyLogger.log(WHERE(True),'ATTENT','Output channel %s is not spooled: define a persistent spool directory' % Channels[indx]['name'])
+      return None
+    return spool
+
+# replay of a spooled record, raises IOError while channel is throttled or disabled
+def ReplayChannel(indx, info, record, artifacts):
+    global Channels
+    if not Channels[indx]['Conf']['output']:
+      raise IOError("output channel %s is disabled" % Channels[indx]['name'])
+    if time() < Channels[indx]['timeout']:
+      raise IOError("output channel %s is throttled" % Channels[indx]['name'])
+    return PublishChannel(indx, info, record, artifacts, replay=True)
+
+def ChannelWorker(indx, inbox):
+    global Channels
+    while True:
+      item = inbox.get()
+      try:
+        if item == None: return # drained, stop worker
+        PublishChannel(indx, *item)
+      except Exception as e:
+        MyLogger.log(WHERE(True),'ERROR','Output channel %s worker failure: %s' % (Channels[indx]['name'],str(e)))
+      finally: inbox.task_done()
+
+def StartChannelWorkers():
+    global Channels, __stop__
+    for indx in range(len(Channels)):
+      if Channels[indx].get('inboxes') != None: continue
+      try:
+        if not Channels[indx]['module'] or not Channels[indx]['Conf']['output']: continue
+      except: continue
+      fanout = ChannelFanout(indx)
+      Channels[indx]['inboxes'] = []; Channels[indx]['workers'] = []
+      Channels[indx]['stats'] = { 'queued': 0, 'dropped': 0 }
+      spool = ChannelSpool(indx)
+      if spool and Channels[indx].get('spooler') == None:
+        try:
+          Channels[indx]['spooler'] = MySpool.Spool(re.sub(r'[^\w.-]','_',Channels[indx]['name'])+('_w%d' % Supervised if Supervised != None else ''), log=MyLogger.log, **spool)
+          Channels[indx]['spooler'].start(publish=(lambda info, record, artifacts, indx=indx: ReplayChannel(indx, info, record, artifacts)))
+        except Exception as e:
+          MyLogger.log(WHERE(True),'ERROR','Output channel %s: no spool: %s' % (Channels[indx]['name'],str(e)))
+      if not fanout['workers']: continue # publish from collector loop
+      for nr in range(fanout['workers']):
+        if not nr or fanout['ordering'] == 'kit':
+          Channels[indx]['inboxes'].append(Queue.Queue(maxsize=max(1,fanout['inbox'])))
+        worker = threading.Thread(name='%s_%d' % (Channels[indx]['name'],nr), target=ChannelWorker, args=(indx,Channels[indx]['inboxes'][-1]))
+        worker.daemon = True   # threads are stopped via StopChannelWorkers()
+        worker.start()
+        Channels[indx]['workers'].append(worker)
+      MyLogger.log(WHERE(),'INFO','Output channel %s: %d worker(s), ordering %s.' % (Channels[indx]['name'],fanout['workers'],fanout['ordering']))
+    if not StopChannelWorkers in __stop__:
+      __stop__.insert(0, StopChannelWorkers) # drain before channel modules are stopped
+
+# hand over record (read only view) to output channel. Returns False if record is dropped
+# info is a read only snapshot of the kit cache entry: channels keep their own kit state
+# with a spool a full inbox is not waited for, and records of a kit with spooled
+# records are spooled as well (ordering of records of a kit)
+def Forward2Channel(indx, info, record, artifacts):
+    global Channels
+    spooler = Channels[indx].get('spooler')
+    try:   # copy on write for channels which change the data record
+      if Channels[indx]['module'].Conf['mutable']: record = MyRecord.RecordCopy(record)
+    except: pass
+    inboxes = Channels[indx].get('inboxes')
+    if not inboxes: # no workers: publish in collector loop
+      PublishChannel(indx, info, record, artifacts)
+      return True
+    kit = info['id']['project']+'_'+info['id']['serial']
+    if spooler != None and spooler.Waiting(kit):  # kit records in order: after spooled ones
+      spooler.put(info, record, artifacts)
+      return True
+    inbox = inboxes[0]
+    if len(inboxes) > 1: # bind kit to a worker
+      inbox = inboxes[hash(kit) % len(inboxes)]
+    try:   # with a spool do not wait on a stalled channel
+      if spooler != None: inbox.put_nowait((info,record,artifacts))
+      else: inbox.put((info,record,artifacts), timeout=ChannelFanout(indx)['wait'])
+      Channels[indx]['stats']['queued'] += 1
+      return True
+    except Queue.Full:
+      if spooler != None:  # channel is stalled
+        spooler.put(info, record, artifacts)
+        return True
+      Channels[indx]['stats']['dropped'] += 1
+      MyLogger.log(WHERE(True),'ERROR','Output channel %s inbox is full: skip record of kit %s_%s (%d skipped)' % (Channels[indx]['name'],info['id']['project'],info['id']['serial'],Channels[indx]['stats']['dropped']))
+      with ChannelsLock: Channels[indx]['errors'] += 1
+      ChannelErrors(indx)
+    return False
+
+# finish publishing queued records, stop channel workers
+def StopChannelWorkers():
+    global Channels, Conf
+    for indx in range(len(Channels)):
+      if not Channels[indx].get('workers'):
+        StopChannelSpool(indx)
+        continue
+      end = time() + ChannelFanout(indx)['drain']
+      # end of records mark for every worker of an inbox
+      for inbox in Channels[indx]['inboxes']:
+        for nr in range(len(Channels[indx]['workers'])//len(Channels[indx]['inboxes'])):
+          try: inbox.put(None, timeout=max(0.1,end-time()))
+          except: pass
+      for worker in Channels[indx]['workers']:
+        worker.join(max(0.1,end-time()))
+      left = sum([inbox.qsize() for inbox in Channels[indx]['inboxes']])
+      if left or [w for w in Channels[indx]['workers'] if w.is_alive()]:
+        MyLogger.log(WHERE(True),'ERROR','Output channel %s: drain timeout, %d records not published' % (Channels[indx]['name'],left))
+      else:
+        MyLogger.log(WHERE(),'INFO','Output channel %s: drained, %d records queued, %d skipped' % (Channels[indx]['name'],Channels[indx]['stats']['queued'],Channels[indx]['stats']['dropped']))
+      Channels[indx]['inboxes'] = None; Channels[indx]['workers'] = []
+      StopChannelSpool(indx)
+
+# stop replay of spooled records, spooled records are replayed on next start
+def StopChannelSpool(indx):
+    global Channels
+    spooler = Channels[indx].get('spooler')
+    if spooler == None: return
+    Channels[indx]['spooler'] = None
+    spooler.stop()
+    MyLogger.log(WHERE(),'INFO','Output channel %s spool: %d spooled, %d replayed, %d expired, %d waiting' % (Channels[indx]['name'],spooler.stats['spooled'],spooler.stats['replayed'],spooler.stats['expired'],len(spooler)))
+
 # main run loop: collect measurement data records, and forward them to output channels.
 def RUNcollector():
     global  Channels, debug, monitor, Conf
     error_cnt = 0; inputError = 0
+    StartChannelWorkers()  # output channel fan out
+    StartMetrics()         # pipeline stage metrics endpoint
+    if Conf['deadkits']:   # kits silent for a long period
+      DeadKits(background=(Conf['deadkits'] == 'background'))
     # configure MySQL luchtmetingen DB access
     while 1:
         if inputError > 10:
@@ -1988,7 +2357,7 @@ def RUNcollector():
             sleep(5*60)
         if (error_cnt > 20) or (inputError > 20):
             MyLogger.log(WHERE(True),'ERROR','To many input errors. Stopped broker')
-            sendNotice('Too many broker server input errors. Suggest to restart the data collecting server %s' % socket.getfqdn(),info=None,all=False)
+            sendNotice('Too many broker server input errors. Suggest to restart the data collecting server %s' % socket.getfqdn(),info=None,all=False,level='CRITICAL')
             break
         record = {}; info = None
         try:
@@ -2121,6 +2490,8 @@ def RUNcollector():
               monitorPrt("        %s" % one); Acnt += 1
             if not frwrd: monitorPrt("   Not forwarding data.",PURPLE)
         if not frwrd or not info or not record: continue
+        view = MyRecord.RecordView(record) # one read only record shared by output channels
+        snapshot = MyRecord.InfoView(info) # read only kit info of this record
 
         for indx in range(len(Channels)): # forwarding record to an output channel
           try:
@@ -2130,6 +2501,8 @@ def RUNcollector():
           PublishMe = True; sentOne = True
           if time() < Channels[indx]['timeout'] or debug:
               PublishMe = False
+              if not debug and Channels[indx].get('spooler') != None: # throttled channel
+                Channels[indx]['spooler'].put(snapshot, view, artifacts)
           elif not info['active'] and PublishMe:
             # sent on active is decided by backend channel
             if info['count'] < 2:
@@ -2140,78 +2513,7 @@ def RUNcollector():
                 monitorPrt("Kit MQTT %s not activated, count: %s, artifacts: '%s'." % (info['count'], str(info['id']),', '.join(artifacts)),BLUE)
 
           if PublishMe:
-              RsltOK = False
-              try: RsltOK = Channels[indx]['Conf']
-              except: pass
-              Rslt = True; filtered = False
-              try:
-                  # check if output is filtered for this channel
-                  if 'filter' in Channels[indx].keys() and Channels[indx]['filter'] and not Channels[indx]['filter'].match(info['id']['project']+'_'+info['id']['serial']):
-                    filtered = True # do not publish if defined not to
-                  if not filtered:
-                    # supply output channel with a copy of data record
-                    Rslt = Channels[indx]['module'].publish(
-                          info = info,
-                          data = copy.deepcopy(record),
-                          artifacts = artifacts,
-                          )
-                  # handle normal result of the data forwarding
-                  # failures without an exception event will not be queued for a retry
-                  if type(Rslt) is bool and not filtered:
-                    if Rslt == True:
-                      if RsltOK and monitor:
-                        try:
-                          if Conf['monitor'].match(info['id']['project']+'_'+info['id']['serial']):
-                            monitorPrt("    %s OK" % ('Forwarded record to %s:' % Channels[indx]['name']),LBLUE)
-                        except: pass
-                    else:
-                      MyLogger.log(WHERE(),'ATTENT','Kit %s/%s data no output to %s' % (info['id']['project'],info['id']['serial'],Channels[indx]['name']))
-                      monitorPrt("    %s no data output" % ('Forwarding record to %s:' % Channels[indx]['name']),BLUE)
-                  elif Rslt:
-                    if type(Rslt) is str or type(Rslt) is unicode:
-                      MyLogger.log(WHERE(),'INFO','Kit %s/%s data output to %s: %s' % (info['id']['project'],info['id']['serial'],Channels[indx]['name'],str(Rslt)))
-                      if Rslt.upper().find('DISABLED') < 0: # output was not disabled for kit
-                        # output not OK
-                        monitorPrt("    %s %s" % ('Attent forwarding record to %s, result ' % Channels[indx]['name'],str(Rslt)))
-                    elif type(Rslt) is list:
-                      try: Rslt = ', '.join(Rslt)
-                      except: Rslt = str(Rslt)
-                      if len(Rslt):
-                        if RsltOK and monitor and not filtered:
-                          try:
-                            if Conf['monitor'].match(info['id']['project']+'_'+info['id']['serial']):
-                              monitorPrt("    %s OK for %s" % ('Forwarding record to %s:' % Channels[indx]['name'],str(Rslt)),LBLUE)
-                          except: pass
-                      else:
-                        MyLogger.log(WHERE(),'ATTENT','Kit %s/%s data output to %s: %s' % (info['id']['project'],info['id']['serial'],Channels[indx]['name'],str(Rslt)))
-                        monitorPrt("    %-50.50s NO output." % (('Kit %s/%s data output to %s:' % (info['id']['project'],info['id']['serial'],Channels[indx]['name'])),str(Rslt)),RED)
-                  else:
-                    MyLogger.log(WHERE(),'ATTENT','Kit %s/%s data output failure to %s returned: %s' % (info['id']['project'],info['id']['serial'],Channels[indx]['name'],str(Rslt)))
-                    monitorPrt("    %-50.50s UNKNOWN FAILURE" % ('Kit %s/%s data NO output to %s:' % (info['id']['project'],info['id']['serial'],Channels[indx]['name'])),RED)
-                  if ('message' in Channels[indx]['module'].Conf.keys()) and Channels[indx]['module'].Conf['message']:
-                    try:
-                      sendNotice(Channels[indx]['module'].Conf['message'],info=info,all=False)
-                      Channels[indx]['module'].Conf['message'] = ''
-                    except: pass
-                  Channels[indx]['errors'] = 0
-                  Channels[indx]['timeout'] = time()-1
-                  MyLogger.log(WHERE(True),'DEBUG','Sent record to outputchannel %s' % Channels[indx]['name'])
-
-              # handle publishing exceptions for current output channel
-              # try to redo the data forwarding later
-              except Exception as e:
-                MyLogger.log(WHERE(True),'ERROR','while sending record to %s: %s' % (Channels[indx]['name'],str(e)))
-                Channels[indx]['errors'] += 1
-
-          if Channels[indx]['errors'] > 20:
-            if time() > Channels[indx]['timeout']: # throttle 5 mins
-              # skip output for 5 minutes
-              Channels[indx]['timeout']+5*50
-              Channels[indx]['errors'] += 1
-          if Channels[indx]['errors'] > 40:
-            Channels[indx]['module']['Conf']['output'] = False
-            MyLogger.log(WHERE(True),'ERROR','Too many errors. Loaded output channel %s: DISABLED' % Channels[indx]['name'])
-            sendNotice('TTN MQTT Server %s: too many errors. Output channel %s: output is DISabled' % (socket.getfqdn(),Channels[indx]['name']),info=None,all=False)
+              Forward2Channel(indx, snapshot, view, artifacts)
 
         if not sentOne:
           MyLogger.log(WHERE(True),'ERROR','No output channel available. Exiting')
@@ -2219,12 +2521,140 @@ def RUNcollector():
           break
     return True
 
+# supervisor mode: worker process nr, records via inbox (multiprocessing queue)
+# routed by the front end, metrics reports via stats queue
+def SupervisedWorker(nr, inbox, stats):
+    global Conf, Channels, DB, Supervised
+    Supervised = nr
+    MyLogger.Forked()        # output threads of the front end are not forked
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # front end will stop the worker
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    DB.Conf['fd'] = None     # own DB connection
+    Conf['metrics']['port'] = Conf['metrics']['file'] = None # exposed by front end
+    if nr: Conf['deadkits'] = False  # scan by one worker
+    Conf['queue']['overflow'] = 'block' # no records dropped: front end waits on full inbox
+    for item in Channels:    # per worker spill files
+      try:
+        if not 'spill' in item['module'].Conf: continue
+        spill = os.path.join((item['module'].Conf['spill'] or tempfile.gettempdir()),'w%d' % nr)
+        if not os.path.isdir(spill): os.makedirs(spill)
+        item['module'].Conf['spill'] = spill
+      except: pass
+    # records routed by front end: MQTT messages, webhook uplinks, input file records
+    brokers = [{ 'resource': 'supervisor', 'port': 'pipe', 'pipe': inbox, 'topic': '+',
+          'clientID': 'MySense_worker%d' % nr, 'import': MyMQTTclient.TTN2MySense(logger=MyLogger.log).RecordImport }]
+    if Conf['supervisor'].get('mode','frontend') == 'shared': # MQTT shared subscriptions
+      # broker balances the messages over the workers: no per kit ordering
+      for broker in Conf['input']:
+        if not broker.get('port') or broker.get('webhook'): continue
+        broker = dict([(k,v) for k, v in broker.items() if not k in ['fd','lock']])
+        broker['topic'] = '$share/%s/%s' % (Conf['supervisor'].get('group','MySense'),broker['topic'])
+        broker['clientID'] = '%s_w%d' % (broker.get('clientID','MySense'),nr)
+        brokers.append(broker)
+    Conf['input'] = brokers
+    Conf['FILE'] = None
+    def Reporter():          # metrics reports to front end
+      while True:
+        sleep(max(1,Conf['supervisor'].get('report',15)))
+        try: stats.put((nr, MyMetrics.Export()), timeout=5)
+        except: pass
+    def Report():            # last report on exit
+      try: stats.put((nr, MyMetrics.Export()), timeout=5)
+      except: pass
+    __stop__.append(Report)
+    reporter = threading.Thread(name='Reporter', target=Reporter)
+    reporter.daemon = True; reporter.start()
+    MyLogger.log(WHERE(),'INFO','Worker %d (pid %d) started.' % (nr,os.getpid()))
+    if not InitResources(DB=DB):
+      MyLogger.log(WHERE(),'CRITICAL','Worker %d: error on initialisation.' % nr)
+      EXIT(1)
+    try: RUNcollector()
+    except Exception as e:
+      MyLogger.log(WHERE(True),'ERROR','Worker %d exception: %s' % (nr,str(e)))
+      EXIT(1)
+    EXIT(0)
+
+# supervisor mode front end: records are routed to worker processes hashed on device ID
+# SIGHUP: rolling restart of workers, SIGTERM/SIGINT: graceful stop
+def Supervise():
+    global Conf
+    supervisor = MySupervisor.Supervisor(SupervisedWorker, log=MyLogger.log, **Conf['supervisor'])
+    stopping = threading.Event()
+    def Restart(signum, frame):
+      MyLogger.log(WHERE(),'ATTENT','Rolling restart of workers.')
+      restart = threading.Thread(name='Restart', target=supervisor.restart)
+      restart.daemon = True; restart.start()
+    def Stop(signum, frame): stopping.set()
+    supervisor.start()
+    signal.signal(signal.SIGHUP, Restart)
+    signal.signal(signal.SIGTERM, Stop); signal.signal(signal.SIGINT, Stop)
+    StartMetrics()           # worker metrics labeled worker="nr"
+    routers = []; webhooks = []
+    # webhook uplinks, HTTP status 429: no room in worker queues for the whole batch
+    # called in a webhook executor thread: route() may wait on a full queue
+    batches = threading.Lock()  # room check and routing of a batch at once
+    def Uplinks(records):
+      payloads = [json.dumps(record) for record in records]
+      IDs = [MyMQTTclient.DeviceID('webhook', payload) for payload in payloads]
+      with batches:
+        if not supervisor.room(IDs): return 429
+        routed = len([ID for ID, payload in zip(IDs,payloads) if supervisor.route(ID, ('webhook', payload))])
+      if routed < len(payloads):  # skipped ones are logged by the supervisor
+        MyLogger.log(WHERE(True),'ERROR','Webhook batch: %d of %d uplinks routed' % (routed,len(payloads)))
+      return 200
+    for broker in Conf['input']:  # webhook input is served by front end in both modes
+      if not broker.get('port') or not broker.get('webhook') or not MyWebhook: continue
+      try:
+        conf = broker['webhook'] if type(broker['webhook']) is dict else {}
+        webhooks.append(MyWebhook.Webhook(Uplinks, **dict(conf, port=broker['port'], log=MyLogger.log)))
+        webhooks[-1].start()
+      except Exception as e:
+        MyLogger.log(WHERE(True),'ERROR','Webhook on port %s failed: %s' % (str(broker['port']),str(e)))
+        webhooks.pop()
+    if Conf['supervisor'].get('mode','frontend') == 'shared':
+      MyLogger.log(WHERE(),'INFO','%d workers with MQTT shared subscriptions.' % supervisor.size)
+    else:
+      for broker in Conf['input']:
+        try:
+          if broker.get('webhook'): continue
+          elif broker.get('port'):     # MQTT broker
+            broker['restarts'] = 0
+            routers.append(MyMQTTclient.MQTT_router(broker, supervisor.route, logger=MyLogger.log))
+            routers[-1].MQTTstart()
+          else:                      # input file
+            with MyMQTTclient.OpenInput(broker['resource']) as fd:
+              for record in MyMQTTclient.FileRecords(fd):
+                if stopping.is_set(): break
+                payload = json.dumps(record)
+                supervisor.route(MyMQTTclient.DeviceID('file', payload), ('file', payload))
+        except Exception as e:
+          MyLogger.log(WHERE(True),'ERROR','Input %s failed: %s' % (broker.get('resource'),str(e)))
+      MyLogger.log(WHERE(),'INFO','Records are routed to %d workers.' % supervisor.size)
+    while (routers or webhooks or Conf['supervisor'].get('mode') == 'shared') and not stopping.wait(10):
+      for router in routers:  # reconnect a broker client
+        if router.connected: continue
+        router.MQTTstop()
+        if not stopping.is_set(): router.MQTTstart()
+    for router in routers: router.MQTTstop()
+    for webhook in webhooks: webhook.stop()
+    supervisor.stop()
+    return True
+
 if __name__ == '__main__':
     Configure()
     ImportArguments()
     if not UpdateChannelsConf():
         MyLogger.log(WHERE(),'CRITICAL','Error on Update Channel configurations.')
         EXIT(1)
+    if Conf['supervisor'].get('workers',0) > 1: # collector sharded over worker processes
+        if not Initialize(resources=False):
+            MyLogger.log(WHERE(),'CRITICAL','Error on initialisation.')
+            EXIT(1)
+        try: Supervise()
+        except Exception as e:
+            sys.stderr.write("EXITING by exception: %s\n" % str(e))
+        EXIT(0)
     if not Initialize():
         MyLogger.log(WHERE(),'CRITICAL','Error on initialisation.')
         EXIT(1)
@@ -26,15 +26,28 @@ __license__ = 'RPL-1.5'
 
 """ Publish measurements to MySQL database
     Relies on Conf setting by main program
+    Measurement rows are buffered per measurements table and written with one
+    multi-row parameterized INSERT ... ON DUPLICATE KEY UPDATE when the table
+    buffer has Conf['rows'] rows, or its oldest row is Conf['age'] secs old.
+    Crash safety: buffered rows are lost when the process is killed or crashes,
+    at most Conf['rows'] rows or Conf['age'] secs of measurements per kit.
+    On exit Conf['STOP'] flushes all buffers. Rows which failed on a DB connection
+    error are kept in the buffer for a retry, at most 10 times Conf['rows'] rows
+    per table: older rows are dropped, logged and counted (Dropped).
+    On a query error the rows are inserted one by one: only failing rows are
+    dropped and counted. MyDB adds an unknown sensor column and redoes the insert.
+    publish() returns True when the row is committed, ['Buffered'] if the row
+    is buffered. Use Conf['rows'] = 1 to write every measurement directly.
+    Commit() is publish() for a replay of a spooled record: True when committed.
 """
 __modulename__='$RCSfile: MyARCHIVE.py,v $'[10:-4]
 __version__ = "0." + "$Revision: 5.20 $"[11:-2]
-import inspect
+import sys
 def WHERE(fie=False):
    global __modulename__, __version__
    if fie:
      try:
-       return "%s V%s/%s" % (__modulename__ ,__version__,inspect.stack()[1][3])
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
      except: pass
    return "%s V%s" % (__modulename__ ,__version__)
 
@@ -43,14 +56,17 @@ try:
     if sys.version_info[0] >= 3: unicode = str
     import os
     import datetime
-    from time import time
+    from time import time, sleep
     import re
+    try: from collections.abc import Mapping  # data record may be a read only view
+    except ImportError: from collections import Mapping
     import atexit
+    import threading
 except ImportError as e:
     sys.exit("FATAL: One of the import modules not found: %s"% e)
 
 # configurable options
-__options__ = ['output','calibrate','DB','log','level','DEBUG']
+__options__ = ['output','calibrate','DB','log','level','DEBUG','rows','age']
 
 Conf = {
     'output': False,     # output to database
@@ -58,6 +74,9 @@ Conf = {
     'log': None,         # MyLogger log routine
     'level': None,       # MyLogger log level, default INFO
     'DEBUG': False,      # Debugging info
+    'rows': 10,          # max rows buffered per measurements table
+    'age': 60,           # max secs a row is buffered
+    'STOP': None,        # flush buffered rows on exit
                          # Reg. expression: fields not archived in DB
     'omit' : '(time|geolocation|coordinates|version|gps|meteo|dust|net|pwr|gwlocation|event|value)',
                          # Reg. expression of publication skipped on these artifacts
@@ -68,22 +87,18 @@ Conf = {
 # check if field is supported and field name already exists in measurement table
 # returns False (not supported), True (exists in measurement table), fieldname (supported, not exists)
 # measurement table supported columns/fields are defined in MyDB.py getFieldInfo(), SupportedFields (reg exp)
-def checkField(tableName, info, field):
+def checkField(tableName, kit, field):
     global Conf
-    if field in info['fields']: return True
+    if field in kit['fields']: return True
     DB = Conf['DB']   # SupportedFields
     if not DB.SupportedFields.match(field):
-      try:
-        if type(info['unknown_fields']) is list:
-          info['unknown_fields'] = set(info['unknown_fields'])
-      except: info['unknown_fields'] = set([])
-      if not field in info['unknown_fields']:
+      if not field in kit['unknown_fields']:
         # Conf['log'](WHERE(),'ATTENT',"Unknown field '%s' for table %s. Skipped." % (field,tableName))
-        info['unknown_fields'] |= set([field])
+        kit['unknown_fields'] |= set([field])
       return False
     return field  # add sensor field/column name to measurement table column names
 
-def AddColumns(info,tableName,toAdd):
+def AddColumns(kit,tableName,toAdd):
     global Conf
     qry = []
     for fld in toAdd:
@@ -95,10 +110,10 @@ def AddColumns(info,tableName,toAdd):
       except IOError: raise IOError
       except:
         Conf['log'](WHERE(True),'ERROR',"Unable to add column(s): %s" % ', '.join(toAdd))
-        info['unknown_fields'] |= set(toAdd)
+        kit['unknown_fields'] |= set(toAdd)
         return False
     Conf['log'](WHERE(),'ATTENT',"Added new column(s) '%s' to table %s" % (','.join(toAdd),tableName))
-    info['fields'] |= set(toAdd)
+    kit['fields'] |= set(toAdd)
     return True
 
 # upgrade measurement table for one field/column
@@ -171,12 +186,22 @@ def UpgradeTable(tableName,field):
 #  'End of iNput Data',              'Fatal error on subscriptions',
 # ]
 
+# archive state per measurements table, kept by the archive (info is a read only snapshot):
+# { table: { 'fields': set of table columns, 'unknown_fields': set of not supported fields } }
+Kits = {}
+
 def registrate(tableName, info, data):
     global Conf
     if type(Conf['omit']) is str: Conf['omit'] = re.compile(Conf['omit'])
     toAdd = []
-    try: info['fields']
-    except:
+    kit = Kits.get(tableName)
+    if kit == None:  # table columns and not supported fields, once per table
+      kit = { 'fields': None, 'unknown_fields': set([]) }
+      try: kit['unknown_fields'] = set(info['unknown_fields'])
+      except: pass
+      try: kit['fields'] = set(info['fields'])  # kit cache may know the columns
+      except: pass
+    if kit['fields'] == None:
       if not Conf['DB'].db_table(tableName):
         raise ValueError("No archive table available")
       # we rely on the fact that fields in ident denote all fields in data dict
@@ -186,7 +211,8 @@ def registrate(tableName, info, data):
       # only once to upgrade measurement table (should go away)
       if not 'sensors' in table_flds: UpgradeTable(tableName,'sensors')
       else: table_flds -= set(['sensors'])
-      info['fields'] = table_flds
+      kit['fields'] = table_flds
+    Kits[tableName] = kit
     valid = True
     try:  # True if in operation, None if invalid values, False if not active
       valid = True if info['valid'] else None
@@ -213,11 +239,11 @@ def registrate(tableName, info, data):
           if type(value) is tuple: value = list(value)
           if type(value) is list:
             try:
-              if value[0] in info['unknown_fields']:
+              if value[0] in kit['unknown_fields']:
                 continue                               # old not supported field
             except: pass
             if Conf['omit'].match(value[0]): continue  # do not archive unwanted sensors
-            checked = checkField(tableName, info, value[0])
+            checked = checkField(tableName, kit, value[0])
             if not checked:
               Conf['log'](WHERE(True),'ATTENT',"Not supported sensor field '%s', value: %s. Skipped." % (value[0],str(value)))
               continue                   # new not supported field
@@ -242,7 +268,7 @@ def registrate(tableName, info, data):
         fields.append(u'geohash')
       else:
         measurements[GeoIndx] = (u'geohash',str(geohash.encode(float(Lat),float(Lon),12),valid))
-    if toAdd: AddColumns(info,tableName,set(toAdd))
+    if toAdd: AddColumns(kit,tableName,set(toAdd))
     # To Do: handle doubles -> average in measurements list (here no calibration diff is applied)
     # def calcAvg(mnts, dbls):
     #   for i in range(len(dbls)-1):
@@ -263,6 +289,16 @@ def registrate(tableName, info, data):
     sensors = sorted(set(sensors))
     return (sensors,measurements)
 
+# measurements of a kit are archived as valid: active, valid and at home location
+def ValidKit(info):
+    try:
+      if not info['valid'] or not info['active']: return False
+    except: pass
+    try:
+      if info['kit_loc']: return False
+    except: pass
+    return True
+
 # return Taylor sequence correction
 def Taylor(avalue,seq,positive=False):
     if avalue == None: return None
@@ -299,6 +335,60 @@ def correctValue(info,field,value,unit): # unit is [unit,[value calibration seq]
       except: pass
     return value
 
+# calibration plan of a sensor type: ((field, Taylor seq or None, rounding decimals),...)
+# catalog sensor type entries are shared read only: plans are cached per entry,
+# a changed sensor type gets a new catalog entry and so a new plan
+SensorPlans = {}  # id(sensor type entry): (sensor type entry, calibration plan)
+def SensorPlan(sensor):
+    try:
+      cached, plan = SensorPlans[id(sensor)]
+      if cached is sensor: return plan
+    except KeyError: pass
+    plan = []
+    for one in sensor['fields']:
+      try: dec = Conf['DB'].getFieldInfo(one[0])[1]
+      except: dec = False  # unknown field, resolved on use
+      plan.append((one[0], tuple(one[2]) if len(one) > 2 and type(one[2]) is list else None, dec))
+    SensorPlans[id(sensor)] = (sensor, tuple(plan))
+    return SensorPlans[id(sensor)][1]
+
+# calibration plan of a kit: { field: (Taylor seq, rounding decimals, positive) }
+# first sensor type with the field defines the calibration (as correctValue does)
+# plan is renewed if the list of sensor types of the kit (Sensors, SensorTypes tables) changes
+Plans = {}  # kit: (sensor types, calibration plan)
+def CalPlan(info):
+    try: sensors = tuple(info['sensors']) if type(info['sensors']) in [list,tuple] else ()
+    except: sensors = ()
+    try: kit = info['DATAid'] if info.get('DATAid') else info['id']['project']+'_'+info['id']['serial']
+    except: kit = None
+    try:
+      cached, plan = Plans[kit]
+      if len(cached) == len(sensors) and all([a is b for a, b in zip(cached,sensors)]):
+        return plan
+    except: pass
+    plan = {}
+    for sensor in sensors:
+      if not type(sensor) is dict: break
+      try:
+        for field, seq, dec in SensorPlan(sensor):
+          if not field in plan: plan[field] = (seq, dec, field[:2] == 'pm')
+      except: break
+    if kit: Plans[kit] = (sensors, plan)
+    return plan
+
+# calibrate, unit convert and round the value in one pass via the calibration plan of the kit
+def Calibrated(plan,field,value,unit):
+    try: seq, dec, positive = plan[field]
+    except KeyError:  # not a sensor type field: only rounding
+      seq, dec, positive = plan[field] = (None, Conf['DB'].getFieldInfo(field)[1], False)
+    if dec is False: dec = Conf['DB'].getFieldInfo(field)[1]
+    if dec == None: return 1 if value else 0
+    if seq: value = Taylor(value,seq,positive)
+    if unit:
+      try: value = Taylor(value,UnitConversion[unit[0]])
+      except: pass
+    return int(value) if dec == 0 else round(value,dec)
+
 # publish argument examples: cached info, measurements record, record artifacts.
 # info = {                           # cached meta info per measurement kit
 #     'count': 1,
@@ -352,6 +442,7 @@ def correctValue(info,field,value,unit): # unit is [unit,[value calibration seq]
 # entry point to forward measurements to measurements table in the database
 # returns:
 #     True: OK stored, False: no data to be stored
+#     ['Buffered']: OK, row is buffered and stored later
 #     string: failure reason on output
 #     list of strings: ok : string which one of the sub output channels had result
 # raised event on failure in eg connection, query error
@@ -369,12 +460,10 @@ def publish(**args):
     if not 'Forward data' in artifacts: return "Not archiving"
     try: timestamp = data['timestamp']
     except: timestamp = None
-    if 'data' in data.keys() and type(data['data']) is dict and len(data['data']):
+    if 'data' in data.keys() and isinstance(data['data'],Mapping) and len(data['data']):
       data = data['data']
     else: return "No data to archive" # no data to archive
-    try:
-      if not 'DATAid' in info.keys() or not info['DATAid']:
-        info['DATAid'] = info['id']['project']+'_'+info['id']['serial']
+    try: table = info['DATAid'] if info.get('DATAid') else info['id']['project']+'_'+info['id']['serial']
     except: return "No archive table name"
     # skip records not to forward to Sensors.Community
     if len(artifacts) > 1:
@@ -383,7 +472,7 @@ def publish(**args):
         if not Conf['dontSkip'].match(one): return "Archiving data is skipped: %s" % one
     
     try:   # ready to put measurements in the measurements table
-      sensors, data = registrate(info['DATAid'],info,data) # list of measurements
+      sensors, data = registrate(table,info,data) # list of measurements
       # registrate side effect: measurements table is updated with all fields needed
       if not data: return "No data to archive"
     except Exception as e: return str(e)
@@ -394,69 +483,221 @@ def publish(**args):
     except: pass
 
     # table is created and updated with missing fields, insert data into database
-    cols = []; vals = []; DB = Conf['DB']
+    cols = []; vals = []; plan = CalPlan(info)
     for one in data:  # one: (field,value,valid[,Taylor calibration seq])
         if one[1] == None: continue
         if DfltValid: validity = one[2]
         else: validity = DfltValid
         # To Do: check one[0] for fields supported in DB archive
-        if type(one[1]) in [str, unicode]: vals.append("'%s'" % one[1])
-        elif type(one[1]) is bool: vals.append("1" if one[1] else "0")
-        elif one[1] == None: vals.append('NULL')
+        if type(one[1]) in [str, unicode]: vals.append(one[1])
+        elif type(one[1]) is bool: vals.append(1 if one[1] else 0)
         elif type(one[1]) in [int,float]: # check range of value is done by Datacollector
-          dec = DB.getFieldInfo(one[0])[1] # try to find rounding factor.
-          if dec == None: vals.append("1" if one[1] else "0")
-          else:
-            # add check if value is in range ?
-            if dec == 0: vals.append(str(int(correctValue(info,one[0],one[1],one[3:]))))
-            else: vals.append(str(round(correctValue(info,one[0],one[1],one[3:]),dec)))
+          # add check if value is in range ?
+          vals.append(Calibrated(plan,one[0],one[1],one[3:]))
         else: # not supported type, e.g. list. Skipped
           continue
         cols.append(one[0])
         # if info['FromFILE']: continue   # do not handle validity if restored from file
         if one[0] != 'geohash':
           cols.append(one[0]+'_valid')
-          if validity == None: vals.append('NULL')
-          elif validity: vals.append('1')
-          else: vals.append('0')
+          if validity == None: vals.append(None)
+          elif validity: vals.append(1)
+          else: vals.append(0)
     if not vals: return False
-    cols += ['datum','sensors']; vals += ["FROM_UNIXTIME(%d)" % int(timestamp),"'%s'" % ','.join(sensors)]
-
-    # assert len(cols) == len(vals)
-    query = "REPLACE INTO %s " % info['DATAid']
-    query += "(%s) " % ','.join(cols)
-    query += "VALUES (%s)" % ','.join(vals)
-    # speedup reasons suggests to first try without on duplicate flag first and try again
-    #if info['FromFILE']:  # measurements from file have probably duplicate timestamps
-    # use next with INSERT iso REPLACE
-    #query += " ON DUPLICATE KEY UPDATE %s" % ','.join(['%s=VALUES(%s)' % (a,a) for a in cols])
+    cols += ['datum','sensors']; vals += [int(timestamp),','.join(sensors)]  # datum: FROM_UNIXTIME()
 
     # insert or update new measurement
     if Conf['DEBUG']:
-      sys.stderr.write("DEBUG DB: %s\n" % query); return ['DEBUG modus, skip archiving']
-    else:
-      # for speedup reasons try first without on dublicate check
-      #for _ in range(1 if info['FromFILE'] else 2):
-      try:
-          # To Do: should add multi=True to query
-          #if Conf['DB'].db_query(("LOCK TABLE %s WRITE;" % info['DATAid']) +query+ ";UNLOCK TABLES",False):
-          if Conf['DB'].db_query(query,False):
-            ErrorCnt = 0  #; break
-          else: ErrorCnt += 1
-      except IOError as e:
-          raise IOError(e)
-      except:
-          #if not _: # try again with handling a duplicate on datum timestamp
-          #  query += " ON DUPLICATE KEY UPDATE %s" % ','.join(['%s=VALUES(%s)' % (a,a) for a in cols])
-          #  continue
-          Conf['log'](WHERE(True),'ERROR',"Error in query: %s" % query)
-          ErrorCnt += 1
+      sys.stderr.write("DEBUG DB: %s %s\n" % (InsertQuery(table,cols),str(vals))); return ['DEBUG modus, skip archiving']
+    committed = BufferRow(table,cols,vals)
     if ErrorCnt > 10: raise ValueError("ERROR %d: DB archiving problems" % ErrorCnt)
     elif ErrorCnt: return "WARNING archiving into DB tables"
+    return True if committed else ['Buffered']
+
+# multi-row insert or update (on same datum) of measurements table, datum as unix timestamp
+def InsertQuery(table,cols):
+    return "INSERT INTO %s (%s) VALUES (%s) ON DUPLICATE KEY UPDATE %s" % (table,','.join(cols),','.join([('FROM_UNIXTIME(%s)' if a == 'datum' else '%s') for a in cols]),','.join(['%s=VALUES(%s)' % (a,a) for a in cols]))
+
+# write buffers per measurements table: { table: { 'rows': [(cols,vals),...], 'first': time oldest row } }
+Buffers = {}
+BufLock = threading.RLock()     # buffers are shared by publish and the flusher thread
+FlushLock = threading.RLock()   # keep rows of a table in order
+Flusher = None                  # thread to flush buffers on age
+Dropped = 0                     # rows dropped from full retry buffers or on query errors
+
+# add row to table buffer, flush buffers on max rows or age
+# returns True if the row is committed. Raises IOError if rows of table are not written
+def BufferRow(table,cols,vals):
+    global Conf, Buffers, Flusher
+    flush = []; now = time()
+    with BufLock:
+      if not table in Buffers.keys() or not Buffers[table]['rows']:
+        Buffers[table] = { 'rows': [], 'first': now }
+      Buffers[table]['rows'].append((tuple(cols),tuple(vals)))
+      for tbl, buf in Buffers.items():
+        if len(buf['rows']) >= Conf['rows'] or (buf['rows'] and now-buf['first'] >= Conf['age']):
+          flush.append(tbl)
+    if Flusher == None and Conf['rows'] > 1:
+      Flusher = threading.Thread(target=FlushOnAge, name='ArchiveFlusher')
+      Flusher.daemon = True
+      Flusher.start()
+    if not flush: return False
+    failed = Flush(flush)
+    if table in failed: raise IOError("DB connection error")
+    if failed:  # other tables: rows are kept for a retry
+      Conf['log'](WHERE(True),'ERROR',"DB connection error for table(s) %s" % ', '.join(failed))
+    return table in flush
+
+# flusher thread: flush buffers with rows older as max age
+def FlushOnAge():
+    global Conf, Buffers
+    while True:
+      sleep(max(Conf['age']/2.0,1))
+      now = time()
+      with BufLock:
+        flush = [tbl for tbl, buf in Buffers.items() if buf['rows'] and now-buf['first'] >= Conf['age']]
+      if flush:
+        try:
+          failed = Flush(flush)
+          if failed: Conf['log'](WHERE(True),'ERROR',"Flush of measurements buffers failed for table(s) %s" % ', '.join(failed))
+        except Exception as e:
+          Conf['log'](WHERE(True),'ERROR',"Flush of measurements buffers failed: %s" % str(e))
+
+# write buffered rows of tables (dflt all tables) to database with multi-row inserts
+# returns list of tables with rows kept for a retry on a DB connection error
+def Flush(tables=None):
+    global Conf, Buffers, ErrorCnt, Dropped
+    failed = []
+    with FlushLock:
+      with BufLock:
+        if tables == None: tables = list(Buffers.keys())
+        todo = []
+        for tbl in tables:
+          try: buf = Buffers.pop(tbl)
+          except KeyError: continue
+          if buf['rows']: todo.append((tbl,buf))
+      for tbl, buf in todo:
+        groups = []  # rows with same columns, in order
+        for cols, vals in buf['rows']:
+          if not groups or groups[-1][0] != cols: groups.append((cols,[]))
+          groups[-1][1].append(vals)
+        for indx in range(len(groups)):
+          cols, rows = groups[indx]
+          bad = 0
+          try:
+            if Conf['DB'].db_executemany(InsertQuery(tbl,cols),rows):
+              ErrorCnt = 0; continue
+            # query error: insert row by row, only the failing rows are dropped
+            # rows are inserted or updated: a retry after a connection error is harmless
+            if len(rows) == 1: bad = 1
+            else: bad = len([v for v in rows if not Conf['DB'].db_executemany(InsertQuery(tbl,cols),[v])])
+          except IOError: # keep rows for a retry, limited
+            with BufLock:
+              retry = [(c,v) for c, r in groups[indx:] for v in r]
+              if tbl in Buffers.keys(): retry += Buffers[tbl]['rows']
+              dropped = max(len(retry)-10*max(Conf['rows'],1),0)
+              Buffers[tbl] = { 'rows': retry[dropped:], 'first': buf['first'] }
+              Dropped += dropped
+            ErrorCnt += 1; failed.append(tbl)
+            Conf['log'](WHERE(True),'ERROR',"DB connection error: %d rows for table %s kept in buffer" % (len(retry)-dropped,tbl))
+            if dropped:
+              Conf['log'](WHERE(True),'ERROR',"Retry buffer of table %s is full: %d oldest rows dropped (%d dropped in total)" % (tbl,dropped,Dropped))
+            break
+          if not bad:
+            ErrorCnt = 0; continue
+          ErrorCnt += 1; Dropped += bad
+          Conf['log'](WHERE(True),'ERROR',"Failed to archive %d of %d rows into table %s (%d dropped in total)" % (bad,len(rows),tbl,Dropped))
+    return failed
+
+# replay of a spooled record: publish and write the row of the record at once
+# returns True if the row is committed, raises IOError if it is not written
+def Commit(**args):
+    rts = publish(**args)
+    try: table = args['info']['DATAid'] if args['info'].get('DATAid') else args['info']['id']['project']+'_'+args['info']['id']['serial']
+    except: return rts
+    with BufLock: buffered = table in Buffers.keys() and len(Buffers[table]['rows'])
+    if not buffered: return rts
+    if table in Flush([table]): raise IOError("DB connection error")
     return True
 
+# on exit: write all buffered rows
+def FlushAll():
+    try:
+      failed = Flush()
+      if not failed: return True
+      Conf['log'](WHERE(True),'ERROR',"Rows in buffers of table(s) %s are lost" % ', '.join(failed))
+    except Exception as e:
+      Conf['log'](WHERE(True),'ERROR',"Rows in buffers are lost: %s" % str(e))
+    return False
+Conf['STOP'] = FlushAll
+
+# benchmark rows/sec archiving: one statement per row vs buffered multi-row inserts
+# uses SQLite (file) as stand-in for MySQL: INSERT OR REPLACE iso ON DUPLICATE KEY UPDATE
+# command line: bench [kits=N] [records=N] [rows=N]
+def Bench(kits=20, records=100, rows=10):
+    import sqlite3, tempfile, MyDB
+    class SQLiteDB(object):   # stand-in for MyDB with measurements tables in SQLite DB file
+      SupportedFields = MyDB.SupportedFields
+      Sensor_fields = MyDB.Sensor_fields
+      getFieldInfo = staticmethod(MyDB.getFieldInfo)
+      def __init__(self, fields):
+        self.dir = tempfile.mkdtemp()
+        self.fd = sqlite3.connect(os.path.join(self.dir,'bench.db'), check_same_thread=False)
+        for kit in range(kits):
+          self.fd.execute("CREATE TABLE BENCH_%d (datum DATETIME UNIQUE, sensors VARCHAR(64), %s, CHECK (temp < 100))" % (kit,','.join(['%s DECIMAL, %s_valid BOOL' % (f,f) for f in fields])))
+        self.fd.commit()
+      def db_executemany(self, query, rows):
+        query = query[:query.find(' ON DUPLICATE KEY')].replace('INSERT INTO','INSERT OR REPLACE INTO')
+        query = query.replace('FROM_UNIXTIME(%s)',"datetime(%s,'unixepoch','localtime')").replace('%s','?')
+        try: self.fd.executemany(query, rows)
+        except sqlite3.Error:  # query error: nothing of the rows is inserted
+          self.fd.rollback(); return False
+        self.fd.commit()
+        return True
+      def count(self):
+        return sum([self.fd.execute("SELECT COUNT(*) FROM BENCH_%d" % kit).fetchone()[0] for kit in range(kits)])
+    fields = ['temp','rv','luchtdruk','pm10','pm25']
+    Conf['log'] = lambda *args: sys.stderr.write("%s %s: %s\n" % args)
+    Conf['output'] = True; Conf['DEBUG'] = False; Conf['age'] = 24*60*60
+    start = int(time()) - records*60
+    for rowsPerFlush in [1,rows]:
+      Conf['DB'] = SQLiteDB(fields); Conf['rows'] = rowsPerFlush
+      infos = [{ 'id': {'project': 'BENCH', 'serial': str(kit)}, 'DATAid': 'BENCH_%d' % kit, 'valid': 1, 'active': 1,
+                'fields': set(fields), 'unknown_fields': set([]), 'sensors': [] } for kit in range(kits)]
+      timing = time()
+      for rec in range(records):
+        for kit in range(kits):
+          publish(info=infos[kit], artifacts=['Forward data'],
+            data={ 'timestamp': start+rec*60+kit, 'data': {
+                'BME280': [('temp',20.0+rec%10),('rv',60.5),('luchtdruk',1012)],
+                'SDS011': [('pm10',12.3+kit),('pm25',7.1)] } })
+      Flush()
+      timing = time()-timing
+      assert Conf['DB'].count() == kits*records
+      print("%3d rows per insert: %6d rows in %6.3f secs, %8.1f rows/sec" % (rowsPerFlush,kits*records,timing,kits*records/max(timing,0.000001)))
+    # a row failing on a query error does not drop the other rows of the insert
+    global Dropped
+    dropped = Dropped
+    for rec in range(rows):
+      publish(info=infos[0], artifacts=['Forward data'],
+        data={ 'timestamp': start+(records+rec)*60, 'data': {
+            'BME280': [('temp',20.0 if rec != rows//2 else 200.0),('rv',60.5),('luchtdruk',1012)],
+            'SDS011': [('pm10',12.3),('pm25',7.1)] } })
+    Flush()
+    assert Conf['DB'].count() == kits*records+rows-1 and Dropped == dropped+1
+    print("    failing row in an insert of %d rows: %d row dropped" % (rows,Dropped-dropped))
+    # replay of a spooled record: committed at once iso buffered
+    assert Commit(info=infos[1], artifacts=['Forward data'], data={ 'timestamp': start+(records+rows)*60,
+        'data': { 'BME280': [('temp',20.0)] } }) is True and Conf['DB'].count() == kits*records+rows
+
 # test main loop
 if __name__ == '__main__':
+    if 'bench' in sys.argv[1:]:
+      args = { 'kits': 20, 'records': 100, 'rows': 10 }
+      for arg in sys.argv[1:]:
+        if arg.find('=') > 0 and arg.split('=')[0] in args.keys(): args[arg.split('=')[0]] = int(arg.split('=')[1])
+      Bench(**args)
+      exit(0)
     Conf['output'] = True
     Conf['DEBUG'] = True
     import MyDB
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Contact Teus Hagen webmaster@behouddeparel.nl to report improvements and bugs
+#
+# Copyright (C) 2022, Behoud de Parel, Teus Hagen, the Netherlands
+# Open Source Initiative  https://opensource.org/licenses/RPL-1.5
+#
+#   Unless explicitly acquired and licensed from Licensor under another
+#   license, the contents of this file are subject to the Reciprocal Public
+#   License ("RPL") Version 1.5, or subsequent versions as allowed by the RPL,
+#   and You may not copy or use this file in either source code or executable
+#   form, except in compliance with the terms and conditions of the RPL.
+#
+#   All software distributed under the RPL is provided strictly on an "AS
+#   IS" basis, WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESS OR IMPLIED, AND
+#   LICENSOR HEREBY DISCLAIMS ALL SUCH WARRANTIES, INCLUDING WITHOUT
+#   LIMITATION, ANY WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#   PURPOSE, QUIET ENJOYMENT, OR NON-INFRINGEMENT. See the RPL for specific
+#   language governing rights and limitations under the RPL.
+__license__ = 'RPL-1.5'
+
+# $Id: MyBench.py,v 1.1 2022/03/19 14:21:05 teus Exp teus $
+
+""" End to end throughput benchmark of the data collector.
+    MQTT records of a test file (dflt inputtests/stressTestData.mqtt) and of
+    synthetic kits (records of the test file as templates) are fed by an in
+    process fake MQTT broker through the real path: MQTT_broker on message,
+    TTN2MySense record import, RecordFiFo, KitCache, Data2Frwrd and the output
+    channel fan out to an in memory output channel.
+    MyDB is replaced by an in memory stand-in: kits are registered on the fly,
+    sensor types are read from MySQLdbSetup.sql. No geocoding service is used.
+    Two phases: flood (records as fast as possible) for the throughput,
+    paced (kits/interval records per sec) for the latencies.
+    Reported: throughput, p50/p99 latency (on message till published),
+    mean latency per pipeline stage, peak RSS. Results can be saved as
+    baseline json file and compared with a previous baseline.
+    Command line: bench [kits=N] [interval=secs] [records=N] [duration=secs]
+        [save=file.json] [baseline=file.json] [tolerance=%] [file ...]
+    Calibration test: calibration [file ...] (dflt all inputtests files)
+    compares calibration plans of MyARCHIVE and MyCOMMUNITY with the per value
+    calibration for all measurements of the records fed through the collector.
+"""
+__modulename__='$RCSfile: MyBench.py,v $'[10:-4]
+__version__ = "0." + "$Revision: 1.1 $"[11:-2]
+import sys
+def WHERE(fie=False):
+   global __modulename__, __version__
+   if fie:
+     try:
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
+     except: pass
+   return "%s V%s" % (__modulename__ ,__version__)
+
+try:
+    import os
+    import re
+    import json
+    import datetime
+    import threading
+    from time import time, sleep
+    try: from time import perf_counter as clock
+    except ImportError: from time import time as clock
+except ImportError as e:
+    sys.exit("FATAL: One of the import modules not found: %s" % e)
+
+Conf = {
+    'kits': 5000,      # nr of synthetic kits
+    'interval': 60,    # secs between records of a kit
+    'records': 20000,  # nr of synthetic records in flood phase
+    'duration': 30,    # secs of paced phase, kits/interval records per sec
+    'files': None,     # MQTT test files, None: inputtests/stressTestData.mqtt
+    'save': None,      # save results as baseline in this json file
+    'baseline': None,  # compare results with this baseline json file
+    'tolerance': 10,   # max % of worse results compared to baseline
+}
+
+# in memory stand-in of MyDB module: registered kits and SensorTypes table
+class BenchDB(object):
+    def __init__(self, sqlfile=None):
+      self.Conf = { 'fd': True, 'output': False, 'log': None }
+      self.kits = {}    # 'TTN_app/TTN_id': meta info DB row
+      self.products = [] # SensorTypes rows: (datum, product, matching, producer, category, fields)
+      self.queries = 0
+      if not sqlfile: return
+      with open(sqlfile) as fd:
+        for line in fd:
+          if line.find('INSERT INTO `SensorTypes`') < 0: continue
+          for one in re.findall(r"\('[^']*','[^']*','([^']*)','([^']*)','([^']*)','([^']*)','([^']*)'\)", line):
+            self.products.append((int(time()),)+one)
+
+    # register a kit: TTNtable and Sensors rows
+    def Register(self, app, device, sensors, location=None):
+      ID = '%s/%s' % (app,device)
+      if ID in self.kits: return
+      serial = re.sub(r'[^A-Za-z0-9]','',device)
+      self.kits[ID] = ('BENCH', serial, len(self.kits)+1, 'BENCH_%s' % serial, ID, serial, 1,
+          len(self.kits)+1, ','.join(sensors), location, 1, 1, 'bench kit V1.8')
+
+    def db_query(self, query, answer):
+      self.queries += 1
+      if not answer: return True
+      if query.find('FROM SensorTypes') > 0:
+        if query.find('MAX(datum)') > 0:   # SensorTypes changes
+          return [(max([a[0] for a in self.products]) if self.products else None, len(self.products))]
+        since = re.search(r"UNIX_TIMESTAMP\(datum\) >= ([0-9]+)", query)
+        return [a for a in self.products if not since or a[0] >= int(since.group(1))]
+      if query.find('FROM TTNtable, Sensors') > 0:
+        ID = re.search(r"TTNtable.TTN_app = '([^']*)' AND TTNtable.TTN_id = '([^']*)'", query)
+        if not ID: return list(self.kits.values())  # kit cache warm up: active kits
+        one = self.kits.get('%s/%s' % ID.groups())
+        return [one] if one else []
+      if query.find('ORDER BY datum DESC LIMIT 1') > 0:  # last seen
+        return [(int(time())-15*60,)]
+      if query.find('MAX(id)') > 0: return [(1,1)]     # registration changes
+      if query.find('SELECT valid FROM TTNtable') == 0: return [(1,)]
+      return []
+    def db_connect(self): return True
+    def db_table(self, table): return True
+    def db_tables(self): return ['TTNtable','Sensors','SensorTypes']+[a[3] for a in self.kits.values()]
+    def db_lastseen(self, tables): return {}
+    def getNodeFields(self, *args, **kwargs): return {}
+    def setNodeFields(self, *args, **kwargs): return True
+
+# in memory output channel: publish time per (MQTT id, timestamp)
+class BenchChannel(object):
+    def __init__(self):
+      self.Conf = { 'output': True, 'log': None }
+      self.published = {}
+    def publish(self, info=None, data=None, artifacts=None):
+      self.published[(info['MQTTid'],data['timestamp'])] = clock()
+      return True
+
+class Message(object):  # paho MQTT message
+    __slots__ = ('topic','payload')
+    def __init__(self, topic, payload):
+      self.topic = topic; self.payload = payload
+
+# json string of record with placeholders for device ID and time
+def Template(record):
+    record = json.loads(json.dumps(record))
+    if 'dev_id' in record:    # TTN V2
+      record['dev_id'] = '@DEV@'; record['app_id'] = '@APP@'
+      record['metadata']['time'] = '@TIME@'
+      record['metadata'].pop('airtime',None)
+    else:                     # TTN V3
+      record['end_device_ids']['device_id'] = '@DEV@'
+      record['end_device_ids']['application_ids']['application_id'] = '@APP@'
+      record['received_at'] = '@TIME@'
+      record.get('uplink_message',{}).pop('consumed_airtime',None)
+    return json.dumps(record)
+
+def Percentile(values, pct):
+    if not values: return None
+    return values[min(len(values)-1,int(len(values)*pct/100.0))]
+
+def Bench(kits=5000, interval=60, records=20000, duration=30, files=None, save=None, baseline=None, tolerance=10):
+    import resource
+    path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, path)
+    import MyDatacollector as Collector
+    MyMQTTclient = Collector.MyMQTTclient; MyMetrics = Collector.MyMetrics
+    if not files: files = [os.path.join(path,'inputtests','stressTestData.mqtt')]
+    Collector.MyLogger.Conf['level'] = 'ERROR'
+    log = lambda *args: None
+
+    # test records, kits are registered with sensor types and home location of their first record
+    importer = MyMQTTclient.TTN2MySense(logger=log).RecordImport
+    db = BenchDB(os.path.join(path,'MySQLdbSetup.sql'))
+    tested = []; templates = []
+    def Register(app, device, record):
+      location = None
+      for one in record.get('data',{}).values():
+        if type(one) is dict and 'geohash' in one: location = one['geohash']
+      db.Register(app, device, [a for a in record.get('data',{}).keys() if a != 'version'], location)
+    for file in files:
+      fd = MyMQTTclient.OpenInput(file)
+      for record in MyMQTTclient.FileRecords(fd):
+        decoded = importer(json.loads(json.dumps(record)))
+        if not decoded: continue
+        Register(decoded['net']['TTN_app'], decoded['net']['TTN_id'], decoded)
+        tested.append(json.dumps(record).encode())
+        templates.append((Template(record), decoded))
+      fd.close()
+    for kit in range(kits):
+      Register('mysense-bench', 'bench-%05d' % kit, templates[kit % len(templates)][1])
+
+    # record import with (MQTT id, timestamp) of records on message
+    Injected = {}; Injecting = [None]
+    def Import(record):
+      rts = importer(record)
+      try: Injected[(rts['net']['TTN_app']+'/'+rts['net']['TTN_id'],rts['timestamp'])] = Injecting[0]
+      except: pass
+      return rts
+
+    # collector with in process fake broker, DB stand-in and in memory output channel
+    geocoding = Collector.MyGPS.GPS2Address
+    Collector.MyGPS.GPS2Address = lambda place, *args, **kwargs: {} # no geocoding service
+    Collector.DB = db; Collector.notices = None; Collector.monitor = None
+    Collector.Conf['rate'] = 0          # no throttling, time is compressed
+    Collector.Conf['deadkits'] = False
+    Collector.CompileRules()
+    broker = { 'resource': 'bench', 'port': 1883, 'topic': '+', 'clientID': 'MyBench', 'import': Import }
+    Collector.Conf['input'] = [broker]
+    Collector.Resources = Resources = MyMQTTclient.MQTT_data(Collector.Conf['input'], DB=db, logger=log, sec2pol=0.5,
+          qsize=Collector.Conf['queue'].get('size',100), overflow='block', cache=Collector.Conf['cache'])
+    client = MyMQTTclient.MQTT_broker(broker, Resources.MQTTFiFo, logger=log)
+    client.connected = True
+    broker.update({ 'fd': client, 'restarts': 0, 'count': 0, 'startTime': time(), 'timestamp': time() })
+    channel = BenchChannel()
+    Collector.Channels = [{ 'name': 'bench', 'module': channel, 'Conf': channel.Conf, 'timeout': time()-1, 'errors': 0 }]
+
+    # fake broker: flood phase, paced phase, end of input
+    stamp = lambda secs: datetime.datetime.utcfromtimestamp(secs).strftime('%Y-%m-%dT%H:%M:%SZ')
+    start = int(time())-24*60*60; phases = {}
+    def Synthetic(first):
+      nr = first
+      while True:
+        kit = nr % kits; tmpl = templates[kit % len(templates)][0]
+        payload = tmpl.replace('@DEV@','bench-%05d' % kit,1).replace('@APP@','mysense-bench',1)
+        yield payload.replace('@TIME@',stamp(start+(nr//kits)*interval+kit*interval//kits),1).encode()
+        nr += 1
+    def Inject(payload):
+      Injecting[0] = clock()
+      client._on_message(None, None, Message('bench', payload))
+    def Drained():
+      while len(Resources.MQTTFiFo) or sum([a.qsize() for a in (Collector.Channels[0].get('inboxes') or [])]):
+        sleep(0.01)
+      sleep(0.1)
+    def Feed():
+      phases['flood'] = [len(Injected), clock()]
+      for payload in tested: Inject(payload)
+      synthetic = Synthetic(0)
+      for _ in range(records): Inject(next(synthetic))
+      Drained(); phases['flood'].append(len(Injected))
+      rate = float(kits)/interval; phases['paced'] = [len(Injected), clock()]
+      for nr in range(int(rate*duration)):
+        wait = phases['paced'][1]+nr/rate-clock()
+        if wait > 0.002: sleep(wait)
+        Inject(next(synthetic))
+      Drained(); phases['paced'].append(len(Injected))
+      del Resources.MQTTbrokers[:]   # end of input
+    feeder = threading.Thread(name='MyBench', target=Feed)
+    feeder.daemon = True
+    feeder.start()
+    Collector.RUNcollector()
+    Collector.StopChannelWorkers()
+    feeder.join(5)
+    Collector.MyGPS.GPS2Address = geocoding
+
+    # results
+    injected = sorted(Injected.items(), key=lambda a: a[1])
+    results = { 'version': Collector.__version__, 'date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M"),
+        'kits': kits, 'interval': interval, 'records': len(injected),
+        'published': len(channel.published), 'DBqueries': db.queries, 'cache': Resources.CacheStats() }
+    for phase in ['flood','paced']:
+      keys = [key for key, _ in injected[phases[phase][0]:phases[phase][2]]]
+      done = [key for key in keys if key in channel.published]
+      latencies = sorted([channel.published[key]-Injected[key] for key in done])
+      end = max([channel.published[key] for key in done]) if done else clock()
+      results[phase] = { 'records': len(keys), 'published': len(done),
+          'throughput': round(len(done)/max(end-phases[phase][1],0.000001),1),
+          'p50': Percentile(latencies,50), 'p99': Percentile(latencies,99) }
+    results['throughput'] = results['flood']['throughput']
+    results['p50'] = results['paced']['p50']; results['p99'] = results['paced']['p99']
+    results['stages'] = {}  # mean secs per pipeline stage
+    for (name, labels), metric in MyMetrics.Registry.items():
+      if metric.kind != 'histogram' or labels: continue
+      value = metric.Value()
+      if value['count']: results['stages'][name] = value['sum']/value['count']
+    results['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0  # MB peak
+    if sys.platform == 'darwin': results['rss'] /= 1024.0
+
+    print("%d kits at 1 record per %d secs, %d test records, %d records: %d published, %d DB queries" % (kits,interval,len(tested),results['records'],results['published'],db.queries))
+    print("    flood:  %6d records, throughput %8.1f records/sec" % (results['flood']['records'],results['flood']['throughput']))
+    print("    paced:  %6d records at %.1f records/sec, latency p50 %.2f msecs, p99 %.2f msecs" % (results['paced']['records'],float(kits)/interval,(results['p50'] or 0)*1000,(results['p99'] or 0)*1000))
+    print("    stages: %s" % ', '.join(["%s %.1f usecs" % (a,v*1000000) for a, v in sorted(results['stages'].items())]))
+    print("    kit cache: %s" % ', '.join(["%s %d" % (k,v) for k, v in sorted(results['cache'].items())]))
+    print("    peak RSS %.1f MB" % results['rss'])
+
+    regressions = []
+    if baseline:
+      with open(baseline) as fd: previous = json.load(fd)
+      for item, worse in [('throughput',-1),('p50',1),('p99',1),('rss',1)]:
+        try: change = (results[item]-previous[item])*100.0/previous[item]
+        except: continue
+        print("    %-10s baseline %10.4f now %10.4f (%+.1f%%)" % (item,previous[item],results[item],change))
+        if change*worse > tolerance: regressions.append(item)
+      if regressions: print("REGRESSION of %s compared to baseline %s (%s)" % (', '.join(regressions),baseline,previous.get('date','')))
+    if save:
+      with open(save,'w') as fd: json.dump(results, fd, indent=1, sort_keys=True)
+      print("    saved as baseline in %s" % save)
+    return (results, regressions)
+
+# calibration test: calibration plans of MyARCHIVE and MyCOMMUNITY against the per value
+# calibration (correctValue, getCal) for all records of the test files through the collector
+def Calibration(files=None, refs='SDS011,BAM1020'):
+    import glob
+    path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, path)
+    import MyDatacollector as Collector
+    from lib import MyARCHIVE, MyCOMMUNITY, MyDB
+    MyMQTTclient = Collector.MyMQTTclient
+    if not files: files = sorted(glob.glob(os.path.join(path,'inputtests','*.mqtt')))
+    Collector.MyLogger.Conf['level'] = 'ERROR'
+    log = lambda *args: None
+
+    importer = MyMQTTclient.TTN2MySense(logger=log).RecordImport
+    db = BenchDB(os.path.join(path,'MySQLdbSetup.sql'))
+    tested = []
+    for file in files:
+      fd = MyMQTTclient.OpenInput(file)
+      for record in MyMQTTclient.FileRecords(fd):
+        decoded = importer(json.loads(json.dumps(record)))
+        if not decoded: continue
+        db.Register(decoded['net']['TTN_app'], decoded['net']['TTN_id'], [a for a in decoded.get('data',{}).keys() if a != 'version'])
+        tested.append(json.dumps(record).encode())
+      fd.close()
+
+    # per value calibration of MyCOMMUNITY before calibration plans
+    def SensorData(SType,values,info):
+      Sflds = {}
+      try:
+        for sens in info['sensors']:
+          if not type(sens) is dict: continue
+          if sens['match'].match(SType):
+            Sflds = sens; break
+      except: return []
+      if not Sflds: return []
+      rts = []
+      try:
+        s_tble_entry = MyCOMMUNITY.sense_table[Sflds['category']]
+        pin, calibrations = MyCOMMUNITY.getCalDB(SType,s_tble_entry)
+        for val in values:
+          field = None
+          value = MyCOMMUNITY.getCal(calibrations,val[0],val[1],PM=(Sflds['category']=='dust'))
+          try:
+            for item, tr in s_tble_entry['translate'].items():
+              if val[0] in tr:
+                field = item; break
+          except: pass
+          if not field or not pin: continue
+          if field == 'pressure': value = int(value*100)
+          else: value = round(value,2)
+          rts.append((pin, field, value))
+      except: return []
+      return rts
+
+    # compare values and types: numerically identical
+    same = lambda a, b: repr(a) == repr(b) and type(a) is type(b)
+    counts = { 'records': 0, 'values': 0, 'calibrated': 0, 'community': 0, 'differences': 0 }
+    class Channel(object):
+      def __init__(self):
+        self.Conf = { 'output': True, 'log': None }
+      def publish(self, info=None, data=None, artifacts=None):
+        counts['records'] += 1
+        plan = MyARCHIVE.CalPlan(info)
+        for SType, values in data['data'].items():
+          if not type(values) in [list,tuple]: continue
+          for one in values:
+            if not type(one) in [list,tuple] or not type(one[1]) in [int,float] or type(one[1]) is bool: continue
+            counts['values'] += 1
+            dec = MyDB.getFieldInfo(one[0])[1]
+            if dec == None: old = 1 if one[1] else 0
+            elif dec == 0: old = int(MyARCHIVE.correctValue(info,one[0],one[1],one[2:]))
+            else: old = round(MyARCHIVE.correctValue(info,one[0],one[1],one[2:]),dec)
+            new = MyARCHIVE.Calibrated(plan,one[0],one[1],one[2:])
+            if plan[one[0]][0]: counts['calibrated'] += 1
+            if not same(old,new):
+              counts['differences'] += 1
+              print("DIFFERENCE archive %s %s %s: %s != %s" % (info['DATAid'],SType,one[0],repr(old),repr(new)))
+          values = [a for a in values if type(a) in [list,tuple] and len(a) > 1]
+          old = SensorData(SType,values,info); new = MyCOMMUNITY.SensorData(SType,values,info)
+          counts['community'] += len(old)
+          if len(old) != len(new) or not all([same(a,b) for a, b in zip(old,new)]):
+            counts['differences'] += 1
+            print("DIFFERENCE community %s %s: %s != %s" % (info['DATAid'],SType,str(old),str(new)))
+        return True
+
+    geocoding = Collector.MyGPS.GPS2Address
+    Collector.MyGPS.GPS2Address = lambda place, *args, **kwargs: {} # no geocoding service
+    Collector.DB = db; Collector.notices = None; Collector.monitor = None
+    Collector.Conf['rate'] = 0; Collector.Conf['deadkits'] = False
+    Collector.Conf['dedup']['size'] = 0   # test files have repeated uplinks
+    Collector.Conf['CalRefs'] = refs.split(',')
+    Collector.MySensorTypes.Load(DB=db, CalRefs=Collector.Conf['CalRefs'], log=log)
+    MyARCHIVE.Conf['DB'] = MyDB; MyCOMMUNITY.Conf['DB'] = db
+    Collector.CompileRules()
+    broker = { 'resource': 'calibration', 'port': 1883, 'topic': '+', 'clientID': 'MyBench' }
+    Collector.Conf['input'] = [broker]
+    Collector.Resources = Resources = MyMQTTclient.MQTT_data(Collector.Conf['input'], DB=db, logger=log, sec2pol=0.5,
+          qsize=100, overflow='block', cache=Collector.Conf['cache'])
+    client = MyMQTTclient.MQTT_broker(broker, Resources.MQTTFiFo, logger=log)
+    client.connected = True
+    broker.update({ 'fd': client, 'restarts': 0, 'count': 0, 'startTime': time(), 'timestamp': time() })
+    channel = Channel()
+    Collector.Channels = [{ 'name': 'calibration', 'module': channel, 'Conf': channel.Conf, 'timeout': time()-1, 'errors': 0 }]
+    def Feed():
+      for payload in tested: client._on_message(None, None, Message('calibration', payload))
+      while len(Resources.MQTTFiFo): sleep(0.01)
+      del Resources.MQTTbrokers[:]   # end of input
+    feeder = threading.Thread(name='MyBench', target=Feed)
+    feeder.daemon = True
+    feeder.start()
+    Collector.RUNcollector()
+    Collector.StopChannelWorkers()
+    feeder.join(5)
+    Collector.MyGPS.GPS2Address = geocoding
+
+    print("%d test records of %d files, %d published: %d values (%d calibrated), %d Community values, %d differences" % (len(tested),len(files),counts['records'],counts['values'],counts['calibrated'],counts['community'],counts['differences']))
+    return counts
+
+if __name__ == '__main__':
+    if 'calibration' in sys.argv[1:]:
+      counts = Calibration(files=[a for a in sys.argv[1:] if a != 'calibration'] or None)
+      sys.stdout.flush()
+      os._exit(1 if counts['differences'] or not counts['calibrated'] else 0)
+    args = Conf.copy(); files = []
+    for arg in sys.argv[1:]:
+      if arg == 'bench': continue
+      if arg.find('=') > 0 and arg.split('=')[0] in args.keys():
+        key, value = arg.split('=',1)
+        args[key] = int(value) if value.isdigit() else value
+      else: files.append(arg)
+    if not 'bench' in sys.argv[1:]:
+      sys.exit("Usage: %s bench [kits=N] [interval=secs] [records=N] [duration=secs] [save=file] [baseline=file] [tolerance=%%] [file ...]" % sys.argv[0])
+    if files: args['files'] = files
+    results, regressions = Bench(**args)
+    sys.stdout.flush()
+    os._exit(1 if regressions else 0)
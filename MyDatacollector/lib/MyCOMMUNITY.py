@@ -29,16 +29,21 @@ __license__ = 'RPL-1.5'
     by emailing the prefix-serial and location details.
     Madavi is disabled due to too many connection problems.
     Relies on Conf setting by main program.
+    POSTs are done by Conf['workers'] threads per host with keep-alive
+    sessions. Failing POSTs are retried with exponential backoff within a
+    retry budget. Records which cannot be queued or posted are spilled to
+    a file per host and posted later, also after a restart.
+    Command line: bench [records=N] [stall=secs] [workers=N] [timeout=secs] local HTTP stub test.
 """
 __modulename__='$RCSfile: MyCOMMUNITY.py,v $'[10:-4]
 __version__ = "0." + "$Revision: 5.8 $"[11:-2]
 import re
-import inspect
+import sys
 def WHERE(fie=False):
    global __modulename__, __version__
    if fie:
      try:
-       return "%s V%s/%s" % (__modulename__ ,__version__,inspect.stack()[1][3])
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
      except: pass
    return "%s V%s" % (__modulename__ ,__version__)
 
@@ -48,10 +53,14 @@ try:
     import datetime
     from time import time, sleep
     import json
+    import os
     import requests
+    import requests.adapters
     import signal
     from time import time
     import re
+    try: from collections.abc import Mapping  # data record may be a read only view
+    except ImportError: from collections import Mapping
     import threading
     if sys.version[0] == '2':
       import Queue
@@ -60,35 +69,49 @@ try:
 
 except ImportError as e:
     sys.exit("FATAL: One of the import modules not found: %s" % e)
+try: from lib import MyMetrics
+except: import MyMetrics
+try: from lib import MySensorTypes
+except: import MySensorTypes
 
 # configurable options
-__options__ = ['output','id_prefix', 'timeout', 'notForwarded','active','calibrate','DEBUG']
+__options__ = ['output','id_prefix', 'timeout', 'notForwarded','active','calibrate','DEBUG',
+    'workers','queue','spill','retries','backoff','budget']
 
 HTTP_POST = {}
 #  per hostname: {
 #          'queue': None,
 #          'stop': False,
-#          'running': False,
+#          'running': 0,   # nr of running POST worker threads
+#          'workers': 1,   # nr of POST worker threads
+#          'lock': None,   # lock on spill file and counters
+#          'budget': 0,    # retry budget: nr of retries allowed
+#          'spilled': 0,   # nr of records in spill file
+#          'posted': 0,    # nr of records posted OK
 #          'timeout': 0,   # optional in case of error or timeout
 #          'warned': 0,    # optional
 #          'url': None
 #       }
 def HTTPstop(immediate=False):
     global HTTP_POST
-    for on in HTTP_POST.keys():
+    for ahost, one in HTTP_POST.items():
       try:
         if not one['running']:
           one['stop'] = True; continue
-        if immediate:
-          one['stop'] = True
-          with one['queue'].mutex: one['queue'].clear()
+        if immediate: one['stop'] = True
         else:
-          while one['queue'].full(): sleep(1)
-        one['queue'].put((None,[]),timeout=5)
-        waiting = 0
-        while not one['queue'].empty() and waiting < 15: 
-          waiting += 1; sleep(1)
-        one['stop'] = True
+          for _ in range(one['workers']):  # one stop record per worker
+            while one['queue'].full(): sleep(1)
+            one['queue'].put((None,[]),timeout=5)
+          waiting = 0
+          while one['running'] and waiting < 15:
+            waiting += 1; sleep(1)
+          one['stop'] = True
+        # records not yet posted are saved to spill file for next run
+        while True:
+          try: ID, data = one['queue'].get_nowait()
+          except Queue.Empty: break
+          if ID != None: Spill(ahost,(ID,data))
       except: pass
 
 Conf = {
@@ -103,10 +126,17 @@ Conf = {
     'active': True,      # output to sensors.community maps is also activated
     'registrated': None, # has done initial setup
     'timeout': 4*30,     # timeout on wait of http request result in seconds
+    'workers': 2,        # nr of POST threads per host, each with keep-alive session
+    'queue': 250,        # max POST records in queue per host, overflow to spill file
+    'spill': None,       # spill file directory, None: system temp directory
+    'retries': 3,        # max retries of a POST on connection error, timeout, 5xx
+    'backoff': 2,        # backoff in secs before first retry, doubled every retry
+    'budget': 20,        # retry budget per host, on every POST OK budget + 0.1
     'log': None,         # MyLogger log print routine
     'message': None,     # event message from this module, eg skipping output
     'DEBUG': False,      # debugging info
     'stop': HTTPstop,    # stop HTTP POST threads
+    'STOP': HTTPstop,    # on exit: post queued records, spill the rest
 }
 
 # ========================================================
@@ -309,16 +339,62 @@ def alrmHandler(signal,frame):
 #     }
 #######
 
-#  HTTP_POST dict: per hostname {
-#          'queue': None,
-#          'stop': False,
-#          'running': False,
-#          'timeout': 0,   # optional in case of error or timeout
-#          'warned': 0,    # optional
-#          'url': None
-#       }
-# HTTP POST thread. One thread per host? For now only Luftdaten   ############ POST THREAD
-# To Do: use Python multiprocessing and queue
+#  HTTP_POST dict: per hostname see above
+# Records which cannot be queued or posted (yet) are not dropped but
+# appended to a spill file per host (json per line) and queued again when
+# the queue has room. Spilled records survive a restart.
+def SpillFile(ahost):
+    global Conf
+    import tempfile
+    return os.path.join((Conf['spill'] if Conf['spill'] else tempfile.gettempdir()),'MyCOMMUNITY-%s.spill' % ahost)
+
+def Spill(ahost,record):
+    global Conf, HTTP_POST
+    host = HTTP_POST[ahost]
+    try:
+      with host['lock']:
+        with open(SpillFile(ahost),'a') as fd:
+          fd.write(json.dumps(record)+'\n')
+        host['spilled'] += 1
+        if host['spilled'] == 1 or not host['spilled']%1000:
+          Conf['log'](WHERE(True),'ATTENT',"Postage to %s delayed: %d records in spill file" % (ahost,host['spilled']))
+      return True
+    except Exception as e:
+      Conf['log'](WHERE(True),'ERROR',"Unable to spill record to host %s: %s. Skipped." % (ahost,str(e)))
+    return False
+
+# move spilled records back to the queue as long as there is room
+def Unspill(ahost):
+    global Conf, HTTP_POST
+    host = HTTP_POST[ahost]; cnt = 0
+    with host['lock']:
+      if not host['spilled']: return 0
+      host['spilled'] = 0
+      try:
+        with open(SpillFile(ahost)) as fd: lines = fd.readlines()
+        os.remove(SpillFile(ahost))
+      except: return 0
+      rest = []
+      for line in lines:
+        if not rest:
+          try:
+            ID, data = json.loads(line)
+            host['queue'].put_nowait((ID,data)); cnt += 1
+            continue
+          except Queue.Full: pass
+          except: continue   # corrupted line
+        rest.append(line)
+      if rest:
+        try:
+          with open(SpillFile(ahost),'a') as fd: fd.write(''.join(rest))
+          host['spilled'] = len(rest)
+        except Exception as e:
+          Conf['log'](WHERE(True),'ERROR',"Unable to spill %d records to host %s: %s" % (len(rest),ahost,str(e)))
+    if cnt: Conf['log'](WHERE(True),'DEBUG',"Requeued %d spilled records to host %s" % (cnt,ahost))
+    return cnt
+
+# HTTP POST thread. Conf['workers'] threads per host.
+# Every worker has a keep-alive session: the connection is reused per POST.
 def HTTPposter(ahost):
     global Conf, HTTP_POST
     try:
@@ -326,7 +402,7 @@ def HTTPposter(ahost):
       if not host['url'] or not host['queue']: raise ValueError()
       if host['stop']: return False
     except:
-      Conf['log'](WHERE(True),'ERROR',"HTTP POST config error for host '%s'" % str(host))
+      Conf['log'](WHERE(True),'ERROR',"HTTP POST config error for host '%s'" % str(ahost))
       return False
 
     def PostTimeout(timeout=None):
@@ -348,29 +424,44 @@ def HTTPposter(ahost):
       sys.stderr.write("    Timeout: %s secs\n" % str(Conf['timeout']))
       sys.stderr.write("    returns: %d\n" % status)
 
-    host['running'] = True; ID = None; data = None; PostSkip = {}
+    # retry record with exponential backoff while in retry budget, else spill it
+    def Retry(ID,data,retries,cause):
+      with host['lock']:
+        retry = retries < Conf['retries'] and host['budget'] >= 1
+        if retry: host['budget'] -= 1
+      if retry:
+        Conf['log'](WHERE(True),'DEBUG','Retry %d POST %s to %s: %s' % (retries+1,ID,ahost,cause))
+        sleep(min(Conf['backoff']*(2**retries),300))
+        return True
+      Conf['log'](WHERE(True),'ATTENT','POST %s to %s failed (%s). Spilled.' % (ID,ahost,cause))
+      Spill(ahost,(ID,data))
+      return False
+
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1,pool_maxsize=1))
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1,pool_maxsize=1))
+    with host['lock']: host['running'] += 1
+    ID = None; data = None; PostSkip = {}; retries = 0
     #tmin = 1000; tmax = 0; tcnt = 0; tavg = 0.0
     while not host['stop']:   # run loop
       if 'timeout' in host.keys() and int(time()) < host['timeout']:  # POSTs should wait
-        sleep(10)
-        if host['queue'].full():
-          try:
-            ID, data = host['queue'].get(timeout=30)
-          except: continue
+        sleep(10)             # queue overflow goes to spill file
         continue
       if data == None:  # get new post record
         try:
           ID, data = host['queue'].get(timeout=30)
-        except: continue
+          retries = 0
+        except:
+          Unspill(ahost); continue
       if ID == None:   # stop thread
-        host['running'] = False; host['stop'] = True
-        return False # exit thread
+        break
 
       #sys.stderr.write("Got a record for ID %s, data %s\n" % (ID, str(data)))
       #timing = time()
       #sys.stderr.write("Queue size: %d\n" % (host['queue'].qsize()+1))
       try:                           # connect and POST to Sensors.Community
-        if not data or not data[1]: continue
+        if not data or not data[1]:
+          data = None; continue
         try:
           if PostSkip[host]%20:
             PostSkip[host] += 1; continue
@@ -383,7 +474,9 @@ def HTTPposter(ahost):
           ok = True
         else:
           #timing = time()
-          r = requests.post(host['url'], json=data[1], headers=data[0], timeout=Conf['timeout'])
+          start = MyMetrics.clock()
+          r = session.post(host['url'], json=data[1], headers=data[0], timeout=Conf['timeout'])
+          host['latency'].since(start)
           #timing = time()-timing
           #tmin = min(tmin,timing); tmax = max(tmax,timing); tcnt += 1; tavg += (timing-tavg)/tcnt
           #sys.stderr.write("Request took %.2f secs, min %.2f - avg %.2f - max %.2f\n" % (timing,tmin,tavg,tmax))
@@ -401,6 +494,14 @@ def HTTPposter(ahost):
             host['timeout'] = 0; host['warned'] = 0 # clear errors
           Conf['log'](WHERE(True),'DEBUG','Sent %s postage to %s OK.' % (ID,ahost))
           if ID in PostSkip.keys(): del PostSkip[ID]
+          with host['lock']:
+            host['posted'] += 1
+            host['budget'] = min(host['budget']+0.1,Conf['budget'])
+          if host['spilled'] and host['queue'].qsize() < host['queue'].maxsize//2:
+            Unspill(ahost)
+        elif ok_status >= 500:       # temporary server error
+          if Retry(ID,data,retries,'status code %d' % ok_status):
+            retries += 1; continue
         else:                        # POST NOT OK, skipped
           if ok_status == 403 or ok_status == 400:
             try: PostSkip[ID] += 1
@@ -412,7 +513,7 @@ def HTTPposter(ahost):
               if not PostSkip[ID]%100:
                 Conf['log'](WHERE(),'ATTENT','Not registered POST %s to %s with ID %s, count %d' % (ID,ahost,data[0]['X-Sensor'],PostSkip[ID]))
                 #Conf['log'](WHERE(),'ATTENT','Not registered POST %s to %s with header: %s, data %s and ID %s, status code: 400' % (ID,ahost,str(data[0]),str(json.dumps(data[1])),data[0]['X-Sensor']))
-          else: # temporary error?
+          else:
             Conf['log'](WHERE(),'ATTENT','Post %s with ID %s returned status code: %d' % (ID,data[0]['X-Sensor'],ok_status))
         data = None  # try next post record
         continue
@@ -421,11 +522,16 @@ def HTTPposter(ahost):
       except requests.ConnectionError as e:
         if str(e).find('Interrupted system call') < 0: # if so watchdog interrupt
           Conf['log'](WHERE(True),'ERROR','Connection error: ' + str(e))
-          timeout = int(time())+2*60*60
         #sys.stderr.write("Request took %.2f secs\n" % (time()-timing))
+        if Retry(ID,data,retries,'connection error'):
+          retries += 1; continue
+        data = None
       except requests.exceptions.Timeout as e:
         Conf['log'](WHERE(),'ERROR','HTTP %d sec request timeout POST error with ID %s' % (Conf['timeout'],data[0]['X-Sensor']))
         #sys.stderr.write("Request took %.2f secs\n" % (time()-timing))
+        if Retry(ID,data,retries,'timeout'):
+          retries += 1; continue
+        data = None
       except Exception as e:
         if str(e).find('EVENT') >= 0:
           raise ValueError(str(e)) # send notice event
@@ -434,6 +540,10 @@ def HTTPposter(ahost):
         #Conf['log'](WHERE(),'ERROR','Error: %s. Stop POST thread for host %s.' % (str(e),ahost))
         #host['stop'] = True
         # PostTimeout(timeout=int(time()+10))
+    if data and ID != None: Spill(ahost,(ID,data))  # stopped while posting
+    session.close()
+    with host['lock']: host['running'] -= 1
+    return False # exit thread
 ###########                              END OF POST THREAD
       
 # to each element of array of POST URL's, 
@@ -465,9 +575,18 @@ def post2Community(postTo,postings,ID):
         host = ('api.luftdaten.info' if url.find('luftdaten') > 0 else 'api-rrd.madavi.de')
       if not host in HTTP_POST.keys():
         HTTP_POST[host] = {
-            'queue':  Queue.Queue(maxsize=25), 'url': url,  # queue size used probably 6 max
-            'stop': False, 'running': False }
-        threading.Thread(name='HTTPposter', target=HTTPposter, args=(host,)).start()
+            'queue':  Queue.Queue(maxsize=max(int(Conf['queue']),1)), 'url': url,
+            'stop': False, 'running': 0, 'workers': max(int(Conf['workers']),1),
+            'lock': threading.Lock(), 'budget': Conf['budget'],
+            'spilled': 0, 'posted': 0,
+            'latency': MyMetrics.histogram('http_post_seconds','HTTP POST to community host',host=host) }
+        MyMetrics.gauge('http_queue_records', (lambda host=host: HTTP_POST[host]['queue'].qsize()), 'records waiting for HTTP POST', host=host)
+        MyMetrics.gauge('http_posted', (lambda host=host: HTTP_POST[host]['posted']), 'records posted', host=host)
+        MyMetrics.gauge('http_spilled', (lambda host=host: HTTP_POST[host]['spilled']), 'records spilled to file', host=host)
+        if os.path.isfile(SpillFile(host)):  # spilled records from previous run
+          HTTP_POST[host]['spilled'] = 1
+        for _ in range(HTTP_POST[host]['workers']):
+          threading.Thread(name='HTTPposter', target=HTTPposter, args=(host,)).start()
       for _ in range(5):
         if HTTP_POST[host]['stop']: return False
         if HTTP_POST[host]['running']: break
@@ -477,20 +596,15 @@ def post2Community(postTo,postings,ID):
         Conf['output'] = False
         return False
 
-      timeout = 6; errorCnt = 0
       for data in postings:
-        errorCnt = 0
         try:
-          while HTTP_POST[host]['queue'].full() and errorCnt < 5:
-            errorCnt += 1; sleep(timeout+1)
-          HTTP_POST[host]['queue'].put((ID,data), timeout=(timeout+1))
+          try: HTTP_POST[host]['queue'].put_nowait((ID,data))
+          except Queue.Full:   # do not wait: delay the postage
+            if not Spill(host,(ID,data)): break
           cat = getCategory(int(data[0]['X-Pin'])); IDhost = "%s@%s" % (ID,host.split('.')[1])
           try: rts[IDhost].append(cat)
           except: rts[IDhost] = [cat]
           #sleep(self.timeout)  # give thread time to do something
-        except Queue.Full:
-          Conf['log'](WHERE(True),'ATTENT',"Postage queue full timeout. Skip record to host %s" % host)
-          break
         except:
           Conf['log'](WHERE(True),'ERROR',"HTTP POST queue put error for host %s. Skipping." % host)
           break
@@ -600,9 +714,9 @@ sense_table = {
     },
 }
 
-# update sense_table cached calibration info from database if possible
+# update sense_table cached calibration info from SensorTypes catalog if possible
 # returns (pin nr, { sensor type to be calibrated, Taylor seq }).
-# To Do: maybe on failure should try again after a while
+# calibration info is renewed on a change of the catalog (generation nr)
 def getCalDB(SType,category):
     global Conf, sense_Table
     if not Conf['calibrate']: return {}
@@ -613,35 +727,25 @@ def getCalDB(SType,category):
         try: return (entry[SType],{})
         except: return (entry[entry['DEFLT']],{})
       if type(entry[SType]) is int: return (entry[SType],{})   # has pin nr, no calibration
-      elif type(entry[SType]) is tuple:                        # has pin nr, calibration, DB entry ttl
+      elif type(entry[SType]) is tuple:                        # has pin nr, calibration, catalog generation
         if len(entry[SType]) > 2:
-          if time() < entry[SType][2]: return entry[SType][:2] # pin,cal,ttl OK
-          try:
-            if not Conf['DB']: return entry[SType][:2]         # cannot use DB table for calibration info
-          except: pass
+          if entry[SType][2] and entry[SType][2] == MySensorTypes.Generation(): return entry[SType][:2] # pin,cal OK
+          if not Conf.get('DB') and not MySensorTypes.Generation():
+            return entry[SType][:2]                            # cannot use DB table for calibration info
       elif not entry[SType]: return None
     except: pass
 
-    try: # try to get calibration from DB table SensorTypes
+    try: # try to get calibration from SensorTypes catalog
       refSType = None
       for one in entry.keys():
         if one != 'DEFLT' and entry[one] == entry[entry['DEFLT']]:
           refSType = one; break
       if not refSType:
-        raise ValueError("Missing default sensor ref type %d" % refType)
-      cals = {}
-      flds = Conf['DB'].db_query("SELECT fields FROM SensorTypes WHERE product = '%s'" % SType, True)[0][0]
-      if len(flds):
-        flds = flds.split(';')
-        # list of eg pm10,ug/m3,SDS011/-3.7600/0.8643|SPS30/-2.3970/0.6002|BAM1020/13.6900/0.2603
-        for fld in flds:
-          fld = fld.split(',')  # [field,unit,ref type/T1/T2]
-          if len(fld) > 2: # has calibration info
-             for cal in fld[2].split('|'):
-                cal = cal.split('/')      # [ref sensor type, Taylor args ...]
-                if cal[0].upper() != refSType.upper(): continue  # only need to info
-                cals[fld[0]] = [float(a) for a in cal[1:]]
-      entry[SType] = (entry[entry['DEFLT']],cals,int(time())+24*60*60)  # TTL one day
+        raise ValueError("Missing default sensor ref type %s" % str(entry['DEFLT']))
+      # eg pm10,ug/m3,SDS011/-3.7600/0.8643|SPS30/-2.3970/0.6002|BAM1020/13.6900/0.2603
+      cals = MySensorTypes.Calibrations(SType, refSType, DB=Conf.get('DB'))
+      if cals == None: return None
+      entry[SType] = (entry[entry['DEFLT']],cals,MySensorTypes.Generation())
       return entry[SType][:2]
     except: pass
     return None
@@ -664,6 +768,35 @@ def getCal(calibrations,field,value,PM=False):
       if field.lower() == one.lower(): return Taylor(value,cal,positive=PM)
     return value
 
+# calibration plans per (sensor type, category): (calibrations, { field: plan })
+# a plan is renewed when getCalDB renews the calibrations from SensorTypes DB table
+CalPlans = {}
+def CalPlan(SType,category,calibrations):
+    global CalPlans
+    try:
+      cached, plan = CalPlans[(SType,category)]
+      if cached is calibrations or (not cached and not calibrations): return plan
+    except KeyError: pass
+    plan = {}
+    CalPlans[(SType,category)] = (calibrations, plan)
+    return plan
+
+# calibration plan of a sensor field: (Sensors Community field, Taylor seq, rounding decimals)
+# rounding decimals None: hPa -> Pa unit conversion
+def FieldPlan(s_tble_entry,calibrations,name):
+    seq = None; field = None
+    if type(calibrations) is dict:
+      for one,cal in calibrations.items():
+        if name.lower() == one.lower():
+          seq = cal; break
+    try:
+      for item, tr in s_tble_entry['translate'].items():
+        # translate field name into Sensors Community field name
+        if name in tr:
+          field = item; break
+    except: pass
+    return (field, seq, None if field == 'pressure' else 2)
+
 # turn values into a list of tuples (pin, field, value) to be sent
 # calibrate the value if needed and instructed
 def SensorData(SType,values,info):
@@ -674,9 +807,9 @@ def SensorData(SType,values,info):
       # forget sensor types not in info as dict
       for sens in info['sensors']:
         if not type(sens) is dict: continue
-        if type(sens['match']) in [str,unicode]:
-          sens['match'] = re.compile(sens['match'],re.I)
-        if sens['match'].match(SType):
+        match = sens['match']   # catalog entries have a compiled matching
+        if type(match) in [str,unicode]: match = re.compile(match,re.I)
+        if match.match(SType):
           Sflds = sens; break
     except: return []
     if not Sflds: return []
@@ -684,21 +817,16 @@ def SensorData(SType,values,info):
       s_tble_entry = sense_table[Sflds['category']]
       calibrations = []; pin = None
       pin, calibrations = getCalDB(SType,s_tble_entry)
+      plan = CalPlan(SType,Sflds['category'],calibrations)
       for val in values: # val = (sensor field,value,unit) # unit is optional
-        #              (calibration seq, field, value, is dust?)
-        field = None; value = val[1]
-        value = getCal(calibrations,val[0],value,PM=(Sflds['category']=='dust'))
-        try:
-          for item, tr in s_tble_entry['translate'].items():
-            # translate field name into Sensors Community field name
-            if val[0] in tr:
-              field = item; break
-        except: pass
+        try: field, seq, dec = plan[val[0]]
+        except KeyError: field, seq, dec = plan[val[0]] = FieldPlan(s_tble_entry,calibrations,val[0])
         if not field or not pin: continue  # field not supported, or pin not defined
         # we have now sensor Stype, field name, value, sensor type ref for calibration
+        value = Taylor(val[1],seq,positive=(Sflds['category']=='dust'))
         # Community API corrections
-        if field == 'pressure': value = int(value*100)  # hPa -> Pa unit
-        else: value = round(value,2)                    # API uses round 2 decimals
+        if dec == None: value = int(value*100)  # hPa -> Pa unit
+        else: value = round(value,dec)          # API uses round 2 decimals
         rts.append((pin, field, value))
     except: return []
     return rts
@@ -723,7 +851,7 @@ def publish(**args):
     except: return "ERROR in publish() arguments"
     try: timestamp = data['timestamp']
     except: timestamp = None
-    if 'data' in data.keys() and type(data['data']) is dict and len(data['data']):
+    if 'data' in data.keys() and isinstance(data['data'],Mapping) and len(data['data']):
       data = data['data']
     else: return False # no data to forward
 
@@ -760,8 +888,81 @@ def publish(**args):
     if data2send: return send2Community(info,data2send,timestamp)
     return False
 
+# local HTTP stub server test: POST rate with keep-alive sessions and
+# no record loss while the server stalls for some seconds. The stall exceeds
+# the shortened POST timeout: stalled POSTs time out and are retried
+def Bench(records=2000, stall=5, workers=2, timeout=2):
+    global Conf, HTTP_POST
+    import tempfile
+    try: from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError: from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    try: from socketserver import ThreadingMixIn
+    except ImportError: from SocketServer import ThreadingMixIn
+    class StubServer(ThreadingMixIn, HTTPServer):
+      daemon_threads = True
+      def handle_error(self, request, client_address): pass  # client timeouts
+    Received = {}; Stalled = [0, 0]; RLock = threading.Lock()
+    class StubHandler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'  # keep-alive
+      disable_nagle_algorithm = True
+      def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with RLock:
+          if not Stalled[0] and len(Received) >= records//4:
+            Stalled[0] = time()+stall  # server stall starts
+          Received[body['n']] = Received.get(body['n'],0)+1
+        if Stalled[0] and time() < Stalled[0]:
+          Stalled[1] += 1; sleep(Stalled[0]-time())
+        self.send_response(200)
+        self.send_header('Content-Length','2'); self.end_headers()
+        self.wfile.write(b'OK')
+      def log_message(self, *args): pass
+    server = StubServer(('127.0.0.1',0), StubHandler)
+    threading.Thread(target=server.serve_forever, name='StubServer').start()
+    url = 'http://127.0.0.1:%d/v1/push-sensor-data/' % server.server_address[1]
+
+    def Post(n): return ({'X-Sensor': 'TTN-bench', 'X-Pin': '1'},
+        {'n': n, 'sensordatavalues': [{'value_type': 'P1', 'value': n%100}]})
+    # reference: a fresh connection per POST
+    cnt = min(200,records); start = time()
+    for n in range(cnt):
+      requests.post(url, json=Post(-n-1)[1], headers=Post(-n-1)[0], timeout=10)
+    fresh = cnt/(time()-start)
+    Received.clear()
+
+    Conf['id_prefix'] = 'TTN-'; Conf['workers'] = workers
+    Conf['timeout'] = timeout; Conf['backoff'] = 0.5
+    Retries = [0]
+    def Log(where,level,message):
+      if message.find('Retry') == 0: Retries[0] += 1
+    Conf['spill'] = tempfile.mkdtemp(); Conf['log'] = Log
+    start = time()
+    for n in range(records):
+      if not post2Community([url],[Post(n)],'bench'):
+        print("Failed to queue record %d" % n)
+    queued = time()-start
+    while len(Received) < records and time()-start < 60+stall: sleep(0.1)
+    took = time()-start
+    HTTPstop()
+    server.shutdown()
+    lost = [n for n in range(records) if not n in Received]
+    print("%d records, %d POST workers, server stall of %d secs, POST timeout %d secs:" % (records,workers,stall,timeout))
+    print("    fresh connection per POST: %7.1f posts/sec" % fresh)
+    print("    keep-alive sessions:       %7.1f posts/sec, %.1f incl. stall, queued in %.2f secs" % (records/max(took-stall,0.001),records/took,queued))
+    print("    %d POSTs stalled, %d duplicate POSTs, %d records lost" % (Stalled[1],sum(Received.values())-len(Received),len(lost)))
+    print("    %d POSTs retried after timeout" % Retries[0])
+    assert not lost, "records lost: %s" % str(lost[:10])
+    assert stall <= timeout or Retries[0], "stalled POSTs were not retried"
+    os.rmdir(Conf['spill'])
+
 # test main loop
 if __name__ == '__main__':
+    if 'bench' in sys.argv[1:]:
+      args = { 'records': 2000, 'stall': 5, 'workers': 2, 'timeout': 2 }
+      for arg in sys.argv[1:]:
+        if arg.find('=') > 0 and arg.split('=')[0] in args.keys(): args[arg.split('=')[0]] = int(arg.split('=')[1])
+      Bench(**args)
+      exit(0)
     Conf['output'] = True
     import MyDB
     Conf['DB'] = MyDB
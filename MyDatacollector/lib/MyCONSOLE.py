@@ -30,12 +30,12 @@ __version__ = "0." + "$Revision: 3.27 $"[11:-2]
     Module can be used in stand alone modus for debugging and tests.
 """
 
-import inspect
+import sys
 def WHERE(fie=False):
    global __modulename__, __version__
    if fie:
      try:
-       return "%s V%s/%s" % (__modulename__ ,__version__,inspect.stack()[1][3])
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
      except: pass
    return "%s V%s" % (__modulename__ ,__version__)
 
@@ -285,7 +285,8 @@ def MeasurementsList(sensorInfo,Stype,item,refs=[]):
     def element(iterable):
         return(iterable[3])
     vals = []
-    if type(item) is list:
+    # list of measurements, in read only record view a tuple of tuples
+    if type(item) is list or (type(item) is tuple and len(item) and type(item[0]) in [list,tuple]):
       for one in item:
         vals += MeasurementsList(sensorInfo,Stype,one,refs=refs)
     #elif type(item) is dict:
@@ -389,7 +390,7 @@ def publish(**args):
           for CHid,CHval in channels.items():
             for item in CHval:
               try:
-                if type(data[one][item[1]]) is list: val = "%d" % len(data[one][item[1]])
+                if type(data[one][item[1]]) in [list,tuple]: val = "%d" % len(data[one][item[1]])
                 else: val = data[one][item[1]]
                 string.append('%s %s' % (item[0], str(val)))
               except: pass
@@ -25,15 +25,21 @@ __license__ = 'RPL-1.5'
 
 """ Publish measurements to MySQL database
     Relies on Conf setting by main program
+    Threads share a pool of max Conf['pool'] DB connections. A connection is used
+    by one thread at a time and caches Conf['statements'] prepared statements.
+    db_execute(query,params,answer) and db_executemany(query,rows) are parameterized
+    queries, db_query(query,answer) is the string query (compatibility) interface.
+    On a connection failure queries raise IOError without waiting: new pool
+    connections are opened after a backoff time.
 """
 __modulename__='$RCSfile: MyDB.py,v $'[10:-4]
 __version__ = "0." + "$Revision: 5.12 $"[11:-2]
-import inspect
+import sys
 def WHERE(fie=False):
    global __modulename__, __version__
    if fie:
      try:
-       return "%s V%s/%s" % (__modulename__ ,__version__,inspect.stack()[1][3])
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
      except: pass
    return "%s V%s" % (__modulename__ ,__version__)
 
@@ -46,19 +52,27 @@ try:
     from time import time, sleep
     import atexit
     import re
+    import threading
+    from collections import OrderedDict
+    if sys.version[0] == '2': import Queue
+    else: import queue as Queue
 except ImportError as e:
     sys.exit("FATAL: One of the import modules not found: %s"% e)
 
 # configurable options
-__options__ = ['output','hostname','port','database','user','password','DEBUG']
+__options__ = ['output','hostname','port','database','user','password','pool','DEBUG']
 
 # close socket connection on exit
 def db_exit( conf=None):
    global Conf
    if not conf: conf = Conf
    try:
-     # if conf['fd']: conf['fd'].close()
-     if conf['fd']: conf['fd'].shutdown()
+     while True: Pool.get_nowait().close()  # idle pool connections
+   except: pass
+   try:
+     # dedicated connection, not shared with pool users
+     if conf['fd'] and not conf['fd'] is True: conf['fd'].shutdown()
+     conf['fd'] = None
      return True
    except: pass
    return False
@@ -70,6 +84,10 @@ Conf = {
     'database': 'luchtmetingen',    # dflt MySQL database name
     'port': 3306,        # default mysql port number
     'fd': None,          # have sent to db: current fd descriptor, 0 on IO error
+    'pool': 4,           # max nr of DB connections shared by threads
+    'retries': 5,        # max nr of connect attempts by db_connect
+    'registered': False, # db_exit is registered at exit
+    'statements': 32,    # max nr of prepared statements cached per connection
     'log': None,         # MyLogger log routine
     'level': None,       # MyLogger log level, default INFO
     'tables': ['Sensors','TTNtable','SensorTypes'], # allow columns cache for these tables
@@ -159,10 +177,12 @@ def attributes(**t):
     global Conf
     Conf.update(t)
 
-# connect to db and keep connection as long as possible
+# connect to db on start: checks credentials and DB access
+# Conf['fd'] is a dedicated connection, queries use the pool (no reconnect via db_connect)
+# connection attempts are bounded: raises IOError after Conf['retries'] failures
 def db_connect():
     """ Connect to MYsql database and save filehandler """
-    global Conf
+    global Conf, Backoff
     if not Conf['log']:
         try: from lib import MyLogger
         except: import MyLogger
@@ -171,51 +191,46 @@ def db_connect():
     if not 'fd' in Conf.keys(): Conf['fd'] = None
     if not 'last' in Conf.keys():
         Conf['waiting'] = 5 * 30 ; Conf['last'] = 0 ; Conf['waitCnt'] = 0
-    elif Conf['waitCnt']: sleep(Conf['waiting'])
-    if (Conf['fd'] == None) or (not Conf['fd']):
-        # get DBUSER, DBHOST, DBPASS from process environment if present
-        for credit in ['hostname','user','password','database']:
-            if not credit in Conf.keys():
-                Conf[credit] = None
-            if Conf[credit] == None:  # if not provided eg via configuration init file
-              try:
-                Conf[credit] = os.getenv('DB'+(credit[0:4].upper() if credit != 'database' else ''),Conf[credit])
-              except:
-                pass
-        Conf['log'](WHERE(),'INFO',"Using database '%s' on host '%s', user '%s' credentials." % (Conf['database'],Conf['hostname'],Conf['user']))
-        if (Conf['hostname'] != 'localhost'): # just a reminder
-            Conf['log'](WHERE(True),'CRITICAL',"THIS IS NOT A LOCALHOST ACCESS! Database host %s / %s."  % (Conf['hostname'], Conf['database']))      
-        for M in ('user','password','hostname','database'):
-            if (not M in Conf.keys()) or not Conf[M]:
-                Conf['log'](WHERE(True),'FATAL',"Define DB details and credentials!")
-                return False
-        if (Conf['fd'] != None) and (not Conf['fd']):
-            if ('waiting' in Conf.keys()) and ((Conf['waiting']+Conf['last']) >= time()):
-                raise IOError
-                return False
+    if Conf['fd']: return True
+    # get DBUSER, DBHOST, DBPASS from process environment if present
+    for credit in ['hostname','user','password','database']:
+        if not credit in Conf.keys():
+            Conf[credit] = None
+        if Conf[credit] == None:  # if not provided eg via configuration init file
+          try:
+            Conf[credit] = os.getenv('DB'+(credit[0:4].upper() if credit != 'database' else ''),Conf[credit])
+          except:
+            pass
+    Conf['log'](WHERE(),'INFO',"Using database '%s' on host '%s', user '%s' credentials." % (Conf['database'],Conf['hostname'],Conf['user']))
+    if (Conf['hostname'] != 'localhost'): # just a reminder
+        Conf['log'](WHERE(True),'CRITICAL',"THIS IS NOT A LOCALHOST ACCESS! Database host %s / %s."  % (Conf['hostname'], Conf['database']))
+    for M in ('user','password','hostname','database'):
+        if (not M in Conf.keys()) or not Conf[M]:
+            Conf['log'](WHERE(True),'FATAL',"Define DB details and credentials!")
+            return False
+    if (Conf['fd'] != None) and (not Conf['fd']):   # in wait period after failures
+        if (Conf['waiting']+Conf['last']) >= time():
+            raise IOError("DB connection backoff")
+    for attempt in range(max(Conf['retries'],1)):
+        if attempt:
+            Conf['log'](WHERE(True),'ATTENT',"Retry to connect with DB in %d seconds" % min(5*2**attempt,Conf['waiting']))
+            sleep(min(5*2**attempt,Conf['waiting']))
         try:
-            Conf['fd'] = mysql.connector.connect(
-                charset='utf8',
-                user=Conf['user'],
-                password=Conf['password'],
-                host=Conf['hostname'],
-                port=Conf['port'],
-                database=Conf['database'],
-                connection_timeout=2*60)
-            atexit.register(db_exit,Conf)
+            Conf['fd'] = db_fd()
+            if not Conf['registered']:
+                atexit.register(db_exit,Conf); Conf['registered'] = True
             Conf['last'] = 0 ; Conf['waiting'] = 5 * 30 ; Conf['waitCnt'] = 0
+            with PoolLock: Backoff['fails'] = 0; Backoff['until'] = 0
             return True
-        except IOError:
+        except Exception as err:
+            if not db_broken(err):
+                Conf['fd'] = None
+                Conf['log'](WHERE(True),'ERROR',"MySQL Connection failure type: %s; value: %s" % (sys.exc_info()[0],sys.exc_info()[1]) )
+                return False
             Conf['last'] = time() ; Conf['fd'] = 0 ; Conf['waitCnt'] += 1
-            if not (Conf['waitCnt'] % 5): Conf['waiting'] *= 2
-            if Conf['waitCnt'] > 5: raise IOError
-            else: return db_connect()
-        except:
-            del Conf['fd']
-            Conf['log'](WHERE(True),'ERROR',"MySQL Connection failure type: %s; value: %s" % (sys.exc_info()[0],sys.exc_info()[1]) )
-            return False
-    else:
-        return True
+            if not (Conf['waitCnt'] % 5): Conf['waiting'] = min(Conf['waiting']*2,60*60)
+            Conf['log'](WHERE(True),'ERROR',"MySQL connection failure: %s" % str(err))
+    raise IOError("Unable to connect to DB after %d attempts" % max(Conf['retries'],1))
 
 # create table Sensors
        # id      timestamp       CURRENT_TIMESTAMP       timestamp last change row
@@ -266,62 +281,210 @@ def db_tableColError(failureType,query):
     except: return False
     return True
 
-# do a query
-Retry = False
+# ========================================================
+# DB connection pool, thread safe
+# ========================================================
+# a pool connection with cache of prepared statements
+# new MySQL connection, autocommit: no stale reads on idle connections
+def db_fd():
+    return mysql.connector.connect(
+                charset='utf8',
+                user=Conf['user'],
+                password=Conf['password'],
+                host=Conf['hostname'],
+                port=Conf['port'],
+                database=Conf['database'],
+                autocommit=True,
+                connection_timeout=2*60)
+
+class PoolConnection(object):
+    def __init__(self):
+        self.fd = db_fd()
+        self.statements = OrderedDict() # query: prepared statement cursor, LRU
+        self.plain = None               # cursor for not prepared queries
+
+    # returns cursor, cached prepared statement cursor if query is defined
+    def cursor(self, query=None):
+        if query == None:
+          if self.plain == None: self.plain = self.fd.cursor(buffered=True)
+          return self.plain
+        try: c = self.statements.pop(query)
+        except KeyError:
+          c = self.fd.cursor(prepared=True)
+          while len(self.statements) >= max(Conf['statements'],1):
+            try: self.statements.popitem(last=False)[1].close()
+            except: pass
+        self.statements[query] = c
+        return c
+
+    # drop cursor after query error
+    def forget(self, query=None):
+        try:
+          if query == None: self.plain.close(); self.plain = None
+          else: self.statements.pop(query).close()
+        except: pass
+
+    def close(self):
+        try: self.fd.close()
+        except: pass
+
+Pool = Queue.LifoQueue()   # idle connections, last used first
+PoolCnt = 0                # nr of open connections
+PoolLock = threading.Lock()
+Backoff = { 'fails': 0, 'until': 0 } # wait time to reconnect after a connection failure
+
+# open a new connection, does not wait on backoff time: raises IOError
+def db_open():
+    global Backoff
+    if Backoff['until'] > time(): raise IOError("DB connection backoff")
+    try: conn = PoolConnection()
+    except Exception as e:
+      with PoolLock:
+        Backoff['fails'] += 1
+        Backoff['until'] = time() + min(5*2**min(Backoff['fails'],7),10*60)
+      Conf['log'](WHERE(True),'ERROR',"MySQL Connection failure type: %s; value: %s" % (sys.exc_info()[0],sys.exc_info()[1]) )
+      raise IOError("MySQL connection failure: %s" % str(e))
+    Backoff['fails'] = 0; Backoff['until'] = 0
+    return conn
+
+# get a connection from the pool, open one if max is not reached
+def db_checkout(timeout=60):
+    global PoolCnt
+    try: return Pool.get_nowait()
+    except Queue.Empty: pass
+    with PoolLock:
+      new = PoolCnt < max(Conf['pool'],1)
+      if new: PoolCnt += 1
+    if new:
+      try: return db_open()
+      except:
+        with PoolLock: PoolCnt -= 1
+        raise
+    try: return Pool.get(timeout=timeout)
+    except Queue.Empty: raise IOError("No DB connection available")
+
+# return connection to the pool, or close it when it is broken
+def db_checkin(conn, broken=False):
+    global PoolCnt
+    if broken:
+      conn.close()
+      with PoolLock: PoolCnt -= 1
+    else: Pool.put(conn)
+
+# is exception a connection failure?
+def db_broken(err):
+    if isinstance(err,(IOError,OSError,mysql.connector.errors.InterfaceError,mysql.connector.errors.OperationalError)):
+      return True
+    try:
+      if err.errno in [2006,2013,2055]: return True
+    except: pass
+    return str(err).find('onnection not avail') > 0
+
+# run query on a pool connection, retry once on a broken connection
+# raises IOError on connection failure, query errors are raised as well
+def _db_execute(query,params=None,answer=False,many=False):
+    for retry in [False,True]:
+      conn = db_checkout()
+      try:
+        if many:
+          c = conn.cursor(); c.executemany(query,params)
+          rts = True
+        else:
+          c = conn.cursor(query if params != None else None)
+          if params != None: c.execute(query,params)
+          else: c.execute(query)
+          rts = c.fetchall() if answer else True
+        db_checkin(conn)
+        return rts
+      except Exception as err:
+        if db_broken(err):
+          db_checkin(conn, broken=True)
+          if retry: raise IOError("Connection broke down.")
+          Conf['log'](WHERE(True),'ERROR','Retry to connect with DB')
+          continue
+        conn.forget(query if params != None and not many else None)
+        db_checkin(conn)
+        raise
+
+# parameterized query eg "SELECT pm10 FROM %s WHERE datum > %%s" % table, params (timestamp,)
+# returns list of rows if answer else True, False on query error
+# raises IOError on connection failure
+def db_execute(query,params=None,answer=False):
+    """ communicate with parameterized sql to database """
+    Conf['log'](WHERE(True),'DEBUG',"MySQL query: %s %s" % (query,str(params)))
+    try: return _db_execute(query,params,answer)
+    except IOError: raise
+    except:
+      Conf['log'](WHERE(True),'ERROR',"Failure type: %s; value: %s" % (sys.exc_info()[0],sys.exc_info()[1]) )
+      Conf['log'](WHERE(True),'ERROR',"On query: %s" % query)
+    return False
+
+# parameterized query for a list of rows eg multi-row insert, committed at once
+# an unknown column of a measurements table is added and the query is redone once
+# returns True/False, raises IOError on connection failure
+def db_executemany(query,rows,retry=True):
+    """ execute parameterized sql for every row of parameters """
+    Conf['log'](WHERE(True),'DEBUG',"MySQL query: %s (%d rows)" % (query,len(rows)))
+    try: return _db_execute(query,rows,many=True)
+    except IOError: raise
+    except:
+      FailType = sys.exc_info()[1]
+      Conf['log'](WHERE(True),'ERROR',"Failure type: %s; value: %s" % (sys.exc_info()[0],FailType) )
+      Conf['log'](WHERE(True),'ERROR',"On query: %s" % query)
+      if retry and db_tableColError(str(FailType),query):
+        Conf['log'](WHERE(True),'INFO',"Retry the query")
+        return db_executemany(query,rows,retry=False)
+    return False
+
+# do a query (compatibility interface, string query) on a pool connection
 # returns either True/False or an array of tuples
-def db_query(query,answer):
+# raises IOError on a connection failure or in the pool backoff time: does not wait
+def db_query(query,answer,retry=True):
     """ communicate in sql to database """
-    global Conf, Retry
-    if Conf['fd'] == None and not db_connect():
-        Conf['log'](WHERE(True),'FATAL','Unable to connect to DB')
-        exit(1)
+    global Conf
     # testCnt = 0 # just for testing connectivity failures
     # if testCnt > 0: raise IOError
     Conf['log'](WHERE(True),'DEBUG',"MySQL query: %s" % query)
-    try:
-        c = Conf['fd'].cursor()
-        c.execute (query)
-        if answer:
-            return c.fetchall()     
-        else:
-            Conf['fd'].commit()
-    except IOError:
-        Conf['fd'].close; Conf['fd'] = None; Conf['waitCnt'] += 1
-        db_connect()
-    except mysql.connector.Error as err:
-        if err.errno == 2006: # try to reconnect
-          try:
-            Conf['fd'].close; Conf['fd'] = None; Conf['waitCnt'] += 1
-            if not db_connect(): raise IOError("Connection broke down.")
-          except:
-            Conf['log'](WHERE(True),'FATAL','Failed to reconnect to MySQL DB.')
-            # raise IOError("Connection broke down.")
-            return False
-        else:
-          FailType = sys.exc_info()[1]
-          Conf['log'](WHERE(True),'ERROR',"Failure type: %s; value: %s" % (sys.exc_info()[0],FailType) )
-          if str(FailType).find('onnection not avail') > 0:
-              Conf['log'](WHERE(True),'ERROR','Retry to connect with DB')
-              Conf['fd'].close; Conf['fd'] = None; Conf['waitCnt'] += 1
-              if not db_connect(): raise IOError("Connection broke down.")
-          else:
-              Conf['log'](WHERE(True),'ERROR',"On query: %s" % query)
-              db_tableColError(FailType,query)  # maybe we can correct this
-        if Retry:
-            return False
-        Retry = True
-        Conf['log'](WHERE(True),'INFO',"Retry the query")
-        if db_query(query,answer):
-            Retry = False
-            return True
-        Conf['log'](WHERE(True),'ERROR','Failed to redo query.')
-        return False
+    try: return _db_execute(query,None,answer)
+    except IOError: raise          # caller may buffer or spool, pool reconnects
     except:
         FailType = sys.exc_info()[1]
         Conf['log'](WHERE(True),'ERROR',"Failure type: %s; value: %s" % (sys.exc_info()[0],FailType) )
         Conf['log'](WHERE(True),'ERROR',"On query: %s" % query)
-        return False
-    return True
+        if not retry or not db_tableColError(str(FailType),query):  # maybe we can correct this
+          return False
+    Conf['log'](WHERE(True),'INFO',"Retry the query")
+    rts = db_query(query,answer,retry=False)
+    if not rts: Conf['log'](WHERE(True),'ERROR','Failed to redo query.')
+    return rts
+
+# names of tables in the database with one information_schema query
+# iso a SHOW TABLES query per table. Returns set of names, None on error
+def db_tables(like=None):
+    """ tables in the database """
+    query = "SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s"
+    params = (Conf['database'],)
+    if like:
+      query += " AND TABLE_NAME LIKE %s"; params += (like,)
+    rows = db_execute(query,params,True)
+    if rows == False and type(rows) is bool: return None
+    return set([str(r[0]) for r in rows])
+
+# latest datum (unix timestamp) of measurement tables: one UNION ALL query
+# per chunk of tables iso a query per table. Returns dict table: timestamp
+def db_lastseen(tables,column='datum',chunk=100):
+    """ last time a measurement was stored per table """
+    rts = {}; tables = list(tables)
+    for strt in range(0,len(tables),chunk):
+      part = tables[strt:strt+chunk]
+      rows = db_query(' UNION ALL '.join(["SELECT '%s', UNIX_TIMESTAMP(MAX(%s)) FROM %s" % (tbl,column,tbl) for tbl in part]),True,retry=False)
+      if rows == False and type(rows) is bool:
+        if len(part) == 1: continue
+        rts.update(db_lastseen(part,column=column,chunk=1))  # find the failing one
+        continue
+      for tbl, datum in rows:
+        if datum: rts[str(tbl)] = int(datum)
+    return rts
 
 def CreateLoRaTable(table):
     if not db_query("""CREATE TABLE %s (
@@ -383,9 +546,6 @@ def TableColumns(table):
 # get a field/column value from a table. Fields maybe (prefeable) be a list
 def getNodeFields(id,fields,table='Sensors',project=None,serial=None):
     global Conf
-    if Conf['fd'] == None and not db_connect():
-        Conf['log'](WHERE(True),'FATAL','Unable to connect to DB')
-        exit(1)
     if project and serial:
         try:
             if table == 'Sensors':
@@ -501,8 +661,61 @@ def db_table(table,create=True):
     Conf[table] = True
     return Conf[table]
 
+# startup scan of latest measurement per kit: SHOW TABLES and a query per
+# kit table vs. one information_schema query and UNION ALL chunks of tables.
+# SQLite stand-in for MySQL, latency: simulated msecs round trip per query
+def Bench(kits=1000, latency=0.3, records=10):
+    global _db_execute, Conf
+    import sqlite3, tempfile
+    dbdir = tempfile.mkdtemp(); dbfile = os.path.join(dbdir,'bench.db')
+    fd = sqlite3.connect(dbfile, check_same_thread=False)
+    fd.execute("CREATE TABLE Sensors (project VARCHAR(16), serial VARCHAR(16), active BOOL, datum INT)")
+    now = int(time())
+    for kit in range(kits):
+      fd.execute("INSERT INTO Sensors VALUES ('BENCH', '%012x', 1, %d)" % (kit,now))
+      if kit % 10 == 9: continue     # kit without measurements table
+      fd.execute("CREATE TABLE BENCH_%012x (datum INT UNIQUE, sensors VARCHAR(64), pm10 DECIMAL)" % kit)
+      fd.executemany("INSERT INTO BENCH_%012x VALUES (?, 'SDS011', 1.0)" % kit,
+          [(now-kit*60-i*300,) for i in range(records)])
+    fd.commit()
+    Queries = [0]
+    def SQLite(query,params=None,answer=False,many=False):  # MySQL dialect -> SQLite
+      Queries[0] += 1; sleep(latency/1000.0)
+      query = re.sub(r'UNIX_TIMESTAMP\(([^()]*(\([^()]*\))?)\)',r'\1',query)
+      query = re.sub(r"SHOW TABLES like ('[^']*')",r"SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE \1",query,flags=re.I)
+      if query.find('information_schema.TABLES') > 0:
+        query = "SELECT name FROM sqlite_master WHERE type = 'table'"; params = None
+      rows = fd.execute(query.replace('%s','?'),params if params else ()).fetchall()
+      return rows if answer else True
+    _db_execute = SQLite; Conf['fd'] = True
+
+    kitTbls = db_query("SELECT DISTINCT project, serial FROM Sensors WHERE active ORDER BY datum DESC",True)
+    start = time(); Queries[0] = 0; old = {}
+    for kit in kitTbls:      # per kit queries as done before
+      tbl = db_query("SHOW TABLES like '%s_%s'" % (kit[0],kit[1]), True)
+      if not len(tbl) or not len(tbl[0]): continue
+      datum = db_query("SELECT UNIX_TIMESTAMP(datum) FROM %s_%s ORDER BY datum DESC LIMIT 1" % (kit[0],kit[1]), True)
+      if datum[0][0]: old['%s_%s' % kit] = int(datum[0][0])
+    perkit = (time()-start, Queries[0])
+    start = time(); Queries[0] = 0
+    tables = db_tables()
+    new = db_lastseen([tbl for tbl in ['%s_%s' % kit for kit in kitTbls] if tbl in tables])
+    chunked = (time()-start, Queries[0])
+    fd.close(); os.remove(dbfile); os.rmdir(dbdir)
+    assert old == new, "different last seen results"
+    print("%d kits, %d measurement tables, %.1f msecs simulated latency per query:" % (kits,len(new),latency))
+    print("    SHOW TABLES and query per kit: %7.3f secs, %5d queries" % perkit)
+    print("    information_schema and chunks: %7.3f secs, %5d queries (%.1f times faster)" % (chunked[0],chunked[1],perkit[0]/max(chunked[0],0.000001)))
+
 # test main loop. Will create tables Sensors, SensorTypes, TTNtable if needed.
 if __name__ == '__main__':
+    if 'bench' in sys.argv[1:]:
+      args = { 'kits': 1000, 'latency': 0.3, 'records': 10 }
+      for arg in sys.argv[1:]:
+        if arg.find('=') > 0 and arg.split('=')[0] in args.keys(): args[arg.split('=')[0]] = type(args[arg.split('=')[0]])(arg.split('=')[1])
+      Conf['log'] = lambda *args: None
+      Bench(**args)
+      exit(0)
     from time import sleep
     Conf['hostname'] = 'localhost'         # host InFlux server
     Conf['database'] = 'luchtmetingen'     # the MySql db for test usage, must exists
@@ -22,12 +22,12 @@ __license__ = 'RPL-1.5'
 
 __modulename__='$RCSfile: MyGPS.py,v $'[10:-4]
 __version__ = "0." + "$Revision: 1.11 $"[11:-2]
-import inspect
+import sys
 def WHERE(fie=False):
    global __modulename__, __version__
    if fie:
      try:
-       return "%s V%s/%s" % (__modulename__ ,__version__,inspect.stack()[1][3])
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
      except: pass
    return "%s V%s" % (__modulename__ ,__version__)
 
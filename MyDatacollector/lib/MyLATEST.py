@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Contact Teus Hagen webmaster@behouddeparel.nl to report improvements and bugs
+#
+# Copyright (C) 2022, Behoud de Parel, Teus Hagen, the Netherlands
+# Open Source Initiative  https://opensource.org/licenses/RPL-1.5
+#
+#   Unless explicitly acquired and licensed from Licensor under another
+#   license, the contents of this file are subject to the Reciprocal Public
+#   License ("RPL") Version 1.5, or subsequent versions as allowed by the RPL,
+#   and You may not copy or use this file in either source code or executable
+#   form, except in compliance with the terms and conditions of the RPL.
+#
+#   All software distributed under the RPL is provided strictly on an "AS
+#   IS" basis, WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESS OR IMPLIED, AND
+#   LICENSOR HEREBY DISCLAIMS ALL SUCH WARRANTIES, INCLUDING WITHOUT
+#   LIMITATION, ANY WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#   PURPOSE, QUIET ENJOYMENT, OR NON-INFRINGEMENT. See the RPL for specific
+#   language governing rights and limitations under the RPL.
+__license__ = 'RPL-1.5'
+
+# $Id: MyLATEST.py,v 1.1 2022/03/27 14:21:09 teus Exp teus $
+
+""" Latest measurement per kit, output channel next to MyARCHIVE.
+    One row per kit in the table Conf['table'] (LatestMeasurements): datum of
+    last measurement, last valid value per field (as archived, JSON
+    { field: [value, unix timestamp] }) and best gateway with rssi/snr.
+    The rows are kept in memory (loaded from the table on first use) and
+    a changed kit row is upserted at most once per Conf['interval'] secs.
+    A failed load is retried at most once per Conf['interval'] secs.
+    Status lookups (DeadKits, kit cache last seen, dashboards) use
+    Lookup(kit) or LastSeen() from memory iso a query per measurements table.
+    Command line:
+        test [kits=N] [records=N] streams records into a SQLite stand-in DB,
+            compares table, memory and per table ORDER BY datum DESC lookups.
+"""
+__modulename__='$RCSfile: MyLATEST.py,v $'[10:-4]
+__version__ = "0." + "$Revision: 1.1 $"[11:-2]
+import sys
+def WHERE(fie=False):
+   global __modulename__, __version__
+   if fie:
+     try:
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
+     except: pass
+   return "%s V%s" % (__modulename__ ,__version__)
+
+try:
+    import sys
+    if sys.version_info[0] >= 3: unicode = str
+    import os
+    import datetime
+    from time import time, sleep
+    import re
+    import json
+    try: from collections.abc import Mapping  # data record may be a read only view
+    except ImportError: from collections import Mapping
+    import threading
+    try: from lib import MyARCHIVE
+    except: import MyARCHIVE
+except ImportError as e:
+    sys.exit("FATAL: One of the import modules not found: %s"% e)
+
+# configurable options
+__options__ = ['output','DB','log','level','DEBUG','interval','table']
+
+Conf = {
+    'output': False,     # output to latest measurements table
+    'DB': None,          # measurements database module to be used
+    'log': None,         # MyLogger log routine
+    'level': None,       # MyLogger log level, default INFO
+    'DEBUG': False,      # Debugging info
+    'interval': 60,      # min secs between updates of a kit row
+    'table': 'LatestMeasurements', # one row per kit
+    'STOP': None,        # write changed kit rows on exit
+}
+
+Columns = ['kit','datum','measurements','gateway','rssi','snr','gateways']
+Location = set(['longitude','latitude'])   # kit location is geohash
+
+# in memory copy of the table: { kit: { 'timestamp': unix, 'values': { field: [value, unix] },
+#     'gateway': best gateway id, 'rssi', 'snr', 'gateways': nr of gateways } }
+Latest = {}
+Dirty = {}                      # kit: changed since last write
+Written = {}                    # kit: time of last write
+Loaded = False
+Reload = 0                      # no load of the table before this time after a failure
+Lock = threading.RLock()        # copy is shared by publish, lookups and flusher thread
+FlushLock = threading.RLock()
+Flusher = None                  # thread to write changed kit rows
+ErrorCnt = 0
+
+# create latest measurements table if not existing
+def Table():
+    global Conf
+    if Conf.get('created') == Conf['table']: return True
+    if not Conf['DB'].db_query("""CREATE TABLE IF NOT EXISTS %s (
+            id TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+                COMMENT 'date/time latest change',
+            kit varchar(40) NOT NULL COMMENT 'measurements table PROJECT_SERIAL',
+            datum datetime DEFAULT NULL COMMENT 'last measurement, local time',
+            measurements text DEFAULT NULL COMMENT 'JSON last valid value per field: [value, unix timestamp]',
+            gateway varchar(64) DEFAULT NULL COMMENT 'best LoRa gateway',
+            rssi decimal(5,1) DEFAULT NULL COMMENT 'last rssi of best gateway',
+            snr decimal(5,1) DEFAULT NULL COMMENT 'last snr of best gateway',
+            gateways int(11) DEFAULT 0 COMMENT 'nr of gateways seen',
+            PRIMARY KEY (kit)
+            ) ENGINE=InnoDB DEFAULT CHARSET=latin1
+            COMMENT='latest measurement per kit'""" % Conf['table'], False):
+      Conf['log'](WHERE(True),'ERROR',"Unable to create table %s" % Conf['table'])
+      return False
+    Conf['created'] = Conf['table']
+    return True
+
+def UpsertQuery(table):
+    return "INSERT INTO %s (%s) VALUES (%s) ON DUPLICATE KEY UPDATE %s" % (table,','.join(Columns),','.join(['%s']*len(Columns)),','.join(['%s=VALUES(%s)' % (a,a) for a in Columns[1:]]))
+
+# load table into memory once, newer in memory rows are kept
+# after a failure the load is retried at most once per interval secs
+def Load():
+    global Conf, Latest, Loaded, Reload
+    if Loaded: return True
+    if time() < Reload: return False
+    with Lock:
+      if Loaded: return True
+      if time() < Reload: return False
+      Reload = time()+max(Conf['interval'],1)
+      try:
+        if not Table(): return False
+        rows = Conf['DB'].db_query("SELECT kit, UNIX_TIMESTAMP(datum), measurements, gateway, rssi, snr, gateways FROM %s" % Conf['table'], True)
+        if rows == False and type(rows) is bool: raise IOError("query error")
+      except Exception as e:
+        Conf['log'](WHERE(True),'ERROR',"Unable to load table %s: %s" % (Conf['table'],str(e)))
+        return False
+      for row in (rows if rows else []):
+        if not row[1] or (row[0] in Latest and Latest[row[0]]['timestamp'] >= int(row[1])): continue
+        try: values = json.loads(row[2]) if row[2] else {}
+        except: values = {}
+        Latest[str(row[0])] = { 'timestamp': int(row[1]), 'values': values, 'gateway': row[3],
+            'rssi': float(row[4]) if row[4] != None else None,
+            'snr': float(row[5]) if row[5] != None else None, 'gateways': row[6] }
+      Loaded = True
+      Conf['log'](WHERE(),'INFO',"Loaded %d kits from table %s" % (len(rows) if rows else 0,Conf['table']))
+    return True
+
+# latest measurement of a kit (copy), None if not known
+def Lookup(kit):
+    Load()
+    with Lock:
+      try: one = Latest[kit]
+      except KeyError: return None
+      one = dict(one); one['values'] = dict(one['values'])
+    return one
+
+# last seen (unix timestamp) of a kit, or of all kits as dict
+def LastSeen(kit=None):
+    Load()
+    with Lock:
+      if kit == None: return dict([(a,b['timestamp']) for a, b in Latest.items()])
+      try: return Latest[kit]['timestamp']
+      except KeyError: return None
+
+# entry point to update latest measurement of a kit
+# returns True: OK, string: reason not updated
+def publish(**args):
+    global Conf, Latest, Dirty, Flusher
+    try:
+      info = args['info']; data = args['data']; artifacts = args['artifacts']
+    except: return "Error in publish() arguments"
+    if not 'Forward data' in artifacts: return "Not forwarded"
+    try: timestamp = int(data['timestamp'])
+    except: return "No timestamp"
+    if 'data' in data.keys() and isinstance(data['data'],Mapping) and len(data['data']):
+      data = data['data']
+    else: return "No data"
+    try: kit = info['DATAid'] if info['DATAid'] else info['id']['project']+'_'+info['id']['serial']
+    except: return "No kit table name"
+    Load()
+    valid = MyARCHIVE.ValidKit(info)
+    if valid:
+      if type(MyARCHIVE.Conf['omit']) in [str,unicode]: MyARCHIVE.Conf['omit'] = re.compile(MyARCHIVE.Conf['omit'])
+      if not MyARCHIVE.Conf['DB']: MyARCHIVE.Conf['DB'] = Conf['DB']  # archive calibration
+    with Lock:
+      one = Latest.get(kit)
+      if one and one['timestamp'] >= timestamp: return "Not the latest measurement"
+      if not one:
+        one = Latest[kit] = { 'timestamp': timestamp, 'values': {}, 'gateway': None, 'rssi': None, 'snr': None, 'gateways': 0 }
+      one['timestamp'] = timestamp
+      if valid:
+        plan = MyARCHIVE.CalPlan(info); seen = set()
+        for sensor, values in data.items():   # ('BME680', [(u'rv', 69.3, ...),...])
+          if not type(values) in [list,tuple]: continue
+          for value in values:
+            try:
+              field = value[0]
+              if field in seen or field in Location: continue   # first value of a field is archived
+              seen.add(field)
+              if value[1] == None or not Conf['DB'].SupportedFields.match(field): continue
+              if type(value[1]) in [str,unicode]:
+                if field == 'geohash': one['values'][field] = [value[1],timestamp]
+                continue
+              if not type(value[1]) in [int,float] or MyARCHIVE.Conf['omit'].match(field): continue
+              if type(value[1]) is bool: one['values'][field] = [1 if value[1] else 0,timestamp]
+              else: one['values'][field] = [MyARCHIVE.Calibrated(plan,field,value[1],value[2:]),timestamp]
+            except: continue
+      try:  # best gateway first: [gwID, [rssi,min,max], [snr,min,max][,geohash]]
+        if info['gtw']:
+          one['gateway'] = info['gtw'][0][0]
+          one['rssi'] = info['gtw'][0][1][0]; one['snr'] = info['gtw'][0][2][0]
+          one['gateways'] = len(info['gtw'])
+      except: pass
+      Dirty[kit] = True
+    if Flusher == None:
+      Flusher = threading.Thread(target=FlushOnInterval, name='LatestFlusher')
+      Flusher.daemon = True
+      Flusher.start()
+    if ErrorCnt > 10: raise ValueError("ERROR %d: DB latest measurements problems" % ErrorCnt)
+    return True
+
+# flusher thread: write changed kit rows not written during last interval
+def FlushOnInterval():
+    global Conf
+    while True:
+      sleep(max(min(Conf['interval'],10),1))
+      try: Flush()
+      except Exception as e:
+        Conf['log'](WHERE(True),'ERROR',"Update of latest measurements failed: %s" % str(e))
+
+# one multi-row upsert of changed kits, not written since interval secs
+# all: all changed kits. Returns nr of written kit rows
+def Flush(all=False, now=None):
+    global Conf, Dirty, Written, ErrorCnt
+    if now == None: now = time()
+    with FlushLock:
+      with Lock:
+        kits = [a for a in Dirty.keys() if all or Written.get(a,0)+Conf['interval'] <= now]
+        rows = []
+        for kit in kits:
+          one = Latest[kit]; del Dirty[kit]
+          rows.append((kit,datetime.datetime.fromtimestamp(one['timestamp']).strftime('%Y-%m-%d %H:%M:%S'),
+              json.dumps(one['values'],sort_keys=True),one['gateway'],one['rssi'],one['snr'],one['gateways']))
+      if not rows: return 0
+      try:
+        if not Table(): raise IOError("No table %s" % Conf['table'])
+        if Conf['DB'].db_executemany(UpsertQuery(Conf['table']),rows):
+          ErrorCnt = 0
+          with Lock:
+            for kit in kits: Written[kit] = now
+          return len(rows)
+      except IOError: # write again on retry
+        with Lock:
+          for kit in kits: Dirty[kit] = True
+        ErrorCnt += 1
+        Conf['log'](WHERE(True),'ERROR',"DB connection error: latest measurements kept in memory")
+        raise IOError("DB connection error")
+      ErrorCnt += 1
+      Conf['log'](WHERE(True),'ERROR',"Failed to update %d kits in table %s" % (len(rows),Conf['table']))
+    return 0
+
+# on exit: write all changed kit rows
+def FlushAll():
+    try: return Flush(all=True)
+    except Exception as e:
+      Conf['log'](WHERE(True),'ERROR',"Latest measurements are not updated: %s" % str(e))
+    return False
+Conf['STOP'] = FlushAll
+
+# test: records of kits every 5 minutes, flush on simulated clock with interval,
+# compare table with memory, reload from table, lookups vs query per measurements table
+# uses SQLite (file) as stand-in for MySQL
+def Test(kits=100, records=50):
+    global Conf, Flusher, Latest, Dirty, Written, Loaded, Reload
+    import sqlite3, tempfile, random, MyDB
+    class SQLiteDB(object):   # stand-in for MyDB with measurements tables in SQLite DB file
+      SupportedFields = MyDB.SupportedFields
+      Sensor_fields = MyDB.Sensor_fields
+      getFieldInfo = staticmethod(MyDB.getFieldInfo)
+      def __init__(self, fields):
+        self.dir = tempfile.mkdtemp(); self.queries = 0
+        self.fd = sqlite3.connect(os.path.join(self.dir,'test.db'), check_same_thread=False)
+        for kit in range(kits):
+          self.fd.execute("CREATE TABLE TEST_%d (datum DATETIME UNIQUE, sensors VARCHAR(64), %s)" % (kit,','.join(['%s DECIMAL, %s_valid BOOL' % (f,f) for f in fields])))
+        self.fd.commit(); self.lock = threading.RLock()
+      def SQL(self, query):
+        query = query.replace('FROM_UNIXTIME(%s)',"datetime(%s,'unixepoch','localtime')")
+        query = query.replace('%s','?').replace(' ENGINE=InnoDB DEFAULT CHARSET=latin1','')
+        query = re.sub(r" COMMENT(=| )'[^']*'", '', query).replace(' ON UPDATE CURRENT_TIMESTAMP','')
+        query = re.sub(r"UNIX_TIMESTAMP\((\w+)\)", r"CAST(strftime('%s',\1,'utc') AS INTEGER)", query)
+        if query.find(' ON DUPLICATE KEY UPDATE ') > 0:
+          insert, update = query.split(' ON DUPLICATE KEY UPDATE ')
+          if insert.find('INSERT INTO TEST_') == 0:  # archive
+            return insert.replace('INSERT INTO','INSERT OR REPLACE INTO')
+          query = insert + ' ON CONFLICT(kit) DO UPDATE SET ' + re.sub(r"VALUES\((\w+)\)", r"excluded.\1", update)
+        return query
+      def db_query(self, query, answer):
+        with self.lock:
+          self.queries += 1
+          rows = self.fd.execute(self.SQL(query)).fetchall()
+          self.fd.commit()
+        return rows if answer else True
+      def db_executemany(self, query, rows):
+        with self.lock:
+          self.queries += 1
+          self.fd.executemany(self.SQL(query), [[(str(v) if isinstance(v,datetime.datetime) else v) for v in r] for r in rows])
+          self.fd.commit()
+        return True
+
+    fields = ['temp','rv','luchtdruk','pm10','pm25']
+    log = lambda *args: sys.stderr.write("%s %s: %s\n" % args) if args[1] in ['ERROR','CRITICAL'] else None
+    DB = SQLiteDB(fields)
+    for module in [MyARCHIVE.Conf, Conf]:
+      module.update({ 'DB': DB, 'log': log, 'output': True, 'DEBUG': False })
+    MyARCHIVE.Conf['rows'] = 100; MyARCHIVE.Conf['age'] = 24*60*60
+    Flusher = False   # no flusher thread: flush on simulated clock
+    start = int(time()) - records*5*60; random.seed(1)
+    infos = [{ 'id': {'project': 'TEST', 'serial': str(kit)}, 'DATAid': 'TEST_%d' % kit, 'valid': 1, 'active': 1,
+              'fields': set(fields), 'unknown_fields': set([]), 'sensors': [],
+              'gtw': [['eui-%04d' % (kit%7), [-90-kit%20,-110,-80], [7.5,-2.0,9.5]]] } for kit in range(kits)]
+    DB.queries = 0; writes = 0; errors = 0
+    for rec in range(records):
+      now = start+rec*5*60
+      for kit in range(kits):
+        infos[kit]['valid'] = None if kit == 0 and rec >= records//2 else 1  # kit 0 in repair
+        record = { 'timestamp': now+kit%300, 'data': {
+              'BME280': [('temp',round(random.uniform(-5,30),2)),('rv',round(random.uniform(30,100),1)),('luchtdruk',random.randint(990,1030))],
+              'SDS011': [('pm10',round(random.uniform(0,80),2)),('pm25',round(random.uniform(0,40),2))] } }
+        MyARCHIVE.publish(info=infos[kit], artifacts=['Forward data'], data=record)
+        publish(info=infos[kit], artifacts=['Forward data'], data=record)
+        publish(info=infos[kit], artifacts=['Forward data'], data=record)  # replay is skipped
+      writes += Flush(now=now)
+      Conf['interval'] = 15*60  # coalesce: max one write per 15 minutes per kit
+    MyARCHIVE.Flush(); writes += Flush(all=True)
+    print("%d records of %d kits: %d kit row writes, %d queries (incl. archive)" % (records*kits,kits,writes,DB.queries))
+
+    # table, memory and raw tables should be equal
+    memory = dict([(a,dict(b)) for a, b in Latest.items()])
+    Latest = {}; Dirty = {}; Written = {}; Loaded = False
+    query = DB.db_query   # DB is down on load: one load attempt per interval
+    def Down(query, answer):
+      DB.queries += 1; raise IOError("DB connection error")
+    DB.db_query = Down; DB.queries = 0; Conf['log'] = lambda *args: None
+    for kit in range(kits): LastSeen('TEST_%d' % kit)
+    if DB.queries > 1:
+      errors += 1; print("DIFFERENCE failed load is retried on every lookup: %d queries" % DB.queries)
+    DB.db_query = query; Conf['log'] = log; Reload = 0
+    DB.queries = 0; timing = time()
+    lastseen = LastSeen()
+    loaded = (time()-timing, DB.queries)
+    for kit, one in memory.items():
+      if Lookup(kit) != one:
+        errors += 1; print("DIFFERENCE %s: %s != %s" % (kit,str(Lookup(kit)),str(one)))
+    if memory['TEST_0']['values']['temp'][1] >= memory['TEST_1']['values']['temp'][1]:
+      errors += 1; print("DIFFERENCE TEST_0 invalid values are used as latest")
+    DB.queries = 0; timing = time()
+    raw = {}
+    for kit in range(kits):
+      row = DB.db_query("SELECT UNIX_TIMESTAMP(datum), temp FROM TEST_%d ORDER BY datum DESC LIMIT 1" % kit, True)[0]
+      raw['TEST_%d' % kit] = int(row[0])
+      if kit and float(row[1]) != memory['TEST_%d' % kit]['values']['temp'][0]:
+        errors += 1; print("DIFFERENCE TEST_%d temp: %s != %s" % (kit,row[1],memory['TEST_%d' % kit]['values']['temp']))
+    perkit = (time()-timing, DB.queries)
+    if raw != lastseen:
+      errors += 1; print("DIFFERENCE last seen of table %s and measurement tables" % Conf['table'])
+    timing = time()
+    for kit in range(kits): LastSeen('TEST_%d' % kit)
+    print("last seen of %d kits: ORDER BY datum DESC LIMIT 1 per table %.4f secs, %d queries" % (kits,perkit[0],perkit[1]))
+    print("    %s loaded %.4f secs, %d queries, lookups from memory %.4f secs" % (Conf['table'],loaded[0],loaded[1],time()-timing))
+    print("    e.g. %s" % str(sorted(memory.items())[1]))
+    print("%d differences" % errors)
+    return errors
+
+# test main loop
+if __name__ == '__main__':
+    if 'test' in sys.argv[1:]:
+      args = { 'kits': 100, 'records': 50 }
+      for arg in sys.argv[1:]:
+        if arg.find('=') > 0 and arg.split('=')[0] in args.keys(): args[arg.split('=')[0]] = int(arg.split('=')[1])
+      errors = Test(**args)
+      sys.stdout.flush()
+      os._exit(1 if errors else 0)
+    print("Usage: %s test [kits=N] [records=N]" % sys.argv[0])
+    exit(1)
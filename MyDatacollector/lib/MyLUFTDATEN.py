@@ -33,12 +33,12 @@ __license__ = 'RPL-1.5'
 __modulename__='$RCSfile: MyLUFTDATEN.py,v $'[10:-4]
 __version__ = "0." + "$Revision: 4.7 $"[11:-2]
 import re
-import inspect
+import sys
 def WHERE(fie=False):
    global __modulename__, __version__
    if fie:
      try:
-       return "%s V%s/%s" % (__modulename__ ,__version__,inspect.stack()[1][3])
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
      except: pass
    return "%s V%s" % (__modulename__ ,__version__)
 
@@ -308,6 +308,14 @@ def PostError(key,cause,timeout=None):
 #     }
 #######
 
+# keep-alive HTTP session per host: reuse connection iso connect per POST
+Sessions = {}
+def getSession(host):
+    global Sessions
+    if not host in Sessions.keys():
+      Sessions[host] = requests.Session()
+    return Sessions[host]
+
 # to each element of array of POST URL's, 
 #    POST all posting elements tuple of type, header dict and data dict
 def post2Community(postTo,postings,ID):
@@ -360,7 +368,7 @@ def post2Community(postTo,postings,ID):
         else:
           try:
             prev = watchOn(host)
-            r = requests.post(url, json=data[1], headers=data[0], timeout=timeout)
+            r = getSession(host).post(url, json=data[1], headers=data[0], timeout=timeout)
             Conf['log'](WHERE(True),'DEBUG','Post %s returned status: %d' % (host,r.status_code))
             #if not r.ok:
             #  sys.stderr.write("Luftdaten %s POST to %s:\n" % (ID,url))
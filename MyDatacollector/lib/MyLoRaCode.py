@@ -23,12 +23,12 @@ __version__ = "0." + "$Revision: 2.15 $"[11:-2]
 import sys
 if sys.version_info[0] >= 3: unicode = str
 
-import inspect
+import sys
 def WHERE(fie=False):
    global __modulename__, __version__
    if fie:
      try:
-       return "%s V%s/%s" % (__modulename__ ,__version__,inspect.stack()[1][3])
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
      except: pass
    return "%s V%s" % (__modulename__ ,__version__)
 
@@ -159,6 +159,8 @@ def WHERE(fie=False):
 #                     LoRaCoding.Decode(): decode the LoRa base64 payload
 
 import base64
+import struct
+import re
 from time import time
 
 # uses python geohash lib, try to correct lat/long swap
@@ -167,7 +169,7 @@ try: from lib.MyGPS import convert2geohash
 except: from MyGPS import convert2geohash
 
 ############################ LoRaCoding ##############
-class LoRaCoding:
+class LoRaCoding(object):
     def __init__(self, LoRaCodeRules=None, DefaultUnits = ['%','C','hPa','mm/h','degrees', 'sec','m','Kohm','ug/m3','pcs/m3','m/sec'], PortMap=None, logger=None):
       # arguments:
       # LoRaCodeRules: a dictionary with coding rules, default: use defualt rule set
@@ -277,7 +279,7 @@ class LoRaCoding:
           ]
       }
       if (not type(LoRaCodeRules) is dict) or not len(LoRaCodeRules):
-          raise valueError("Fatal error: LoRa Decode rules")
+          raise ValueError("Fatal error: LoRa Decode rules")
       self.LoRaCodeRules = LoRaCodeRules
       # default vaule units, omit those in data records
       if not type(DefaultUnits) is list:
@@ -299,6 +301,24 @@ class LoRaCoding:
         try: self.logger('LoRaCoding',pri,message)
         except: sys.stderr.write("LoRaCoding %s: %s\n" % (str(pri), message))
 
+    # compiled decode plans are cleared on a change of coding rules or default units
+    # on a change in place of a rules list call ClearPlans()
+    @property
+    def LoRaCodeRules(self): return self._LoRaCodeRules
+    @LoRaCodeRules.setter
+    def LoRaCodeRules(self, rules):
+        self._LoRaCodeRules = rules; self.ClearPlans()
+
+    @property
+    def DefaultUnits(self): return self._DefaultUnits
+    @DefaultUnits.setter
+    def DefaultUnits(self, units):
+        self._DefaultUnits = units; self.ClearPlans()
+
+    def ClearPlans(self):
+        self.Plans = {}    # product ID: (rules list, endian, {sensor ID: plan})
+        self.Structs = {}  # variable length pack string: struct.Struct
+
     # search in format array row type sensor ID, return tuple IDnr, IDname, array compressie
     # eg self.GetFrmt(LoRaCode['weerDIY1'],'BME280')
     def GetFrm(self, format, tpe, indx=1 ):
@@ -330,7 +350,7 @@ class LoRaCoding:
     # return a tuple with pack and value
     def CompElmnt(self, format, type, sensor, value):
         if not format in self.LoRaCodeRules.keys(): 
-            raise valueError("Unknown encoding format: %s" % format)
+            raise ValueError("Unknown encoding format: %s" % format)
         try:
             frmmt = self.GetFrmt( format, type )
             for item in frmmt[2]:
@@ -428,21 +448,136 @@ class LoRaCoding:
           else: decoded = [x for x in decoded]
         return decoded
 
+    # compile decode plan of rules row [ID, sensor name, [[field, pack, NaN, Taylor, unit],...]]
+    # plan: (sensor name, struct.Struct or None on variable length, pack string, field plans, rules fields)
+    # field plan: (values index, field name, NaN, Taylor, round type, unit or None, value names or None)
+    # round type: 1 ordinates 7 decimals, 2 int, 0 one decimal, None: incomplete field definition
+    FixedPack = re.compile(r'^([0-9]*[bcs?hilfdq])*$', re.I)
+    def CompilePlan(self, item, endian):
+        pck = ''; fields = []
+        for j in range(len(item[2])):
+          fld = item[2][j]
+          pck += fld[1]
+          if fld[0] in ['unknown',None]: continue
+          if len(fld) < 5:
+            fields.append((j,fld[0],None,None,None,None,None)); continue
+          if type(fld[4]) is list:
+            fields.append((j,fld[0],None,None,0,None,fld[4])); continue
+          rnd = 0
+          if fld[0][:3] in ['lon','lat']: rnd = 1
+          elif fld[0] in ['wr','luchtdruk']: rnd = 2
+          unit = None
+          if fld[4] and (not fld[4] in self.DefaultUnits): unit = fld[4]
+          fields.append((j,fld[0],fld[2],fld[3],rnd,unit,None))
+        packer = None
+        if self.FixedPack.match(pck):
+          try:
+            packer = struct.Struct(endian+pck)
+            if packer.size != self.calcsize(pck,b'')[0]: packer = None
+          except: packer = None
+        return (item[1], packer, pck, tuple(fields), item[2])
+
+    # get (compiled) decode plan for product ID and sensor ID or 'version'
+    ByteID = struct.Struct('B')
+    def GetPlan(self, ProdID, frmt, ID):
+        try:
+          rules, endian, plans = self.Plans[ProdID]
+          if rules is frmt: return plans[ID]
+        except KeyError: pass
+        if ID == 'version': # version plan is always asked first
+          item = self.GetFrm(frmt, 'version')
+          endian = item[0]; plans = {}
+          self.Plans[ProdID] = (frmt, endian, plans)
+          if not type(item[2]) is list:
+            plans[ID] = None; return None
+        else:
+          item = self.GetFrm(frmt, ID, indx=0)
+        plans[ID] = self.CompilePlan(item, endian)
+        return plans[ID]
+
+    # decode payload with compiled decode plans per (product ID, sensor ID)
+    # same result as DecodeRulesPort10or12() which interprets the rules on every payload
     # the micro processor does not have a reliable time provision
     # so we use the timestamps from the nearest LoRaWan gateway
     # some kits will have GPS timestamp available however
     def DecodePort10or12(self,raw,port=12,timestamp=None):
-        import struct
-        import datetime
-        import dateutil.parser as dp
-    
         ProdID = ''
         if type(port) is int:
             try: ProdID = self.PortMap[port][0]
             except: pass
         else: ProdID = port
         if not ProdID in self.LoRaCodeRules.keys():
-            raise valueError("Unknown LoRa payload encoding product ID: %s" % ProdID)
+            raise ValueError("Unknown LoRa payload encoding product ID: %s" % ProdID)
+        frmt = self.LoRaCodeRules[ProdID]
+        PackedData = self.Base64Decode(raw,raw=True)
+        i = -1; data = {}; geohash = None
+        try:
+          while i < len(PackedData):
+            try:
+              if i < 0:
+                i = 0
+                plan = self.GetPlan(ProdID, frmt, 'version')
+                if not plan: continue
+              else: # get decode plan for one sensor
+                plan = self.GetPlan(ProdID, frmt, self.ByteID.unpack_from(PackedData,i)[0])
+                i += 1
+            except Exception as e:
+                self._logger("ERROR","Datagram error for %s on port %s with %s." % (raw,str(port),str(e)))
+                return { 'data': data, }
+            name, packer, pck, fields, rules = plan
+            if packer:
+              values = packer.unpack_from(PackedData,i)
+              i += packer.size
+            else: # variable length
+              (cnt, pck) = self.calcsize(pck, PackedData[i:])
+              pck = self.Plans[ProdID][1]+pck
+              try: packer = self.Structs[pck]
+              except KeyError: packer = self.Structs[pck] = struct.Struct(pck)
+              values = packer.unpack(PackedData[i:i+cnt])
+              i += cnt
+            sensor = None
+            for (j, field, aNAN, taylor, rnd, unit, names) in fields:
+              try:
+                if sensor == None:
+                  if not name in data.keys(): data[name] = {}
+                  sensor = data[name]
+                if names != None: # multiple values
+                  for nr in range(len(values)):
+                    if names[nr] != '?': # not end of variable size string hack
+                      sensor[names[nr]] = values[nr]
+                  continue
+                if rnd == None: raise ValueError("incomplete field definition")
+                value = values[j]
+                if value == aNAN: value = None
+                elif taylor: value = (value-taylor[0])/taylor[1]
+                sensor[field] = value
+                if type(value) is float:  # try to round
+                  if rnd == 1:
+                    geohash = name; value = round(value,7)
+                  elif rnd == 2: value = int(value)
+                  else: value = round(value,1)
+                  sensor[field] = value
+                # default units: do not provide units info
+                if unit and not 'units' in sensor.keys(): sensor[field] = (value,unit)
+              except:
+                self._logger("ERROR","Decode error with sensor ID %d (fields %s, values %s)\n" % (i, str(rules), str(values)))
+        except Exception as e:
+            self._logger("ERROR","Decode error: %s\n" % str(e))
+            return { 'data': data, }
+        return self.DecodeFinish(data, timestamp, geohash)
+
+    # rules interpretation decoder, reference for the compiled decode plans
+    # the micro processor does not have a reliable time provision
+    # so we use the timestamps from the nearest LoRaWan gateway
+    # some kits will have GPS timestamp available however
+    def DecodeRulesPort10or12(self,raw,port=12,timestamp=None):
+        ProdID = ''
+        if type(port) is int:
+            try: ProdID = self.PortMap[port][0]
+            except: pass
+        else: ProdID = port
+        if not ProdID in self.LoRaCodeRules.keys():
+            raise ValueError("Unknown LoRa payload encoding product ID: %s" % ProdID)
         frmt = self.LoRaCodeRules[ProdID]
         # #try: PackedData = base64.b64decode(raw)
         # if type(raw) is list: PackedData = raw
@@ -505,8 +640,13 @@ class LoRaCoding:
         except Exception as e:
             self._logger("ERROR","Decode error: %s\n" % str(e))
             return { 'data': data, }
+        return self.DecodeFinish(data, timestamp, geohash)
+
+    # add timestamp, convert ordinates to geohash, move version info to top level
+    def DecodeFinish(self, data, timestamp, geohash):
         # if defined it is in UTC time
         if type(timestamp) is str:
+          import dateutil.parser as dp
           # sys.stderr.write("Got timestamp: '%s', " % timestamp)
           timestamp = int(dp.parse(timestamp).strftime("%s"))
           # sys.stderr.write("converted to: %d\n" % timestamp)
@@ -881,50 +1021,100 @@ if __name__ == '__main__':
             print("\t%12.12s (example %s) not found in decoded record fields" % (item,str(payld[item]))) 
 
 
-    if len(sys.argv) > 1: # DECODING payload TTN V2 or V3 tests
+    # read TTN MQTT records (json) from files, '-' is stdin
+    def ReadRecords(files):
+        for file in files:
+          if file == '-': fd = sys.stdin # just read from stdin with argument '-'
+          else:
+            try: fd = open(file,'r')
+            except:
+              sys.stderr.write("ERROR: unable to read file %s\n" % file)
+              continue
+          line = ''
+          while(1):
+            readln = fd.readline().strip()
+            if not readln: break
+            if 0 <= readln.find('#') < 10:
+              sys.stderr.write("COMMENT: %s\n" % readln[readln.find("#")+1:])
+              continue
+            elif 0 <= readln.find('//') < 10:
+              sys.stderr.write("COMMENT: %s\n" % readln[readln.find("//")+2:])
+              continue
+            #elif readln.find('[0x') > 0:
+            #  sys.stderr.write("SKIP json does not support hexadecimals:\n\tline %s" % line)
+            #  continue
+            line += readln
+            # simple check if we have a full record
+            if line.count('{') > line.count('}'): continue
+            if 0 <= line.find('{') < 10:
+              line = line[line.find('{'):]
+            elif line.find('up {') > 0:
+              line = line[line.find('up {')+3:]
+            else:
+              sys.stderr.write("WARNING not an MQTT record: skip: %s" % line)
+              continue
+            line = JsonHex2Int(line)
+            try: line = json.loads(line)
+            except Exception as e:
+              sys.stderr.write("JSON ERROR: %s\n" % str(e))
+              sys.stderr.write("ERROR in decoding json string: %s\n" % line)
+              continue
+            yield line
+            line = ''
+          fd.close()
+
+    # replay raw payloads: compiled decode plans should give same result as rules interpretation
+    # usage: MyLoRaCode.py --bench [loops=N] file.mqtt ...
+    def Bench(files, loops=100):
+        from time import time
+        payloads = []
+        for test in ReadRecords(files):
+          try:
+            if "payload_raw" in test.keys(): payloads.append((test["payload_raw"],test["port"]))
+            else: payloads.append((test["uplink_message"]["frm_payload"],test["uplink_message"]["f_port"]))
+          except: pass
+        payloads = [x for x in payloads if type(x[1]) is int and x[1] in [2,3,4,10,12]]
+        if not payloads:
+          sys.stderr.write("No payloads to replay\n"); return False
+        Reference = { 10: Coding.DecodeRulesPort10or12, 12: Coding.DecodeRulesPort10or12 }
+        for payload, port in payloads: # decode plans equal to rules interpretation
+          rslt = Coding.Decode(payload,port=port)
+          if port in Reference.keys(): ref = Reference[port](payload,port=port)
+          else: ref = Coding.Decode(payload,port=port)
+          for one in [rslt,ref]:
+            if 'timestamp' in one.keys(): del one['timestamp']
+          if repr(rslt) != repr(ref):
+            sys.stderr.write("DIFFERENCE port %d payload %s:\n\tplans %s\n\trules %s\n" % (port,str(payload),repr(rslt),repr(ref)))
+            return False
+        print("%d payloads decoded identical with decode plans and rules interpretation" % len(payloads))
+        # rules based ports 10 and 12 alone (decode plans), and all payloads
+        for title, subset in [('ports 10, 12',[x for x in payloads if x[1] in Reference.keys()]),('all ports',payloads)]:
+          if not subset: continue
+          print("  %s:" % title)
+          timings = {}
+          for name in ['rules','plans']:
+            start = time()
+            for _ in range(loops):
+              for payload, port in subset:
+                if name == 'rules' and port in Reference.keys(): Reference[port](payload,port=port)
+                else: Coding.Decode(payload,port=port)
+            timings[name] = time()-start
+            print("    %s: %7.3f secs, %6.1f usecs/payload" % (name,timings[name],timings[name]*1000000.0/(loops*len(subset))))
+          print("    decode plans %.1f times faster (%d payloads, %d loops)" % (timings['rules']/max(timings['plans'],0.000001),len(subset),loops))
+        return True
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--bench':
+      loops = 100; files = []
+      for arg in sys.argv[2:]:
+        if arg.find('loops=') == 0: loops = int(arg[6:])
+        else: files.append(arg)
+      if not Bench(files, loops=loops): exit(1)
+    elif len(sys.argv) > 1: # DECODING payload TTN V2 or V3 tests
       # check with data file input raw paytload from TTN
       import os.path
-      import json
       # DECODING tests
-      for file in sys.argv[1:]:
-        if file == '-': fd = sys.stdin # just read from stdin with argument '-'
-        else:
-          try: fd = open(file,'r')
-          except:
-            sys.stderr.write("ERROR: unable to read file %s\n" % file)
-            continue
-        line = ''
-        while(1):
-          readln = fd.readline().strip()
-          if not readln: break
-          if 0 <= readln.find('#') < 10:
-            sys.stderr.write("COMMENT: %s\n" % readln[readln.find("#")+1:])
-            continue
-          elif 0 <= readln.find('//') < 10:
-            sys.stderr.write("COMMENT: %s\n" % readln[readln.find("//")+2:])
-            continue
-          #elif readln.find('[0x') > 0:
-          #  sys.stderr.write("SKIP json does not support hexadecimals:\n\tline %s" % line)
-          #  continue
-          line += readln
-          # simple check if we have a full record
-          if line.count('{') > line.count('}'): continue
-          if 0 <= line.find('{') < 10:
-            line = line[line.find('{'):]
-          elif line.find('up {') > 0:
-            line = line[line.find('up {')+3:]
-          else:
-            sys.stderr.write("WARNING not an MQTT record: skip: %s" % line)
-            continue
-          line = JsonHex2Int(line)
-          try: line = json.loads(line)
-          except Exception as e:
-            sys.stderr.write("JSON ERROR: %s\n" % str(e))
-            sys.stderr.write("ERROR in decoding json string: %s\n" % line)
-            continue
-          checkRecord(line)
-          line = ''
-        fd.close()
+      for line in ReadRecords(sys.argv[1:]):
+        checkRecord(line)
     else: # ENCODING hardcoded firmware payload encoding tests
       # first encode into a raw payload encoding engine rules
       port = 12
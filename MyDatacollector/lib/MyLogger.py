@@ -24,15 +24,20 @@ __license__ = 'RPL-1.5'
 # TO DO:
 
 """ Push logging to the external world.
+    log() does not wait on output: messages are queued to a print thread (MyPrint)
+    or to a logging QueueListener thread (syslog, file).
+    Identical messages repeated within Conf['repeat'] secs are suppressed and
+    reported as repeated with the next one logged.
 """
 modulename='$RCSfile: MyLogger.py,v $'[10:-4]
 __version__ = "0." + "$Revision: 3.13 $"[11:-2]
 
 import sys
-from time import sleep
+from time import time
+import threading
 
 # configurable options
-__options__ = ['level','file','output','date','print']
+__options__ = ['level','file','output','date','print','repeat']
 
 def stop():
     global Conf
@@ -51,6 +56,7 @@ Conf = {
     'date': True, # prepend with date
     'print': True, # color printing
     'shutdown': [],
+    'repeat': 60,  # secs to suppress identical messages, 0: no suppression
     'STOP': stop
 }
 # ===========================================================================
@@ -69,6 +75,46 @@ CRITICAL = 60
 
 log_levels = ['NOTSET','DEBUG','INFO','ATTENT','WARNING','ERROR','CRITICAL','FATAL']
 log_colors = [16,6,21,4,3,5,9,1]
+# suppress repeated messages: { (name,level,message): [time first logged, suppressed count] }
+Repeated = {}
+RepeatLock = threading.Lock()
+
+# returns False if message is a repetition in last Conf['repeat'] secs,
+# message string with nr of repetitions otherwise
+def Repetition(name,level,message):
+    global Conf, Repeated
+    if not Conf['repeat']: return message
+    now = time(); key = (name,level,message)
+    with RepeatLock:
+      try:
+        seen = Repeated[key]
+        if now - seen[0] < Conf['repeat']:
+          seen[1] += 1; return False
+        if seen[1]: message += ' (repeated %d times)' % seen[1]
+        seen[0] = now; seen[1] = 0
+      except KeyError:
+        if len(Repeated) > 1000: # cleanup of old messages
+          for one in [k for k, v in Repeated.items() if now-v[0] >= Conf['repeat']]:
+            del Repeated[one]
+        Repeated[key] = [now,0]
+    return message
+
+# reset logging output in a forked child process: output threads of parent are gone
+def Forked():
+    global Conf, Repeated, RepeatLock
+    Repeated = {}; RepeatLock = threading.Lock()
+    Conf['shutdown'] = []
+    try:
+      if Conf['fd']:
+        for handler in Conf['fd'].handlers[:]: Conf['fd'].removeHandler(handler)
+        Conf['fd'] = None
+    except: Conf['fd'] = None
+    if not type(Conf['print']) is bool and Conf['print'] != None:
+      try:
+        Conf['print'].Forked()
+        Conf['shutdown'].append(Conf['print'].stop)
+      except: Conf['print'] = True
+
 # TO DO: install remote logging
 def log(name,level,message): # logging to console or log file
     global Conf
@@ -110,6 +156,8 @@ def log(name,level,message): # logging to console or log file
             return False
     except:
         pass
+    message = Repetition(name,level,message)
+    if message == False: return True
     name = name.replace('.py','')
     if name != 'MySense': name = 'MySense ' + name.replace('My','')
     if Conf['fd'] == None and Conf['print'] == None:
@@ -130,10 +178,10 @@ def log(name,level,message): # logging to console or log file
         try:
             # map logger levels: NOTSET,DEBUG,INFO,ATTENT,WARNING,ERROR,CRITICAL,FATAL
             # to syslog levels:  NOTSET,DEBUG,INFO,       WARNING,ERROR,CRITICAL
-            level = log_levels.index(Conf['level'])*10
-            if level == 30: level -= 5
-            elif level > 30: level -= 10
-            Conf['fd'].setLevel(level)
+            lvl = log_levels.index(Conf['level'])*10
+            if lvl == 30: lvl -= 5
+            elif lvl > 30: lvl -= 10
+            Conf['fd'].setLevel(lvl)
         except:
             Conf['fd'].setLevel(logging.WARNING)
         if Conf['date']:
@@ -155,6 +203,17 @@ def log(name,level,message): # logging to console or log file
             log_handle = Conf['file']
             # log_handle = logging.StreamHandler(Conf['file'])
             # log_handle.setFormatter(log_frmt)
+        if not isinstance(log_handle,logging.Handler):
+            log_handle = logging.StreamHandler(log_handle)
+            log_handle.setFormatter(log_frmt)
+        try: # log output via a listener thread
+            import queue
+            records = queue.Queue(-1)
+            listener = logging.handlers.QueueListener(records,log_handle)
+            listener.start()
+            Conf['shutdown'].append(listener.stop)
+            log_handle = logging.handlers.QueueHandler(records)
+        except: pass  # Python 2: log directly via handler
         Conf['fd'].addHandler(log_handle)
     elif type(Conf['print']) is bool:
       if (not 'file' in Conf.keys()) or not Conf['file']:
@@ -185,7 +244,6 @@ def log(name,level,message): # logging to console or log file
     else:
         printc("%s %s: %s" % (name,log_levels[int(level/10)%len(log_levels)], message),log_colors[int(level/10)%len(log_levels)])
         rts = True
-    sleep(0.2)  # give room to print thread
     return rts
     
 def show_error():               # print sys error
@@ -20,13 +20,13 @@
 __license__ = 'RPL-1.5'
 __modulename__='$RCSfile: MyMQTTclient.py,v $'[10:-4]
 __version__ = "0." + "$Revision: 2.58 $"[11:-2]
-import inspect
+import sys
 import random
 def WHERE(fie=False):
    global __modulename__, __version__
    if fie:
      try:
-       return "%s V%s/%s" % (__modulename__ ,__version__,inspect.stack()[1][3])
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
      except: pass
    return "%s V%s" % (__modulename__ ,__version__)
 
@@ -50,7 +50,7 @@ def WHERE(fie=False):
     json/dict internal std format, or
     empty dict for no recort, or None for End of Records/Data.
     Module can be used as library as well CLI
-    MQTT_data(MQTTbrokers,verbose=False,debug=False,logger=None,sec2pol=10)
+    MQTT_data(MQTTbrokers,verbose=False,debug=False,logger=None,sec2pol=10,qsize=100,overflow='drop-newest',cache=None)
     MQTTbrokers: has configuration argument a list [broker, ...] of MQTT brokers:
       broker = {
         "resource": resource,                # Broker address or file name '-' std in
@@ -63,10 +63,20 @@ def WHERE(fie=False):
         "import": TTN2MySense().RecordImport # routine to import record to internal exchange format
       }
     Malfunctioning broker will be deleted from the brokers list.
+    A broker with 'pipe' (multiprocessing queue) receives MQTT messages routed
+    by a supervisor process (MQTT_router) hashed on device ID.
     Use 'resource' as name for input (backup) file, std in, or named pipe.
     Use logging=function as logging function. Keepalive as ping delay.
     Use verbose or debug to enable more verbosity.
-    Use sec2pol is wait time on empty rcrd queue.
+    Use sec2pol is max wait time on empty rcrd queue, GetData() wakes up on arrival.
+    Use qsize as max nr of records in queue between MQTT client threads and GetData().
+    Use overflow as policy on full queue: 'drop-newest' (dflt), 'drop-oldest' or
+    'block' (MQTT client thread waits max 'qtimeout' secs, None is forever).
+    Overflow counters are available via MQTT_data.QueueStats().
+    A broker with 'webhook' (options dict) receives TTN V3 webhook POSTs (MyWebhook.py).
+    Use dedup as dict with UplinkFilter arguments: size (max uplinks), window (secs):
+    the same uplink received via more brokers (e.g. TTN V2 and V3) is decoded and
+    queued once, gateways of duplicates are merged into the queued record.
 
     (test) command line (CLI) arguments:
         verbose=true|false or -v or --verbose. Default False. True if debug is true.
@@ -83,17 +93,32 @@ def WHERE(fie=False):
     to read from the file broker['resource'].
 
     Kit information from Sensors and TTNtable DB will be cached.
-    Show chache on stderr with USR1 signal. Cache entry is cleared after 6 hours.
+    Show chache on stderr with USR1 signal. Cache entry is refreshed after ttl secs.
+    Use cache as dict with KitCache arguments: size (max nr of kits in least
+    recently used cache), ttl (secs, refresh meta info from DB), jitter (ttl
+    is shortened randomly with max jitter fraction, avoids simultaneous refresh),
+    warmup (load all active kits at startup with one DB query).
+    Not registered devices are rejected via a negative cache: unknown (max nr of
+    devices), unknown_ttl (secs). The negative cache is cleared on changes in
+    TTNtable or Sensors tables (polled every regpoll secs). Rejected devices are
+    reported every report secs.
+    Cache counters are available via MQTT_data.CacheStats().
 """
 
 import paho.mqtt.client as mqttClient
 import threading
-import time, datetime
+import time, datetime, calendar
+import zlib
 import re
 import sys
 import json
 import atexit
 import signal
+from collections import deque, OrderedDict
+if sys.version[0] == '2':
+    import Queue
+else:
+    import queue as Queue
 
 #
 # The Things Netwoprk Stack V2 up to 2021-12-31
@@ -307,8 +332,78 @@ import signal
 #   data (sensor types dust/meteo/gps: {field,value}),
 #   meta (dust/meteo/gps [sensors types], geohash geolocation),
 #   net (type=TTNV?,spf, gateways [{gwID,rssi,snr,geohash}]) skip gtw brokers
+# TTN timestamps in UTC to epoch secs (float)
+# fast path for the RFC3339 shapes TTN emits, e.g. 2021-08-20T11:54:20.098754836Z
+# (nanoseconds), 2021-09-29T07:40:00Z, or with +hh:mm offset. Else via dateutil.
+RFC3339 = re.compile(r'^(\d{4})-(\d\d)-(\d\d)[Tt ](\d\d):(\d\d):(\d\d)(\.\d+)?([Zz]|[+-]\d\d:?\d\d)?$')
+def ParseTime(stamp):
+    match = RFC3339.match(stamp)
+    if not match: return ParseTimeDateutil(stamp)
+    fld = match.groups()
+    secs = calendar.timegm((int(fld[0]),int(fld[1]),int(fld[2]),int(fld[3]),int(fld[4]),int(fld[5]),0,0,0))
+    if fld[6]: secs += float(fld[6][:10])   # truncate to nanosecs
+    if fld[7] and len(fld[7]) > 1:          # time zone offset
+      offset = fld[7].replace(':','')
+      secs -= (1 if offset[0] == '+' else -1)*(int(offset[1:3])*3600+int(offset[3:5])*60)
+    return secs
+
+def ParseTimeDateutil(stamp):
+    import dateutil.parser as dp
+    from dateutil.tz import tzutc
+    stamp = dp.parse(stamp, tzinfos={'Z': 0})
+    if stamp.tzinfo is None: stamp = stamp.replace(tzinfo=tzutc())  # TTN times are in UTC
+    return (stamp - datetime.datetime(1970,1,1,tzinfo=tzutc())).total_seconds()
+
 try: from lib import MyLoRaCode
 except: import MyLoRaCode
+try: from lib import MyMetrics
+except: import MyMetrics
+
+# pipeline stage latency metrics
+Stage = {
+    'message': MyMetrics.histogram('mqtt_message_seconds','MQTT client on message callback'),
+    'decode':  MyMetrics.histogram('decode_seconds','RecordImport and LoRa payload decode'),
+    'wait':    MyMetrics.histogram('queue_wait_seconds','record wait time in input queue'),
+    'cache':   MyMetrics.histogram('kitcache_seconds','kit cache lookup of a record'),
+    'db':      MyMetrics.histogram('kitcache_db_seconds','kit cache DB queries'),
+}
+# LoRa gateways (id, rssi, snr, geohash) of a TTN V3 or V2 uplink record
+def UplinkGateways(record):
+    try: from pygeohash import encode as geohash
+    except: from geohash import encode as geohash
+    def getLocation(rcrd):
+      try: # precision 11 is about 3 meter resolution
+        return { 'geohash': geohash(float(rcrd['latitude']),float(rcrd['longitude']),precision=11) }
+      except: return {}
+    gateways = []
+    try: msg = record['uplink_message']['rx_metadata']   # TTN V3
+    except:
+      for one in record.get('metadata',{}).get('gateways',[]) or []: # TTN V2, deprecated
+        gtw = {}
+        for item in ['gtw_id','rssi','snr']:
+          try: gtw[item] = one[item]
+          except: continue
+        gtw.update(getLocation(one))
+        if gtw: gateways.append(gtw)
+      return gateways
+    for i in list(range(len(msg))):
+      gtw = {}
+      for one in ['gateway_id','rssi','snr']:
+        v = None
+        try:
+          if one == 'gateway_id':
+            v = msg[i]['gateway_ids']['gateway_id']
+            if v == 'packetbroker': # ttnv2 home_network broker
+              try: v = msg[i]['packet_broker']['forwarder_gateway_id'] # ttnv2 tenant
+              except: break
+          else: v = msg[i][one]
+          if not v == None: gtw[one] = v
+        except: pass
+      try: gtw.update(getLocation(msg[i]['location']))
+      except: pass
+      if gtw: gateways.append(gtw)
+    return gateways
+
 class TTN2MySense:
     def __init__(self, LoRaCodeRules=None, DefaultUnits = ['%','C','hPa','mm/h','degrees', 'sec','m','Kohm','ug/m3','pcs/m3','m/sec'], PortMap=None, logger=None):
         self.logger = logger  # routine to print logging from eg MyLoRaCode
@@ -321,7 +416,6 @@ class TTN2MySense:
 
     # convert  and payload decode TTN V2/V3 record to data exchange format dict
     def RecordImport(self, record):
-        import dateutil.parser as dp # add timezone infos!
         try: from pygeohash import encode as geohash
         except: from geohash import encode as geohash
         if not record: return (None if record == None else {})
@@ -366,23 +460,7 @@ class TTN2MySense:
             airtime = float(msg['consumed_airtime'].replace('s',''))
           except: pass
           if 'rx_metadata' in msg.keys():
-            msg = msg['rx_metadata']
-            for i in list(range(len(msg))):
-              gtw = {}
-              for one in ['gateway_id','rssi','snr']:
-                v = None
-                try:
-                  if one == 'gateway_id':
-                    v = msg[i]['gateway_ids']['gateway_id']
-                    if v == 'packetbroker': # ttnv2 home_network broker
-                      try: v = msg[i]['packet_broker']['forwarder_gateway_id'] # ttnv2 tenant
-                      except: break
-                  else: v = msg[i][one]
-                  if not v == None: gtw[one] = v
-                except: pass
-              try: gtw.update(getLocation(msg[i]['location']))
-              except: pass
-              if gtw: rts['net']['gateways'].append(gtw)
+            rts['net']['gateways'] = UplinkGateways(record)
         elif rts['net']['type'] == 'TTNV2':   # TTN V2, deprecated
           for item in [('timestamp','time'),('airtime','airtime'),('gateways','gateways'),('meta','longitude')]:
             try:
@@ -395,14 +473,7 @@ class TTN2MySense:
               val = getLocation(record['metadata']); val['GeoGuess'] = True
               meta.update({ 'geolocation': val })
             elif item[0] == 'gateways':  # list of gateways
-              for i in list(range(len(val))):
-                gtw = {}
-                for one in ['gtw_id','rssi','snr']:
-                  try:
-                    gtw[one] = record['metadata']['gateways'][i][one]
-                  except: continue
-                gtw.update(getLocation(record['metadata']['gateways'][i]))
-                if gtw: rts['net']['gateways'].append(gtw)
+              rts['net']['gateways'] = UplinkGateways(record)
             else: rts[item[0]] = val
         else: return {}
           
@@ -411,14 +482,192 @@ class TTN2MySense:
         try:
           if type(rts['timestamp']) is float: rts['timestamp'] = int(rts['timestamp']+0.5)
           if not type(rts['timestamp']) is int:    # convert timestamp is in epoch secs
-            # somehow the parser diffs from data --date=timestamp +%s with 3600 secs
-            rts['timestamp'] = int(float(dp.parse(rts['timestamp'], tzinfos={'Z': 0}).strftime("%s.%f"))+3600-airtime+0.5) # 1 sec resolution
+            rts['timestamp'] = int(ParseTime(rts['timestamp'])-airtime+0.5) # 1 sec resolution
         except:
           rts['timestamp'] = int(time.time()-airtime+0.5) # add a timestamp
         return rts
 
+# bounded first in, first out queue of imported records
+# MQTT client threads put records, GetData() waits (with timeout) on arrival of a record
+# overflow policy on a full queue:
+#   'drop-newest': skip the received record (dflt),
+#   'drop-oldest': skip the oldest queued record in favour of the received one,
+#   'block': let the MQTT client thread wait for free space (max timeout secs, None: forever)
+class RecordFiFo:
+    Policies = ['drop-newest','drop-oldest','block']
+
+    def __init__(self, maxsize=100, overflow='drop-newest', timeout=None):
+        if not overflow in self.Policies:
+          raise ValueError("Unknown record queue overflow policy %s" % str(overflow))
+        self.maxsize = maxsize if type(maxsize) is int and maxsize > 0 else 100
+        self.overflow = overflow
+        self.timeout = timeout          # max secs MQTT client thread may block
+        self.queue = deque()
+        self.queued = set()             # id() of records in the queue
+        self.lock = threading.Lock()
+        self.notEmpty = threading.Condition(self.lock)
+        self.notFull = threading.Condition(self.lock)
+        # overflow counters
+        self.stats = { 'queued': 0, 'dropped-newest': 0, 'dropped-oldest': 0, 'blocked': 0, 'max': 0 }
+
+    def __len__(self):
+        with self.lock: return len(self.queue)
+
+    def Full(self):
+        with self.lock: return len(self.queue) >= self.maxsize
+
+    # nr of records which can be queued without overflow
+    def Room(self):
+        with self.lock: return max(0, self.maxsize - len(self.queue))
+
+    # account a received record which was not queued on overflow (drop-newest)
+    def Refuse(self):
+        with self.lock:
+          self.stats['dropped-newest'] += 1
+          return self.stats['dropped-newest']
+
+    # returns True if record is queued
+    def put(self, record):
+        with self.lock:
+          if len(self.queue) >= self.maxsize:
+            if self.overflow == 'drop-newest':
+              self.stats['dropped-newest'] += 1
+              return False
+            elif self.overflow == 'drop-oldest':
+              self.queued.discard(id(self.queue.popleft()[1]))
+              self.stats['dropped-oldest'] += 1
+            else: # block MQTT client thread
+              self.stats['blocked'] += 1
+              end = None if self.timeout is None else time.time() + self.timeout
+              while len(self.queue) >= self.maxsize:
+                if end is None: self.notFull.wait()
+                else:
+                  remaining = end - time.time()
+                  if remaining <= 0:
+                    self.stats['dropped-newest'] += 1
+                    return False
+                  self.notFull.wait(remaining)
+          self.queue.append((MyMetrics.clock(),record))  # enqueue time for wait metric
+          self.queued.add(id(record))
+          self.stats['queued'] += 1
+          if len(self.queue) > self.stats['max']: self.stats['max'] = len(self.queue)
+          self.notEmpty.notify()
+          return True
+
+    # wait max timeout secs for a record, raises Queue.Empty on timeout
+    def get(self, timeout=None):
+        with self.lock:
+          end = None if timeout is None else time.time() + timeout
+          while not len(self.queue):
+            if end is None: self.notEmpty.wait()
+            else:
+              remaining = end - time.time()
+              if remaining <= 0: raise Queue.Empty
+              self.notEmpty.wait(remaining)
+          queued, record = self.queue.popleft()
+          self.queued.discard(id(record))
+          self.notFull.notify()
+        Stage['wait'].since(queued)
+        return record
+
+    # change a record with routine(record) only while it is still queued
+    # returns False if the record is not (anymore) in the queue
+    def Update(self, record, routine):
+        with self.lock:
+          if not id(record) in self.queued: return False
+          routine(record)
+          return True
+
+    # end of input mark (get returns None), queued regardless of the overflow policy
+    def End(self):
+        with self.lock:
+          self.queue.append((MyMetrics.clock(),None))
+          self.notEmpty.notify()
+
+    def Stats(self):
+        with self.lock:
+          rts = self.stats.copy()
+          rts['size'] = len(self.queue); rts['maxsize'] = self.maxsize
+          return rts
+
+# duplicate uplink suppression, e.g. the same uplink via TTN V2 and V3 broker, or
+# overlapping subscriptions. Key: (application, device, frame counter, payload).
+# Bounded (size uplinks) and time windowed (window secs). Gateways of a duplicate
+# are merged into the first decoded record (BestGtw/GTWstat see all gateways)
+# only while it waits in the record queue: gateways of a late duplicate are
+# counted, not merged. The payload in the key is a stable crc32 digest.
+class UplinkFilter:
+    def __init__(self, size=10000, window=120):
+        self.size = max(1,int(size)); self.window = window
+        self.seen = OrderedDict()    # key: [time first seen, decoded record, pending gateways]
+        self.lock = threading.Lock()
+        self.stats = { 'uplinks': 0, 'duplicates': 0, 'late': 0 }
+        self.duplicates = MyMetrics.counter('uplink_duplicates_total','duplicate uplinks suppressed')
+
+    # uplink key of a TTN V3 or V2 json record, None if there is no frame counter
+    @staticmethod
+    def Key(record):
+        try:
+          msg = record['uplink_message']; ids = record['end_device_ids']
+          return (ids['application_ids']['application_id'], ids['device_id'], msg['f_cnt'], zlib.crc32(str(msg['frm_payload']).encode()))
+        except: pass
+        try: return (record['app_id'], record['dev_id'], record['counter'], zlib.crc32(str(record['payload_raw']).encode()))
+        except: return None
+
+    # merge gateways in decoded record, gateways already seen are skipped
+    @staticmethod
+    def Merge(record, gateways):
+        try: net = record['net']
+        except: return
+        known = set([a.get('gateway_id',a.get('gtw_id')) for a in net.get('gateways',[])])
+        for gtw in gateways:
+          if gtw.get('gateway_id',gtw.get('gtw_id')) in known: continue
+          net.setdefault('gateways',[]).append(gtw)
+
+    # returns True if uplink is a duplicate: its gateways are merged into the first
+    # one while that one is in record queue fifo
+    def Duplicate(self, key, record, fifo):
+        now = time.time()
+        with self.lock:
+          while self.seen:   # expire oldest uplinks
+            first = next(iter(self.seen.values()))
+            if now - first[0] < self.window and len(self.seen) < self.size: break
+            self.seen.popitem(last=False)
+          entry = self.seen.get(key)
+          if entry == None:
+            self.seen[key] = [now, None, []]; self.stats['uplinks'] += 1
+            return False
+          self.stats['duplicates'] += 1
+        self.duplicates.inc()
+        gateways = UplinkGateways(record)
+        with self.lock:
+          if entry[1] == None: entry[2] += gateways  # first one is not yet queued
+          elif not fifo.Update(entry[1], lambda rec: self.Merge(rec, gateways)):
+            self.stats['late'] += 1                  # first one is dequeued
+        return True
+
+    # first uplink was not queued: a duplicate may take over
+    def Forget(self, key):
+        with self.lock: self.seen.pop(key, None)
+
+    # decoded record of first uplink is queued in fifo
+    def Decoded(self, key, record, fifo):
+        with self.lock:
+          entry = self.seen.get(key)
+          if entry == None or not record: return
+          entry[1] = record
+          if entry[2]:
+            gateways = entry[2]; entry[2] = []
+            if not fifo.Update(record, lambda rec: self.Merge(rec, gateways)):
+              self.stats['late'] += 1
+
+    def Stats(self):
+        with self.lock:
+          rts = self.stats.copy(); rts['size'] = len(self.seen)
+          return rts
+
 # routines to collect messages from MQTT broker (yet only subscription)
-# collect records in RecordQueue[] using QueueLock
+# collect records in RecordQueue (RecordFiFo)
 # broker with MQTT connection details: host, user credentials, list of topics
 # broker = {
 #        "resource": "eu1.cloud.thethings.network", # Broker address default
@@ -429,11 +678,11 @@ class TTN2MySense:
 #        "topic": "+" , # topic or list of topics to subscribe to
 #    }
 class MQTT_broker:
-    def __init__(self, broker, fifo, lock, verbose=False, debug=False, logger=None):
+    def __init__(self, broker, fifo, verbose=False, debug=False, logger=None, dedup=None):
         self.connected = None     # None=not yet, False from disconnected, True connected
         self.message_nr = 0       # number of messages received
-        self.RecordQueue = fifo   # list of received data records
-        self.QueueLock = lock     # Threadlock fopr queue handling
+        self.RecordQueue = fifo   # RecordFiFo queue of received data records
+        self.Dedup = dedup        # UplinkFilter shared by brokers, None: no suppression
         self.client = None        # MQTT connection handle
         self.verbose = verbose    # verbosity
         self.debug = debug        # more verbosity
@@ -454,7 +703,16 @@ class MQTT_broker:
     
     def _logger(self, pri, message):
         try: self.logger('MQTT_broker',pri,'MQTT client MQTT_broker: ' + str(message))
-        except: sys.stderr.write("MQTT_broker MyMQTTclient %s: %s\n" % (str(pri), str(message))) 
+        except: sys.stderr.write("MQTT_broker MyMQTTclient %s: %s\n" % (str(pri), str(message)))
+
+    # log skipped record on full record queue: first one and every 100th
+    def QueueOverflow(self, record, dropped):
+        if dropped % 100 != 1: return
+        try: ID = record['end_device_ids']['device_id']
+        except:
+          try: ID = record['dev_id']
+          except: ID = 'unknown'
+        self._logger("WARNING","exhausting record queue (%d records dropped). Skip record: %s." % (dropped,ID))
 
     def _on_connect(self, client, userdata, flags, rc):
         if rc == 0:
@@ -477,6 +735,11 @@ class MQTT_broker:
      
     # pickup in thread call back the MQTT record and queue it
     def _on_message(self, client, userdata, message):
+        start = MyMetrics.clock()
+        try: return self.OnMessage(message)
+        finally: Stage['message'].since(start)
+
+    def OnMessage(self, message):
         self.message_nr += 1
         if self.broker['restarts'] and self.message_nr > 5: self.broker['restarts'] = 0
         try:
@@ -486,28 +749,44 @@ class MQTT_broker:
             self._logger("ERROR","it is not json payload, error: %s" % str(e))
             self._logger("INFO","\t%s skipped message %d received: " % (datetime.datetime.now().strftime("%m-%d %Hh%Mm"),self.message_nr) + 'topic: %s' % message.topic + ', payload: %s' % message.payload)
             return False
+        return self.OnRecord(record)
+
+    # import json record and queue it
+    # a not queued uplink is forgotten by dedup: a copy via another gateway is decoded
+    def OnRecord(self, record):
+        key = None
         try:
+            key = self.Dedup.Key(record) if self.Dedup else None
+            if key != None and self.Dedup.Duplicate(key, record, self.RecordQueue):
+              return True  # gateways are merged into first uplink
             if len(record) > 25: # primitive way to identify incorrect records
+              if key != None: self.Dedup.Forget(key)
               self._logger("WARNING","TTN MQTT records overload. Skipping.")
-            elif len(self.RecordQueue) > 100:
-              try:
-                self._logger("WARNING","exhausting record queue. Skip record: %s." % record['end_device_ids']['device_id'])
-              except:
-                self._logger("WARNING","exhausting record queue. Skip record: %s." % record['dev_id'])
+            elif self.RecordQueue.overflow == 'drop-newest' and self.RecordQueue.Full():
+              if key != None: self.Dedup.Forget(key)
+              self.QueueOverflow(record, self.RecordQueue.Refuse())
             else:
               try:
                 #if isinstance(self.broker['import'],tuple): # a terrible hack
                 #  self.broker['import'] = self.broker['import'][0]
+                ID = record # for overflow message
+                start = MyMetrics.clock()
                 record = self.broker['import'](record) # convert TTN record to MySense internal data struct
+                Stage['decode'].since(start)
               except Exception as e:
+                  if key != None: self.Dedup.Forget(key)
                   self._logger("ERROR","Import routine failure, error: %s" % str(e))
                   return False
-              with self.QueueLock: # queue the record
-                self.RecordQueue.append(record)
-                # in principle next should be guarded by a semaphore
-                with self.broker['lock']: self.broker['timestamp']  = time.time()
+              if not self.RecordQueue.put(record): # queue the record
+                if key != None: self.Dedup.Forget(key)
+                self.QueueOverflow(ID, self.RecordQueue.Stats()['dropped-newest'])
+                return False
+              if key != None: self.Dedup.Decoded(key, record, self.RecordQueue)
+              # in principle next should be guarded by a semaphore
+              with self.broker['lock']: self.broker['timestamp']  = time.time()
             return True
         except Exception as e:
+            if key != None and self.Dedup: self.Dedup.Forget(key)
             sys.stderr.write("Exception as %s" % str(e))
             return False
 
@@ -602,10 +881,109 @@ class MQTT_broker:
         self.client = None  # renew MQTT object class
         time.sleep(15) # give thread a chance to stop
 
+# MQTT message as received from paho MQTT client
+class Message(object):
+    __slots__ = ('topic','payload')
+    def __init__(self, topic, payload):
+        self.topic = topic; self.payload = payload
+
+# device ID of an MQTT message from topic <app>/devices/<dev>/up, or from payload
+def DeviceID(topic, payload=None):
+    try: return topic.split('/devices/')[1].split('/')[0]
+    except: pass
+    try:
+        record = json.loads(payload)
+        try: return record['end_device_ids']['device_id']
+        except: return record['dev_id']
+    except: return str(topic)
+
+# supervisor front end: route received messages (topic, payload) not decoded to
+# route(device ID, item) e.g. a worker process queue hashed on device ID
+class MQTT_router(MQTT_broker):
+    def __init__(self, broker, route, verbose=False, debug=False, logger=None):
+        MQTT_broker.__init__(self, broker, None, verbose=verbose, debug=debug, logger=logger)
+        self.route = route
+
+    def OnMessage(self, message):
+        self.message_nr += 1
+        if self.broker['restarts'] and self.message_nr > 5: self.broker['restarts'] = 0
+        try:
+            if not self.route(DeviceID(message.topic, message.payload), (message.topic, message.payload)):
+              return False
+            with self.broker['lock']: self.broker['timestamp'] = time.time()
+            return True
+        except Exception as e:
+            self._logger("ERROR","Routing of message failed: %s" % str(e))
+            return False
+
+# supervised worker: messages (topic, payload) routed by the supervisor via
+# broker['pipe'] (multiprocessing queue) are handled as MQTT messages.
+# An item None from the pipe denotes end of input (graceful stop of the worker)
+class MQTT_pipe(MQTT_broker):
+    def MQTTstart(self):
+        if self.connected: return True
+        self.clientID = self.broker['clientID'] = self.broker.get('clientID','MQTTpipe')
+        self.connected = True
+        with self.broker['lock']: self.broker['timestamp'] = time.time()
+        self.client = threading.Thread(name=self.clientID, target=self.Reader)
+        self.client.daemon = True
+        self.client.start()
+        self._logger("INFO","Records are routed to %s." % self.clientID)
+        return True
+
+    def Reader(self):
+        while self.connected:
+          try: item = self.broker['pipe'].get(timeout=1)
+          except Queue.Empty: continue
+          except (EOFError, OSError): item = None  # supervisor has gone
+          if item == None:
+            self.RecordQueue.End()
+            return
+          self._on_message(None, None, Message(*item))
+
+    def MQTTstop(self):
+        self.connected = False
+        self.client = None
+
+# TTN V3 webhook input: uplinks POSTed to an asyncio HTTP server (MyWebhook.py)
+# broker['webhook'] dict with webhook options, e.g. secret, path; broker['port'] listen port
+# A batch of uplinks is refused (HTTP 429) if the record queue has no room for it
+class MQTT_webhook(MQTT_broker):
+    def MQTTstart(self):
+        if self.connected: return True
+        self.clientID = self.broker['clientID'] = self.broker.get('clientID','MyWebhook')
+        try:
+            try: from lib import MyWebhook
+            except: import MyWebhook
+            conf = self.broker['webhook'] if type(self.broker['webhook']) is dict else {}
+            self.client = MyWebhook.Webhook(self.Ingest, **dict(conf, port=self.broker['port'], log=self.logger))
+            self.client.start()
+        except Exception as e:
+            self._logger("ERROR","Webhook on port %s failed: %s" % (str(self.broker['port']),str(e)))
+            self.client = None
+            return False
+        self.connected = True
+        with self.broker['lock']: self.broker['timestamp'] = time.time()
+        return True
+
+    # webhook batch of uplink records, returns HTTP status
+    def Ingest(self, records):
+        if self.RecordQueue.Room() < len(records): return 429 # back pressure
+        for record in records:
+            self.message_nr += 1
+            self.OnRecord(record)
+        return 200
+
+    def MQTTstop(self):
+        if self.client: self.client.stop()
+        self.connected = False
+        self.client = None
+
 # KitCache: cache with refs DB kit info into KitCached dict cache
+# least recently used cache with max size entries, entry expires after ttl secs
 class KitCache:
     import signal
-    def __init__(self, ReDoCache=24*60*60, DB=None, logger=None):
+    def __init__(self, ReDoCache=24*60*60, DB=None, logger=None, size=500, ttl=24*60*60, jitter=0.1, warmup=True, unknown=1000, unknown_ttl=60*60, regpoll=5*60, report=60*60):
       self.logger=logger
       # cached meta info  and handling info measurement kits
       # cache to limit DB access
@@ -624,7 +1002,22 @@ class KitCache:
       self.redoCache  = ReDoCache        # period in time to check for new kits
       self.updateCacheTime = int(time.time())+ReDoCache # last time update cached check was done
       # self.dirtyCache = False            # force a check of cached items to DB info
-      self.KitCached = {
+      self.sized = size == None          # size from nr of active kits on warm up
+      self.size = max(int(size),1) if size != None else 500  # max entries in cache
+      self.ttl = int(ttl)                # time to live of DB meta info in cache
+      self.jitter = min(max(float(jitter),0.0),0.5) # random part of ttl
+      self.stats = { 'hits': 0, 'misses': 0, 'evictions': 0, 'refreshes': 0, 'warmed': 0, 'rejected': 0 }
+      # negative cache: not registered devices { ID: [ttl, rejected count] }
+      self.Unknown = OrderedDict()
+      self.unknownSize = max(int(unknown),1)
+      self.unknownTTL = int(unknown_ttl)
+      self.regPoll = int(regpoll)      # secs to check registration tables for changes
+      self.regCheck = int(time.time())+self.regPoll
+      self.registrations = self.Registrations() # last change of registration tables
+      self.Latest = None               # optional: last seen of kit table name, e.g. MyLATEST.LastSeen
+      self.reportTime = int(report)    # secs to report rejected devices
+      self.report = int(time.time())+self.reportTime
+      self.KitCached = OrderedDict({
         # 'project_serial': { 
             # 'id':        { 'project': project ID, 'serial':  measurement kit serial number ID }
 
@@ -648,7 +1041,8 @@ class KitCache:
             # 'gtw': [[],...] LoRa gateway nearby [gwID,rssi,snr,(lat,long,alt)]
             # 'unknown_fields': [] seen but not used fields
         # },
-      }
+      })   # least recently used entry first
+      if warmup: self.WarmUp()
       # there is a namespace problem with signal handling if done inside an import
       signal.signal(signal.SIGUSR1, self.SigUSR1handler)
       # signal.signal(signal.SIGUSR2, self.SigUSR2handler)
@@ -680,38 +1074,147 @@ class KitCache:
     # show current status of nodes seen so far
     def SigUSR1handler(self, signum,frame):
       self.PrtCached()
+      self._logger('INFO',"Cache stats: %s" % ', '.join(["%s %d" % (k,v) for k,v in self.Stats().items()]))
 
     # clear KitCached with next data reception
     #def SigUSR2handler(self, signum,frame):
     #  self.dirtyCache = True
 
-    def cleanCache(self):  # maintain cache first in, first out
+    def cleanCache(self):  # maintain cache: least recently used entry is evicted first
       # if self.dirtyCache:
       #   self.KitCached = {}; self.dirtyCache = False
       #   return
-      #if len(self.KitCached) <= 50: return # allow max 50 cache entries
-      timestamp = int(time.time()) #; fnd = False
+      timestamp = int(time.time())
       if self.updateCacheTime <  timestamp: # try to keep in sync
-        for one, val in self.KitCached.items():
-          if val['ttl'] < timestamp:
-            del self.KitCached[one]  # refresh entry from DB
-            #fnd = True
+        for one in [x for x, val in self.KitCached.items() if val['ttl'] < timestamp-self.redoCache]:
+          del self.KitCached[one]  # not seen for a long time
         self.updateCacheTime += self.redoCache
-      if len(self.KitCached) <= 50: return # allow max 50 cache entries
-      #if fnd:
-      #  #self._logger('ERROR',"TTL Size Kit Cache %d" % len(self.KitCached))
-      #  return True
-      #first = float('inf')
-      first = timestamp + 24*60*60; fnd = None
-      for one, val in self.KitCached.items():
-        if val['ttl'] < first:
-          fnd = one; first = val['ttl']
-      if fnd:
-        del self.KitCached[fnd]
-        #self._logger('ERROR',"first TTL Size Kit Cache %d" % len(self.KitCached))
-        return True
-      else: self._logger('ERROR',"Cache exhausted current length %d" % len(self.KitCached))
-      return False
+      while len(self.KitCached) > self.size:
+        self.KitCached.popitem(last=False)
+        self.stats['evictions'] += 1
+      return True
+
+    # time to live of a cache entry, jitter avoids a refresh storm of entries cached at same time
+    def TTL(self):
+      return int(time.time() + self.ttl*(1.0 - self.jitter*random.random()))
+
+    # put entry as most recently used in cache, evict least recently used on overflow
+    def CacheEntry(self, ID, entry):
+      try: del self.KitCached[ID]
+      except KeyError: pass
+      self.KitCached[ID] = entry
+      self.cleanCache()
+      return entry
+
+    # cache counters for monitoring
+    def Stats(self):
+      rts = self.stats.copy(); rts['size'] = len(self.KitCached)
+      rts['unknown'] = len(self.Unknown)
+      return rts
+
+    # last change in registration tables TTNtable and Sensors
+    def Registrations(self):
+      try:
+        return tuple(self.DB.db_query("SELECT (SELECT UNIX_TIMESTAMP(MAX(id)) FROM TTNtable), (SELECT UNIX_TIMESTAMP(MAX(id)) FROM Sensors)", True)[0])
+      except: return None
+
+    # add not registered device to negative cache
+    def AddUnknown(self, ID):
+      self.Unknown[ID] = [int(time.time())+self.unknownTTL, 0]
+      while len(self.Unknown) > self.unknownSize:
+        self.Unknown.popitem(last=False)
+
+    # returns nr of rejections of a device in negative cache, 0 if not in negative cache
+    def Rejected(self, ID):
+      try: one = self.Unknown[ID]
+      except KeyError: return 0
+      if one[0] < int(time.time()):
+        del self.Unknown[ID]; return 0
+      one[1] += 1; self.stats['rejected'] += 1
+      return one[1]
+
+    # negative cache maintenance: invalidate on registration changes, report rejected devices
+    def CheckUnknown(self):
+      now = int(time.time())
+      if self.regCheck < now:
+        self.regCheck = now+self.regPoll
+        registrations = self.Registrations()
+        if registrations != self.registrations:
+          self.registrations = registrations
+          if len(self.Unknown):
+            self._logger('INFO','Registration tables changed: cleared %d not registered devices' % len(self.Unknown))
+            self.Unknown.clear()
+      if self.report < now:
+        self.report = now+self.reportTime
+        rejected = ["%s (%d)" % (ID,one[1]) for ID, one in self.Unknown.items() if one[1]]
+        if rejected:
+          self._logger('ATTENT','Rejected records of not registered devices: %s' % ', '.join(rejected))
+          for one in self.Unknown.values(): one[1] = 0
+
+    # DB meta info columns for cache entries
+    MetaColumns = """TTNtable.project, TTNtable.serial,
+                     UNIX_TIMESTAMP(TTNtable.id),
+                     IF(NOT ISNULL(TTNtable.DBactive) AND TTNtable.DBactive,
+                          CONCAT(TTNtable.project,'_',TTNtable.serial),NULL),
+                     IF(NOT ISNULL(TTNtable.TTN_id),
+                          CONCAT(TTNtable.TTN_app,'/',TTNtable.TTN_id),NULL),
+                     IF(NOT ISNULL(TTNtable.luftdaten) AND TTNtable.luftdaten,
+                          IF(NOT ISNULL(TTNtable.luftdatenID),TTNtable.luftdatenID,TTNtable.serial),NULL),
+                     TTNtable.website,
+                     UNIX_TIMESTAMP(Sensors.id), Sensors.sensors, Sensors.geohash, Sensors.active, TTNtable.valid, Sensors.description"""
+
+    # update cache entry with DB meta info query row
+    def MetaInfo(self, CacheInfo, row):
+        self.addEntry(CacheInfo,['TTNtableID','DATAid','MQTTid','Luftdaten','WEBactive','SensorsID','sensors','location','active','valid','version'],row[2:])
+        try: # measurement kit firmware version detection expected in field 'description'
+          CacheInfo['version'] = re.compile(r'.*(?P<version>V[0-9][0-9\.]*)').match(CacheInfo['version']).group('version')
+        except: del CacheInfo['version']
+        CacheInfo['ttl'] = self.TTL()  # update with meta DB info after ttl secs
+        return CacheInfo
+
+    # load meta info of all active kits with one DB query into the cache
+    # last seen is obtained on first access of the kit
+    def WarmUp(self):
+        try:
+          qry = """SELECT %s
+                   FROM TTNtable, Sensors
+                   WHERE Sensors.active AND NOT ISNULL(TTNtable.TTN_id)
+                     AND Sensors.project = TTNtable.project AND Sensors.serial = TTNtable.serial
+                   ORDER BY Sensors.datum DESC""" % self.MetaColumns
+          qry = self.DB.db_query( re.sub(r'\n *',' ',qry).strip(), True)
+        except Exception as e:
+          self._logger('ATTENT','Kit cache warm up failed with %s' % str(e))
+          return 0
+        cnt = 0
+        if self.sized and qry:     # room for all active kits and some new ones
+          self.size = max(self.size, int(len(qry)*1.25))
+        for row in (qry if qry else []):
+          CacheInfo = {'last_seen': 0, 'count': 0, 'interval': 15*16,
+                    'gtw': [], 'unknown_fields': [], 'id': { 'project': row[0], 'serial': row[1] } }
+          self.MetaInfo(CacheInfo, row)
+          if not CacheInfo['MQTTid'] or CacheInfo['MQTTid'] in self.KitCached: continue # latest only
+          self.KitCached[CacheInfo['MQTTid']] = CacheInfo; cnt += 1
+          if cnt >= self.size: break
+        self.stats['warmed'] += cnt
+        self._logger('INFO','Kit cache warm up with %d active kits, cache size %d' % (cnt,self.size))
+        return cnt
+
+    # DB query with latency metric
+    def Query(self, query):
+        start = MyMetrics.clock()
+        try: return self.DB.db_query(query, True)
+        finally: Stage['db'].since(start)
+
+    # get last seen timestamp from measurements table
+    def LastSeen(self, CacheInfo):
+        try:
+          last = self.Latest('%s_%s' % (CacheInfo['id']['project'],CacheInfo['id']['serial'])) if self.Latest else None
+          if not last: last = self.Query("SELECT UNIX_TIMESTAMP(datum) FROM %s_%s ORDER BY datum DESC LIMIT 1" % (CacheInfo['id']['project'],CacheInfo['id']['serial']))[0][0]
+          CacheInfo['last_seen'] = last
+          Seen = 'Last'
+        except:
+          CacheInfo['last_seen'] = int(time.time()); Seen = 'First'
+        self._logger('INFO','%s seen %s_%s at %s' % (Seen,CacheInfo['id']['project'],CacheInfo['id']['serial'],datetime.datetime.fromtimestamp(int(CacheInfo['last_seen'])).strftime("%Y-%m-%d %H:%M:%S")))
 
     # add key,value to a info record
     def addEntry( self, record, keys, values ):
@@ -722,16 +1225,21 @@ class KitCache:
     # initialize new cache record and put it into KitCached
     # rts: ref to KitCached entry
     def AccessInfo(self, ID):
-        #self.cleanCache()
         try:
           one = self.KitCached[ID]
-          if one['ttl'] > int(time.time()): return one
+          if one['ttl'] > int(time.time()):
+            self.stats['hits'] += 1
+            if not one['last_seen']: self.LastSeen(one) # warmed up entry
+            return self.CacheEntry(ID, one)
           # force update entry with info from tables Sensors and TTNtable
           # this enables updates of meta info in running state
           CacheInfo = self.KitCached[ID] # copy cache statistics
+          self.stats['refreshes'] += 1
           self._logger('INFO','Update cached meta info for %s' % ID)
         except:
           # measurement kit not seen so far
+          if self.Rejected(ID): return {}  # not registered device
+          self.stats['misses'] += 1
           CacheInfo = {'last_seen': 0, 'count': 0, 'interval': 15*16,
                     'gtw': [], 'unknown_fields': [], }
 
@@ -746,53 +1254,38 @@ class KitCache:
           except: pass
         if not match2:
           self._logger('ATTENT','Skip record, a not registered end node: %s' % ID)
+          self.AddUnknown(ID)
           return {}
         try:  # get meta info items from database into KIT cache. ttl info is 24 hours.
-          qry = """SELECT
-                     TTNtable.project, TTNtable.serial,
-                     UNIX_TIMESTAMP(TTNtable.id),
-                     IF(NOT ISNULL(TTNtable.DBactive) AND TTNtable.DBactive,
-                          CONCAT(TTNtable.project,'_',TTNtable.serial),NULL),
-                     IF(NOT ISNULL(TTNtable.TTN_id),
-                          CONCAT(TTNtable.TTN_app,'/',TTNtable.TTN_id),NULL),
-                     IF(NOT ISNULL(TTNtable.luftdaten) AND TTNtable.luftdaten,
-                          IF(NOT ISNULL(TTNtable.luftdatenID),TTNtable.luftdatenID,TTNtable.serial),NULL),
-                     TTNtable.website,
-                     UNIX_TIMESTAMP(Sensors.id), Sensors.sensors, Sensors.geohash, Sensors.active, TTNtable.valid, Sensors.description
+          qry = """SELECT %s
                    FROM TTNtable, Sensors
                    WHERE TTNtable.%s = '%s' AND TTNtable.%s = '%s'
                      AND Sensors.project = TTNtable.project AND Sensors.serial = TTNtable.serial
                    ORDER BY Sensors.active DESC, Sensors.datum DESC
-                   LIMIT 1""" % (col1,match1,col2,match2)
-          qry = self.DB.db_query( re.sub(r'\n *',' ',qry).strip(), True)
+                   LIMIT 1""" % (self.MetaColumns,col1,match1,col2,match2)
+          qry = self.Query(re.sub(r'\n *',' ',qry).strip())
           if not qry or not len(qry):
             self._logger('INFO','Skip meta info of record broker ID %s (not registered device).' % ID)
+            try: del self.KitCached[ID]  # kit has been deregistered
+            except KeyError: pass
+            self.AddUnknown(ID)
             return {}
           qry = qry[0]
         except Exception as e:
           self._logger('ATTENT','Exception will skip CacheInfo with ID %s (%s).' % (ID,str(e)))
           return {}
         # update cache with database measurement table meta info
-        self.addEntry(CacheInfo,['TTNtableID','DATAid','MQTTid','Luftdaten','WEBactive','SensorsID','sensors','location','active','valid','version'],qry[2:])
-        try: # measurement kit firmware version detection expected in field 'description'
-          CacheInfo['version'] = re.compile(r'.*(?P<version>V[0-9][0-9\.]*)').match(CacheInfo['version']).group('version')
-        except: del CacheInfo['version']
+        self.MetaInfo(CacheInfo, qry)
         if not CacheInfo['last_seen'] or not 'last_seen' in CacheInfo.keys():
           # it is a brand new entry in the cache
           CacheInfo['id'] = { 'project': qry[0], 'serial': qry[1] }
-          try:
-            CacheInfo['last_seen'] = self.DB.db_query("SELECT UNIX_TIMESTAMP(datum) FROM %s_%s ORDER BY datum DESC LIMIT 1" % (CacheInfo['id']['project'],CacheInfo['id']['serial']), True)[0][0]
-            Seen = 'Last'
-          except:
-            CacheInfo['last_seen'] = int(time.time()); Seen = 'First'
-          self._logger('INFO','%s seen %s_%s at %s' % (Seen,CacheInfo['id']['project'],CacheInfo['id']['serial'],datetime.datetime.fromtimestamp(int(CacheInfo['last_seen'])).strftime("%Y-%m-%d %H:%M:%S")))
-        CacheInfo['ttl'] = int(time.time())+24*60*60  # update with meta DB info after 24 hours
-        self.KitCached[ID] = CacheInfo
-        return self.KitCached[ID]
+          self.LastSeen(CacheInfo)
+        return self.CacheEntry(ID, CacheInfo)
 
     # use cache to get last meta info for app, dev ID conversion to project, serial
     def getDataInfo(self, record, FromFile=False):
-      self.cleanCache()  # cache maintenance, make sure there is no overflow of entries
+      start = MyMetrics.clock()
+      self.CheckUnknown()
       entry = {}
       try: entry = self.AccessInfo(record['id']['project']+'_'+record['id']['serial'])
       except: pass
@@ -814,7 +1307,10 @@ class KitCache:
           RecID = 'MQTT missing applID/topic'
           self._logger("ERROR","NO MQTT appID/topic in record %s found" % str(record))
         #self._logger("ERROR","MQTT appID/topic in record %s found. Cache size %d" % (str(record),len(self.KitCached)))
-        self._logger("INFO","Skip record with ID: '%s' (not registrated node)." % RecID)
+        try: RecID2 = record['net']['TTN_app']+'/'+record['net']['TTN_id']
+        except: RecID2 = None
+        if not RecID2 in self.Unknown or not self.Unknown[RecID2][1]: # reported periodically
+          self._logger("INFO","Skip record with ID: '%s' (not registrated node)." % RecID)
         #entry = self.AccessInfo(RecID)
       else:
         try: # remove location guessed from GTW location from data dict
@@ -822,12 +1318,17 @@ class KitCache:
             del record['meta']['geolocation']
             if not record['meta']: del record['meta']
         except: pass
+      Stage['cache'].since(start)
       return (entry,record)
 
 # get data from MQTT server. Returns data record and DB access/forwarding info record from Kit cache
 class MQTT_data:
     # logger is log routine to be used, database access for MQTT -> project/serial ID conversion
-    def __init__(self, MQTTbrokers, DB=None, verbose=False, debug=False, logger=None, sec2pol=10):
+    # qsize: max records in queue, overflow policy: drop-newest, drop-oldest or block
+    # qtimeout: max secs a MQTT client thread is blocked on full queue (None: forever)
+    # cache: dict with KitCache arguments eg { 'size': 500, 'ttl': 86400, 'jitter': 0.1, 'warmup': True }
+    # replay: replay mode of input files, dict with Replay arguments eg { 'speed': 0, 'workers': 4, 'chunk': 500 }
+    def __init__(self, MQTTbrokers, DB=None, verbose=False, debug=False, logger=None, sec2pol=10, qsize=100, overflow='drop-newest', qtimeout=None, cache=None, replay=None, dedup=None):
       self.MQTTbrokers = MQTTbrokers
       if not type(MQTTbrokers) is list: self.MQTTbrokers = [MQTTbrokers] # single broker
       self.verbose = verbose
@@ -835,14 +1336,19 @@ class MQTT_data:
       self.logger = logger
       self.sec2pol = sec2pol
       self.MQTTrunning = False          # atexit enabled
-      self.MQTTFiFo = []                # first in, first out data records queue
-      self.MQTTLock = threading.RLock() # lock for queue access
+      # first in, first out data records queue
+      self.MQTTFiFo = RecordFiFo(maxsize=qsize, overflow=overflow, timeout=qtimeout)
+      # duplicate uplinks (more brokers) suppression
+      self.Dedup = UplinkFilter(**dedup) if dedup and dedup.get('size',1) else None
       self.Restart  = 0                 # time to retry MQTT broker client to startup
       if not DB:
         try: from lib import MyDB
         except: import MyDB
         DB=MyDB
-      self.KitInfo = KitCache(DB=DB,logger=logger)    # kit cache with DB/forwarding info
+      self.KitInfo = KitCache(DB=DB,logger=logger,**(cache if cache else {}))    # kit cache with DB/forwarding info
+      MyMetrics.gauge('input_queue_records', (lambda: len(self.MQTTFiFo)), 'records waiting in input queue')
+      MyMetrics.gauge('input_queue_dropped', (lambda: self.MQTTFiFo.stats['dropped-newest']+self.MQTTFiFo.stats['dropped-oldest']), 'records dropped on full input queue')
+      MyMetrics.gauge('kitcache_kits', (lambda: len(self.KitInfo.KitCached)), 'kits in kit cache')
 
       for i in list(reversed(range(len(self.MQTTbrokers)))): # reading from file if port is 0 or None
         broker = self.MQTTbrokers[i]
@@ -860,11 +1366,21 @@ class MQTT_data:
               if broker['resource'] == '-':
                 broker['fd'] = sys.stdin  # just read from stdin
               elif type(broker['resource']) is str:
-                broker['fd'] = open(broker['resource'],'r')
+                broker['fd'] = OpenInput(broker['resource'])
             except:
               raise IOError("INPUT ERROR: unable to read file %s\n" % str(broker['resource']))
               # exit(1)
         except: raise ValueError("Unknown broker %s definition" % str(broker))
+
+      self.Replayed = None   # replay mode: iterator of decoded records of input files
+      if replay:
+        files = [b for b in self.MQTTbrokers if not b['port'] and b['resource']]
+        if files:
+          names = [('-' if b['resource'] in ['-',sys.stdin] else b['resource']) for b in files]
+          self.Replayed = iter(Replay(names, files[0]['import'], logger=logger, **replay))
+          for broker in files:
+            if broker['fd'] and broker['fd'] != sys.stdin: broker['fd'].close()
+            self.MQTTbrokers.remove(broker)
       
     def _logger(self, pri, message):
       try: self.logger('MyMQTTclient', pri, message)
@@ -904,7 +1420,10 @@ class MQTT_data:
           self._logger("ATTENT","Wait for broker %s to be started" % broker['clientID'])
           continue  # do not start a client which has to wait
         broker['lock'] = threading.RLock() # sema for timestamp
-        broker['fd'] = MQTT_broker(broker, self.MQTTFiFo, self.MQTTLock, verbose=self.verbose, debug=self.debug, logger=self.logger)
+        client = MQTT_broker
+        if broker.get('pipe') != None: client = MQTT_pipe         # records routed by supervisor
+        elif broker.get('webhook'): client = MQTT_webhook         # TTN webhook HTTP POSTs
+        broker['fd'] = client(broker, self.MQTTFiFo, verbose=self.verbose, debug=self.debug, logger=self.logger, dedup=self.Dedup)
         if not broker['fd']:
           self._logger("ERROR","Unable to initialize MQTT broker class for %s" % str(broker))
           del self.MQTTbrokers[indx]
@@ -938,6 +1457,10 @@ class MQTT_data:
     # returns KitCached = None if not identified in DB,
     #         record = None on end of input, {} unaccepted record
     def GetData(self):
+      if self.Replayed != None:   # replay mode of input files
+        record = next(self.Replayed, None)
+        if record: return self.KitInfo.getDataInfo(record, FromFile=True)
+        self.Replayed = None
       # try to read all records from a broker backup file
       for i in list(reversed(range(len(self.MQTTbrokers)))): # reading from file
         broker = self.MQTTbrokers[i]
@@ -947,7 +1470,10 @@ class MQTT_data:
         try:
           #if isinstance(broker['import'],tuple): # a terrible hack
           #  broker['import'] = broker['import'][0]
-          record = broker['import'](self.GetDataFromFile(broker['fd']))
+          record = self.GetDataFromFile(broker['fd'])
+          start = MyMetrics.clock()
+          record = broker['import'](record)
+          Stage['decode'].since(start)
           if record: return self.KitInfo.getDataInfo(record, FromFile=True)
           broker['fd'].close()
           self.MQTTbrokers.pop(i)
@@ -1010,66 +1536,345 @@ class MQTT_data:
             broker['fd'].MQTTstop()
             self.MQTTbrokers.pop(i)
   
-        # try to find a (next) queue with a data record
-        if len(self.MQTTFiFo):
-          with self.MQTTLock: record = self.MQTTFiFo.pop(0)
-          return self.KitInfo.getDataInfo(record)
-        else: time.sleep(self.sec2pol)
-  
+        # wait max sec2pol secs for a (next) data record in the queue
+        try: record = self.MQTTFiFo.get(timeout=self.sec2pol)
+        except Queue.Empty: continue
+        if record == None: return (None,None)  # end of input e.g. supervised worker stops
+        return self.KitInfo.getDataInfo(record)
+
       return (None,None)
 
+    # record queue size and overflow counters
+    def QueueStats(self):
+      return self.MQTTFiFo.Stats()
+
+    # kit cache hits, misses, evictions counters
+    def CacheStats(self):
+      return self.KitInfo.Stats()
+
     # handle data records from (backup) file
     def GetDataFromFile(self,fd):  # obtain records from file iso a TTN broker
-      import json
-      # convert [0xhex,..,0xhex] to int values for json payload corrections
-      def JsonHex2Int(string):
-        string = string.replace(' ','')
-        if string.find('[') >= 0:
-          strt = string.find('[')+1
-          end = string[strt:].find(']')
-          if end < 0: raise ValueError("List does not end")
-          end += strt
-        else: return string.strip()
-        lst = []
-        for item in string[strt:end].split(','):
-           item = item.strip()
-           if item[:2] == '0x' or item[:2] == '0X': item = str(int(item,16))
-           lst.append(item)
-        lst = ','.join(lst)
-        return string[:strt]+ lst + JsonHex2Int(string[end:]).strip()
-
-      line = ''
-      while(True):
-        readln = fd.readline().strip()
-        if not readln: return None               # EOF
-        if 0 <= readln.find('#') < 10:
-          sys.stderr.write("COMMENT: %s\n" % readln[readln.find("#")+1:])
-          continue
-        elif 0 <= readln.find('//') < 10:
-          sys.stderr.write("COMMENT: %s\n" % readln[readln.find("//")+2:])
-          continue
-        line += readln
-        # simple check if we have a full record
-        if line.count('{') > line.count('}'): continue
-        if 0 <= line.find('{') < 10:
-          line = line[line.find('{'):]
-        elif line.find('up {') > 0:
-          line = line[line.find('up {')+3:]
-        else:
-          sys.stderr.write("WARNING not an MQTT record: skip: %s" % line)
-          continue
-        line = JsonHex2Int(line)
-        try:
-          line = json.loads(line)
+      return ReadRecord(fd)
+
+# open input file or '-' std in, gzip compressed files are supported
+def OpenInput(name):
+    if name == '-': return sys.stdin
+    with open(name,'rb') as fd: magic = fd.read(2)
+    if magic == b'\x1f\x8b':
+      import gzip
+      return gzip.open(name,'rt')
+    return open(name,'r')
+
+# convert [0xhex,..,0xhex] to int values for json payload corrections
+def JsonHex2Int(string):
+    string = string.replace(' ','')
+    if string.find('[') >= 0:
+      strt = string.find('[')+1
+      end = string[strt:].find(']')
+      if end < 0: raise ValueError("List does not end")
+      end += strt
+    else: return string.strip()
+    lst = []
+    for item in string[strt:end].split(','):
+       item = item.strip()
+       if item[:2] == '0x' or item[:2] == '0X': item = str(int(item,16))
+       lst.append(item)
+    lst = ','.join(lst)
+    return string[:strt]+ lst + JsonHex2Int(string[end:]).strip()
+
+# read next json record from (backup) file, returns None on end of file
+def ReadRecord(fd):
+    line = ''
+    while(True):
+      readln = fd.readline()
+      if not readln: return None               # EOF
+      readln = readln.strip()
+      if not readln: continue
+      if 0 <= readln.find('#') < 10:
+        sys.stderr.write("COMMENT: %s\n" % readln[readln.find("#")+1:])
+        continue
+      elif 0 <= readln.find('//') < 10:
+        sys.stderr.write("COMMENT: %s\n" % readln[readln.find("//")+2:])
+        continue
+      line += readln
+      # simple check if we have a full record
+      if line.count('{') > line.count('}'): continue
+      if 0 <= line.find('{') < 10:
+        line = line[line.find('{'):]
+      elif line.find('up {') > 0:
+        line = line[line.find('up {')+3:]
+      else:
+        sys.stderr.write("WARNING not an MQTT record: skip: %s" % line)
+        line = ''
+        continue
+      line = JsonHex2Int(line)
+      try:
+        line = json.loads(line)
+      except Exception as e:
+        sys.stderr.write("JSON ERROR: %s\n" % str(e))
+        sys.stderr.write("ERROR in decoding json string: %s\n" % line)
+        line = ''
+        continue
+      return line
+
+# streaming json records of a (backup) file
+def FileRecords(fd):
+    while True:
+      record = ReadRecord(fd)
+      if record == None: return
+      yield record
+
+# replay speed: None or 0 (unlimited), 'realtime' (1), N or 'Nx' (N times real time)
+def ReplaySpeed(speed):
+    if speed in [None,False,True]: return 0 if not speed is True else 1
+    if type(speed) in [int,float]: return max(float(speed),0)
+    speed = str(speed).strip().lower()
+    if speed in ['','0','unlimited','max','none']: return 0
+    if speed in ['realtime','real-time','1x']: return 1
+    return max(float(speed.rstrip('x')),0)
+
+# decode records of a file in a worker process, batches of decoded records to queue
+def _DecodeFile(name, importer, queue, chunk):
+    try:
+      fd = OpenInput(name); batch = []
+      for record in FileRecords(fd):
+        try: record = importer(record)
         except Exception as e:
-          sys.stderr.write("JSON ERROR: %s\n" % str(e))
-          sys.stderr.write("ERROR in decoding json string: %s\n" % line)
-          continue
-        return line
-  
+          sys.stderr.write("Skip record of %s: %s\n" % (name,str(e))); continue
+        if not record: continue
+        batch.append(record)
+        if len(batch) >= chunk:
+          queue.put(batch); batch = []
+      if batch: queue.put(batch)
+      fd.close()
+    except Exception as e:
+      sys.stderr.write("Replay of %s failed: %s\n" % (name,str(e)))
+    queue.put(None)
+
+# high speed replay and backfill of MQTT dump files (gzip supported), no poll waits
+# files are decoded in parallel worker processes in chunks of records and
+# merged on timestamp: records of a kit stay in order
+# speed: 0 unlimited, 1 real time, N times real time. Iterate to get decoded records.
+class Replay(object):
+    def __init__(self, files, importer, speed=0, workers=None, chunk=500, logger=None):
+      self.files = files if type(files) is list else [files]
+      self.importer = importer
+      self.speed = ReplaySpeed(speed)
+      import multiprocessing
+      if workers == None: workers = len(self.files)
+      # more decode processes as cpu's only adds overhead
+      self.workers = min(max(int(workers),0),len(self.files),multiprocessing.cpu_count())
+      self.chunk = max(int(chunk),1)
+      self.logger = logger
+      self.count = 0
+
+    def _logger(self, pri, message):
+      try: self.logger('MyMQTTclient', pri, message)
+      except: sys.stderr.write("MyMQTTclient %s: %s\n" % (str(pri), message))
+
+    # decoded records of a file from a worker process
+    def _Stream(self, queue, process):
+      while True:
+        batch = queue.get()
+        if batch == None: break
+        for record in batch: yield record
+      process.join()
+
+    # decoded records of a file in this process
+    def _Local(self, name):
+      fd = OpenInput(name)
+      for record in FileRecords(fd):
+        try: record = self.importer(record)
+        except Exception as e:
+          self._logger('ERROR',"Skip record of %s: %s" % (name,str(e))); continue
+        if record: yield record
+      if fd != sys.stdin: fd.close()
+
+    def __iter__(self):
+      import heapq, multiprocessing
+      streams = []
+      try: context = multiprocessing.get_context('fork')
+      except: context = multiprocessing  # importer need to be pickable
+      for indx in range(len(self.files)):
+        if indx < self.workers and self.workers > 1 and self.files[indx] != '-':
+          queue = context.Queue(maxsize=4)   # bounded: max 4 chunks per file in memory
+          process = context.Process(target=_DecodeFile, name='Replay_%d' % indx, args=(self.files[indx],self.importer,queue,self.chunk))
+          process.daemon = True; process.start()
+          streams.append(self._Stream(queue, process))
+        else: streams.append(self._Local(self.files[indx]))
+      self._logger('INFO',"Replay of %d file(s) with %d decode process(es), speed %s" % (len(self.files),len([a for a in streams if a.__name__ == '_Stream']),(('%gx' % self.speed) if self.speed else 'unlimited')))
+      if len(streams) > 1:
+        records = heapq.merge(*streams, key=lambda r: r.get('timestamp',0))
+      else: records = streams[0]
+      first = None
+      for record in records:
+        if self.speed:   # pace on record timestamps
+          try:
+            if first == None: first = (record['timestamp'], time.time())
+            wait = first[1]+(record['timestamp']-first[0])/self.speed-time.time()
+            if wait > 0: time.sleep(wait)
+          except (KeyError, TypeError): pass
+        self.count += 1
+        yield record
+
+# timestamp parsing of TTN records: fast path vs dateutil
+# command line: bench [file ...] dflt inputtests TTN-testsuite and stressTestData
+def Bench(files, loops=20):
+    import os, dateutil.parser as dp
+    global ParseTime
+    records = []; stamps = []
+    for file in files:
+      with open(file) as fd:
+        for line in fd:
+          if line.find('{') < 0: continue
+          try: records.append(json.loads(line[line.find('{'):]))
+          except ValueError: continue
+    for record in records:   # record and gateway times
+      meta = record.get('metadata',{}); uplink = record.get('uplink_message',{})
+      for one in [record.get('received_at'), meta.get('time')]+[a.get('time') for a in meta.get('gateways',[])+uplink.get('rx_metadata',[])]:
+        if one: stamps.append(one)
+    # previous conversion: local time zone hack, correct for the CET zone of the collector
+    os.environ['TZ'] = 'Europe/Amsterdam'; time.tzset()
+    for stamp in stamps:
+      org = float(dp.parse(stamp, tzinfos={'Z': 0}).strftime("%s.%f"))+3600
+      assert abs(ParseTime(stamp)-org) < 0.000002, "different time for %s: %f %f" % (stamp,ParseTime(stamp),org)
+      assert abs(ParseTimeDateutil(stamp)-org) < 0.000002
+    fast = ParseTime; timings = []
+    for parser in [ParseTimeDateutil, fast]:
+      start = time.time()
+      for _ in range(loops):
+        for stamp in stamps: parser(stamp)
+      timings.append((time.time()-start)*1000000.0/(loops*len(stamps)))
+    imports = []; importer = TTN2MySense(logger=lambda *args: None)
+    for parser in [ParseTimeDateutil, fast]:
+      ParseTime = parser
+      start = time.time()
+      for _ in range(loops):
+        for record in records: importer.RecordImport(record)
+      imports.append((time.time()-start)*1000000.0/(loops*len(records)))
+    ParseTime = fast
+    print("%d records, %d timestamps: identical epoch times" % (len(records),len(stamps)))
+    print("    parse timestamp: dateutil %6.1f usecs, fast path %6.1f usecs (%.1f times faster)" % (timings[0],timings[1],timings[0]/timings[1]))
+    print("    RecordImport:    dateutil %6.1f usecs, fast path %6.1f usecs per record" % (imports[0],imports[1]))
+
+# replay of gzip dump files: parallel decode vs sequential read and decode per record
+# command line: replay [file ...] [copies=N] [files=N] [workers=N]
+def ReplayBench(files, copies=50, nrfiles=4, workers=4):
+    import os, gzip, tempfile, heapq, multiprocessing
+    importer = TTN2MySense(logger=lambda *args: None).RecordImport
+    lines = []
+    for file in files:
+      with open(file) as fd: lines += [a for a in fd if a.find('{') >= 0]
+    directory = tempfile.mkdtemp(); dumps = []
+    for nr in range(nrfiles):   # month of dumps: files of copies of the test records
+      dumps.append(os.path.join(directory,'dump%d.mqtt.gz' % nr))
+      with gzip.open(dumps[-1],'wt') as fd:
+        for _ in range(copies): fd.writelines(lines)
+    start = time.time(); perfile = []
+    for dump in dumps:         # previous way: read line, decode record, one by one
+      fd = OpenInput(dump); perfile.append([])
+      while True:
+        record = ReadRecord(fd)
+        if record == None: break
+        record = importer(record)
+        if record: perfile[-1].append(record)
+      fd.close()
+    sequential = time.time()-start
+    start = time.time()
+    replayed = list(Replay(dumps, importer, speed=0, workers=workers, logger=lambda *args: None))
+    parallel = time.time()-start
+    assert replayed == list(heapq.merge(*perfile, key=lambda r: r.get('timestamp',0))), "replay differs"
+    # pacing: replay one dump file in about 2 secs
+    records = perfile[0][:len(lines)]
+    span = max([r['timestamp'] for r in records])-min([r['timestamp'] for r in records])
+    start = time.time()
+    for _ in Replay([dumps[0]], importer, speed=span/2.0, workers=0, logger=lambda *args: None): pass
+    paced = time.time()-start
+    for dump in dumps: os.remove(dump)
+    os.rmdir(directory)
+    print("%d gzip files, %d records: identical records, merged on timestamp" % (nrfiles,len(replayed)))
+    print("    sequential read and decode: %.2f secs (%.0f records/sec)" % (sequential,len(replayed)/sequential))
+    print("    replay %d decode processes (%d cpu's): %.2f secs (%.0f records/sec)" % (min(workers,nrfiles,multiprocessing.cpu_count()),multiprocessing.cpu_count(),parallel,len(replayed)/parallel))
+    print("    replay at %.0fx real time of %d secs of records: %.1f secs" % (span/2.0,span,paced))
+
+# duplicate uplinks via two brokers (other gateways), with and without UplinkFilter
+# command line: dedup [file ...]
+def DedupBench(files):
+    import copy
+    messages = [[], []]   # per broker: messages (topic, payload)
+    for file in files:
+      fd = OpenInput(file)
+      for record in FileRecords(fd):
+        if UplinkFilter.Key(record) == None or not UplinkGateways(record): continue
+        messages[0].append(Message('up', json.dumps(record)))
+        record = copy.deepcopy(record)   # same uplink received by other gateways
+        for gtw in record.get('uplink_message',{}).get('rx_metadata',[]):
+          gtw['gateway_ids']['gateway_id'] = 'other-' + gtw['gateway_ids']['gateway_id']; gtw.pop('packet_broker',None)
+        for gtw in record.get('metadata',{}).get('gateways',[]): gtw['gtw_id'] = 'other-' + gtw['gtw_id']
+        messages[1].append(Message('up', json.dumps(record)))
+      fd.close()
+    uplinks = len(set([UplinkFilter.Key(json.loads(a.payload)) for a in messages[0]]))
+    results = []
+    for dedup in [None, UplinkFilter()]:
+      fifo = RecordFiFo(maxsize=10*len(messages[0]), overflow='drop-newest')
+      brokers = [MQTT_broker({ 'clientID': 'broker%d' % nr, 'restarts': 0 }, fifo, logger=lambda *args: None, dedup=dedup) for nr in range(2)]
+      decoded = Stage['decode'].Value()['count']
+      start = time.time()
+      threads = [threading.Thread(target=lambda nr=nr: [brokers[nr]._on_message(None, None, a) for a in messages[nr]]) for nr in range(2)]
+      for thread in threads: thread.start()
+      for thread in threads: thread.join()
+      took = time.time()-start
+      records = []
+      while len(fifo): records.append(fifo.get())
+      results.append((took, len(records), Stage['decode'].Value()['count']-decoded, records))
+    # a late duplicate does not change the dequeued first record
+    before = json.dumps(results[1][3][0], sort_keys=True)
+    late = json.loads(messages[1][0].payload)
+    for gtw in late.get('uplink_message',{}).get('rx_metadata',[]): gtw['gateway_ids']['gateway_id'] = 'late-gateway'
+    for gtw in late.get('metadata',{}).get('gateways',[]): gtw['gtw_id'] = 'late-gateway'
+    brokers[1]._on_message(None, None, Message('up', json.dumps(late)))
+    assert before == json.dumps(results[1][3][0], sort_keys=True) and dedup.Stats()['late'] == 1, "dequeued record changed"
+    assert results[1][1] == uplinks, "duplicates queued"
+    # a copy of an uplink which failed to decode is decoded and queued
+    def Failing(record): raise ValueError("decode failure")
+    dedup = UplinkFilter(); fifo = RecordFiFo(maxsize=10, overflow='drop-newest')
+    failing = MQTT_broker({ 'clientID': 'failing', 'restarts': 0, 'import': Failing }, fifo, logger=lambda *args: None, dedup=dedup)
+    failing._on_message(None, None, messages[0][0])
+    brokers[1].RecordQueue = fifo; brokers[1].Dedup = dedup
+    brokers[1]._on_message(None, None, messages[1][0])
+    assert len(fifo) == 1, "uplink failed to decode is suppressed as duplicate"
+    for record in results[1][3]:
+      gateways = [a.get('gateway_id',a.get('gtw_id')) for a in record['net'].get('gateways',[])]
+      assert [a for a in gateways if a.find('other-') == 0] and [a for a in gateways if a.find('other-') < 0], "gateways not merged"
+    print("%d uplinks received twice via two brokers (other gateways)" % len(messages[0]))
+    print("    no filter:     %d records decoded and queued in %.1f msecs" % (results[0][2],results[0][0]*1000))
+    print("    UplinkFilter:  %d records decoded and queued in %.1f msecs, %d duplicates suppressed" % (results[1][2],results[1][0]*1000,len(messages[0])*2-results[1][1]))
+    print("    queued records have gateways of both brokers merged, late duplicate not merged")
+
 if __name__ == '__main__':
     import os
     # command line defaults
+    if 'dedup' in sys.argv[1:]:
+      files = [a for a in sys.argv[1:] if a != 'dedup']
+      if not files:
+        files = [os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','inputtests','stressTestData.mqtt')]
+      DedupBench(files)
+      exit(0)
+    if 'replay' in sys.argv[1:]:
+      args = { 'copies': 50, 'files': 4, 'workers': 4 }
+      for arg in sys.argv[1:]:
+        if arg.find('=') > 0 and arg.split('=')[0] in args.keys(): args[arg.split('=')[0]] = int(arg.split('=')[1])
+      files = [a for a in sys.argv[1:] if a != 'replay' and a.find('=') < 0]
+      if not files:
+        files = [os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','inputtests','stressTestData.mqtt')]
+      ReplayBench(files, copies=args['copies'], nrfiles=args['files'], workers=args['workers'])
+      exit(0)
+    if 'bench' in sys.argv[1:]:
+      files = [a for a in sys.argv[1:] if a != 'bench']
+      if not files:
+        files = [os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','inputtests',a) for a in ['TTN-testsuite.mqtt','stressTestData.mqtt']]
+      Bench(files)
+      exit(0)
     verbose = False     # be verbose
     debug = False       # log level debug
     # show full received TTN MQTT record for this pattern
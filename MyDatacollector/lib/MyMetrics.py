@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Contact Teus Hagen webmaster@behouddeparel.nl to report improvements and bugs
+#
+# Copyright (C) 2022, Behoud de Parel, Teus Hagen, the Netherlands
+# Open Source Initiative  https://opensource.org/licenses/RPL-1.5
+#
+#   Unless explicitly acquired and licensed from Licensor under another
+#   license, the contents of this file are subject to the Reciprocal Public
+#   License ("RPL") Version 1.5, or subsequent versions as allowed by the RPL,
+#   and You may not copy or use this file in either source code or executable
+#   form, except in compliance with the terms and conditions of the RPL.
+#
+#   All software distributed under the RPL is provided strictly on an "AS
+#   IS" basis, WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESS OR IMPLIED, AND
+#   LICENSOR HEREBY DISCLAIMS ALL SUCH WARRANTIES, INCLUDING WITHOUT
+#   LIMITATION, ANY WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#   PURPOSE, QUIET ENJOYMENT, OR NON-INFRINGEMENT. See the RPL for specific
+#   language governing rights and limitations under the RPL.
+__license__ = 'RPL-1.5'
+
+# $Id: MyMetrics.py,v 1.1 2022/03/18 10:12:37 teus Exp teus $
+
+""" Pipeline stage metrics: counters, fixed bucket latency histograms and gauges.
+    A sample in the hot path is a bisect in a short tuple and two additions,
+    no locking (counts may be off by one on a rare thread switch).
+    Gauges are routines evaluated on exposition, e.g. queue depths.
+    Exposition on a local HTTP endpoint (Conf['port']) in Prometheus text
+    format, and/or a periodic JSON dump to Conf['file'].
+    Metrics reported by other processes (Export() lists in Remote, e.g. of
+    supervised workers) are exposed with an extra label e.g. worker="1".
+    Command line: bench [samples=N] timing of samples, and exposition example.
+"""
+__modulename__='$RCSfile: MyMetrics.py,v $'[10:-4]
+__version__ = "0." + "$Revision: 1.1 $"[11:-2]
+import sys
+def WHERE(fie=False):
+   global __modulename__, __version__
+   if fie:
+     try:
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
+     except: pass
+   return "%s V%s" % (__modulename__ ,__version__)
+
+try:
+    import threading
+    import json
+    from bisect import bisect_left
+    from time import time, sleep
+    try: from time import perf_counter as clock   # high resolution timer for latencies
+    except ImportError: from time import time as clock
+except ImportError as e:
+    sys.exit("FATAL: One of the import modules not found: %s" % e)
+
+# configurable options
+__options__ = ['port','address','file','interval','prefix']
+
+def stop():
+    global Exporter
+    for one in ['server','dumper']:
+      if not Exporter[one]: continue
+      try:
+        if one == 'server': Exporter[one].shutdown()
+        else: Exporter['stop'].set(); Exporter[one].join(5)
+      except: pass
+      Exporter[one] = None
+    if Conf['file']: Dump()  # last values
+
+Conf = {
+    'port': None,       # local HTTP port of Prometheus text endpoint, None: no endpoint
+    'address': '127.0.0.1', # listen address of the endpoint
+    'file': None,       # file for periodic JSON dump of metrics, None: no dump
+    'interval': 60,     # secs between JSON dumps
+    'prefix': 'mysense_', # metric names prefix
+    'log': None,        # MyLogger log routine
+    'STOP': stop,       # stop endpoint and dumper, last dump
+}
+
+# default latency buckets in secs: 50 usecs up to 10 secs
+Buckets = (0.00005,0.0001,0.00025,0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+
+class Counter(object):
+    __slots__ = ('name','help','labels','value')
+    kind = 'counter'
+    def __init__(self, name, help, labels):
+      self.name = name; self.help = help; self.labels = labels; self.value = 0
+    def inc(self, amount=1): self.value += amount
+    def Samples(self): return [('', self.labels, self.value)]
+    def Value(self): return self.value
+
+class Histogram(object):
+    __slots__ = ('name','help','labels','bounds','counts','sum')
+    kind = 'histogram'
+    def __init__(self, name, help, labels, buckets=Buckets):
+      self.name = name; self.help = help; self.labels = labels
+      self.bounds = tuple(sorted(buckets))
+      self.counts = [0]*(len(self.bounds)+1)   # last one: above highest bound
+      self.sum = 0.0
+    # add a sample, e.g. latency in secs
+    def observe(self, value):
+      self.counts[bisect_left(self.bounds, value)] += 1
+      self.sum += value
+    # add latency since start (clock() value)
+    def since(self, start):
+      value = clock()-start
+      self.counts[bisect_left(self.bounds, value)] += 1
+      self.sum += value
+    def Samples(self):
+      rts = []; total = 0
+      for indx in range(len(self.bounds)):
+        total += self.counts[indx]
+        rts.append(('_bucket', self.labels+(('le','%g' % self.bounds[indx]),), total))
+      total += self.counts[-1]
+      rts.append(('_bucket', self.labels+(('le','+Inf'),), total))
+      rts.append(('_sum', self.labels, self.sum))
+      rts.append(('_count', self.labels, total))
+      return rts
+    def Value(self):
+      return { 'count': sum(self.counts), 'sum': self.sum,
+               'buckets': dict([('%g' % b, c) for b, c in zip(self.bounds+(float('inf'),), self.counts)]) }
+
+class Gauge(object):
+    __slots__ = ('name','help','labels','function')
+    kind = 'gauge'
+    def __init__(self, name, help, labels, function):
+      self.name = name; self.help = help; self.labels = labels; self.function = function
+    def Value(self):
+      try: return self.function()
+      except: return None
+    def Samples(self):
+      value = self.Value()
+      return [] if value == None else [('', self.labels, value)]
+
+# metrics registry: (name, labels): metric
+Registry = {}
+RegistryLock = threading.Lock()
+
+def _register(cls, name, help, labels, *args):
+    key = (name, tuple(sorted(labels.items())))
+    with RegistryLock:
+      if not key in Registry: Registry[key] = cls(name, help, key[1], *args)
+      return Registry[key]
+
+# get or create a metric, labels as keyword arguments e.g. channel='archive'
+def counter(name, help='', **labels):
+    return _register(Counter, name, help, labels)
+
+def histogram(name, help='', buckets=Buckets, **labels):
+    return _register(Histogram, name, help, labels, buckets)
+
+# function is called on exposition, e.g. lambda: len(queue)
+def gauge(name, function, help='', **labels):
+    with RegistryLock: Registry.pop((name, tuple(sorted(labels.items()))), None)  # redefine
+    return _register(Gauge, name, help, labels, function)
+
+# metrics of other processes e.g. supervised workers: { (label, value): Export() list }
+# exposed with the extra label
+Remote = {}
+
+# all metrics as list of (name, kind, help, labels, samples, value) e.g. to report to another process
+def Export():
+    with RegistryLock: metrics = sorted(Registry.items(), key=lambda a: a[0])
+    return [(name, metric.kind, metric.help, labels, metric.Samples(), metric.Value()) for (name, labels), metric in metrics]
+
+# local and remote metrics sorted on name and labels
+def Metrics():
+    rts = Export()
+    for label, metrics in list(Remote.items()):
+      for name, kind, help, labels, samples, value in metrics:
+        rts.append((name, kind, help, labels+(label,), [(s, l+(label,), v) for s, l, v in samples], value))
+    return sorted(rts, key=lambda a: (a[0], a[3]))
+
+# all metrics in Prometheus text exposition format
+def Exposition():
+    lines = []; seen = None
+    for name, kind, help, labels, samples, value in Metrics():
+      name = Conf['prefix'] + name
+      if name != seen:
+        if help: lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        seen = name
+      for suffix, labels, value in samples:
+        label = ','.join(['%s="%s"' % (k, str(v).replace('\\','\\\\').replace('"','\\"')) for k, v in labels])
+        lines.append('%s%s%s %s' % (name, suffix, ('{%s}' % label) if label else '', repr(float(value)) if type(value) is float else str(value)))
+    return '\n'.join(lines) + '\n'
+
+# all metrics as dict: name{labels}: value
+def Snapshot():
+    rts = { 'timestamp': int(time()) }
+    for name, kind, help, labels, samples, value in Metrics():
+      if labels: name += '{%s}' % ','.join(['%s=%s' % (k, v) for k, v in labels])
+      rts[Conf['prefix'] + name] = value
+    return rts
+
+def Dump():
+    try:
+      with open(Conf['file']+'.tmp','w') as fd: json.dump(Snapshot(), fd, indent=1)
+      import os
+      os.rename(Conf['file']+'.tmp', Conf['file'])
+    except Exception as e:
+      if Conf['log']: Conf['log'](WHERE(True),'ERROR','Metrics dump to %s failed: %s' % (Conf['file'],str(e)))
+
+# exporter state
+Exporter = { 'server': None, 'dumper': None, 'stop': threading.Event() }
+
+def Dumper():
+    while not Exporter['stop'].wait(max(Conf['interval'],1)): Dump()
+
+# start HTTP endpoint and/or periodic JSON dump as defined in Conf
+def Start():
+    global Conf, Exporter
+    if Conf['port'] and not Exporter['server']:
+      try:
+        try: from http.server import BaseHTTPRequestHandler, HTTPServer
+        except ImportError: from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        try: from socketserver import ThreadingMixIn
+        except ImportError: from SocketServer import ThreadingMixIn
+        class Handler(BaseHTTPRequestHandler):
+          def do_GET(self):
+            if self.path.split('?')[0] in ['/','/metrics']:
+              body = Exposition().encode(); ctype = 'text/plain; version=0.0.4'
+            elif self.path.split('?')[0] == '/metrics.json':
+              body = json.dumps(Snapshot()).encode(); ctype = 'application/json'
+            else:
+              self.send_error(404); return
+            self.send_response(200)
+            self.send_header('Content-Type', ctype); self.send_header('Content-Length', str(len(body)))
+            self.end_headers(); self.wfile.write(body)
+          def log_message(self, *args): pass
+        class Server(ThreadingMixIn, HTTPServer):
+          daemon_threads = True; allow_reuse_address = True
+        Exporter['server'] = Server((Conf['address'], int(Conf['port'])), Handler)
+        thread = threading.Thread(name='MyMetrics', target=Exporter['server'].serve_forever)
+        thread.daemon = True; thread.start()
+        if Conf['log']: Conf['log'](WHERE(),'INFO','Metrics on http://%s:%d/metrics' % (Conf['address'],Exporter['server'].server_address[1]))
+      except Exception as e:
+        if Conf['log']: Conf['log'](WHERE(True),'ERROR','Metrics endpoint failed: %s' % str(e))
+    if Conf['file'] and not Exporter['dumper']:
+      Exporter['stop'].clear()
+      Exporter['dumper'] = threading.Thread(name='MyMetricsDump', target=Dumper)
+      Exporter['dumper'].daemon = True; Exporter['dumper'].start()
+    return True
+
+# timing of samples in the hot path, exposition example
+if __name__ == '__main__':
+    args = { 'samples': 1000000 }
+    for arg in sys.argv[1:]:
+      if arg.find('=') > 0 and arg.split('=')[0] in args.keys(): args[arg.split('=')[0]] = int(arg.split('=')[1])
+    if not 'bench' in sys.argv[1:]:
+      sys.exit("Usage: %s bench [samples=N]" % sys.argv[0])
+    hist = histogram('publish_seconds', 'publish latency', channel='archive')
+    count = counter('records_total', 'records received')
+    gauge('input_queue_records', lambda: 42, 'records in input queue')
+    values = [(nr % 1000)*0.00002 for nr in range(1000)]
+    loops = args['samples']//len(values)
+    start = clock()
+    for _ in range(loops):
+      for value in values: pass
+    empty = clock()-start
+    start = clock()
+    for _ in range(loops):
+      for value in values: hist.observe(value)
+    observe = clock()-start-empty
+    start = clock()
+    for _ in range(loops):
+      for value in values: count.inc()
+    inc = clock()-start-empty
+    start = clock()
+    for _ in range(loops):
+      for value in values: hist.since(clock())
+    since = clock()-start-empty
+    samples = loops*len(values)
+    print("%d samples: observe %.3f usecs, since(start) incl. clock %.3f usecs, counter inc %.3f usecs per sample" % (samples,observe*1000000/samples,since*1000000/samples,inc*1000000/samples))
+    assert observe*1000000/samples < 1.0
+    import socket   # free local port
+    sock = socket.socket(); sock.bind(('127.0.0.1',0)); Conf['port'] = sock.getsockname()[1]; sock.close()
+    Start()
+    try: from urllib.request import urlopen
+    except ImportError: from urllib2 import urlopen
+    text = urlopen('http://127.0.0.1:%d/metrics' % Exporter['server'].server_address[1]).read().decode()
+    assert text.find('mysense_publish_seconds_count{channel="archive"} %d' % (2*samples)) >= 0
+    print(''.join([a+'\n' for a in text.split('\n') if a.find('_bucket') < 0 or a.find('le="0.01"') > 0]))
+    stop()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Contact Teus Hagen webmaster@behouddeparel.nl to report improvements and bugs
+#
+# Copyright (C) 2022, Behoud de Parel, Teus Hagen, the Netherlands
+# Open Source Initiative  https://opensource.org/licenses/RPL-1.5
+#
+#   Unless explicitly acquired and licensed from Licensor under another
+#   license, the contents of this file are subject to the Reciprocal Public
+#   License ("RPL") Version 1.5, or subsequent versions as allowed by the RPL,
+#   and You may not copy or use this file in either source code or executable
+#   form, except in compliance with the terms and conditions of the RPL.
+#
+#   All software distributed under the RPL is provided strictly on an "AS
+#   IS" basis, WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESS OR IMPLIED, AND
+#   LICENSOR HEREBY DISCLAIMS ALL SUCH WARRANTIES, INCLUDING WITHOUT
+#   LIMITATION, ANY WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#   PURPOSE, QUIET ENJOYMENT, OR NON-INFRINGEMENT. See the RPL for specific
+#   language governing rights and limitations under the RPL.
+__license__ = 'RPL-1.5'
+
+# $Id: MyNotice.py,v 1.1 2022/03/12 14:21:05 teus Exp teus $
+
+""" Background dispatcher of event notices via email and Slack.
+    email() and slack() do not wait: notices are queued (bounded) to a
+    dispatcher thread. Notices per recipient are coalesced during Conf['digest']
+    secs into one digest email or one Slack message. Notices with a level in
+    Conf['urgent'] (default CRITICAL, ERROR) are sent without delay.
+    The SMTP connection is kept open and closed when idle for Conf['idle'] secs.
+    Slack notices are posted via a keep-alive HTTP session.
+    Command line: test [notices=N] [delay=secs] with local SMTP and HTTP stub servers.
+"""
+__modulename__='$RCSfile: MyNotice.py,v $'[10:-4]
+__version__ = "0." + "$Revision: 1.1 $"[11:-2]
+import sys
+def WHERE(fie=False):
+   global __modulename__, __version__
+   if fie:
+     try:
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
+     except: pass
+   return "%s V%s" % (__modulename__ ,__version__)
+
+try:
+    from time import time, sleep
+    import threading
+    import json
+    import smtplib
+    from email.mime.text import MIMEText
+    if sys.version[0] == '2':
+      import Queue
+    else:
+      import queue as Queue
+except ImportError as e:
+    sys.exit("FATAL: One of the import modules not found: %s" % e)
+
+# configurable options
+__options__ = ['from','SMTP','subject','queue','digest','urgent','idle','timeout']
+
+def stop():
+    global Dispatcher
+    if not Dispatcher['thread']: return
+    try:
+      Dispatcher['queue'].put(None, timeout=5)  # flush pending notices and stop
+      Dispatcher['thread'].join(timeout=3*Conf['timeout'])
+    except: pass
+
+Conf = {
+    'from': None,      # sender email address
+    'SMTP': None,      # SMTP server host[:port]
+    'subject': 'MySense: TTN data collector service TEST notice',
+    'header': 'Notice from TTN collector\n',
+    'slack': '_MySense_ TTN collector service *notice*!\n',
+    'queue': 200,      # max notices waiting for the dispatcher, overflow is dropped
+    'digest': 5*60,    # secs to coalesce notices per recipient into one digest
+    'urgent': ['FATAL','CRITICAL','ERROR'], # notice levels sent without digest delay
+    'idle': 5*60,      # secs to keep an idle SMTP connection open
+    'timeout': 30,     # SMTP and HTTP timeout in secs
+    'log': None,       # MyLogger log routine
+    'STOP': stop,      # flush pending notices
+}
+
+# dispatcher state
+Dispatcher = {
+    'queue': None,     # notices: (method, recipient, message, level)
+    'thread': None,
+    'lock': threading.Lock(),
+    'dropped': 0,      # nr of notices dropped on full queue
+    'failed': 0,       # nr of notices dropped on failed delivery
+}
+
+def Log(level, msg):
+    global Conf
+    if not Conf['log']:
+      try: from lib import MyLogger
+      except: import MyLogger
+      Conf['log'] = MyLogger.log
+    Conf['log'](WHERE(True),level,msg)
+
+def Start():
+    global Conf, Dispatcher
+    with Dispatcher['lock']:
+      if Dispatcher['thread'] and Dispatcher['thread'].is_alive(): return True
+      Dispatcher['queue'] = Queue.Queue(maxsize=max(int(Conf['queue']),1))
+      Dispatcher['thread'] = threading.Thread(name='MyNotice', target=Dispatch)
+      Dispatcher['thread'].daemon = True
+      Dispatcher['thread'].start()
+    return True
+
+# queue a notice for every recipient, returns False if not queued
+def Queued(method, recipients, message, level='ATTENT'):
+    global Dispatcher
+    if not recipients: return True
+    if not type(recipients) is list: recipients = recipients.split(',')
+    Start(); rts = True
+    for one in recipients:
+      if not one.strip(): continue
+      try: Dispatcher['queue'].put_nowait((method,one.strip(),message,level.upper()))
+      except Queue.Full:
+        Dispatcher['dropped'] += 1; rts = False
+        if Dispatcher['dropped'] == 1 or not Dispatcher['dropped']%100:
+          Log('ERROR',"Notice queue full: %d notices dropped" % Dispatcher['dropped'])
+    return rts
+
+def email(message, recipients, level='ATTENT'):
+    return Queued('email', recipients, message, level)
+
+def slack(message, urls, level='ATTENT'):
+    return Queued('slack', urls, message, level)
+
+# SMTP connection kept open between digests
+class SMTPsession(object):
+    def __init__(self):
+      self.smtp = None; self.used = 0; self.connects = 0
+
+    def connect(self):
+      global Conf
+      self.close()
+      self.smtp = smtplib.SMTP(Conf['SMTP'], timeout=Conf['timeout'])
+      self.connects += 1
+
+    def send(self, you, msg):
+      global Conf
+      for retry in range(2):  # server may have closed the connection
+        try:
+          if not self.smtp: self.connect()
+          self.smtp.sendmail(Conf['from'], [you], msg.as_string())
+          self.used = time()
+          return True
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, IOError) as e:
+          self.smtp = None
+          if retry: raise
+      return False
+
+    def idle(self):
+      global Conf
+      if self.smtp and time()-self.used > Conf['idle']: self.close()
+
+    def close(self):
+      if not self.smtp: return
+      try: self.smtp.quit()
+      except: pass
+      self.smtp = None
+
+# send one digest of notices to one recipient
+def Deliver(method, recipient, messages, smtp, session):
+    global Conf
+    try:
+      if method == 'email':
+        if not Conf['from'] or not Conf['SMTP']: return True
+        if len(messages) == 1:
+          msg = MIMEText(Conf['header'] + messages[0])
+          msg['Subject'] = Conf['subject']
+        else:
+          msg = MIMEText(Conf['header'] + ("\n%s\n" % ('-'*40)).join(messages))
+          msg['Subject'] = '%s (%d notices)' % (Conf['subject'],len(messages))
+        msg['From'] = Conf['from']
+        msg['To'] = recipient
+        smtp.send(recipient, msg)
+      elif method == 'slack':
+        url = recipient if recipient.find('://') > 0 else 'https://' + recipient
+        r = session.post(url, json={'text': Conf['slack'] + "\n".join(messages)}, timeout=Conf['timeout'])
+        if not r.ok: raise IOError("status code %d" % r.status_code)
+      return True
+    except Exception as e:
+      Log('ERROR',"%s notice failure to %s: %s" % (method,recipient,str(e)))
+    return False
+
+# dispatcher thread: coalesce notices per recipient and deliver digests
+def Dispatch():
+    global Conf, Dispatcher
+    import requests
+    session = requests.Session(); smtp = SMTPsession()
+    Pending = {}   # (method, recipient): [time first notice or 0 if urgent, [messages]]
+    running = True
+    while running:
+      if Pending:
+        wait = min([one[0] for one in Pending.values()])+Conf['digest']-time()
+      else: wait = Conf['idle']
+      try:
+        notice = Dispatcher['queue'].get(timeout=max(wait,0.01))
+        if notice == None: running = False
+        else:
+          try: Pending[notice[:2]][1].append(notice[2])
+          except KeyError: Pending[notice[:2]] = [time(),[notice[2]]]
+          if notice[3] in Conf['urgent']: Pending[notice[:2]][0] = 0  # send now
+          continue   # empty the queue first
+      except Queue.Empty: pass
+      now = time()
+      for key in list(Pending.keys()):
+        if running and Pending[key][0]+Conf['digest'] > now: continue
+        if not Deliver(key[0], key[1], Pending[key][1], smtp, session):
+          Dispatcher['failed'] += len(Pending[key][1])
+          Log('ERROR',"Dropped %d %s notice(s) to %s, in total %d dropped" % (len(Pending[key][1]),key[0],key[1],Dispatcher['failed']))
+        del Pending[key]
+      smtp.idle()
+    smtp.close(); session.close()
+    Dispatcher['thread'] = None
+
+# local SMTP and HTTP stub servers: notices are coalesced, sent over one
+# SMTP connection and the caller is not delayed by a slow SMTP server.
+# Urgent notices are not delayed, undeliverable notices are counted
+def Test(notices=50, delay=1):
+    global Conf
+    try: import socketserver
+    except ImportError: import SocketServer as socketserver
+    try: from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError: from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    Mails = []; Slacks = []; Connects = [0]
+    class SMTPstub(socketserver.StreamRequestHandler):
+      def reply(self, line): self.wfile.write((line+'\r\n').encode())
+      def handle(self):
+        Connects[0] += 1
+        self.reply('220 stub ESMTP')
+        while True:
+          line = self.rfile.readline().decode()
+          if not line: break
+          cmd = line[:4].upper()
+          if cmd in ('EHLO','HELO'): self.reply('250 stub')
+          elif cmd == 'DATA':
+            self.reply('354 end with .')
+            data = []
+            while True:
+              line = self.rfile.readline().decode()
+              if line in ('.\r\n','.\n',''): break
+              data.append(line)
+            sleep(delay)   # slow SMTP server
+            Mails.append(''.join(data)); self.reply('250 OK')
+          elif cmd == 'QUIT':
+            self.reply('221 bye'); break
+          else: self.reply('250 OK')
+    class HTTPstub(BaseHTTPRequestHandler):
+      def do_POST(self):
+        Slacks.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+        self.send_response(200); self.send_header('Content-Length','2'); self.end_headers()
+        self.wfile.write(b'ok')
+      def log_message(self, *args): pass
+    class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+      daemon_threads = True; allow_reuse_address = True
+    smtpd = Server(('127.0.0.1',0), SMTPstub)
+    httpd = Server(('127.0.0.1',0), HTTPstub)
+    for one in (smtpd, httpd):
+      threading.Thread(target=one.serve_forever).start()
+
+    Conf['SMTP'] = '127.0.0.1:%d' % smtpd.server_address[1]
+    Conf['from'] = 'collector@localhost'
+    Conf['digest'] = 2; Conf['log'] = lambda *args: sys.stderr.write("%s %s\n" % args[1:])
+    slackURL = 'http://127.0.0.1:%d/services/stub' % httpd.server_address[1]
+    start = time()
+    for nr in range(notices):
+      email("Kit project TEST, serial %d: malfunctioning sensor." % nr, 'admin@localhost,owner@localhost')
+      slack("Kit project TEST, serial %d: malfunctioning sensor." % nr, slackURL)
+    queued = time()-start
+    sleep(Conf['digest']+0.5)
+    email("Kit project TEST: one more notice.", 'admin@localhost')
+    while len(Mails) < 2 and time()-start < 4*delay+Conf['digest']: sleep(0.05)
+    urgent = time()
+    slack("Kit project TEST: broker is down.", slackURL, level='CRITICAL')
+    while len(Slacks) < 2 and time()-urgent < Conf['digest']+1: sleep(0.05)
+    urgent = time()-urgent
+    slack("Kit project TEST: undeliverable.", 'http://127.0.0.1:1/services/none', level='ERROR')
+    stop()
+    took = time()-start
+    smtpd.shutdown(); httpd.shutdown()
+    print("%d notices to 2 email recipients and 1 Slack URL, SMTP delay %d secs:" % (notices,delay))
+    print("    queued in %.3f msecs (%.1f usecs per notice)" % (queued*1000,queued*1000000/(3*notices)))
+    print("    %d SMTP connection(s), %d digest emails, %d Slack messages in %.1f secs" % (Connects[0],len(Mails),len(Slacks),took))
+    print("    urgent notice sent in %.2f secs (digest %d secs), %d undeliverable dropped" % (urgent,Conf['digest'],Dispatcher['failed']))
+    assert len(Mails) == 3 and len(Slacks) == 2 and Connects[0] == 1
+    assert urgent < Conf['digest'] and Dispatcher['failed'] == 1
+    for one in Mails[:2]:
+      assert one.count('Kit project TEST, serial') == notices, "notices lost"
+    assert Slacks[0]['text'].count('\n') == notices
+    assert queued < delay
+
+if __name__ == '__main__':
+    if not 'test' in sys.argv[1:]:
+      sys.exit("Usage: %s test [notices=N] [delay=secs]" % sys.argv[0])
+    args = { 'notices': 50, 'delay': 1 }
+    for arg in sys.argv[1:]:
+      if arg.find('=') > 0 and arg.split('=')[0] in args.keys(): args[arg.split('=')[0]] = int(arg.split('=')[1])
+    Test(**args)
@@ -137,10 +137,16 @@ class MyPrint:
         try:
           self.queue.put((time(),line,color), timeout=(self.timeout+1))
           #sleep(self.timeout)  # give thread time to do something
-        except self.queue.FULL: return False # skip message
+        except Queue.Full: return False # skip message
         return True
 
+    # in a forked child process the printer thread is not running: restart on next print
+    def Forked(self):
+        self.queue = Queue.Queue(maxsize=100)
+        self.STOP = False; self.RUNNING = False
+
     def stop(self):
+        if not self.RUNNING: return # nothing printed
         cnt = 0
         while not self.queue.empty() and cnt < 10: # empty Queue
            sleep(self.timeout)
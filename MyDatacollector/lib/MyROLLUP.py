@@ -0,0 +1,511 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Contact Teus Hagen webmaster@behouddeparel.nl to report improvements and bugs
+#
+# Copyright (C) 2022, Behoud de Parel, Teus Hagen, the Netherlands
+# Open Source Initiative  https://opensource.org/licenses/RPL-1.5
+#
+#   Unless explicitly acquired and licensed from Licensor under another
+#   license, the contents of this file are subject to the Reciprocal Public
+#   License ("RPL") Version 1.5, or subsequent versions as allowed by the RPL,
+#   and You may not copy or use this file in either source code or executable
+#   form, except in compliance with the terms and conditions of the RPL.
+#
+#   All software distributed under the RPL is provided strictly on an "AS
+#   IS" basis, WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESS OR IMPLIED, AND
+#   LICENSOR HEREBY DISCLAIMS ALL SUCH WARRANTIES, INCLUDING WITHOUT
+#   LIMITATION, ANY WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#   PURPOSE, QUIET ENJOYMENT, OR NON-INFRINGEMENT. See the RPL for specific
+#   language governing rights and limitations under the RPL.
+__license__ = 'RPL-1.5'
+
+# $Id: MyROLLUP.py,v 1.1 2022/03/26 11:05:47 teus Exp teus $
+
+""" Hourly and daily rollups of measurements per kit, output channel next to MyARCHIVE.
+    Per kit, period (local time) and field the aggregates count, sum, min, max and
+    sum of squares of the valid values (as archived: calibrated and rounded) are
+    kept in memory and added to the rollup tables (Conf['hourly'], Conf['daily'])
+    with multi-row upserts every Conf['age'] secs or at Conf['buckets'] aggregates.
+    Average: sum/count, standard deviation: sqrt(sumsq/count - average^2).
+    A late record (e.g. replayed from a spool) is added to the rollups of its own
+    hour and day: the upserts add to the aggregates. A record of a kit with the
+    same timestamp as a record rolled up in the last Conf['window'] secs is skipped.
+    The last rolled up record time is stored per rollup row (column last) in the
+    same upsert as the aggregates: on start the high water per kit and rollup table
+    is read from the DB, records rolled up before the (re)start are skipped.
+    Aggregates are kept in memory on a DB connection error, at most 10 times
+    Conf['buckets']: the oldest are dropped and counted (Dropped). On a query
+    error the aggregates are added one by one: only the failing ones are dropped.
+    Backfill: aggregates of the valid values (<field>_valid) of the raw measurements
+    tables are written (overwrite) into the rollup tables, per chunk of days.
+    Command line:
+        backfill [kits=reg exp] [since=YYYY-MM-DD] [until=YYYY-MM-DD] [chunk=days]
+            dflt all kits, since first measurement, until today
+        test [kits=N] [days=N] streams records via MyARCHIVE and rollups into a
+            SQLite stand-in DB, backfills and compares the rollups.
+"""
+__modulename__='$RCSfile: MyROLLUP.py,v $'[10:-4]
+__version__ = "0." + "$Revision: 1.1 $"[11:-2]
+import sys
+def WHERE(fie=False):
+   global __modulename__, __version__
+   if fie:
+     try:
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
+     except: pass
+   return "%s V%s" % (__modulename__ ,__version__)
+
+try:
+    import sys
+    if sys.version_info[0] >= 3: unicode = str
+    import os
+    import datetime
+    from time import time, sleep
+    import re
+    try: from collections.abc import Mapping  # data record may be a read only view
+    except ImportError: from collections import Mapping
+    import threading
+    try: from lib import MyARCHIVE
+    except: import MyARCHIVE
+except ImportError as e:
+    sys.exit("FATAL: One of the import modules not found: %s"% e)
+
+# configurable options
+__options__ = ['output','DB','log','level','DEBUG','age','buckets','window','hourly','daily']
+
+Conf = {
+    'output': False,     # output to rollup tables
+    'DB': None,          # measurements database module to be used
+    'log': None,         # MyLogger log routine
+    'level': None,       # MyLogger log level, default INFO
+    'DEBUG': False,      # Debugging info
+    'age': 5*60,         # max secs aggregates are kept in memory
+    'buckets': 5000,     # max (kit, period, field) aggregates in memory
+    'window': 6*60*60,   # secs rolled up record times per kit are kept to skip duplicates
+    'hourly': 'MeasurementsHourly', # rollup table per hour
+    'daily': 'MeasurementsDaily',   # rollup table per day
+    'STOP': None,        # flush aggregates on exit
+}
+
+# period start as DATETIME string per rollup table, also used as SQL DATE_FORMAT
+Periods = (('hourly','%Y-%m-%d %H:00:00'), ('daily','%Y-%m-%d 00:00:00'))
+Location = set(['geohash','longitude','latitude'])   # not rolled up
+
+# create rollup tables if not existing
+def Tables():
+    global Conf
+    if Conf.get('tables') == (Conf['hourly'],Conf['daily']): return True
+    for period, _ in Periods:
+      if not Conf['DB'].db_query("""CREATE TABLE IF NOT EXISTS %s (
+            id TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+                COMMENT 'date/time latest change',
+            kit varchar(40) NOT NULL COMMENT 'measurements table PROJECT_SERIAL',
+            datum datetime NOT NULL COMMENT 'start of %s period, local time',
+            field varchar(16) NOT NULL COMMENT 'measurements field',
+            count int(11) DEFAULT 0 COMMENT 'nr of valid values',
+            sum double DEFAULT NULL COMMENT 'sum of valid values',
+            min double DEFAULT NULL COMMENT 'minimum valid value',
+            max double DEFAULT NULL COMMENT 'maximum valid value',
+            sumsq double DEFAULT NULL COMMENT 'sum of squares of valid values',
+            last int(11) DEFAULT NULL COMMENT 'unix time last rolled up record',
+            UNIQUE KEY rollup_id (kit,datum,field)
+            ) ENGINE=InnoDB DEFAULT CHARSET=latin1
+            COMMENT='%s rollups of measurements'""" % (Conf[period],period[:-2],period), False):
+        Conf['log'](WHERE(True),'ERROR',"Unable to create rollup table %s" % Conf[period])
+        return False
+      # rollup tables of a previous version have no column last
+      if not Conf['DB'].db_query("SELECT column_name FROM information_schema.columns WHERE table_name = '%s' AND table_schema = '%s' AND column_name = 'last'" % (Conf[period],Conf['DB'].Conf['database']), True):
+        if not Conf['DB'].db_query("ALTER TABLE %s ADD COLUMN last int(11) DEFAULT NULL COMMENT 'unix time last rolled up record'" % Conf[period], False):
+          Conf['log'](WHERE(True),'ERROR',"Unable to add column last to rollup table %s" % Conf[period])
+          return False
+    Conf['tables'] = (Conf['hourly'],Conf['daily'])
+    return True
+
+# multi-row upsert of aggregates (kit,datum,field,count,sum,min,max,sumsq,last)
+# add: add to existing aggregates (stream), else overwrite (backfill)
+def UpsertQuery(table, add=True):
+    if add:
+      update = "count=count+VALUES(count),sum=sum+VALUES(sum),min=LEAST(min,VALUES(min)),max=GREATEST(max,VALUES(max)),sumsq=sumsq+VALUES(sumsq),last=GREATEST(COALESCE(last,0),VALUES(last))"
+    else:
+      update = ','.join(['%s=VALUES(%s)' % (a,a) for a in ['count','sum','min','max','sumsq','last']])
+    return "INSERT INTO %s (kit,datum,field,count,sum,min,max,sumsq,last) VALUES (%%s,%%s,%%s,%%s,%%s,%%s,%%s,%%s,%%s) ON DUPLICATE KEY UPDATE %s" % (table,update)
+
+# in memory aggregates: { (period, kit, datum): { field: [count,sum,min,max,sumsq,last] } }
+Pending = {}
+Last = {}                       # (period, kit): last rolled up record before start
+Seen = {}                       # kit: { timestamp: True } of rolled up records in window
+Lock = threading.RLock()        # aggregates are shared by publish and the flusher thread
+FlushLock = threading.RLock()
+Flusher = None                  # thread to flush aggregates on age
+ErrorCnt = 0
+Dropped = 0                     # aggregates dropped on memory limit or query error
+
+# add aggregate of values to in memory aggregate
+def Merge(key, field, agg):
+    global Pending
+    one = Pending.setdefault(key,{})
+    try: cur = one[field]
+    except KeyError:
+      one[field] = list(agg); return
+    cur[0] += agg[0]; cur[1] += agg[1]; cur[4] += agg[4]
+    if agg[2] < cur[2]: cur[2] = agg[2]
+    if agg[3] > cur[3]: cur[3] = agg[3]
+    if agg[5] > cur[5]: cur[5] = agg[5]
+
+# high water of a kit in a rollup table on start: last rolled up record of latest period
+# raises IOError if it cannot be obtained
+def Seed(period, kit):
+    global Conf, Last
+    if not Tables(): raise IOError("No rollup tables")
+    rows = Conf['DB'].db_query("SELECT MAX(last) FROM %s WHERE kit = '%s' AND datum = (SELECT MAX(datum) FROM %s WHERE kit = '%s')" % (Conf[period],kit,Conf[period],kit), True)
+    if rows == False and type(rows) is bool: raise IOError("DB error on rollup high water of %s" % kit)
+    try: last = int(rows[0][0] or 0)
+    except: last = 0
+    with Lock: Last.setdefault((period,kit), last)
+
+# record of kit at timestamp is not yet rolled up: remember it in the window. Lock is set
+def Rolled(kit, timestamp):
+    global Seen
+    seen = Seen.setdefault(kit,{})
+    if timestamp in seen: return False
+    seen[timestamp] = True
+    if not len(seen) % 64:   # forget records out of the window
+      oldest = max(seen.keys())-Conf['window']
+      for one in [a for a in seen.keys() if a < oldest]: del seen[one]
+    return True
+
+# entry point to add a measurements record to the rollups
+# returns True: OK (or nothing to roll up), string: reason not rolled up
+def publish(**args):
+    global Conf, Pending, Last, Flusher
+    try:
+      info = args['info']; data = args['data']; artifacts = args['artifacts']
+    except: return "Error in publish() arguments"
+    if not 'Forward data' in artifacts: return "Not rolled up"
+    try: timestamp = int(data['timestamp'])
+    except: return "No timestamp to roll up"
+    if 'data' in data.keys() and isinstance(data['data'],Mapping) and len(data['data']):
+      data = data['data']
+    else: return "No data to roll up"
+    try: kit = info['DATAid'] if info['DATAid'] else info['id']['project']+'_'+info['id']['serial']
+    except: return "No kit table name"
+    # skip records which are not archived
+    if len(artifacts) > 1:
+      if type(MyARCHIVE.Conf['dontSkip']) in [str,unicode]: MyARCHIVE.Conf['dontSkip'] = re.compile(MyARCHIVE.Conf['dontSkip'],re.I)
+      for one in artifacts:
+        if not MyARCHIVE.Conf['dontSkip'].match(one): return "Rollup is skipped: %s" % one
+    if not MyARCHIVE.ValidKit(info): return True  # no valid measurements
+    if type(MyARCHIVE.Conf['omit']) in [str,unicode]: MyARCHIVE.Conf['omit'] = re.compile(MyARCHIVE.Conf['omit'])
+    if not MyARCHIVE.Conf['DB']: MyARCHIVE.Conf['DB'] = Conf['DB']  # archive calibration
+    for period, _ in Periods:
+      if not (period,kit) in Last: Seed(period, kit)
+    with Lock:
+      periods = [(p, datetime.datetime.fromtimestamp(timestamp).strftime(f)) for p, f in Periods if Last[(p,kit)] < timestamp]
+      if not periods: return "Record already rolled up"
+      if not Rolled(kit, timestamp): return "Record already rolled up"
+      plan = MyARCHIVE.CalPlan(info); seen = set()
+      for sensor, values in data.items():   # ('BME680', [(u'rv', 69.3, ...),...])
+        if not type(values) in [list,tuple]: continue
+        for value in values:
+          try:
+            field = value[0]
+            if field in seen or field in Location: continue   # first value of a field is archived
+            seen.add(field)
+            if not type(value[1]) in [int,float] or type(value[1]) is bool: continue
+            if MyARCHIVE.Conf['omit'].match(field) or not Conf['DB'].SupportedFields.match(field): continue
+            if Conf['DB'].getFieldInfo(field)[1] == None: continue  # boolean
+            value = MyARCHIVE.Calibrated(plan,field,value[1],value[2:])
+          except: continue
+          for period, datum in periods:
+            Merge((period,kit,datum),field,(1,value,value,value,value*value,timestamp))
+      flush = len(Pending) >= Conf['buckets']
+    if flush: Flush()
+    if Flusher == None:
+      Flusher = threading.Thread(target=FlushOnAge, name='RollupFlusher')
+      Flusher.daemon = True
+      Flusher.start()
+    if ErrorCnt > 10: raise ValueError("ERROR %d: DB rollup problems" % ErrorCnt)
+    return True
+
+# flusher thread: flush aggregates every max age secs
+def FlushOnAge():
+    global Conf
+    while True:
+      sleep(max(Conf['age'],1))
+      try: Flush()
+      except Exception as e:
+        Conf['log'](WHERE(True),'ERROR',"Flush of rollup aggregates failed: %s" % str(e))
+
+# add in memory aggregates to the rollup tables with multi-row upserts
+# raises IOError on a DB connection error: aggregates are kept for a retry
+def Flush():
+    global Conf, Pending, ErrorCnt, Dropped
+    with FlushLock:
+      with Lock:
+        todo = Pending; Pending = {}
+      if not todo: return True
+      rows = {}
+      for (period, kit, datum), fields in todo.items():
+        for field, agg in fields.items():
+          rows.setdefault(period,[]).append((kit,datum,field)+tuple(agg))
+      for period, _ in Periods:
+        if not period in rows: continue
+        rws = rows[period]
+        try:
+          if not Tables(): raise IOError("No rollup tables")
+          if Conf['DB'].db_executemany(UpsertQuery(Conf[period]),rws):
+            ErrorCnt = 0; del rows[period]; continue
+          # query error: add aggregates one by one, only the failing ones are dropped
+          bad = len([r for r in rws if not Conf['DB'].db_executemany(UpsertQuery(Conf[period]),[r])]) if len(rws) > 1 else 1
+        except IOError: # keep not added aggregates for a retry
+          Keep(rows)
+          ErrorCnt += 1
+          Conf['log'](WHERE(True),'ERROR',"DB connection error: rollup aggregates kept in memory")
+          raise IOError("DB connection error")
+        del rows[period]
+        if not bad:
+          ErrorCnt = 0; continue
+        ErrorCnt += 1; Dropped += bad
+        Conf['log'](WHERE(True),'ERROR',"Failed to add %d of %d aggregates into table %s (%d dropped in total)" % (bad,len(rws),Conf[period],Dropped))
+    return True
+
+# keep not added aggregates in memory for a next flush, oldest periods are dropped
+# if there are more as 10 times max aggregates
+def Keep(rows):
+    global Pending, Dropped
+    dropped = 0
+    with Lock:
+      for prd, rws in rows.items():
+        for row in rws: Merge((prd,row[0],row[1]),row[2],row[3:])
+      excess = len(Pending)-10*max(Conf['buckets'],1)
+      if excess > 0:
+        for key in sorted(Pending.keys(), key=lambda k: k[2])[:excess]:
+          dropped += len(Pending.pop(key))
+        Dropped += dropped
+    if dropped:
+      Conf['log'](WHERE(True),'ERROR',"Rollup aggregates in memory are full: %d oldest dropped (%d dropped in total)" % (dropped,Dropped))
+
+# on exit: write all aggregates
+def FlushAll():
+    try: return Flush()
+    except Exception as e:
+      Conf['log'](WHERE(True),'ERROR',"Rollup aggregates are lost: %s" % str(e))
+    return False
+Conf['STOP'] = FlushAll
+
+# rollups from raw measurements tables: kits reg exp (dflt all), since/until: datetime
+# (dflt first measurement/today 00:00), per chunk of days. Rollups of the periods are overwritten.
+# returns (nr of raw measurements, nr of hourly rollups, nr of daily rollups)
+def Backfill(kits=None, since=None, until=None, chunk=7):
+    global Conf
+    DB = Conf['DB']
+    if not Tables(): return None
+    if until == None: until = datetime.datetime.combine(datetime.date.today(),datetime.time())
+    tables = DB.db_tables()
+    try: registered = set(['%s_%s' % tuple(a) for a in DB.db_query("SELECT DISTINCT project, serial FROM Sensors", True)])
+    except: registered = set()
+    tables = sorted([a for a in (tables or []) if a in registered and (not kits or re.match(kits,a))])
+    totals = [0,0,0]
+    for kit in tables:
+      fields = []
+      for one in DB.db_query("SELECT column_name FROM information_schema.columns WHERE table_name = '%s' AND table_schema = '%s' AND column_name like '%%_valid'" % (kit,DB.Conf['database']), True):
+        field = one[0][:-6]
+        if field in Location or not DB.SupportedFields.match(field): continue
+        try:
+          if DB.getFieldInfo(field)[1] == None: continue
+        except: continue
+        fields.append(field)
+      if not fields: continue
+      start = since
+      if start == None:
+        try: start = DB.db_query("SELECT MIN(datum) FROM %s" % kit, True)[0][0]
+        except: start = None
+        if not start: continue
+        if not isinstance(start, datetime.datetime): start = datetime.datetime.strptime(str(start)[:19],'%Y-%m-%d %H:%M:%S')
+      start = datetime.datetime.combine(start.date(),datetime.time())
+      timing = time(); counts = [0,0,0]
+      while start < until:
+        end = min(start+datetime.timedelta(days=max(int(chunk),1)),until)
+        aggs = []
+        for field in fields:
+          valid = "CASE WHEN %s_valid THEN %s END" % (field,field)
+          aggs.append("COUNT(%s),SUM(%s),MIN(%s),MAX(%s),SUM(%s*%s)" % (valid,valid,valid,valid,valid,valid))
+        rows = DB.db_query("SELECT DATE_FORMAT(datum,'%s') AS hour, COUNT(*), UNIX_TIMESTAMP(MAX(datum)), %s FROM %s WHERE datum >= '%s' AND datum < '%s' GROUP BY hour" % (Periods[0][1],','.join(aggs),kit,start.strftime('%Y-%m-%d %H:%M:%S'),end.strftime('%Y-%m-%d %H:%M:%S')), True)
+        hourly = []; daily = {}
+        for row in (rows if rows else []):
+          counts[0] += int(row[1])
+          for nr, field in enumerate(fields):
+            agg = row[3+5*nr:8+5*nr]
+            if not agg[0]: continue
+            agg = (int(agg[0]),float(agg[1]),float(agg[2]),float(agg[3]),float(agg[4]),int(row[2]))
+            hourly.append((kit,str(row[0]),field)+agg)
+            day = (str(row[0])[:10]+' 00:00:00',field)
+            if not day in daily: daily[day] = list(agg)
+            else:
+              cur = daily[day]
+              cur[0] += agg[0]; cur[1] += agg[1]; cur[4] += agg[4]
+              cur[2] = min(cur[2],agg[2]); cur[3] = max(cur[3],agg[3]); cur[5] = max(cur[5],agg[5])
+        daily = [(kit,)+day+tuple(agg) for day, agg in sorted(daily.items())]
+        for period, rws in [('hourly',hourly),('daily',daily)]:
+          if rws and not DB.db_executemany(UpsertQuery(Conf[period],add=False),rws):
+            Conf['log'](WHERE(True),'ERROR',"Failed to backfill %d rollups of %s into %s" % (len(rws),kit,Conf[period]))
+        counts[1] += len(hourly); counts[2] += len(daily)
+        start = end
+      Conf['log'](WHERE(),'INFO',"Backfilled %s: %d measurements into %d hourly, %d daily rollups in %.1f secs" % (kit,counts[0],counts[1],counts[2],time()-timing))
+      totals = [a+b for a, b in zip(totals,counts)]
+    return tuple(totals)
+
+# test: records streamed via MyARCHIVE (raw tables) and rollups, backfill into other tables, compare
+# uses SQLite (file) as stand-in for MySQL (ON CONFLICT iso ON DUPLICATE KEY, strftime iso DATE_FORMAT)
+def Test(kits=5, days=2):
+    import sqlite3, tempfile, MyDB
+    class SQLiteDB(object):   # stand-in for MyDB with measurements tables in SQLite DB file
+      SupportedFields = MyDB.SupportedFields
+      Sensor_fields = MyDB.Sensor_fields
+      getFieldInfo = staticmethod(MyDB.getFieldInfo)
+      Conf = { 'database': 'main' }
+      def __init__(self, fields):
+        self.dir = tempfile.mkdtemp()
+        self.fd = sqlite3.connect(os.path.join(self.dir,'test.db'), check_same_thread=False)
+        self.fd.execute("CREATE TABLE Sensors (project VARCHAR(16), serial VARCHAR(16))")
+        for kit in range(kits):
+          self.fd.execute("CREATE TABLE TEST_%d (datum DATETIME UNIQUE, sensors VARCHAR(64), %s)" % (kit,','.join(['%s DECIMAL, %s_valid BOOL' % (f,f) for f in fields])))
+          self.fd.execute("INSERT INTO Sensors VALUES ('TEST','%d')" % kit)
+        self.fd.commit(); self.lock = threading.RLock()
+      def SQL(self, query):
+        query = query.replace('FROM_UNIXTIME(%s)',"datetime(%s,'unixepoch','localtime')")
+        query = query.replace('%s','?').replace(' ENGINE=InnoDB DEFAULT CHARSET=latin1','')
+        query = re.sub(r"UNIX_TIMESTAMP\(([^()]*(\([^()]*\))?)\)", r"CAST(strftime('%s',\1,'utc') AS INTEGER)", query)
+        query = re.sub(r"DATE_FORMAT\(([^,]*),('[^']*')\)", r"strftime(\2,\1)", query)
+        query = re.sub(r" COMMENT(=| )'[^']*'", '', query).replace(' ON UPDATE CURRENT_TIMESTAMP','')
+        query = query.replace('int(11)','INTEGER').replace('UNIQUE KEY rollup_id','UNIQUE')
+        if query.find(' ON DUPLICATE KEY UPDATE ') > 0:
+          insert, update = query.split(' ON DUPLICATE KEY UPDATE ')
+          update = re.sub(r"VALUES\((\w+)\)", r"excluded.\1", update)
+          update = update.replace('LEAST(','MIN(').replace('GREATEST(','MAX(')
+          query = insert + ' ON CONFLICT(kit,datum,field) DO UPDATE SET ' + update
+        return query
+      def db_query(self, query, answer):
+        if query.find('information_schema.columns') > 0:
+          table = re.search(r"table_name = '([^']*)'", query).group(1)
+          column = re.search(r"column_name = '([^']*)'", query)
+          return [(a[1],) for a in self.fd.execute("PRAGMA table_info(%s)" % table).fetchall() if (a[1] == column.group(1) if column else a[1].endswith('_valid'))]
+        with self.lock:
+          rows = self.fd.execute(self.SQL(query)).fetchall()
+          self.fd.commit()
+        return rows if answer else True
+      def db_executemany(self, query, rows):
+        with self.lock:
+          if query.find(' ON DUPLICATE KEY') > 0 and query.find('INSERT INTO TEST_') == 0:
+            query = query[:query.find(' ON DUPLICATE KEY')].replace('INSERT INTO','INSERT OR REPLACE INTO')
+          self.fd.executemany(self.SQL(query), [[(str(v) if isinstance(v,datetime.datetime) else v) for v in r] for r in rows])
+          self.fd.commit()
+        return True
+      def db_tables(self):
+        return set([a[0] for a in self.fd.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()])
+
+    import random
+    fields = ['temp','rv','luchtdruk','pm10','pm25']
+    log = lambda *args: sys.stderr.write("%s %s: %s\n" % args) if args[1] in ['ERROR','CRITICAL'] else None
+    DB = SQLiteDB(fields)
+    for module in [MyARCHIVE.Conf, Conf]:
+      module.update({ 'DB': DB, 'log': log, 'output': True, 'DEBUG': False })
+    MyARCHIVE.Conf['rows'] = 100; MyARCHIVE.Conf['age'] = 24*60*60
+    Conf['age'] = 24*60*60; Conf['buckets'] = 200  # several partial flushes
+    start = int(time()) - days*24*60*60
+    start -= start % (24*60*60)
+    infos = [{ 'id': {'project': 'TEST', 'serial': str(kit)}, 'DATAid': 'TEST_%d' % kit, 'valid': 1, 'active': 1,
+              'fields': set(fields), 'unknown_fields': set([]), 'sensors': [] } for kit in range(kits)]
+    records = days*24*12; timing = time(); random.seed(1); replays = []; late = []; duplicates = 0
+    for rec in range(records):
+      for kit in range(kits):
+        infos[kit]['valid'] = None if kit == 0 and rec < records//3 else 1  # kit 0 in repair
+        record = { 'timestamp': start+rec*5*60+kit, 'data': {
+              'BME280': [('temp',round(random.uniform(-5,30),2)),('rv',round(random.uniform(30,100),1)),('luchtdruk',random.randint(990,1030))],
+              'SDS011': [('pm10',round(random.uniform(0,80),2)),('pm25',round(random.uniform(0,40),2))] } }
+        MyARCHIVE.publish(info=infos[kit], artifacts=['Forward data'], data=record)
+        if kit == 1 and records//2 <= rec < records//2+36: # channel down: rolled up late
+          late.append((infos[kit],record)); continue
+        publish(info=infos[kit], artifacts=['Forward data'], data=record)
+        if rec % 50 == 0:   # duplicate record
+          duplicates += publish(info=infos[kit], artifacts=['Forward data'], data=record) == "Record already rolled up"
+        if rec >= records-24: replays.append((infos[kit],record))
+    MyARCHIVE.Flush()
+    rolled = [publish(info=info, artifacts=['Forward data'], data=record) for info, record in late]
+    print("%d late records rolled up in own hours, %d duplicates skipped" % (rolled.count(True),duplicates))
+    executemany = DB.db_executemany   # DB is down: aggregates are kept
+    def Down(query, rows):
+      if query.find('INSERT INTO Measurements') == 0: raise IOError("DB connection error")
+      return executemany(query, rows)
+    DB.db_executemany = Down
+    try: Flush(); kept = False
+    except IOError: kept = len(Pending) > 0
+    DB.db_executemany = executemany
+    Flush()
+    streamed = time()-timing
+    raw = sum([DB.db_query("SELECT COUNT(*) FROM TEST_%d" % kit, True)[0][0] for kit in range(kits)])
+    print("streamed %d records of %d kits in %.2f secs (archive and rollups)" % (raw,kits,streamed))
+    differences = 0
+    if not kept:
+      differences += 1; print("DIFFERENCE failed rollup upsert: aggregates are dropped")
+    if rolled.count(True) != len(late):
+      differences += 1; print("DIFFERENCE late records are not rolled up")
+    Last.clear(); Seen.clear()  # restart: replayed records are skipped via high water in the DB
+    replayed = [publish(info=info, artifacts=['Forward data'], data=record) for info, record in replays]
+    Flush()
+    print("replay after restart: %d of %d records skipped as already rolled up" % (replayed.count("Record already rolled up"),len(replays)))
+
+    Conf['hourly'] = 'BackfillHourly'; Conf['daily'] = 'BackfillDaily'
+    timing = time()
+    totals = Backfill(until=datetime.datetime.fromtimestamp(start+(days+1)*24*60*60), chunk=1)
+    print("backfilled %d measurements into %d hourly and %d daily rollups in %.2f secs" % (totals[0],totals[1],totals[2],time()-timing))
+
+    for streams, backfills in [('MeasurementsHourly','BackfillHourly'),('MeasurementsDaily','BackfillDaily')]:
+      one = dict([((r[0],r[1],r[2]),r[3:]) for r in DB.db_query("SELECT kit,datum,field,count,sum,min,max,sumsq,last FROM %s" % streams, True)])
+      two = dict([((r[0],r[1],r[2]),r[3:]) for r in DB.db_query("SELECT kit,datum,field,count,sum,min,max,sumsq,last FROM %s" % backfills, True)])
+      if set(one.keys()) != set(two.keys()):
+        differences += 1; print("DIFFERENCE %s and %s rollups: %d keys differ" % (streams,backfills,len(set(one.keys())^set(two.keys()))))
+      for key in set(one.keys()) & set(two.keys()):
+        a = one[key]; b = two[key]
+        if a[0] != b[0] or a[2] != b[2] or a[3] != b[3] or a[5] != b[5] or abs(a[1]-b[1]) > 1e-6*max(1,abs(b[1])) or abs(a[4]-b[4]) > 1e-6*max(1,abs(b[4])):
+          differences += 1; print("DIFFERENCE %s %s: %s != %s" % (streams,str(key),str(a),str(b)))
+      print("%s: %d rollups (%d raw rows), e.g. %s" % (streams,len(one),raw,str(sorted(one.items())[0])))
+    excluded = DB.db_query("SELECT COUNT(*) FROM MeasurementsHourly WHERE kit = 'TEST_0' AND datum < '%s'" % datetime.datetime.fromtimestamp(start+(records//3)*5*60-3600).strftime('%Y-%m-%d %H:00:00'), True)[0][0]
+    if excluded:
+      differences += 1; print("DIFFERENCE invalid measurements of TEST_0 are rolled up")
+    # aggregates kept in memory are limited
+    hours = [(datetime.datetime(2000,1,1)+datetime.timedelta(hours=nr)).strftime(Periods[0][1]) for nr in range(10*Conf['buckets']+10)]
+    dropped = Dropped
+    Keep({ 'hourly': [('TEST_9',hour,'temp',1,1.0,1.0,1.0,1.0,0) for hour in hours] })
+    if len(Pending) > 10*Conf['buckets'] or Dropped-dropped != 10 or ('hourly','TEST_9',hours[0]) in Pending:
+      differences += 1; print("DIFFERENCE aggregates kept in memory are not limited")
+    Pending.clear()
+    print("%d differences between streamed and backfilled rollups" % differences)
+    return differences
+
+# test main loop
+if __name__ == '__main__':
+    if 'test' in sys.argv[1:]:
+      args = { 'kits': 5, 'days': 2 }
+      for arg in sys.argv[1:]:
+        if arg.find('=') > 0 and arg.split('=')[0] in args.keys(): args[arg.split('=')[0]] = int(arg.split('=')[1])
+      differences = Test(**args)
+      sys.stdout.flush()
+      os._exit(1 if differences else 0)
+    if 'backfill' in sys.argv[1:]:
+      args = { 'kits': None, 'since': None, 'until': None, 'chunk': 7 }
+      for arg in sys.argv[1:]:
+        if arg.find('=') > 0 and arg.split('=')[0] in args.keys(): args[arg.split('=')[0]] = arg.split('=',1)[1]
+      for arg in ['since','until']:
+        if args[arg]: args[arg] = datetime.datetime.strptime(args[arg],'%Y-%m-%d')
+      args['chunk'] = int(args['chunk'])
+      import MyDB
+      Conf['DB'] = MyDB
+      Conf['log'] = lambda *args: sys.stderr.write("%s %s: %s\n" % args)
+      if MyDB.Conf['fd'] == None and not MyDB.db_connect():
+        sys.exit("Unable to connect to database")
+      totals = Backfill(**args)
+      if totals: print("Backfilled %d measurements into %d hourly and %d daily rollups" % totals)
+      exit(0 if totals else 1)
+    print("Usage: %s test [kits=N] [days=N] | backfill [kits=reg exp] [since=YYYY-MM-DD] [until=YYYY-MM-DD] [chunk=days]" % sys.argv[0])
+    exit(1)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Contact Teus Hagen webmaster@behouddeparel.nl to report improvements and bugs
+#
+# Copyright (C) 2022, Behoud de Parel, Teus Hagen, the Netherlands
+# Open Source Initiative  https://opensource.org/licenses/RPL-1.5
+#
+#   Unless explicitly acquired and licensed from Licensor under another
+#   license, the contents of this file are subject to the Reciprocal Public
+#   License ("RPL") Version 1.5, or subsequent versions as allowed by the RPL,
+#   and You may not copy or use this file in either source code or executable
+#   form, except in compliance with the terms and conditions of the RPL.
+#
+#   All software distributed under the RPL is provided strictly on an "AS
+#   IS" basis, WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESS OR IMPLIED, AND
+#   LICENSOR HEREBY DISCLAIMS ALL SUCH WARRANTIES, INCLUDING WITHOUT
+#   LIMITATION, ANY WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#   PURPOSE, QUIET ENJOYMENT, OR NON-INFRINGEMENT. See the RPL for specific
+#   language governing rights and limitations under the RPL.
+__license__ = 'RPL-1.5'
+
+# $Id: MyRecord.py,v 1.1 2022/03/01 10:12:31 teus Exp teus $
+
+""" Read only views of (MDEF) data records for output channels.
+    The data collector creates one read only view of a data record, which is
+    shared by all output channels iso a deep copy of the record per channel.
+    Dicts in the view are read only mappings, lists are converted to tuples.
+    An output channel module which changes the data record in place defines
+    Conf['mutable'] = True and will get a private (deep) copy: RecordCopy(view).
+    The kit cache entry (info) is handed over as a read only snapshot: InfoView(info).
+    Command line: micro benchmark deep copy per channel vs one read only view.
+"""
+__modulename__='$RCSfile: MyRecord.py,v $'[10:-4]
+__version__ = "0." + "$Revision: 1.1 $"[11:-2]
+import sys
+def WHERE(fie=False):
+   global __modulename__, __version__
+   if fie:
+     try:
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
+     except: pass
+   return "%s V%s" % (__modulename__ ,__version__)
+
+try: from collections.abc import Mapping
+except ImportError: from collections import Mapping
+try: from types import MappingProxyType
+except ImportError:    # Python 2: read only dict
+  class MappingProxyType(dict):
+    __slots__ = ()
+    def _readonly(self, *args, **kwargs):
+      raise TypeError("read only data record")
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+# returns read only view of a data record (nested dicts, lists, tuples)
+def RecordView(record):
+    if isinstance(record, MappingProxyType): return record   # already a view
+    if type(record) is dict:
+      return MappingProxyType(dict([(key, RecordView(value)) for key, value in record.items()]))
+    if type(record) in [list,tuple]:
+      return tuple([RecordView(value) for value in record])
+    return record   # immutable as str, int, float, None
+
+# read only snapshot of a kit cache entry (info) for output channels, one per record:
+# the collector keeps updating the kit cache entry while channels publish the record.
+# Sensor type entries (SensorTypes catalog) are shared as is: a changed sensor type
+# gets a new catalog entry. Output channels keep their own state per kit.
+def InfoView(info):
+    if isinstance(info, MappingProxyType): return info   # already a snapshot
+    snapshot = {}
+    for key, value in info.items():
+      if key == 'sensors' and type(value) in [list,tuple]: value = tuple(value)
+      elif type(value) in [set,frozenset]: value = frozenset(value)
+      else: value = RecordView(value)
+      snapshot[key] = value
+    return MappingProxyType(snapshot)
+
+# copy on write: returns private changeable copy of a view (read only mappings -> dict)
+# lists and tuples are copied as lists: a view has turned the lists into tuples
+def RecordCopy(view):
+    if isinstance(view, Mapping):
+      return dict([(key, RecordCopy(value)) for key, value in view.items()])
+    if type(view) in [list,tuple]:
+      return [RecordCopy(value) for value in view]
+    return view
+
+# micro benchmark: deep copy of data record for every output channel vs one view
+if __name__ == '__main__':
+    import copy
+    from time import time
+    try:
+        import Output_test_data
+    except:
+        print("Please provide input test data: ident and data.")
+        exit(1)
+    channels = 4     # nr of output channels eg archive, community, console, monitor
+    loops = 20000
+    for arg in sys.argv[1:]:
+      if arg.find('channels=') == 0: channels = int(arg[9:])
+      elif arg.find('loops=') == 0: loops = int(arg[6:])
+    records = [one['record'] for one in Output_test_data.data]
+    # add MQTT gateway meta info as seen in records from TTN
+    for one in records:
+      one['net'] = { 'TTN_id': 'kit-id', 'TTN_app': 'appl-id', 'type': 'TTNV3',
+          'gateways': [{'rssi': -64, 'snr': 11, 'gtw_id': 'eui-000080029c641f55', 'geohash': 'u1hjx4xkt72'}]*3 }
+
+    for one in records: # check view is equal and read only
+      view = RecordView(one)
+      assert RecordCopy(view)['data'].keys() == one['data'].keys()
+      try:
+        view['timestamp'] = 0
+        raise AssertionError("view is not read only")
+      except TypeError: pass
+
+    start = time()
+    for _ in range(loops):
+      for one in records:
+        for chnl in range(channels): rcrd = copy.deepcopy(one)
+    deep = time()-start
+    start = time()
+    for _ in range(loops):
+      for one in records:
+        view = RecordView(one)
+        for chnl in range(channels): rcrd = view
+    views = time()-start
+    print("%d records, %d output channels:" % (loops*len(records),channels))
+    print("    deepcopy per channel: %7.3f secs, %6.1f usecs/record" % (deep, deep*1000000.0/(loops*len(records))))
+    print("    one read only view:   %7.3f secs, %6.1f usecs/record (%.1f times faster)" % (views, views*1000000.0/(loops*len(records)),deep/max(views,0.000001)))
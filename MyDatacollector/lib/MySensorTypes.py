@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Contact Teus Hagen webmaster@behouddeparel.nl to report improvements and bugs
+#
+# Copyright (C) 2022, Behoud de Parel, Teus Hagen, the Netherlands
+# Open Source Initiative  https://opensource.org/licenses/RPL-1.5
+#
+#   Unless explicitly acquired and licensed from Licensor under another
+#   license, the contents of this file are subject to the Reciprocal Public
+#   License ("RPL") Version 1.5, or subsequent versions as allowed by the RPL,
+#   and You may not copy or use this file in either source code or executable
+#   form, except in compliance with the terms and conditions of the RPL.
+#
+#   All software distributed under the RPL is provided strictly on an "AS
+#   IS" basis, WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESS OR IMPLIED, AND
+#   LICENSOR HEREBY DISCLAIMS ALL SUCH WARRANTIES, INCLUDING WITHOUT
+#   LIMITATION, ANY WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#   PURPOSE, QUIET ENJOYMENT, OR NON-INFRINGEMENT. See the RPL for specific
+#   language governing rights and limitations under the RPL.
+__license__ = 'RPL-1.5'
+
+# $Id: MySensorTypes.py,v 1.1 2022/03/24 10:12:31 teus Exp teus $
+
+""" In memory catalog of the DB table SensorTypes.
+    The whole table is loaded with one query. Products are looked up case
+    insensitive in a dict, not found product names are matched by one compiled
+    reg exp of the SensorTypes matching column (first row in table order).
+    Changes are detected by polling max(datum) and row count of the table:
+    changed rows are reloaded, on deleted or renamed rows the table is reloaded.
+    A changed row gets a new entry (dict), the generation number is incremented
+    on each change: users of entries (calibration plans) renew their info.
+    Shared by the data collector (sensor types of kits, archive calibration)
+    and MyCOMMUNITY (calibration to the Community reference sensor type).
+    Entry: { 'type': product (upper), 'product', 'match': compiled matching,
+        'producer', 'category', 'datum',
+        'fields': ((field, unit[, Taylor seq to Conf['CalRefs'] ref]),...),
+        'calibrations': { field: { REF TYPE: Taylor seq, ...}, ...} }
+"""
+__modulename__='$RCSfile: MySensorTypes.py,v $'[10:-4]
+__version__ = "0." + "$Revision: 1.1 $"[11:-2]
+import sys
+def WHERE(fie=False):
+   global __modulename__, __version__
+   if fie:
+     try:
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
+     except: pass
+   return "%s V%s" % (__modulename__ ,__version__)
+
+try:
+    import re
+    import threading
+    from time import time
+except ImportError as e:
+    sys.exit("FATAL: One of the import modules not found: %s" % e)
+
+# configurable options
+Conf = {
+    'DB': None,        # DB module with db_query()
+    'poll': 5*60,      # secs between checks of SensorTypes table changes
+    'CalRefs': [],     # sensor types as ref to calibrate fields
+    'log': None,       # MyLogger log routine
+}
+
+Catalog = {}           # product (upper): entry
+Matcher = None         # compiled reg exp of matching column, group name: product
+Changes = { 'next': 0, 'datum': None, 'count': None, 'generation': 0 }
+Lock = threading.RLock()
+
+Columns = "UNIX_TIMESTAMP(datum),product,matching,producer,category,fields"
+
+def Log(where, level, msg):
+    try: Conf['log'](where,level,msg)
+    except: sys.stderr.write("%s %s: %s\n" % (where,level,msg))
+
+# get Taylor seq for refs
+CalRefsRE = {}  # compiled reg exp per calibration ref sensor type
+def getCalibration(serialized, stype, refs=[]):
+    if not serialized or not refs: return None # similar to [0,1] Taylor
+    serialized = serialized.split('|')
+    for ref in refs:
+      try: ref = CalRefsRE[ref]
+      except KeyError:
+        CalRefsRE[ref] = re.compile(ref+'/.*',re.I); ref = CalRefsRE[ref]
+      if ref.match(stype): return None  # do not calibrate against similar sensor type
+      for i in range(len(serialized)):
+        if ref.match(serialized[i]): return [float(a) for a in serialized[i].split('/')[1:]]
+    return None
+
+# catalog entry of a SensorTypes row (datum,product,matching,producer,category,fields)
+def Entry(row):
+    fields = []; calibrations = {}
+    if row[5]:
+      for one in row[5].split(';'):
+        fields.append(one.split(','))
+        if len(fields[-1]) > 2:  # ref type/T1/T2|...
+          for cal in fields[-1][2].split('|'):
+            cal = cal.split('/')
+            try: calibrations.setdefault(fields[-1][0],{})[cal[0].upper()] = [float(a) for a in cal[1:]]
+            except: pass
+        try:
+          if len(fields[-1]) == 3 and Conf['CalRefs']:
+            fields[-1][2] = getCalibration(fields[-1][2],row[2],Conf['CalRefs'])
+            if not fields[-1][2]: fields[-1].pop(2)
+        except:
+          if len(fields[-1]) == 3: fields[-1].pop(2)
+        fields[-1] = tuple(fields[-1])
+    # match has reg exp for all product names with same type of measurements
+    return { 'type': row[1].upper(), 'product': row[1], 'match': re.compile(row[2].replace('?','.'),re.I),
+        'producer': row[3], 'category': row[4].lower(), 'datum': row[0],
+        'fields': tuple(fields), 'calibrations': calibrations }
+
+# compile the matching reg exps of all products into one matcher, first product in table wins
+def Compile(products):
+    global Matcher
+    patterns = ["(?P<p%d>%s)" % (nr,one['match'].pattern) for nr, one in enumerate(products)]
+    try: Matcher = (re.compile('|'.join(patterns),re.I), [a['type'] for a in products])
+    except Exception as e:
+      Log(WHERE(True),'ATTENT','Unable to compile SensorTypes matching: %s' % str(e))
+      Matcher = None
+
+# load all or changed (since datum) rows of SensorTypes table into the catalog
+# returns nr of loaded rows, None on DB failure
+def Load(DB=None, CalRefs=None, log=None, since=None):
+    global Catalog, Changes
+    if DB: Conf['DB'] = DB
+    if CalRefs != None: Conf['CalRefs'] = CalRefs
+    if log: Conf['log'] = log
+    with Lock:
+      try:
+        qry = "SELECT %s FROM SensorTypes" % Columns
+        if since != None: qry += " WHERE UNIX_TIMESTAMP(datum) >= %d" % int(since)
+        rows = Conf['DB'].db_query(qry, True)
+        if since == None:
+          state = Conf['DB'].db_query("SELECT UNIX_TIMESTAMP(MAX(datum)), COUNT(*) FROM SensorTypes", True)[0]
+      except Exception as e:
+        Log(WHERE(True),'ATTENT','Unable to load SensorTypes table: %s' % str(e))
+        return None
+      entries = []
+      for row in (rows if rows else []):
+        try: entries.append(Entry(row))
+        except: Log(WHERE(True),'ATTENT','Skip SensorTypes row %s' % str(row[1:3]))
+      if since == None:
+        catalog = {}; products = []
+        for one in entries:
+          if not one['type'] in catalog: products.append(one)
+          catalog[one['type']] = one
+        Catalog = catalog
+        Changes['datum'], Changes['count'] = state[0], state[1]
+      else:
+        products = None
+        for one in entries:
+          if not one['type'] in Catalog: return Load(since=None)  # renamed row
+          Catalog[one['type']] = one
+      if products != None: Compile(products)
+      else:
+        Compile([Catalog[a] for a in Matcher[1] if a in Catalog] if Matcher else Catalog.values())
+      Changes['generation'] += 1
+      Changes['next'] = int(time())+Conf['poll']
+      Log(WHERE(),'INFO','Loaded %d sensor types from SensorTypes table' % len(entries))
+      return len(entries)
+
+# check for changes in SensorTypes table once per poll period, reload changed rows
+# returns generation nr, None if catalog is not loaded
+def Changed():
+    global Changes
+    if not Changes['generation']: return None
+    now = int(time())
+    if Changes['next'] > now: return Changes['generation']
+    with Lock:
+      if Changes['next'] > now: return Changes['generation']
+      Changes['next'] = now+Conf['poll']
+      try: datum, count = Conf['DB'].db_query("SELECT UNIX_TIMESTAMP(MAX(datum)), COUNT(*) FROM SensorTypes", True)[0]
+      except: return Changes['generation']
+      if (datum, count) == (Changes['datum'], Changes['count']): return Changes['generation']
+      Log(WHERE(),'INFO','DB table SensorTypes changed: renew sensor types info')
+      if count != Changes['count'] or datum == None or Changes['datum'] == None or datum < Changes['datum']:
+        Load()  # rows deleted
+      else:
+        Load(since=Changes['datum'])
+        Changes['datum'] = datum; Changes['count'] = count
+    return Changes['generation']
+
+# catalog generation nr, None if not loaded
+def Generation():
+    return Changes['generation'] if Changes['generation'] else None
+
+# catalog entry of a product name, None if not found.
+# catalog is loaded on first use if DB is defined
+def Product(name, DB=None):
+    if not Changes['generation']:
+      with Lock:
+        if not Changes['generation'] and (DB or Conf['DB']): Load(DB=DB)
+    try: return Catalog[name.upper()]
+    except KeyError: pass
+    except: return None
+    try:
+      match = Matcher[0].match(name)
+      return Catalog[Matcher[1][int(match.lastgroup[1:])]]
+    except: return None
+
+# calibrations of fields of a product towards a ref sensor type: { field: Taylor seq }
+def Calibrations(product, ref, DB=None):
+    one = Product(product, DB=DB)
+    if not one: return None
+    ref = ref.upper(); rts = {}
+    for field, cals in one['calibrations'].items():
+      if ref in cals: rts[field] = cals[ref]
+    return rts
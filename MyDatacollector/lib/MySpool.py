@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Contact Teus Hagen webmaster@behouddeparel.nl to report improvements and bugs
+#
+# Copyright (C) 2022, Behoud de Parel, Teus Hagen, the Netherlands
+# Open Source Initiative  https://opensource.org/licenses/RPL-1.5
+#
+#   Unless explicitly acquired and licensed from Licensor under another
+#   license, the contents of this file are subject to the Reciprocal Public
+#   License ("RPL") Version 1.5, or subsequent versions as allowed by the RPL,
+#   and You may not copy or use this file in either source code or executable
+#   form, except in compliance with the terms and conditions of the RPL.
+#
+#   All software distributed under the RPL is provided strictly on an "AS
+#   IS" basis, WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESS OR IMPLIED, AND
+#   LICENSOR HEREBY DISCLAIMS ALL SUCH WARRANTIES, INCLUDING WITHOUT
+#   LIMITATION, ANY WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#   PURPOSE, QUIET ENJOYMENT, OR NON-INFRINGEMENT. See the RPL for specific
+#   language governing rights and limitations under the RPL.
+__license__ = 'RPL-1.5'
+
+# $Id: MySpool.py,v 1.1 2022/03/16 15:02:44 teus Exp teus $
+
+""" Durable spool of records for an output channel which is down.
+    Records (info, data record, artifacts) are appended to a SQLite database
+    in WAL mode per output channel, deduplicated on (kit, timestamp).
+    A replay thread publishes spooled records in order at a controlled rate
+    (records per sec) and pauses retry secs when the channel is down (IOError).
+    A record which fails otherwise is quarantined after Conf['attempts'] replays.
+    Retention: max nr of records (oldest dropped) and max age in secs.
+    Spooled records survive a restart of the collector: the spool directory
+    must be defined and persistent (not a temporary directory).
+    Command line: test [records=N] [down=secs] stops a fake DB output channel
+    in the middle of a stream of records and checks no record is lost.
+"""
+__modulename__='$RCSfile: MySpool.py,v $'[10:-4]
+__version__ = "0." + "$Revision: 1.1 $"[11:-2]
+import sys
+def WHERE(fie=False):
+   global __modulename__, __version__
+   if fie:
+     try:
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
+     except: pass
+   return "%s V%s" % (__modulename__ ,__version__)
+
+try:
+    import os
+    import json
+    import sqlite3
+    import threading
+    from time import time, sleep
+    try: from collections.abc import Mapping
+    except ImportError: from collections import Mapping
+except ImportError as e:
+    sys.exit("FATAL: One of the import modules not found: %s" % e)
+
+# configurable options, can be overwritten per output channel
+Conf = {
+    'directory': None, # persistent spool files directory, required
+    'size': 100000,    # max nr of spooled records per channel, oldest are dropped
+    'age': 7*24*60*60, # max age in secs of a spooled record
+    'rate': 20,        # max nr of records replayed per sec
+    'retry': 60,       # secs to wait before a next replay after a failure
+    'attempts': 5,     # max failed replays of a record before it is quarantined
+    'log': None,       # MyLogger log routine
+}
+
+# serialize read only views (mappings) and other objects
+def _default(obj):
+    if isinstance(obj, Mapping): return dict(obj)
+    if isinstance(obj, (set,frozenset)): return list(obj)
+    return str(obj)
+
+class Spool(object):
+    def __init__(self, name, publish=None, **conf):
+      self.conf = Conf.copy(); self.conf.update(conf)
+      self.name = name
+      # routine(info, record, artifacts): False or exception on a record failure,
+      # raises IOError if the output channel is down
+      self.publish = publish
+      if not self.conf['directory']:
+        raise ValueError("spool %s: no persistent spool directory defined" % name)
+      self.file = os.path.join(self.conf['directory'], 'MySpool-%s.db' % name)
+      self.lock = threading.Lock()
+      self.db = sqlite3.connect(self.file, check_same_thread=False, isolation_level=None)
+      self.db.execute("PRAGMA journal_mode=WAL")
+      self.db.execute("PRAGMA synchronous=NORMAL")  # WAL: durable on process crash
+      self.db.execute("""CREATE TABLE IF NOT EXISTS spool (
+          seq INTEGER PRIMARY KEY AUTOINCREMENT,
+          kit TEXT, timestamp INTEGER, spooled REAL, item TEXT,
+          UNIQUE (kit, timestamp) ON CONFLICT IGNORE)""")
+      self.db.execute("""CREATE TABLE IF NOT EXISTS quarantine (
+          seq INTEGER PRIMARY KEY, kit TEXT, timestamp INTEGER, spooled REAL, item TEXT,
+          failed REAL, error TEXT)""")
+      self.count = self.db.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+      self.stats = { 'spooled': 0, 'duplicates': 0, 'replayed': 0, 'expired': 0, 'failures': 0, 'quarantined': 0 }
+      self.failed = [None, 0]  # seq of record failed to replay, nr of failures
+      self.resume = 0       # no replay before this time
+      self.arrived = threading.Event()
+      self.thread = None; self.stopped = False
+      if self.count:
+        self.Log('ATTENT',"Spool %s has %d records to replay" % (self.name,self.count))
+
+    def Log(self, level, msg):
+      if self.conf['log']: self.conf['log'](WHERE(True),level,msg)
+
+    def __len__(self): return self.count
+
+    # append record to spool. Returns False on duplicate (kit, timestamp)
+    def put(self, info, record, artifacts):
+      try: kit = '%s_%s' % (info['id']['project'],info['id']['serial'])
+      except: kit = None
+      try: timestamp = int(record['timestamp'])
+      except: timestamp = None
+      item = json.dumps([info, record, artifacts], default=_default)
+      with self.lock:
+        cursor = self.db.execute("INSERT INTO spool (kit, timestamp, spooled, item) VALUES (?, ?, ?, ?)", (kit,timestamp,time(),item))
+        if not cursor.rowcount:
+          self.stats['duplicates'] += 1
+          return False
+        self.count += 1; self.stats['spooled'] += 1
+        if self.count == 1:
+          self.Log('ATTENT',"Output channel %s is down: spooling records" % self.name)
+        if not self.stats['spooled'] % 100 or self.count > self.conf['size']:
+          self.Retention()
+      self.arrived.set()
+      return True
+
+    # drop records older as max age, and oldest above max size. Lock is set
+    def Retention(self):
+      expired = self.db.execute("DELETE FROM spool WHERE spooled < ?", (time()-self.conf['age'],)).rowcount
+      if self.count-expired > self.conf['size']:
+        expired += self.db.execute("DELETE FROM spool WHERE seq IN (SELECT seq FROM spool ORDER BY seq LIMIT ?)", (self.count-expired-self.conf['size'],)).rowcount
+      if expired:
+        self.count -= expired; self.stats['expired'] += expired
+        self.Log('ERROR',"Spool %s: %d records dropped on age or size limits" % (self.name,expired))
+
+    # kit has records waiting in the spool: records of kit are spooled to keep the order
+    def Waiting(self, kit):
+      if not self.count: return False
+      with self.lock:
+        return self.db.execute("SELECT 1 FROM spool WHERE kit = ? LIMIT 1", (kit,)).fetchone() != None
+
+    # oldest spooled records: list of (seq, (info, record, artifacts))
+    def Oldest(self, limit=1):
+      with self.lock:
+        rows = self.db.execute("SELECT seq, item FROM spool ORDER BY seq LIMIT ?", (limit,)).fetchall()
+      return [(seq, json.loads(item)) for seq, item in rows]
+
+    def Done(self, seq):
+      with self.lock:
+        if self.db.execute("DELETE FROM spool WHERE seq = ?", (seq,)).rowcount:
+          self.count -= 1; self.stats['replayed'] += 1
+
+    # move a record which fails to replay to the quarantine table
+    def Quarantine(self, seq, error):
+      with self.lock:
+        self.db.execute("INSERT OR REPLACE INTO quarantine SELECT seq, kit, timestamp, spooled, item, ?, ? FROM spool WHERE seq = ?", (time(),error,seq))
+        if self.db.execute("DELETE FROM spool WHERE seq = ?", (seq,)).rowcount:
+          self.count -= 1; self.stats['quarantined'] += 1
+      self.Log('ERROR',"Spool %s: record %d quarantined after %d failed replays: %s" % (self.name,seq,self.conf['attempts'],error))
+
+    # replay thread: publish spooled records in order at max rate records per sec
+    # a channel failure (IOError) pauses the replay, other failures count per record
+    def Replay(self):
+      while not self.stopped:
+        if not self.count:
+          self.arrived.wait(5); self.arrived.clear()
+          continue
+        if time() < self.resume:
+          sleep(min(self.resume-time(),1)); continue
+        start = time(); rows = self.Oldest(max(1,int(self.conf['rate'])))
+        for seq, item in rows:
+          if self.stopped: return
+          error = None
+          try:
+            ok = self.publish(*item)
+            if not ok: error = 'not published'
+          except (IOError, OSError): ok = False  # channel is down
+          except Exception as e:
+            ok = False; error = str(e) or type(e).__name__
+          if not ok:
+            self.stats['failures'] += 1
+            if error != None:   # record failure
+              if self.failed[0] != seq: self.failed = [seq, 0]
+              self.failed[1] += 1
+              if self.failed[1] >= self.conf['attempts']:
+                self.Quarantine(seq, error); continue
+            self.resume = time()+self.conf['retry']
+            self.Log('INFO',"Spool %s: replay failed, %d records waiting, retry in %d secs" % (self.name,self.count,self.conf['retry']))
+            break
+          self.Done(seq)
+          if not self.count:
+            self.Log('ATTENT',"Output channel %s is up: %d spooled records replayed" % (self.name,self.stats['replayed']))
+        else:
+          wait = len(rows)/float(max(self.conf['rate'],0.001)) - (time()-start)
+          if wait > 0: sleep(wait)
+
+    def start(self, publish=None):
+      if publish: self.publish = publish
+      if self.thread or not self.publish: return
+      self.thread = threading.Thread(name='Spool_%s' % self.name, target=self.Replay)
+      self.thread.daemon = True
+      self.thread.start()
+
+    def stop(self):
+      self.stopped = True; self.arrived.set()
+      if self.thread: self.thread.join(5)
+      with self.lock:
+        try: self.db.close()
+        except: pass
+
+# test: fake DB output channel goes down in the middle of a stream of records
+if __name__ == '__main__':
+    import tempfile
+    args = { 'records': 2000, 'down': 3 }
+    for arg in sys.argv[1:]:
+      if arg.find('=') > 0 and arg.split('=')[0] in args.keys(): args[arg.split('=')[0]] = int(arg.split('=')[1])
+    if not 'test' in sys.argv[1:]:
+      sys.exit("Usage: %s test [records=N] [down=secs]" % sys.argv[0])
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import MyDatacollector as Collector
+
+    class FakeDB(object):   # output channel module storing records, raises IOError when down
+      Conf = { 'output': True, 'log': None }
+      def __init__(self): self.stored = {}; self.down = False; self.poison = set(); self.commits = 0
+      def publish(self, info=None, data=None, artifacts=None):
+        if self.down: raise IOError("DB connection error")
+        key = ('%s_%s' % (info['id']['project'],info['id']['serial']), data['timestamp'])
+        if key in self.poison: raise ValueError("record cannot be stored")
+        self.stored[key] = self.stored.get(key,0)+1
+        return True
+      def Commit(self, **args):   # replay: record is written at once
+        rts = self.publish(**args)
+        self.commits += 1
+        return rts
+    fake = FakeDB()
+    directory = tempfile.mkdtemp()
+    Collector.MyLogger.Conf["level"] = "ERROR"
+    Collector.Conf['spool'].update({ 'channels': ['fakedb'], 'directory': directory, 'rate': 1000, 'retry': 1 })
+    Collector.Channels = [{ 'name': 'fakedb', 'module': fake, 'Conf': { 'output': True },
+        'timeout': time()-1, 'errors': 0 }]
+    Collector.StartChannelWorkers()
+    kits = [{'id': {'project': 'TEST', 'serial': 'kit%d' % k}} for k in range(10)]
+    start = time(); downAt = None
+    poison = args['records']//3+1   # spooled record which fails on replay
+    fake.poison.add(('TEST_kit%d' % (poison % len(kits)), 1600000000+poison//len(kits)*60))
+    for nr in range(args['records']):
+      if nr == args['records']//3:    # kill the DB
+        fake.down = True; downAt = time()
+      if downAt and fake.down and time()-downAt > args['down']: fake.down = False
+      info = kits[nr % len(kits)]
+      record = { 'timestamp': 1600000000+nr//len(kits)*60, 'data': {'SDS011': [('pm10', 1.0)]} }
+      Collector.Forward2Channel(0, info, record, ['Forward data'])
+      if nr == args['records']//3 and nr: sleep(0.01)
+      if fake.down: sleep(args['down']*2.0/args['records'])  # stream goes on while DB is down
+      Collector.Forward2Channel(0, info, record, ['Forward data']) if nr % 97 == 0 else None # duplicate
+    fake.down = False
+    spooler = Collector.Channels[0]['spooler']
+    while len(spooler) and time()-start < 60: sleep(0.1)
+    took = time()-start
+    stats = spooler.stats.copy()
+    Collector.StopChannelWorkers()
+    expected = set([('TEST_kit%d' % (nr % len(kits)), 1600000000+nr//len(kits)*60) for nr in range(args['records'])])
+    lost = expected - set(fake.stored.keys()) - fake.poison
+    print("%d records, fake DB down %d secs: %d spooled, %d duplicates skipped, %d replayed, %d replay failures, %d quarantined in %.1f secs" % (args['records'],args['down'],stats['spooled'],stats['duplicates'],stats['replayed'],stats['failures'],stats['quarantined'],took))
+    print("    %d records lost, %d records stored more than once (duplicates forwarded while DB was up)" % (len(lost),len([a for a in fake.stored.values() if a > 1])))
+    assert not lost, "records lost: %s" % str(sorted(lost)[:5])
+    assert stats['quarantined'] == 1, "record failing on replay is not quarantined"
+    assert fake.commits == stats['replayed'], "replayed records not committed at once"
+    # spool append rate
+    spool = Spool('bench', directory=directory)
+    start = time()
+    for nr in range(5000):
+      spool.put(kits[nr % len(kits)], { 'timestamp': nr, 'data': {'SDS011': [('pm10', 1.0)]} }, ['Forward data'])
+    print("    spool append: %.0f records/sec" % (5000/(time()-start)))
+    spool.stop()
+    for file in os.listdir(directory): os.remove(os.path.join(directory,file))
+    os.rmdir(directory)
+    os._exit(0)
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Contact Teus Hagen webmaster@behouddeparel.nl to report improvements and bugs
+#
+# Copyright (C) 2022, Behoud de Parel, Teus Hagen, the Netherlands
+# Open Source Initiative  https://opensource.org/licenses/RPL-1.5
+#
+#   Unless explicitly acquired and licensed from Licensor under another
+#   license, the contents of this file are subject to the Reciprocal Public
+#   License ("RPL") Version 1.5, or subsequent versions as allowed by the RPL,
+#   and You may not copy or use this file in either source code or executable
+#   form, except in compliance with the terms and conditions of the RPL.
+#
+#   All software distributed under the RPL is provided strictly on an "AS
+#   IS" basis, WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESS OR IMPLIED, AND
+#   LICENSOR HEREBY DISCLAIMS ALL SUCH WARRANTIES, INCLUDING WITHOUT
+#   LIMITATION, ANY WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#   PURPOSE, QUIET ENJOYMENT, OR NON-INFRINGEMENT. See the RPL for specific
+#   language governing rights and limitations under the RPL.
+__license__ = 'RPL-1.5'
+
+# $Id: MySupervisor.py,v 1.1 2022/03/21 16:40:12 teus Exp teus $
+
+""" Supervisor of collector worker processes (horizontal sharding).
+    Items (e.g. MQTT messages) are routed to a worker via a bounded queue per
+    worker, hashed on device ID: records of a kit are handled in order by one
+    and the same worker (kit cache locality).
+    A died worker is restarted with a backoff; its queue is kept.
+    Graceful (rolling) restart: a None item in the queue of a worker ends its
+    input, the worker drains its output channels and exits, a new worker
+    continues with the items queued meanwhile.
+    Workers report their metrics (MyMetrics.Export()) via a stats queue,
+    exposed by the supervisor with label worker="N".
+    Command line: test [kits=N] [records=N] [workers=N] runs collector workers
+    with an in process fake MQTT broker, a DB stand-in and a rolling restart.
+"""
+__modulename__='$RCSfile: MySupervisor.py,v $'[10:-4]
+__version__ = "0." + "$Revision: 1.1 $"[11:-2]
+import sys
+def WHERE(fie=False):
+   global __modulename__, __version__
+   if fie:
+     try:
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
+     except: pass
+   return "%s V%s" % (__modulename__ ,__version__)
+
+try:
+    import os
+    import zlib
+    import threading
+    import multiprocessing
+    from time import time, sleep
+    if sys.version[0] == '2': import Queue
+    else: import queue as Queue
+    try: from lib import MyMetrics
+    except: import MyMetrics
+except ImportError as e:
+    sys.exit("FATAL: One of the import modules not found: %s" % e)
+
+# configurable options
+Conf = {
+    'workers': 2,      # nr of worker processes
+    'queue': 1000,     # max items waiting per worker
+    'wait': 5,         # max secs to wait on a full worker queue, then item is skipped
+    'report': 15,      # secs between metrics reports of a worker
+    'drain': 90,       # max secs for a worker to stop gracefully
+    'backoff': 60,     # max secs to wait before restart of a died worker
+    'log': None,       # MyLogger log routine
+}
+
+class Supervisor(object):
+    # target(nr, inbox, stats) is the worker process routine
+    # inbox: queue of routed items, None: end of input; stats: queue for metrics reports
+    def __init__(self, target, **conf):
+      self.conf = Conf.copy()
+      self.conf.update(dict([(k, v) for k, v in conf.items() if k in Conf]))
+      self.target = target
+      self.size = max(1,int(self.conf['workers']))
+      self.inboxes = [multiprocessing.Queue(maxsize=max(1,self.conf['queue'])) for nr in range(self.size)]
+      self.stats = multiprocessing.Queue()
+      self.workers = [None]*self.size
+      self.restarts = [0]*self.size      # restarts of a worker in a row
+      self.retry = [0]*self.size         # time to restart a died worker
+      self.busy = set()                  # workers in graceful restart
+      self.lock = threading.RLock()
+      self.stopped = threading.Event()
+      self.threads = []
+      self.routed = [MyMetrics.counter('supervisor_routed_total','items routed to worker',worker=str(nr)) for nr in range(self.size)]
+      self.dropped = [MyMetrics.counter('supervisor_dropped_total','items skipped on full worker queue',worker=str(nr)) for nr in range(self.size)]
+      self.restarted = [MyMetrics.counter('supervisor_restarts_total','worker process restarts',worker=str(nr)) for nr in range(self.size)]
+      for nr in range(self.size):
+        MyMetrics.gauge('supervisor_queue_items', (lambda nr=nr: self.inboxes[nr].qsize()), 'items waiting in worker queue', worker=str(nr))
+
+    def Log(self, where, level, msg):
+      if self.conf['log']: self.conf['log'](where,level,msg)
+
+    # worker nr of a device ID, stable over restarts
+    def Worker(self, ID):
+      return zlib.crc32(str(ID).encode()) % self.size
+
+    # route an item to the worker of device ID. Returns False if item is skipped
+    def route(self, ID, item):
+      nr = self.Worker(ID)
+      try:
+        self.inboxes[nr].put(item, timeout=self.conf['wait'])
+        self.routed[nr].inc()
+        return True
+      except Queue.Full:
+        self.dropped[nr].inc()
+        if self.dropped[nr].value % 100 == 1:
+          self.Log(WHERE(True),'ERROR','Worker %d queue is full: skipped %d items' % (nr,self.dropped[nr].value))
+      return False
+
+    # have the worker queues room for all items of these device IDs?
+    def room(self, IDs):
+      count = {}
+      for ID in IDs:
+        nr = self.Worker(ID); count[nr] = count.get(nr,0)+1
+      try:
+        for nr, cnt in count.items():
+          if self.inboxes[nr].qsize()+cnt > max(1,self.conf['queue']): return False
+      except NotImplementedError: pass  # no qsize() on this platform
+      return True
+
+    def Start(self, nr):
+      with self.lock:
+        worker = multiprocessing.Process(name='MySense_worker%d' % nr, target=self.target, args=(nr,self.inboxes[nr],self.stats))
+        worker.daemon = False
+        worker.start()
+        self.workers[nr] = worker
+        self.Log(WHERE(),'INFO','Worker %d started (pid %d)' % (nr,worker.pid))
+
+    # restart died workers, exponential backoff on restarts in a row
+    def Monitor(self):
+      while not self.stopped.wait(1):
+        for nr in range(self.size):
+          with self.lock:
+            worker = self.workers[nr]
+            if nr in self.busy or worker == None or worker.is_alive(): continue
+            if not self.retry[nr]:
+              if time() - worker.started > 5*60: self.restarts[nr] = 0
+              self.retry[nr] = time() + min(self.conf['backoff'],2**self.restarts[nr]-1)
+              self.Log(WHERE(True),'ERROR','Worker %d (pid %d) died with exit code %s: restart in %d secs' % (nr,worker.pid,str(worker.exitcode),self.retry[nr]-time()))
+            if time() < self.retry[nr]: continue
+            self.retry[nr] = 0; self.restarts[nr] += 1
+            # queue lock may be held by the died worker: items still queued are lost
+            lost = self.inboxes[nr].qsize()
+            self.inboxes[nr] = multiprocessing.Queue(maxsize=max(1,self.conf['queue']))
+            if lost:
+              self.dropped[nr].inc(lost)
+              self.Log(WHERE(True),'ERROR','Worker %d died: %d queued items are lost' % (nr,lost))
+            self.restarted[nr].inc()
+            self.Start(nr); self.workers[nr].started = time()
+
+    # collect metrics reports of workers
+    def Stats(self):
+      while not self.stopped.is_set():
+        try: nr, metrics = self.stats.get(timeout=1)
+        except Queue.Empty: continue
+        except (EOFError, OSError): return
+        MyMetrics.Remote[('worker',str(nr))] = metrics
+
+    def start(self):
+      for nr in range(self.size):
+        self.Start(nr); self.workers[nr].started = time()
+      for routine in [self.Monitor, self.Stats]:
+        self.threads.append(threading.Thread(name='Supervisor%s' % routine.__name__, target=routine))
+        self.threads[-1].daemon = True
+        self.threads[-1].start()
+      return True
+
+    # graceful stop of worker nr: end of input, wait till the worker has drained
+    def Finish(self, nr):
+      worker = self.workers[nr]
+      if worker == None: return True
+      try: self.inboxes[nr].put(None, timeout=self.conf['drain'])
+      except Queue.Full: pass
+      worker.join(self.conf['drain'])
+      if worker.is_alive():
+        self.Log(WHERE(True),'ERROR','Worker %d (pid %d) did not stop in %d secs: terminated' % (nr,worker.pid,self.conf['drain']))
+        worker.terminate(); worker.join(5)
+        return False
+      return True
+
+    # graceful restart of a worker, or of all workers one by one (rolling restart)
+    def restart(self, nr=None):
+      for one in (range(self.size) if nr == None else [nr]):
+        if self.stopped.is_set(): return False
+        with self.lock: self.busy.add(one)
+        try:
+          self.Finish(one)
+          if self.stopped.is_set(): return False
+          self.Start(one); self.workers[one].started = time()
+          self.Log(WHERE(),'ATTENT','Worker %d restarted' % one)
+        finally:
+          with self.lock: self.busy.discard(one)
+      return True
+
+    # graceful stop of all workers
+    def stop(self):
+      if self.stopped.is_set(): return
+      self.stopped.set()
+      for nr in range(self.size):  # end of input for all workers
+        try: self.inboxes[nr].put(None, timeout=1)
+        except Queue.Full: pass
+      for nr in range(self.size):
+        if self.workers[nr] == None: continue
+        self.workers[nr].join(self.conf['drain'])
+        if self.workers[nr].is_alive():
+          self.Log(WHERE(True),'ERROR','Worker %d did not stop in %d secs: terminated' % (nr,self.conf['drain']))
+          self.workers[nr].terminate(); self.workers[nr].join(5)
+      try:  # last metrics reports
+        while True:
+          nr, metrics = self.stats.get(timeout=0.2)
+          MyMetrics.Remote[('worker',str(nr))] = metrics
+      except: pass
+      self.Log(WHERE(),'INFO','Workers stopped: %d items routed, %d skipped, %d restarts' % (sum([a.value for a in self.routed]),sum([a.value for a in self.dropped]),sum([a.value for a in self.restarted])))
+
+# test: collector workers, fake MQTT broker front end, DB stand-in, rolling restart
+if __name__ == '__main__':
+    import json, signal
+    args = { 'kits': 200, 'records': 4000, 'workers': 3 }
+    for arg in sys.argv[1:]:
+      if arg.find('=') > 0 and arg.split('=')[0] in args.keys(): args[arg.split('=')[0]] = int(arg.split('=')[1])
+    if not 'test' in sys.argv[1:]:
+      sys.exit("Usage: %s test [kits=N] [records=N] [workers=N]" % sys.argv[0])
+    path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, path)
+    import MyDatacollector as Collector
+    try: from lib import MyBench, MyMQTTclient
+    except: import MyBench, MyMQTTclient
+    Collector.MyLogger.Conf['level'] = 'ERROR'
+    log = lambda *args: None
+
+    # registered kits in DB stand-in, records of test file as templates
+    importer = MyMQTTclient.TTN2MySense(logger=log).RecordImport
+    db = MyBench.BenchDB(os.path.join(path,'MySQLdbSetup.sql'))
+    fd = MyMQTTclient.OpenInput(os.path.join(path,'inputtests','stressTestData.mqtt'))
+    templates = [(MyBench.Template(r), importer(json.loads(json.dumps(r)))) for r in MyMQTTclient.FileRecords(fd)]
+    templates = [a for a in templates if a[1]]
+    fd.close()
+    for kit in range(args['kits']):  # with home location of template
+      decoded = templates[kit % len(templates)][1]; location = None
+      for one in decoded['data'].values():
+        if type(one) is dict and 'geohash' in one: location = one['geohash']
+      db.Register('mysense-test', 'test-%04d' % kit, [a for a in decoded['data'].keys() if a != 'version'], location)
+    published = multiprocessing.Queue()
+    class TestChannel(object):  # output channel: (worker, pid, kit, timestamp) to the test
+      def __init__(self): self.Conf = { 'output': True, 'log': None }
+      def publish(self, info=None, data=None, artifacts=None):
+        published.put((Collector.Supervised, os.getpid(), info['MQTTid'], data['timestamp']))
+        return True
+    channel = TestChannel()
+    Collector.MyGPS.GPS2Address = lambda place, *args, **kwargs: {}
+    Collector.DB = db; Collector.notices = None; Collector.monitor = None
+    Collector.Conf['rate'] = 0
+    Collector.Conf['dedup']['size'] = 0  # synthetic records repeat frame counters
+    Collector.Conf['supervisor'].update({ 'workers': args['workers'], 'report': 1, 'drain': 30 })
+    Collector.Channels = [{ 'name': 'test', 'module': channel, 'Conf': channel.Conf, 'timeout': time()-1, 'errors': 0 }]
+    Collector.Conf['input'] = [{ 'resource': 'test', 'port': 1883, 'topic': '+', 'clientID': 'MySupervisorTest' }]
+
+    supervisor = Supervisor(Collector.SupervisedWorker, log=Collector.MyLogger.log, **Collector.Conf['supervisor'])
+    supervisor.start()
+    broker = { 'resource': 'test', 'port': 1883, 'topic': '+', 'clientID': 'MySupervisorTest', 'restarts': 0 }
+    router = MyMQTTclient.MQTT_router(broker, supervisor.route, logger=log)
+    router.connected = True
+    start = int(time())-24*60*60; sent = {}; received = {}; workers = {}; pids = set()
+    def Send(nr):           # MQTT message of record nr via fake broker
+      kit = nr % args['kits']; tmpl = templates[kit % len(templates)][0]
+      device = 'test-%04d' % kit; timestamp = start+(nr//args['kits'])*60
+      payload = tmpl.replace('@DEV@',device,1).replace('@APP@','mysense-test',1).replace('@TIME@',MyBench.datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%SZ'),1)
+      router._on_message(None, None, MyMQTTclient.Message('v3/mysense-test/devices/%s/up' % device, payload.encode()))
+      sent.setdefault('mysense-test/'+device,[]).append(timestamp)
+    def Collect():          # collect published records of workers
+      while True:
+        worker, pid, kit, timestamp = published.get()
+        received.setdefault(kit,[]).append(timestamp); workers.setdefault(kit,set()).add(worker); pids.add(pid)
+    collector = threading.Thread(target=Collect); collector.daemon = True; collector.start()
+    def Received(timeout=30): # wait till all sent records are published
+      until = time()+timeout
+      while sum([len(v) for v in received.values()]) < sum([len(v) for v in sent.values()]) and time() < until:
+        sleep(0.5)
+      return sum([len(v) for v in sent.values()]) - sum([len(v) for v in received.values()])
+    began = time(); first = [a.pid for a in supervisor.workers]
+    for nr in range(args['records']):
+      Send(nr)
+      if nr == args['records']//2:   # rolling restart in the middle of the stream
+        restart = threading.Thread(target=supervisor.restart); restart.start()
+    restart.join()
+    lost = Received(); took = time()-began
+    rolled = [a.pid for a in supervisor.workers]
+    os.kill(rolled[0], signal.SIGKILL)  # died worker is restarted by monitor
+    for cnt in range(20):
+      sleep(0.5)
+      if supervisor.workers[0].pid != rolled[0]: break
+    for nr in range(args['records'], args['records']+args['kits']): Send(nr)
+    lost += Received()
+    sleep(2)  # last metrics report
+    text = MyMetrics.Exposition()
+    supervisor.stop()
+    print("%d records of %d kits via %d workers in %.1f secs, with rolling restart" % (args['records'],args['kits'],args['workers'],took))
+    print("    %d records lost, %d kits out of order, %d kits handled by more than one worker" % (lost,len([k for k in sent if received.get(k) != sent[k]]),len([k for k, v in workers.items() if len(v) > 1])))
+    print("    routed per worker: %s, worker restarts: %d" % (', '.join(['%d' % a.value for a in supervisor.routed]),sum([a.value for a in supervisor.restarted])))
+    assert not lost, "records lost"
+    assert not [k for k in sent if received.get(k) != sent[k]], "records of a kit out of order"
+    assert not [k for k, v in workers.items() if len(v) > 1], "kit handled by more than one worker"
+    assert not set(first) & set(rolled), "rolling restart failed"
+    assert supervisor.restarted[0].value == 1, "died worker not restarted"
+    for nr in range(args['workers']):
+      assert text.find('mysense_translate_seconds_count{worker="%d"}' % nr) >= 0, "no metrics of worker %d" % nr
+    print("    metrics of all workers collected, e.g.:")
+    print(''.join(['        '+a+'\n' for a in text.split('\n') if a.find('translate_seconds_count') >= 0 or a.find('supervisor_restarts') >= 0]))
+    sys.stdout.flush()
+    os._exit(0)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Contact Teus Hagen webmaster@behouddeparel.nl to report improvements and bugs
+#
+# Copyright (C) 2022, Behoud de Parel, Teus Hagen, the Netherlands
+# Open Source Initiative  https://opensource.org/licenses/RPL-1.5
+#
+#   Unless explicitly acquired and licensed from Licensor under another
+#   license, the contents of this file are subject to the Reciprocal Public
+#   License ("RPL") Version 1.5, or subsequent versions as allowed by the RPL,
+#   and You may not copy or use this file in either source code or executable
+#   form, except in compliance with the terms and conditions of the RPL.
+#
+#   All software distributed under the RPL is provided strictly on an "AS
+#   IS" basis, WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESS OR IMPLIED, AND
+#   LICENSOR HEREBY DISCLAIMS ALL SUCH WARRANTIES, INCLUDING WITHOUT
+#   LIMITATION, ANY WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#   PURPOSE, QUIET ENJOYMENT, OR NON-INFRINGEMENT. See the RPL for specific
+#   language governing rights and limitations under the RPL.
+__license__ = 'RPL-1.5'
+
+# $Id: MyValidate.py,v 1.1 2022/03/14 09:45:12 teus Exp teus $
+
+""" Compiled validation rules for sensed values.
+    The dict of valid value ranges/reg expressions per field and the list of
+    (field, trigger) for static value detection are compiled once into rule
+    objects: per value one dict lookup and plain comparisons.
+    Static value detection state is kept per kit in a fixed size list,
+    one slot [count, last value] per checked field.
+    ValidBatch() validates a series of values of one field at once (numpy)
+    for replay and backfill.
+    Command line: regression test of compiled rules against the original
+    validation over MQTT input test files (default inputtests/*.mqtt).
+"""
+__modulename__='$RCSfile: MyValidate.py,v $'[10:-4]
+__version__ = "0." + "$Revision: 1.1 $"[11:-2]
+import sys
+def WHERE(fie=False):
+   global __modulename__, __version__
+   if fie:
+     try:
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
+     except: pass
+   return "%s V%s" % (__modulename__ ,__version__)
+
+if sys.version_info[0] >= 3: unicode = str
+try: import numpy
+except ImportError: numpy = None   # ValidBatch falls back to a python loop
+
+# valid range [low,high) or reg expression for one field
+class ValueRule(object):
+    __slots__ = ('low','high','regex','zero')
+    def __init__(self, field, rule):
+      self.regex = None; self.low = self.high = None
+      if type(rule) in [list,tuple]: self.low, self.high = rule[0], rule[1]
+      else: self.regex = rule
+      self.zero = field.lower() in ['temp']  # 0.0 value denotes a sensor failure
+
+# compile dict of field: [min,max] or field: compiled reg expression
+def Compile(invalids):
+    return dict([(field.lower(), ValueRule(field,rule)) for field, rule in invalids.items()])
+
+# check for valid value of sensed data, out of band values are counted in info['invalids']
+def Valid(rules, info, afield, avalue):
+    if avalue == None: return True
+    fld = afield.lower()
+    if fld == 'accu' and avalue > 15: fld = 'level'
+    rule = rules.get(fld)
+    if rule == None: return True
+    try:
+      if rule.regex:
+        if type(avalue) in [str,unicode] and rule.regex.match(avalue):
+          return True # skip others not in this region
+      elif rule.low <= avalue < rule.high and (avalue != 0.0 or not rule.zero):
+        try: del info['invalids'][fld]
+        except: pass
+        return True
+    except: return True
+    try: info['invalids'][fld] += 1
+    except:
+      try: info['invalids'][fld] = 0
+      except: info['invalids'] = {fld: 0}
+    return False
+
+# validate a series of values of one field (None or NaN: no value)
+# returns list of booleans; info['invalids'] is updated as Valid() would do
+def ValidBatch(rules, afield, values, info=None):
+    fld = afield.lower()
+    if numpy == None or fld in rules and rules[fld].regex:
+      if info == None: info = {}
+      return [Valid(rules,info,afield,(None if value != value else value)) for value in values]
+    values = numpy.asarray(values, dtype=float)
+    present = ~numpy.isnan(values)
+    valid = numpy.ones(len(values), dtype=bool)
+    series = [(fld, numpy.ones(len(values), dtype=bool))]
+    if fld == 'accu':  # accu values above 15 are a level
+      level = numpy.zeros(len(values), dtype=bool)
+      level[present] = values[present] > 15
+      series = [('accu', ~level), ('level', level)]
+    for name, select in series:
+      rule = rules.get(name)
+      if rule == None: continue
+      checked = select & present
+      ok = numpy.zeros(len(values), dtype=bool)
+      ok[checked] = (rule.low <= values[checked]) & (values[checked] < rule.high)
+      if rule.zero: ok &= values != 0.0
+      valid[checked] = ok[checked]
+      if info == None: continue
+      # same invalids count as per value: reset on valid, count invalid ones
+      invalid = numpy.flatnonzero(checked & ~ok)
+      last = numpy.flatnonzero(checked & ok)
+      if len(last):
+        try: del info['invalids'][name]
+        except: pass
+        invalid = invalid[invalid > last[-1]]
+      if not len(invalid): continue
+      try: info['invalids'][name] += len(invalid)
+      except:
+        try: info['invalids'][name] = len(invalid)-1
+        except: info['invalids'] = {name: len(invalid)-1}
+    return valid.tolist()
+
+# compiled list of (field, trigger) for static (not fluctuating) value detection
+class StaticRules(object):
+    def __init__(self, check, trigger=40):
+      self.slots = {}   # field: (slot index, trigger)
+      for one in check:
+        if type(one) in [list,tuple]:
+          if not one[0] in self.slots:
+            self.slots[one[0]] = (len(self.slots), (one[1] if len(one) > 1 else trigger))
+        elif not one in self.slots: self.slots[one] = (len(self.slots), trigger)
+
+    # update static value state of the kit in info['check']
+    # returns None or (nr of repeated values, trigger)
+    def Count(self, info, afield, avalue):
+      try: indx, trigger = self.slots[afield]
+      except KeyError: return None
+      try: chk = info['check'][indx]
+      except:   # fixed size per kit: slot per field [count, last value], -1 not seen
+        info['check'] = [[-1,None] for _ in range(len(self.slots))]
+        chk = info['check'][indx]
+      if chk[0] < 0:  # first value counts as repeated
+        chk[0] = 0; chk[1] = avalue
+      if chk[1] == None or chk[1] != avalue:
+        chk[1] = avalue; chk[0] = 0
+        return None
+      chk[0] += 1
+      return (chk[0], trigger)
+
+# regression test: compiled rules vs original validation of sensed values
+if __name__ == '__main__':
+    import re, json, glob, os, copy
+    from time import time
+    # original validation as in MyDatacollector.ValidValue before compilation
+    def ValidValueOrg(InvalidSensed,info,afield,avalue):
+      if avalue == None: return True
+      fld = afield.lower()
+      if fld == 'accu' and avalue > 15: fld = 'level'
+      try:
+        if not type(InvalidSensed[fld]) is list:
+          if type(avalue) in [str,unicode] and InvalidSensed[fld].match(avalue):
+            return True # skip others not in this region
+        elif InvalidSensed[fld][0] <=  avalue < InvalidSensed[fld][1]:
+          if avalue != 0.0 or not fld in ['temp']:
+            try: del info['invalids'][fld]
+            except: pass
+            return True
+      except: return True
+      try: info['invalids']
+      except: info['invalids'] = {fld: -1}
+      try: info['invalids'][fld] += 1
+      except: info['invalids'][fld] = 0
+      return False
+
+    path = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(path))
+    import MyDatacollector
+    InvalidSensed = MyDatacollector.InvalidSensed
+    rules = Compile(InvalidSensed)
+    files = [a for a in sys.argv[1:] if a.find('=') < 0]
+    if not files: files = sorted(glob.glob(os.path.join(os.path.dirname(path),'inputtests','*.mqtt')))
+    alias = { 'temperature': 'temp', 'humidity': 'rv', 'pressure': 'luchtdruk', 'alt': 'altitude',
+              'lat': 'latitude', 'lon': 'longitude', 'battery': 'accu', 'voltage': 'accu' }
+    def Leaves(record, kit):   # (kit, field, value) of all sensed values in an MQTT record
+      if type(record) is dict:
+        for key, value in record.items():
+          if type(value) in [dict,list]:
+            for one in Leaves(value, kit): yield one
+          elif type(value) in [int,float,str,unicode] and not type(value) is bool:
+            yield (kit, alias.get(key.lower(),key), value)
+      elif type(record) is list:
+        for value in record:
+          for one in Leaves(value, kit): yield one
+    values = []
+    for file in files:
+      with open(file) as fd:
+        for line in fd:
+          if line.find('{') < 0: continue
+          try: record = json.loads(line[line.find('{'):])
+          except ValueError: continue
+          kit = record.get('dev_id', record.get('end_device_ids',{}).get('device_id','kit'))
+          values += list(Leaves(record, kit))
+    # edge cases: out of band, temp sensor failure, accu as level, regions, types
+    for kit in ['edge1','edge2']:
+      for field, value in [('temp',0.0),('temp',0),('temp',21.5),('temp',-30),('temp',45),
+          ('accu',16),('accu',4.1),('accu',200),('accu',-1),('rv',100),('rv',99.9),('pm10',None),
+          ('geohash','u1hjtzwmqd'),('geohash','u2abcdefgh'),('geohash',12),('pm25','12'),
+          ('luchtdruk',699),('luchtdruk',1013),('unknown',3),('PM10',2000),('PM10',20),('level',14)]:
+        values.append((kit,field,value))
+    infoOrg = {}; infoNew = {}; cnt = 0
+    for kit, field, value in values:
+      infoOrg.setdefault(kit,{}); infoNew.setdefault(kit,{})
+      org = ValidValueOrg(InvalidSensed,infoOrg[kit],field,value)
+      new = Valid(rules,infoNew[kit],field,value)
+      assert org == new, "different outcome for %s: %s" % (field,str(value))
+      assert infoOrg[kit].get('invalids',{}) == infoNew[kit].get('invalids',{}), "different invalids for %s" % kit
+      cnt += 1
+    print("%d values of %d kits from %d files: identical valid outcomes and invalids counts" % (cnt,len(infoOrg),len(files)))
+
+    # batch validation per kit per field (numeric values) vs value by value
+    series = {}
+    for kit, field, value in values:
+      if value == None or type(value) in [int,float]:
+        series.setdefault((kit,field),[]).append(value)
+    for (kit, field), serie in series.items():
+      info = {'invalids': {}}; infoBatch = {'invalids': {}}
+      org = [ValidValueOrg(InvalidSensed,info,field,value) for value in serie]
+      batch = ValidBatch(rules, field, [(float('nan') if value == None else value) for value in serie], info=infoBatch)
+      assert org == batch, "different batch outcome for %s/%s" % (kit,field)
+      assert info['invalids'] == infoBatch['invalids'], "different batch invalids for %s/%s: %s %s" % (kit,field,info,infoBatch)
+    print("%d series: identical batch valid outcomes and invalids counts (numpy %s)" % (len(series),'in use' if numpy else 'not available'))
+
+    # timings
+    loops = 20; start = time()
+    for _ in range(loops):
+      info = {}
+      for kit, field, value in values: ValidValueOrg(InvalidSensed,info,field,value)
+    org = time()-start; start = time()
+    for _ in range(loops):
+      info = {}
+      for kit, field, value in values: Valid(rules,info,field,value)
+    new = time()-start
+    print("    original: %.2f usecs per value, compiled: %.2f usecs per value" % (org*1000000/(loops*cnt),new*1000000/(loops*cnt)))
+    serie = [float(v % 1100) for v in range(100000)]
+    start = time()
+    for value in serie: Valid(rules,{},'pm10',value)
+    org = time()-start; start = time()
+    ValidBatch(rules,'pm10',serie,info={})
+    new = time()-start
+    print("    series of %d values: per value %.3f secs, batch %.3f secs" % (len(serie),org,new))
+    os._exit(0)
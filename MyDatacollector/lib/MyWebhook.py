@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Contact Teus Hagen webmaster@behouddeparel.nl to report improvements and bugs
+#
+# Copyright (C) 2022, Behoud de Parel, Teus Hagen, the Netherlands
+# Open Source Initiative  https://opensource.org/licenses/RPL-1.5
+#
+#   Unless explicitly acquired and licensed from Licensor under another
+#   license, the contents of this file are subject to the Reciprocal Public
+#   License ("RPL") Version 1.5, or subsequent versions as allowed by the RPL,
+#   and You may not copy or use this file in either source code or executable
+#   form, except in compliance with the terms and conditions of the RPL.
+#
+#   All software distributed under the RPL is provided strictly on an "AS
+#   IS" basis, WITHOUT WARRANTY OF ANY KIND, EITHER EXPRESS OR IMPLIED, AND
+#   LICENSOR HEREBY DISCLAIMS ALL SUCH WARRANTIES, INCLUDING WITHOUT
+#   LIMITATION, ANY WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+#   PURPOSE, QUIET ENJOYMENT, OR NON-INFRINGEMENT. See the RPL for specific
+#   language governing rights and limitations under the RPL.
+__license__ = 'RPL-1.5'
+
+# $Id: MyWebhook.py,v 1.1 2022/03/23 11:05:48 teus Exp teus $
+
+""" HTTP ingest of TTN V3 webhook uplinks (Python 3 asyncio, no extra modules).
+    An uplink POST body is a json uplink record, a json list of uplink records
+    or newline delimited json records (batched), optionally gzip compressed
+    (Content-Encoding: gzip). HTTP/1.1 keep-alive and chunked bodies are supported.
+    Records are handed over to ingest(records) which returns an HTTP status:
+    e.g. 429 (Too Many Requests) if the ingest queue has no room for the batch.
+    Requests are handled in executor threads: ingest() may block, the event
+    loop is not blocked.
+    Authentication: shared secret in request header Conf['header'] (TTN webhook
+    additional header), e.g. 'Authorization: Bearer <secret>'.
+    Command line: bench [uplinks=N] [batch=N] [connections=N] [gzip=1] [queue=N] [delay=usecs]
+    load generator (other process) against a webhook server with RecordImport,
+    delay: consumer time per queued record to show back pressure.
+"""
+__modulename__='$RCSfile: MyWebhook.py,v $'[10:-4]
+__version__ = "0." + "$Revision: 1.1 $"[11:-2]
+import sys
+def WHERE(fie=False):
+   global __modulename__, __version__
+   if fie:
+     try:
+       return "%s V%s/%s" % (__modulename__ ,__version__,sys._getframe(1).f_code.co_name)
+     except: pass
+   return "%s V%s" % (__modulename__ ,__version__)
+
+try:
+    import asyncio
+    import threading
+    import json
+    import zlib
+    import hmac
+    try: from lib import MyMetrics
+    except: import MyMetrics
+except ImportError as e:
+    sys.exit("FATAL: One of the import modules not found: %s" % e)
+
+# configurable options
+Conf = {
+    'address': '127.0.0.1', # listen address, e.g. 0.0.0.0 behind a reverse proxy
+    'port': 8080,           # listen port, 0: any free port
+    'path': '/',            # uplink POST path, e.g. /ttn/uplink
+    'secret': None,         # shared secret, None: no authentication
+    'header': 'Authorization', # request header with secret (optional 'Bearer ' prefix)
+    'keepalive': 75,        # secs an idle keep-alive connection is kept open
+    'body': 4*1024*1024,    # max (decompressed) request body size
+    'log': None,            # MyLogger log routine
+}
+
+Status = { 200: 'OK', 202: 'Accepted', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found',
+    405: 'Method Not Allowed', 413: 'Payload Too Large', 429: 'Too Many Requests',
+    500: 'Internal Server Error', 503: 'Service Unavailable' }
+
+# parse json body: one record, list of records, or newline delimited json records
+def Records(body):
+    try: records = json.loads(body)
+    except ValueError:
+      records = [json.loads(line) for line in body.splitlines() if line.strip()]
+    if type(records) is dict: records = [records]
+    if not type(records) is list or [a for a in records if not type(a) is dict]:
+      raise ValueError("not a json uplink record")
+    return records
+
+# decompress gzip body, max size bytes
+def Gunzip(body, size):
+    decompress = zlib.decompressobj(16+zlib.MAX_WBITS)
+    body = decompress.decompress(body, size+1)
+    if len(body) > size or decompress.unconsumed_tail: raise OverflowError
+    return body
+
+class Webhook(object):
+    def __init__(self, ingest, **conf):
+      self.conf = Conf.copy()
+      self.conf.update(dict([(k, v) for k, v in conf.items() if k in Conf]))
+      self.ingest = ingest          # ingest(list of records) returns HTTP status
+      self.loop = None; self.server = None; self.thread = None
+      self.port = None              # actual listen port
+      self.ready = threading.Event()
+      self.error = None
+      self.latency = MyMetrics.histogram('webhook_seconds','webhook request handling')
+      self.uplinks = MyMetrics.counter('webhook_uplinks_total','webhook uplink records received')
+      self.refused = MyMetrics.counter('webhook_refused_total','webhook requests refused (429) on full ingest queue')
+      self.errors = MyMetrics.counter('webhook_errors_total','webhook requests with client error')
+      self.connections = 0
+      MyMetrics.gauge('webhook_connections', (lambda: self.connections), 'webhook open connections')
+
+    def Log(self, where, level, msg):
+      if self.conf['log']: self.conf['log'](where,level,msg)
+
+    # handle a request, returns HTTP status
+    def Request(self, method, path, headers, body):
+      if path.split('?')[0] != self.conf['path']: return 404
+      if method != 'POST': return 405
+      if self.conf['secret']:
+        secret = headers.get(self.conf['header'].lower(),'')
+        if secret[:7].lower() == 'bearer ': secret = secret[7:].strip()
+        if not hmac.compare_digest(secret.encode(), str(self.conf['secret']).encode()): return 401
+      try:
+        if headers.get('content-encoding','').lower() in ['gzip','x-gzip']:
+          body = Gunzip(body, self.conf['body'])
+        records = Records(body)
+      except OverflowError: return 413
+      except Exception: return 400
+      if not records: return 200
+      status = self.ingest(records)
+      if status == 429: self.refused.inc()
+      elif status < 300: self.uplinks.inc(len(records))
+      return status
+
+    # read request body: Content-Length or chunked transfer encoding
+    async def Body(self, reader, headers):
+      if headers.get('transfer-encoding','').lower() == 'chunked':
+        chunks = []; size = 0
+        while True:
+          length = int((await reader.readline()).split(b';')[0].strip(), 16)
+          if not length: break
+          size += length
+          if size > self.conf['body']: raise OverflowError
+          chunks.append(await reader.readexactly(length))
+          await reader.readline()
+        while (await reader.readline()) not in [b'\r\n', b'\n', b'']: pass  # trailers
+        return b''.join(chunks)
+      length = int(headers.get('content-length',0))
+      if length > self.conf['body']: raise OverflowError
+      return await reader.readexactly(length) if length else b''
+
+    # HTTP/1.x connection, keep-alive
+    async def Client(self, reader, writer):
+      self.connections += 1
+      try:
+        while True:
+          try: line = await asyncio.wait_for(reader.readline(), self.conf['keepalive'])
+          except asyncio.TimeoutError: break
+          if not line: break
+          if not line.strip(): continue
+          start = MyMetrics.clock()
+          try: method, path, version = line.decode('latin-1').split()
+          except ValueError: break
+          headers = {}
+          while True:
+            line = await reader.readline()
+            if line in [b'\r\n', b'\n', b'']: break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+          keep = headers.get('connection','').lower()
+          keep = (keep != 'close') if version == 'HTTP/1.1' else (keep == 'keep-alive')
+          try:
+            body = await self.Body(reader, headers)
+            status = await self.loop.run_in_executor(None, self.Request, method, path, headers, body)
+          except OverflowError: status = 413; keep = False
+          except (ValueError, asyncio.LimitOverrunError): status = 400; keep = False
+          except asyncio.IncompleteReadError: break
+          except Exception as e:
+            self.Log(WHERE(True),'ERROR','Webhook request failed: %s' % str(e))
+            status = 500
+          if 400 <= status < 500 and status != 429: self.errors.inc()
+          response = '%s %d %s\r\nContent-Length: 0\r\n' % (version if version in ['HTTP/1.0','HTTP/1.1'] else 'HTTP/1.1', status, Status.get(status,''))
+          if status == 429: response += 'Retry-After: 1\r\n'
+          if status == 401: response += 'WWW-Authenticate: Bearer\r\n'
+          response += 'Connection: %s\r\n\r\n' % ('keep-alive' if keep else 'close')
+          writer.write(response.encode('latin-1'))
+          await writer.drain()
+          self.latency.since(start)
+          if not keep: break
+      except (ConnectionError, asyncio.IncompleteReadError): pass
+      finally:
+        self.connections -= 1
+        try: writer.close()
+        except: pass
+
+    def Serve(self):
+      try:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.Client,
+            self.conf['address'], int(self.conf['port']), reuse_address=True, backlog=128))
+        self.port = self.server.sockets[0].getsockname()[1]
+      except Exception as e:
+        self.error = e; self.ready.set()
+        return
+      self.ready.set()
+      try: self.loop.run_forever()
+      finally:
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+    # start server thread, raises exception if server could not be started
+    def start(self):
+      if self.thread: return True
+      self.thread = threading.Thread(name='MyWebhook', target=self.Serve)
+      self.thread.daemon = True
+      self.thread.start()
+      self.ready.wait()
+      if self.error:
+        self.thread = None
+        raise self.error
+      self.Log(WHERE(),'INFO','Webhook uplinks on http://%s:%d%s' % (self.conf['address'],self.port,self.conf['path']))
+      return True
+
+    def stop(self):
+      if not self.thread: return
+      try: self.loop.call_soon_threadsafe(self.loop.stop)
+      except: pass
+      self.thread.join(5); self.thread = None
+
+# load generator: connections with keep-alive POST requests of batch uplinks
+def Generate(port, requests, connections, secret, results):
+    import socket, time
+    async def Connection(bodies):
+      reader, writer = await asyncio.open_connection('127.0.0.1', port)
+      sent = refused = 0
+      for body in bodies:
+        while True:
+          writer.write(body); await writer.drain()
+          status = int((await reader.readline()).split()[1])
+          length = 0
+          while True:
+            line = await reader.readline()
+            if line in [b'\r\n', b'']: break
+            if line.lower().startswith(b'content-length:'): length = int(line.split(b':')[1])
+          if length: await reader.readexactly(length)
+          if status != 429: break
+          refused += 1; await asyncio.sleep(0.05)
+        if status < 300: sent += 1
+      writer.close()
+      return sent, refused
+    async def Run():
+      start = time.time()
+      done = await asyncio.gather(*[Connection(requests[nr::connections]) for nr in range(connections)])
+      results.put((time.time()-start, sum([a[0] for a in done]), sum([a[1] for a in done])))
+    asyncio.run(Run())
+
+# benchmark: webhook with RecordImport into a record queue, load generator in other process
+if __name__ == '__main__':
+    import os, gzip, multiprocessing
+    from time import time, sleep
+    args = { 'uplinks': 20000, 'batch': 10, 'connections': 8, 'gzip': 0, 'queue': 1000, 'delay': 0 }
+    for arg in sys.argv[1:]:
+      if arg.find('=') > 0 and arg.split('=')[0] in args.keys(): args[arg.split('=')[0]] = int(arg.split('=')[1])
+    if not 'bench' in sys.argv[1:]:
+      sys.exit("Usage: %s bench [uplinks=N] [batch=N] [connections=N] [gzip=0|1] [queue=N] [delay=usecs]" % sys.argv[0])
+    path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, path)
+    try: from lib import MyMQTTclient
+    except: import MyMQTTclient
+
+    # uplinks of test file as webhook requests
+    fd = MyMQTTclient.OpenInput(os.path.join(path,'inputtests','stressTestData.mqtt'))
+    uplinks = [json.dumps(a) for a in MyMQTTclient.FileRecords(fd)]; fd.close()
+    secret = 'bench-secret'; requests = []
+    for nr in range(0, args['uplinks'], args['batch']):
+      body = ('[' + ','.join([uplinks[(nr+i) % len(uplinks)] for i in range(min(args['batch'],args['uplinks']-nr))]) + ']').encode()
+      headers = 'Content-Type: application/json\r\nAuthorization: Bearer %s\r\n' % secret
+      if args['gzip']:
+        body = gzip.compress(body, compresslevel=1); headers += 'Content-Encoding: gzip\r\n'
+      requests.append(('POST /uplink HTTP/1.1\r\nHost: localhost\r\n%sContent-Length: %d\r\n\r\n' % (headers,len(body))).encode() + body)
+
+    # ingest: RecordImport and record queue, consumer thread empties the queue
+    importer = MyMQTTclient.TTN2MySense(logger=lambda *args: None).RecordImport
+    fifo = MyMQTTclient.RecordFiFo(maxsize=args['queue'], overflow='drop-newest')
+    lock = threading.Lock()   # requests are handled in executor threads
+    def Ingest(records):
+      with lock:
+        if fifo.Room() < len(records): return 429
+        for record in records:
+          record = importer(record)
+          if record: fifo.put(record)
+      return 200
+    consumed = [0]
+    def Consumer():
+      while True:
+        fifo.get(); consumed[0] += 1
+        if args['delay']: sleep(args['delay']/1000000.0)
+    consumer = threading.Thread(target=Consumer); consumer.daemon = True; consumer.start()
+    webhook = Webhook(Ingest, port=0, path='/uplink', secret=secret)
+    webhook.start()
+
+    # sanity: authentication, bad request, gzip and NDJSON bodies
+    import http.client
+    def Post(body, headers):
+      conn = http.client.HTTPConnection('127.0.0.1', webhook.port); conn.request('POST','/uplink',body,headers)
+      status = conn.getresponse().status; conn.close(); return status
+    assert Post(uplinks[0], {'Authorization': 'Bearer wrong'}) == 401
+    assert Post('{no json', {'Authorization': secret}) == 400
+    assert Post(gzip.compress(('\n'.join(uplinks[:3])).encode()), {'Authorization': secret, 'Content-Encoding': 'gzip'}) == 200
+    sleep(0.5); consumed[0] = 0
+
+    results = multiprocessing.Queue()
+    generator = multiprocessing.Process(target=Generate, args=(webhook.port, requests, args['connections'], secret, results))
+    generator.start()
+    took, sent, refused = results.get(); generator.join()
+    while len(fifo): sleep(0.01)
+    print("%d uplinks in %d requests (batch %d%s) over %d keep-alive connections in %.2f secs: %d uplinks/sec" % (args['uplinks'],sent,args['batch'],', gzip' if args['gzip'] else '',args['connections'],took,args['uplinks']/took))
+    print("    %d requests refused (429) on full ingest queue of %d, %d records queued" % (refused,args['queue'],consumed[0]))
+    histogram = webhook.latency
+    print("    request handling mean %.1f usecs (%d requests)" % (1000000.0*histogram.sum/max(1,sum(histogram.counts)),sum(histogram.counts)))
+    webhook.stop()